@@ -31,6 +31,89 @@ GITHUB_TOKEN = os.getenv("GITHUB_TOKEN", "")
 GITHUB_REPO = os.getenv("GITHUB_REPO", os.getenv("GITHUB_REPOSITORY", ""))
 GITHUB_PR_BASE = os.getenv("GITHUB_PR_BASE", "main")
 
+# Telegram file_id cache (repeat links are resent without downloading)
+MEDIA_CACHE_TTL_DAYS = int(os.getenv("MEDIA_CACHE_TTL_DAYS", "30"))
+MEDIA_CACHE_MAX_ENTRIES = int(os.getenv("MEDIA_CACHE_MAX_ENTRIES", "5000"))
+
+# Global download scheduler
+SCHEDULER_GLOBAL_SLOTS = int(os.getenv("SCHEDULER_GLOBAL_SLOTS", "6"))
+SCHEDULER_PLATFORM_LIMITS = os.getenv("SCHEDULER_PLATFORM_LIMITS", "youtube:3,tiktok:3,instagram:2,reddit:2,torrent:2")
+SCHEDULER_CPU_SLOTS = int(os.getenv("SCHEDULER_CPU_SLOTS", str(os.cpu_count() or 2)))
+SCHEDULER_PREMIUM_WEIGHT = float(os.getenv("SCHEDULER_PREMIUM_WEIGHT", "3"))
+SCHEDULER_STANDARD_WEIGHT = float(os.getenv("SCHEDULER_STANDARD_WEIGHT", "1"))
+
+# Durable job queue (download_queue table)
+JOB_LEASE_SECONDS = int(os.getenv("JOB_LEASE_SECONDS", "120"))
+JOB_HEARTBEAT_SECONDS = int(os.getenv("JOB_HEARTBEAT_SECONDS", "30"))
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "3"))
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "2"))
+JOB_POLL_SECONDS = int(os.getenv("JOB_POLL_SECONDS", "10"))
+
+# yt-dlp executor: "thread" (asyncio.to_thread) or "process" (pool of worker processes)
+YTDLP_EXECUTOR = os.getenv("YTDLP_EXECUTOR", "thread").lower()
+YTDLP_PROCESS_WORKERS = int(os.getenv("YTDLP_PROCESS_WORKERS", "3"))
+YTDLP_WORKER_MAX_JOBS = int(os.getenv("YTDLP_WORKER_MAX_JOBS", "50"))
+YTDLP_WORKER_RSS_MB = int(os.getenv("YTDLP_WORKER_RSS_MB", "1024"))
+
+# Remote download workers over gRPC (protos/worker.proto); defaults to HOME_SERVER_ADDRESS
+REMOTE_WORKERS_ENABLED = os.getenv("REMOTE_WORKERS_ENABLED", "false").lower() == "true"
+REMOTE_WORKERS = os.getenv("REMOTE_WORKERS", "") or HOME_SERVER_ADDRESS
+REMOTE_WORKER_TOKEN = os.getenv("REMOTE_WORKER_TOKEN", "")
+REMOTE_WORKER_CAPACITY = int(os.getenv("REMOTE_WORKER_CAPACITY", "2"))
+REMOTE_WORKER_HEALTH_SECONDS = int(os.getenv("REMOTE_WORKER_HEALTH_SECONDS", "15"))
+REMOTE_WORKER_TIMEOUT = int(os.getenv("REMOTE_WORKER_TIMEOUT", "900"))
+
+# Hedged fallback chain: start the next download method after a per-platform latency budget (seconds)
+HEDGE_ENABLED = os.getenv("HEDGE_ENABLED", "false").lower() == "true"
+HEDGE_DELAYS = os.getenv("HEDGE_DELAYS", "default:25,youtube:30,tiktok:10,instagram:15,reddit:12,facebook:15")
+
+# Circuit breakers per (platform, download method)
+BREAKER_FAILURE_THRESHOLD = int(os.getenv("BREAKER_FAILURE_THRESHOLD", "5"))
+BREAKER_COOLDOWN_SECONDS = int(os.getenv("BREAKER_COOLDOWN_SECONDS", "120"))
+BREAKER_MAX_COOLDOWN_SECONDS = int(os.getenv("BREAKER_MAX_COOLDOWN_SECONDS", "1800"))
+BREAKER_WINDOW = int(os.getenv("BREAKER_WINDOW", "50"))
+BREAKER_HORIZON_SECONDS = int(os.getenv("BREAKER_HORIZON_SECONDS", "1800"))
+BREAKER_EXPLORE_RATE = float(os.getenv("BREAKER_EXPLORE_RATE", "0.1"))
+
+# Shared HTTP connection pools (services/http_client.py)
+HTTP_POOL_LIMIT = int(os.getenv("HTTP_POOL_LIMIT", "100"))
+HTTP_POOL_LIMIT_PER_HOST = int(os.getenv("HTTP_POOL_LIMIT_PER_HOST", "10"))
+HTTP_DNS_TTL = int(os.getenv("HTTP_DNS_TTL", "300"))
+HTTP_KEEPALIVE_SECONDS = float(os.getenv("HTTP_KEEPALIVE_SECONDS", "30"))
+
+# Thumbnails: max parallel ffmpeg frame grabs
+THUMBNAIL_WORKERS = int(os.getenv("THUMBNAIL_WORKERS", "2"))
+
+# Event-loop stall monitor (wake-up interval and the lag that counts as a stall)
+LOOP_MONITOR_INTERVAL_MS = int(os.getenv("LOOP_MONITOR_INTERVAL_MS", "100"))
+LOOP_STALL_THRESHOLD_MS = int(os.getenv("LOOP_STALL_THRESHOLD_MS", "100"))
+
+# Transcoding: x264 quality (CRF); encodes run in the scheduler CPU pool
+TRANSCODE_CRF = int(os.getenv("TRANSCODE_CRF", "23"))
+
+# Playlists: entries downloaded in parallel (delivery stays in playlist order)
+PLAYLIST_CONCURRENCY = max(1, int(os.getenv("PLAYLIST_CONCURRENCY", "3")))
+
+# Key for signed ZIP download links (default: derived from BOT_TOKEN, same on every replica)
+ZIP_LINK_SECRET = os.getenv("ZIP_LINK_SECRET", "")
+
+# Torrents: shared aria2c daemon (JSON-RPC on localhost) and download caps in aria2 syntax ("0" = unlimited, "5M")
+ARIA2_RPC_PORT = int(os.getenv("ARIA2_RPC_PORT", "6800"))
+ARIA2_RPC_SECRET = os.getenv("ARIA2_RPC_SECRET", "")
+TORRENT_MAX_OVERALL_DOWNLOAD_LIMIT = os.getenv("TORRENT_MAX_OVERALL_DOWNLOAD_LIMIT", "0")
+TORRENT_MAX_DOWNLOAD_LIMIT = os.getenv("TORRENT_MAX_DOWNLOAD_LIMIT", "0")
+# Media files of one torrent downloaded at the same time (the rest wait, in upload order)
+TORRENT_FILE_WINDOW = max(1, int(os.getenv("TORRENT_FILE_WINDOW", "2")))
+
+# Usage stats (active users/groups, download counters, history) are buffered and written in batches
+STATS_FLUSH_INTERVAL = float(os.getenv("STATS_FLUSH_INTERVAL", "5"))
+STATS_FLUSH_BATCH = max(1, int(os.getenv("STATS_FLUSH_BATCH", "200")))
+
+# Read-through caches for app settings and user profiles, read on every message (seconds, 0 = off);
+# writes through this process update them at once, the TTL bounds staleness from other replicas
+APP_SETTING_CACHE_TTL = float(os.getenv("APP_SETTING_CACHE_TTL", "60"))
+USER_PROFILE_CACHE_TTL = float(os.getenv("USER_PROFILE_CACHE_TTL", "30"))
+
 BASE_DIR = Path(__file__).parent
 DOWNLOADS_DIR = BASE_DIR / "downloads"
 DATA_DIR = BASE_DIR / "data"
@@ -42,6 +42,37 @@ class DownloadHistory(Base):
     title = Column(String)
     timestamp = Column(DateTime, default=lambda: datetime.now(UTC).replace(tzinfo=None))
 
+class MediaCacheEntry(Base):
+    __tablename__ = 'media_cache'
+    cache_key = Column(String, primary_key=True) # canonical URL + '|' + delivery variant
+    url = Column(String)
+    variant = Column(String) # 'audio' or 'video:<height|max>'
+    media_type = Column(String) # 'audio' or 'video'
+    file_id = Column(String)
+    title = Column(String)
+    uploader = Column(String)
+    webpage_url = Column(String)
+    verified = Column(Integer, default=0)
+    duration = Column(Integer, default=0)
+    width = Column(Integer, default=0)
+    height = Column(Integer, default=0)
+    hits = Column(Integer, default=0)
+    created_at = Column(DateTime, default=lambda: datetime.now(UTC).replace(tzinfo=None))
+    last_used_at = Column(DateTime, default=lambda: datetime.now(UTC).replace(tzinfo=None))
+
+class TorrentFileCache(Base):
+    __tablename__ = 'torrent_file_cache'
+    info_hash = Column(String, primary_key=True)
+    file_index = Column(Integer, primary_key=True) # 1-based, as in the torrent's file list
+    file_name = Column(String)
+    media_type = Column(String) # 'video', 'audio' or 'document'
+    file_id = Column(String)
+    size = Column(BigInteger, default=0)
+    duration = Column(Integer, default=0)
+    hits = Column(Integer, default=0)
+    created_at = Column(DateTime, default=lambda: datetime.now(UTC).replace(tzinfo=None))
+    last_used_at = Column(DateTime, default=lambda: datetime.now(UTC).replace(tzinfo=None))
+
 class UserProfile(Base):
     __tablename__ = 'user_profiles'
     user_id = Column(BigInteger, primary_key=True)
@@ -64,5 +95,23 @@ class DownloadQueueItem(Base):
     id = Column(Integer, primary_key=True, autoincrement=True)
     user_id = Column(BigInteger)
     url = Column(String)
-    status = Column(String, default='pending')
+    status = Column(String, default='pending') # pending / running / uploading / done / failed
     added_at = Column(DateTime, default=datetime.utcnow)
+    # Delivery target, so a job can be resumed without the original update
+    chat_id = Column(BigInteger)
+    message_thread_id = Column(Integer)
+    reply_to_message_id = Column(Integer)
+    status_message_id = Column(Integer)
+    username = Column(String)
+    platform = Column(String)
+    is_music = Column(Integer, default=0)
+    video_height = Column(Integer)
+    is_premium = Column(Integer, default=0)
+    # Leasing / retries
+    attempts = Column(Integer, default=0)
+    max_attempts = Column(Integer, default=3)
+    lease_owner = Column(String)
+    lease_expires_at = Column(DateTime)
+    heartbeat_at = Column(DateTime)
+    last_error = Column(String)
+    updated_at = Column(DateTime, default=datetime.utcnow)
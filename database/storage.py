@@ -1,19 +1,29 @@
+import asyncio
 import json
 import logging
 import os
+import time
 from pathlib import Path
-from collections import defaultdict
-from datetime import datetime, timedelta
-from typing import Dict, Set
-from sqlalchemy import create_engine, func
+from collections import defaultdict, OrderedDict
+from datetime import datetime, timedelta, timezone
+from typing import Dict, List, Set, Optional
+from sqlalchemy import create_engine, func, insert, update
 from sqlalchemy.orm import sessionmaker
-from config import DATABASE_URL, DATA_DIR, WHITELISTED_ENV
-from database.models import Base, WhitelistedUser, DownloadStat, ActiveUser, ActiveGroup, Cookie, DownloadHistory, UserProfile, AppSetting
+from config import (DATABASE_URL, DATA_DIR, WHITELISTED_ENV, MEDIA_CACHE_TTL_DAYS, MEDIA_CACHE_MAX_ENTRIES,
+                    STATS_FLUSH_INTERVAL, STATS_FLUSH_BATCH, APP_SETTING_CACHE_TTL, USER_PROFILE_CACHE_TTL)
+from database.models import Base, WhitelistedUser, DownloadStat, ActiveUser, ActiveGroup, Cookie, DownloadHistory, UserProfile, AppSetting, MediaCacheEntry, TorrentFileCache
+
+# History rows kept while the database is unreachable; the oldest are dropped beyond this
+MAX_PENDING_HISTORY = 10000
+# Profiles kept by the read-through cache (LRU)
+PROFILE_CACHE_SIZE = 10000
 
 class Stats:
     def __init__(self):
         self.users_file = DATA_DIR / "users.json"
         self.stats_file = DATA_DIR / "stats.json"
+        self.media_cache_file = DATA_DIR / "media_cache.json"
+        self.torrent_cache_file = DATA_DIR / "torrent_cache.json"
         
         self.db_engine = None
         self.Session = None
@@ -51,6 +61,19 @@ class Stats:
                         sess.commit()
                     except Exception:
                         sess.rollback()
+                    for column_ddl in (
+                        "chat_id BIGINT", "message_thread_id INTEGER", "reply_to_message_id INTEGER",
+                        "status_message_id INTEGER", "username VARCHAR", "platform VARCHAR",
+                        "is_music INTEGER DEFAULT 0", "video_height INTEGER", "is_premium INTEGER DEFAULT 0",
+                        "attempts INTEGER DEFAULT 0", "max_attempts INTEGER DEFAULT 3", "lease_owner VARCHAR",
+                        "lease_expires_at TIMESTAMP", "heartbeat_at TIMESTAMP", "last_error VARCHAR",
+                        "updated_at TIMESTAMP",
+                    ):
+                        try:
+                            sess.execute(text(f"ALTER TABLE download_queue ADD COLUMN {column_ddl}"))
+                            sess.commit()
+                        except Exception:
+                            sess.rollback()
             except Exception as e:
                 logging.error(f"❌ Failed to connect to database: {e}")
                 self.db_engine = None
@@ -63,6 +86,47 @@ class Stats:
         self.whitelisted_users = set()
         self.active_groups = set()
         
+        # Telegram file_id cache (file mode keeps it in an LRU-ordered dict)
+        self.media_cache: "OrderedDict[str, dict]" = OrderedDict()
+        self.media_cache_hits = 0
+        self.media_cache_misses = 0
+        self.media_cache_evictions = 0
+
+        # Torrent delivery cache: infohash -> {file index -> upload}
+        self.torrent_cache: "OrderedDict[str, Dict[str, dict]]" = OrderedDict()
+        self.torrent_cache_lookups = 0
+        self.torrent_cache_hits = 0
+        self.torrent_cache_files_hit = 0
+
+        # Write-behind buffer for usage stats; see start()
+        self._seen_day = ""
+        self._seen_users: Set[int] = set()
+        self._pending_users: Dict[str, Set[int]] = defaultdict(set)
+        self._pending_groups: Set[int] = set()
+        self._pending_counts: Dict[str, int] = defaultdict(int)
+        self._pending_history: List[dict] = []
+        self._pending = 0
+        self._writer: Optional[asyncio.Task] = None
+        self._wake = asyncio.Event()
+        self._flush_lock = asyncio.Lock()
+        self._closing = False
+        self.flushes = 0
+        self.flushed_events = 0
+        self.flush_errors = 0
+        self.deduplicated = 0
+        self._flush_time = 0.0
+
+        # Read-through caches: key -> (monotonic expiry, value)
+        self.setting_cache_ttl = APP_SETTING_CACHE_TTL
+        self.profile_cache_ttl = USER_PROFILE_CACHE_TTL
+        self._settings: Dict[str, tuple] = {}
+        self._profiles: "OrderedDict[int, tuple]" = OrderedDict()
+        self.setting_hits = 0
+        self.setting_misses = 0
+        self.profile_hits = 0
+        self.profile_misses = 0
+        self.profile_invalidations = 0
+        
         self._load_data()
         
     def _load_data(self):
@@ -116,55 +180,190 @@ class Stats:
                 except Exception as e:
                     logging.error(f"Error loading stats file: {e}")
 
+            if self.media_cache_file.exists():
+                try:
+                    with open(self.media_cache_file, 'r') as f:
+                        data = json.loads(f.read())
+                    for key, entry in data.items():
+                        self.media_cache[key] = entry
+                except Exception as e:
+                    logging.error(f"Error loading media cache file: {e}")
+
+            if self.torrent_cache_file.exists():
+                try:
+                    with open(self.torrent_cache_file, 'r') as f:
+                        data = json.loads(f.read())
+                    for info_hash, files in data.items():
+                        self.torrent_cache[info_hash] = files
+                except Exception as e:
+                    logging.error(f"Error loading torrent cache file: {e}")
+
+    def _file_snapshot(self) -> dict:
+        return {
+            'users': {'whitelisted_users': list(self.whitelisted_users)},
+            'stats': {
+                'downloads_count': dict(self.downloads_count),
+                'active_users': {date: list(users) for date, users in self.active_users.items()},
+                'active_groups': list(self.active_groups)
+            },
+        }
+
+    def _write_files(self, snapshot: dict):
+        with open(self.users_file, 'w') as f:
+            json.dump(snapshot['users'], f, indent=4)
+        with open(self.stats_file, 'w') as f:
+            json.dump(snapshot['stats'], f, indent=4)
+
     def _save_data(self):
         """Save to JSON files (only used in file mode)"""
         if self.Session:
             return
 
         try:
-            with open(self.users_file, 'w') as f:
-                json.dump({'whitelisted_users': list(self.whitelisted_users)}, f, indent=4)
-                
-            with open(self.stats_file, 'w') as f:
-                active_users_data = {date: list(users) for date, users in self.active_users.items()}
-                json.dump({
-                    'downloads_count': dict(self.downloads_count),
-                    'active_users': active_users_data,
-                    'active_groups': list(self.active_groups)
-                }, f, indent=4)
+            self._write_files(self._file_snapshot())
         except Exception as e:
             logging.error(f"Error saving data: {e}")
 
+    # Write-behind usage stats: add_download/add_active_user/add_active_group only touch memory;
+    # the writer task stores them every STATS_FLUSH_INTERVAL seconds or STATS_FLUSH_BATCH events
+    def start(self):
+        """Starts the writer task. Without it (scripts, tools) every event is written right away."""
+        self._closing = False
+        if self._writer is None or self._writer.done():
+            self._writer = asyncio.create_task(self._write_behind())
+
+    async def _write_behind(self):
+        while not self._closing:
+            try:
+                await asyncio.wait_for(self._wake.wait(), STATS_FLUSH_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+            await self.flush()
+
+    async def shutdown(self):
+        """Stops the writer and stores whatever is still buffered."""
+        self._closing = True
+        self._wake.set()
+        if self._writer is not None:
+            await self._writer
+            self._writer = None
+        await self.flush()
+        logging.info(f"[STATS] ✅ Write buffer flushed ({self.flushed_events} events in {self.flushes} batches)")
+
+    def _buffered(self):
+        self._pending += 1
+        if self._writer is None or self._writer.done():
+            batch = self._take()
+            try:
+                self._write(batch)
+            except Exception as e:
+                self._restore(batch)
+                logging.error(f"Error saving stats: {e}")
+        elif self._pending >= STATS_FLUSH_BATCH:
+            self._wake.set()
+
+    def _take(self) -> dict:
+        """Hands the buffer over for writing (on the event loop, so writers never see it change)."""
+        batch = {
+            'events': self._pending,
+            'users': self._pending_users,
+            'groups': self._pending_groups,
+            'counts': self._pending_counts,
+            'history': self._pending_history,
+            'files': None if self.Session else self._file_snapshot(),
+        }
+        self._pending = 0
+        self._pending_users = defaultdict(set)
+        self._pending_groups = set()
+        self._pending_counts = defaultdict(int)
+        self._pending_history = []
+        return batch
+
+    def _restore(self, batch: dict):
+        """Puts a batch that could not be written back in front of newer events."""
+        self._pending += batch['events']
+        for date, users in batch['users'].items():
+            self._pending_users[date] |= users
+        self._pending_groups |= batch['groups']
+        for content_type, count in batch['counts'].items():
+            self._pending_counts[content_type] += count
+        self._pending_history = (batch['history'] + self._pending_history)[-MAX_PENDING_HISTORY:]
+
+    def _write(self, batch: dict):
+        """One transaction per batch: existence checks and inserts in bulk, counters as increments."""
+        if not self.Session:
+            self._write_files(batch['files'])
+            return
+        with self.Session() as session:
+            for date, users in batch['users'].items():
+                known = {user_id for (user_id,) in session.query(ActiveUser.user_id).filter(
+                    ActiveUser.date == date, ActiveUser.user_id.in_(users))}
+                rows = [{'user_id': user_id, 'date': date} for user_id in users - known]
+                if rows:
+                    session.execute(insert(ActiveUser), rows)
+            if batch['groups']:
+                known = {chat_id for (chat_id,) in session.query(ActiveGroup.chat_id).filter(
+                    ActiveGroup.chat_id.in_(batch['groups']))}
+                rows = [{'chat_id': chat_id} for chat_id in batch['groups'] - known]
+                if rows:
+                    session.execute(insert(ActiveGroup), rows)
+            for content_type, count in batch['counts'].items():
+                result = session.execute(update(DownloadStat).where(DownloadStat.content_type == content_type)
+                                         .values(count=DownloadStat.count + count))
+                if not result.rowcount:
+                    session.add(DownloadStat(content_type=content_type, count=count))
+            if batch['history']:
+                session.execute(insert(DownloadHistory), batch['history'])
+            session.commit()
+
+    async def flush(self):
+        """Writes everything buffered so far; callers that read stats from the DB flush first."""
+        async with self._flush_lock:
+            if not self._pending:
+                return
+            batch = self._take()
+            started = time.monotonic()
+            try:
+                await asyncio.to_thread(self._write, batch)
+            except Exception as e:
+                self.flush_errors += 1
+                self._restore(batch)
+                logging.error(f"[STATS] Writing {batch['events']} buffered events failed, keeping them: {e}")
+                return
+            self.flushes += 1
+            self.flushed_events += batch['events']
+            self._flush_time += time.monotonic() - started
+
+    def get_write_buffer_stats(self) -> dict:
+        return {
+            'running': self._writer is not None and not self._writer.done(),
+            'depth': self._pending,
+            'history': len(self._pending_history),
+            'flushes': self.flushes,
+            'flushed_events': self.flushed_events,
+            'errors': self.flush_errors,
+            'deduplicated': self.deduplicated,
+            'avg_flush_ms': self._flush_time / self.flushes * 1000 if self.flushes else 0.0,
+        }
+
     def add_download(self, content_type: str, user_id: int = None, username: str = None, platform: str = None, url: str = None, title: str = None):
         self.downloads_count[content_type] += 1
-        
+
         if self.Session:
-            try:
-                with self.Session() as session:
-                    # Update stats
-                    stat = session.query(DownloadStat).filter_by(content_type=content_type).first()
-                    if not stat:
-                        stat = DownloadStat(content_type=content_type, count=0)
-                        session.add(stat)
-                    stat.count += 1
-                    
-                    # Add history
-                    if user_id:
-                        history = DownloadHistory(
-                            user_id=user_id,
-                            username=username,
-                            platform=platform,
-                            content_type=content_type,
-                            url=url,
-                            title=title
-                        )
-                        session.add(history)
-                    
-                    session.commit()
-            except Exception as e:
-                logging.error(f"Error saving download stat/history to DB: {e}")
-        else:
-            self._save_data()
+            self._pending_counts[content_type] += 1
+            if user_id:
+                self._pending_history.append({
+                    'user_id': user_id,
+                    'username': username,
+                    'platform': platform,
+                    'content_type': content_type,
+                    'url': url,
+                    'title': title,
+                    # Time of the download, not of the flush
+                    'timestamp': datetime.now(timezone.utc).replace(tzinfo=None),
+                })
+        self._buffered()
         
     def add_to_whitelist(self, username: str) -> bool:
         if username in self.whitelisted_users:
@@ -204,38 +403,31 @@ class Stats:
     
     def add_active_user(self, user_id: int):
         today = datetime.now().date().isoformat()
-        
+        if today != self._seen_day:
+            self._seen_day, self._seen_users = today, set()
+        # Only the first message of the day from a user is an event
+        if user_id in self._seen_users:
+            self.deduplicated += 1
+            return
+        self._seen_users.add(user_id)
+
         if self.Session:
-            try:
-                with self.Session() as session:
-                    exists = session.query(ActiveUser).filter_by(user_id=user_id, date=today).first()
-                    if not exists:
-                        session.add(ActiveUser(user_id=user_id, date=today))
-                        session.commit()
-            except Exception as e:
-                logging.error(f"Error adding active user to DB: {e}")
+            self._pending_users[today].add(user_id)
         else:
             if today not in self.active_users:
                 self.active_users[today] = set()
             self.active_users[today].add(user_id)
-            self._save_data()
+        self._buffered()
 
     def add_active_group(self, chat_id: int):
         if chat_id in self.active_groups:
+            self.deduplicated += 1
             return
             
         self.active_groups.add(chat_id)
         if self.Session:
-            try:
-                with self.Session() as session:
-                    exists = session.query(ActiveGroup).filter_by(chat_id=chat_id).first()
-                    if not exists:
-                        session.add(ActiveGroup(chat_id=chat_id))
-                        session.commit()
-            except Exception as e:
-                logging.error(f"Error adding active group to DB: {e}")
-        else:
-            self._save_data()
+            self._pending_groups.add(chat_id)
+        self._buffered()
 
     def get_username_by_id(self, user_id: int) -> str:
         """Returns the username associated with standard user id, or None."""
@@ -379,10 +571,336 @@ class Stats:
             # In file mode, we just return False for now or recommend manually editing logs/downloads.log
             return False
 
+    # Telegram file_id cache
+    def _media_cache_expired(self, created_at: datetime) -> bool:
+        return created_at is not None and created_at < datetime.now() - timedelta(days=MEDIA_CACHE_TTL_DAYS)
+
+    def _save_media_cache_file(self):
+        try:
+            with open(self.media_cache_file, 'w') as f:
+                json.dump(self.media_cache, f)
+        except Exception as e:
+            logging.error(f"Error saving media cache file: {e}")
+
+    def get_cached_media(self, cache_key: str) -> Optional[dict]:
+        """Returns the cached Telegram upload for cache_key, or None on miss/expiry."""
+        entry = None
+        if self.Session:
+            try:
+                with self.Session() as session:
+                    row = session.query(MediaCacheEntry).filter_by(cache_key=cache_key).first()
+                    if row and self._media_cache_expired(row.created_at):
+                        session.delete(row)
+                        session.commit()
+                        row = None
+                    if row:
+                        row.hits = (row.hits or 0) + 1
+                        row.last_used_at = datetime.now()
+                        session.commit()
+                        entry = {
+                            'file_id': row.file_id,
+                            'media_type': row.media_type,
+                            'title': row.title,
+                            'uploader': row.uploader,
+                            'webpage_url': row.webpage_url,
+                            'verified': bool(row.verified),
+                            'duration': row.duration or 0,
+                            'width': row.width or 0,
+                            'height': row.height or 0,
+                        }
+            except Exception as e:
+                logging.error(f"Error reading media cache from DB: {e}")
+        else:
+            cached = self.media_cache.get(cache_key)
+            if cached and self._media_cache_expired(datetime.fromisoformat(cached['created_at'])):
+                del self.media_cache[cache_key]
+                self._save_media_cache_file()
+                cached = None
+            if cached:
+                self.media_cache.move_to_end(cache_key)
+                entry = dict(cached)
+
+        if entry:
+            self.media_cache_hits += 1
+        else:
+            self.media_cache_misses += 1
+        return entry
+
+    def save_cached_media(self, cache_key: str, url: str, variant: str, media_type: str, file_id: str, metadata: dict = None):
+        """Stores a delivered file_id under cache_key and evicts the least recently used entries."""
+        metadata = metadata or {}
+        now = datetime.now()
+        fields = {
+            'url': url,
+            'variant': variant,
+            'media_type': media_type,
+            'file_id': file_id,
+            'title': metadata.get('title'),
+            'uploader': metadata.get('uploader'),
+            'webpage_url': metadata.get('webpage_url'),
+            'verified': 1 if metadata.get('verified') else 0,
+            'duration': int(metadata.get('duration') or 0),
+            'width': int(metadata.get('width') or 0),
+            'height': int(metadata.get('height') or 0),
+        }
+
+        if self.Session:
+            try:
+                with self.Session() as session:
+                    row = session.query(MediaCacheEntry).filter_by(cache_key=cache_key).first()
+                    if not row:
+                        row = MediaCacheEntry(cache_key=cache_key, hits=0)
+                        session.add(row)
+                    for name, value in fields.items():
+                        setattr(row, name, value)
+                    row.created_at = now
+                    row.last_used_at = now
+                    session.commit()
+
+                    total = session.query(func.count(MediaCacheEntry.cache_key)).scalar() or 0
+                    overflow = total - MEDIA_CACHE_MAX_ENTRIES
+                    if overflow > 0:
+                        stale = session.query(MediaCacheEntry.cache_key)\
+                            .order_by(MediaCacheEntry.last_used_at.asc())\
+                            .limit(overflow).all()
+                        session.query(MediaCacheEntry)\
+                            .filter(MediaCacheEntry.cache_key.in_([k[0] for k in stale]))\
+                            .delete(synchronize_session=False)
+                        session.commit()
+                        self.media_cache_evictions += overflow
+            except Exception as e:
+                logging.error(f"Error saving media cache to DB: {e}")
+        else:
+            fields['verified'] = bool(fields['verified'])
+            fields['created_at'] = now.isoformat()
+            self.media_cache[cache_key] = fields
+            self.media_cache.move_to_end(cache_key)
+            while len(self.media_cache) > MEDIA_CACHE_MAX_ENTRIES:
+                self.media_cache.popitem(last=False)
+                self.media_cache_evictions += 1
+            self._save_media_cache_file()
+
+    def drop_cached_media(self, cache_key: str):
+        """Forgets a cached file_id (e.g. Telegram rejected it)."""
+        if self.Session:
+            try:
+                with self.Session() as session:
+                    session.query(MediaCacheEntry).filter_by(cache_key=cache_key).delete()
+                    session.commit()
+            except Exception as e:
+                logging.error(f"Error dropping media cache entry: {e}")
+        elif self.media_cache.pop(cache_key, None) is not None:
+            self._save_media_cache_file()
+
+    def get_media_cache_stats(self) -> dict:
+        entries = len(self.media_cache)
+        if self.Session:
+            try:
+                with self.Session() as session:
+                    entries = session.query(func.count(MediaCacheEntry.cache_key)).scalar() or 0
+            except Exception as e:
+                logging.error(f"Error counting media cache entries: {e}")
+        lookups = self.media_cache_hits + self.media_cache_misses
+        return {
+            'entries': entries,
+            'hits': self.media_cache_hits,
+            'misses': self.media_cache_misses,
+            'evictions': self.media_cache_evictions,
+            'hit_rate': (self.media_cache_hits / lookups * 100) if lookups else 0.0,
+        }
+
+    # Torrent delivery cache (infohash + file index -> Telegram file_id)
+    def _save_torrent_cache_file(self):
+        try:
+            with open(self.torrent_cache_file, 'w') as f:
+                json.dump(self.torrent_cache, f)
+        except Exception as e:
+            logging.error(f"Error saving torrent cache file: {e}")
+
+    def get_cached_torrent_files(self, info_hash: str) -> Dict[str, dict]:
+        """Cached uploads of a torrent's files, keyed by file index (as a string)."""
+        entries = {}
+        if self.Session:
+            try:
+                with self.Session() as session:
+                    now = datetime.now()
+                    for row in session.query(TorrentFileCache).filter_by(info_hash=info_hash).all():
+                        if self._media_cache_expired(row.created_at):
+                            session.delete(row)
+                            continue
+                        row.hits = (row.hits or 0) + 1
+                        row.last_used_at = now
+                        entries[str(row.file_index)] = {
+                            'file_id': row.file_id,
+                            'media_type': row.media_type,
+                            'file_name': row.file_name,
+                            'size': row.size or 0,
+                            'duration': row.duration or 0,
+                        }
+                    session.commit()
+            except Exception as e:
+                logging.error(f"Error reading torrent cache from DB: {e}")
+        else:
+            files = self.torrent_cache.get(info_hash) or {}
+            expired = [i for i, e in files.items() if self._media_cache_expired(datetime.fromisoformat(e['created_at']))]
+            for index in expired:
+                del files[index]
+            if files:
+                self.torrent_cache.move_to_end(info_hash)
+                entries = {index: dict(entry) for index, entry in files.items()}
+            elif info_hash in self.torrent_cache:
+                del self.torrent_cache[info_hash]
+            if expired:
+                self._save_torrent_cache_file()
+
+        self.torrent_cache_lookups += 1
+        if entries:
+            self.torrent_cache_hits += 1
+            self.torrent_cache_files_hit += len(entries)
+        return entries
+
+    def save_cached_torrent_file(self, info_hash: str, file_index: str, file_name: str, media_type: str,
+                                 file_id: str, size: int = 0, duration: int = 0):
+        """Stores the upload of one torrent file; whole torrents are evicted least recently used first."""
+        now = datetime.now()
+        fields = {
+            'file_name': file_name,
+            'media_type': media_type,
+            'file_id': file_id,
+            'size': int(size or 0),
+            'duration': int(duration or 0),
+        }
+
+        if self.Session:
+            try:
+                with self.Session() as session:
+                    row = session.query(TorrentFileCache).filter_by(info_hash=info_hash, file_index=int(file_index)).first()
+                    if not row:
+                        row = TorrentFileCache(info_hash=info_hash, file_index=int(file_index), hits=0)
+                        session.add(row)
+                    for name, value in fields.items():
+                        setattr(row, name, value)
+                    row.created_at = now
+                    row.last_used_at = now
+                    session.commit()
+
+                    total = session.query(func.count(TorrentFileCache.file_id)).scalar() or 0
+                    overflow = total - MEDIA_CACHE_MAX_ENTRIES
+                    if overflow > 0:
+                        stale = session.query(TorrentFileCache.info_hash, TorrentFileCache.file_index)\
+                            .order_by(TorrentFileCache.last_used_at.asc())\
+                            .limit(overflow).all()
+                        for stale_hash, stale_index in stale:
+                            session.query(TorrentFileCache)\
+                                .filter_by(info_hash=stale_hash, file_index=stale_index)\
+                                .delete(synchronize_session=False)
+                        session.commit()
+            except Exception as e:
+                logging.error(f"Error saving torrent cache to DB: {e}")
+        else:
+            fields['created_at'] = now.isoformat()
+            self.torrent_cache.setdefault(info_hash, {})[str(file_index)] = fields
+            self.torrent_cache.move_to_end(info_hash)
+            while sum(len(files) for files in self.torrent_cache.values()) > MEDIA_CACHE_MAX_ENTRIES:
+                self.torrent_cache.popitem(last=False)
+            self._save_torrent_cache_file()
+
+    def drop_cached_torrent_file(self, info_hash: str, file_index: str):
+        """Forgets one cached torrent upload (e.g. Telegram rejected its file_id)."""
+        if self.Session:
+            try:
+                with self.Session() as session:
+                    session.query(TorrentFileCache).filter_by(info_hash=info_hash, file_index=int(file_index)).delete()
+                    session.commit()
+            except Exception as e:
+                logging.error(f"Error dropping torrent cache entry: {e}")
+        else:
+            files = self.torrent_cache.get(info_hash)
+            if files and files.pop(str(file_index), None) is not None:
+                if not files:
+                    del self.torrent_cache[info_hash]
+                self._save_torrent_cache_file()
+
+    def get_torrent_cache_stats(self) -> dict:
+        torrents = len(self.torrent_cache)
+        files = sum(len(f) for f in self.torrent_cache.values())
+        if self.Session:
+            try:
+                with self.Session() as session:
+                    files = session.query(func.count(TorrentFileCache.file_id)).scalar() or 0
+                    torrents = session.query(func.count(func.distinct(TorrentFileCache.info_hash))).scalar() or 0
+            except Exception as e:
+                logging.error(f"Error counting torrent cache entries: {e}")
+        return {
+            'torrents': torrents,
+            'files': files,
+            'lookups': self.torrent_cache_lookups,
+            'hits': self.torrent_cache_hits,
+            'files_hit': self.torrent_cache_files_hit,
+            'hit_rate': (self.torrent_cache_hits / self.torrent_cache_lookups * 100) if self.torrent_cache_lookups else 0.0,
+        }
+
     # Premium and Settings Methods
+    # Read-through caches for get_user_profile/get_app_setting
+    def _cache_profile(self, user_id: int, profile: dict) -> dict:
+        if self.profile_cache_ttl > 0:
+            self._profiles[user_id] = (time.monotonic() + self.profile_cache_ttl, profile)
+            self._profiles.move_to_end(user_id)
+            while len(self._profiles) > PROFILE_CACHE_SIZE:
+                self._profiles.popitem(last=False)
+        return dict(profile)
+
+    def invalidate_user_profile(self, user_id: int):
+        """Call after changing a UserProfile row outside the methods below."""
+        if self._profiles.pop(user_id, None) is not None:
+            self.profile_invalidations += 1
+
+    def _cached_profile(self, user_id: int) -> Optional[dict]:
+        entry = self._profiles.get(user_id)
+        if entry is None:
+            return None
+        expires, profile = entry
+        # Daily counters reset and premium runs out on their own; both need the DB
+        if (expires < time.monotonic() or profile['date'] != datetime.now().strftime("%Y-%m-%d")
+                or (profile['is_premium'] and profile['premium_expiry'] and profile['premium_expiry'] < datetime.now())):
+            del self._profiles[user_id]
+            return None
+        self._profiles.move_to_end(user_id)
+        return profile
+
+    @staticmethod
+    def _profile_dict(profile: UserProfile, is_premium: bool) -> dict:
+        return {
+            "is_premium": is_premium,
+            "premium_expiry": profile.premium_expiry,
+            "daily_premium_site_downloads": profile.daily_premium_site_downloads,
+            "date": profile.last_reset_date,
+        }
+
+    def get_hot_cache_stats(self) -> dict:
+        settings = self.setting_hits + self.setting_misses
+        profiles = self.profile_hits + self.profile_misses
+        return {
+            'settings': len(self._settings),
+            'setting_hits': self.setting_hits,
+            'setting_misses': self.setting_misses,
+            'setting_hit_rate': self.setting_hits / settings * 100 if settings else 0.0,
+            'profiles': len(self._profiles),
+            'profile_hits': self.profile_hits,
+            'profile_misses': self.profile_misses,
+            'profile_hit_rate': self.profile_hits / profiles * 100 if profiles else 0.0,
+            'profile_invalidations': self.profile_invalidations,
+        }
+
     def get_user_profile(self, user_id: int) -> dict:
         if not self.Session:
             return {"is_premium": False, "premium_expiry": None, "daily_premium_site_downloads": 0}
+
+        cached = self._cached_profile(user_id)
+        if cached is not None:
+            self.profile_hits += 1
+            return {k: v for k, v in cached.items() if k != 'date'}
+        self.profile_misses += 1
             
         with self.Session() as session:
             profile = session.query(UserProfile).filter_by(user_id=user_id).first()
@@ -404,11 +922,9 @@ class Stats:
                 profile.is_premium = 0
                 session.commit()
                 
-            return {
-                "is_premium": is_premium,
-                "premium_expiry": profile.premium_expiry,
-                "daily_premium_site_downloads": profile.daily_premium_site_downloads
-            }
+            result = self._cache_profile(user_id, self._profile_dict(profile, is_premium))
+            del result['date']
+            return result
 
     def unlock_premium(self, user_id: int, days: int = 30) -> bool:
         if not self.Session:
@@ -427,6 +943,7 @@ class Stats:
                 profile.premium_expiry = datetime.now() + timedelta(days=days)
                 
             session.commit()
+            self.invalidate_user_profile(user_id)
             return True
 
     def increment_daily_premium(self, user_id: int) -> int:
@@ -447,22 +964,34 @@ class Stats:
             profile.daily_premium_site_downloads += 1
             count = profile.daily_premium_site_downloads
             session.commit()
+            self.invalidate_user_profile(user_id)
             return count
 
+    def _cache_setting(self, key: str, value: str) -> str:
+        if self.setting_cache_ttl > 0:
+            self._settings[key] = (time.monotonic() + self.setting_cache_ttl, value)
+        return value
+
     def get_app_setting(self, key: str, default: str = "False") -> str:
         if not self.Session:
             return default
+
+        entry = self._settings.get(key)
+        if entry is not None and entry[0] > time.monotonic():
+            self.setting_hits += 1
+            return entry[1]
+        self.setting_misses += 1
             
         with self.Session() as session:
             setting = session.query(AppSetting).filter_by(key=key).first()
             if setting:
-                return setting.value
+                return self._cache_setting(key, setting.value)
             
             # Create if not exists
             new_setting = AppSetting(key=key, value=default)
             session.add(new_setting)
             session.commit()
-            return default
+            return self._cache_setting(key, default)
 
     def toggle_app_setting(self, key: str) -> str:
         if not self.Session:
@@ -477,6 +1006,7 @@ class Stats:
             new_val = "False" if setting.value == "True" else "True"
             setting.value = new_val
             session.commit()
+            self._settings.pop(key, None)
             return new_val
 
     def set_app_setting(self, key: str, value: str) -> None:
@@ -491,6 +1021,7 @@ class Stats:
             else:
                 setting.value = value
             session.commit()
+            self._settings.pop(key, None)
 
     def process_referral(self, new_user_id: int, referrer_id: int) -> dict:
         """Process a referral: record who referred the new user, increment referrer's count.
@@ -549,6 +1080,8 @@ class Stats:
                 premium_granted = True
             
             session.commit()
+            self.invalidate_user_profile(new_user_id)
+            self.invalidate_user_profile(referrer_id)
             return {'success': True, 'referral_count': count, 'premium_granted': premium_granted}
 
     def get_referral_count(self, user_id: int) -> int:
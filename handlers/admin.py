@@ -50,6 +50,22 @@ from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup
 from config import ADMIN_USER_ID, DATA_DIR
 from database.storage import stats
 from database.models import Cookie, DownloadHistory
+from services.downloader import download_flights
+from services.scheduler import download_scheduler
+from services.job_queue import job_queue
+from services.ytdlp_pool import ytdlp_pool
+from services.remote_worker import remote_workers
+from services.hedging import fallback_chain
+from services.circuit_breaker import method_health
+from services.http_client import http_client
+from services.media_probe import media_probe
+from services.thumbnails import thumbnail_service
+from services.transcoder import transcoder
+from services.preflight import preflight
+from services.loop_monitor import loop_monitor
+from services.aria2 import aria2
+from services.torrent_service import torrent_service
+from services.tracker_health import tracker_health
 
 router = Router()
 
@@ -94,6 +110,218 @@ class BroadcastStates(StatesGroup):
 class DeleteHistoryStates(StatesGroup):
     waiting_for_id = State()
 
+def get_admin_keyboard(limits_value: str = None) -> InlineKeyboardMarkup:
+    if limits_value is None:
+        limits_value = stats.get_app_setting('premium_limits_enabled', 'True')
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="👥 Users List", callback_data="admin:users")],
+        [InlineKeyboardButton(text="➕ Add User", callback_data="admin:add_user"),
+        InlineKeyboardButton(text="➖ Remove User", callback_data="admin:remove_user")],
+        [InlineKeyboardButton(text="📊 Statistics", callback_data="admin:stats"),
+        InlineKeyboardButton(text="📜 History", callback_data="admin:history")],
+        [InlineKeyboardButton(text="⚡ Performance", callback_data="admin:perf")],
+        [InlineKeyboardButton(text=f"🔄 Toggle Limits: {limits_value}", callback_data="admin:toggle_limits")],
+        [InlineKeyboardButton(text="📨 Broadcast Message", callback_data="admin:broadcast")],
+        [InlineKeyboardButton(text="🍪 Update Cookies", callback_data="admin:update_cookies"),
+        InlineKeyboardButton(text="🔄 Update yt-dlp", callback_data="admin:update_ytdlp")],
+        [InlineKeyboardButton(text="📂 Get Logs", callback_data="admin:get_logs"),
+        InlineKeyboardButton(text="🗑 Clear Logs", callback_data="admin:clear_logs")],
+        [InlineKeyboardButton(text="❌ Close", callback_data="admin:close")]
+    ])
+
+def build_performance_report() -> str:
+    """HTML summary of caches and runtime counters for the admin panel."""
+    cache = stats.get_media_cache_stats()
+    lines = [
+        "⚡ <b>Performance</b>\n",
+        "🗂 <b>File ID cache</b>",
+        f"   Entries: {cache['entries']} | Evicted: {cache['evictions']}",
+        f"   Hits: {cache['hits']} | Misses: {cache['misses']} | Hit rate: {cache['hit_rate']:.1f}%",
+    ]
+
+    hot = stats.get_hot_cache_stats()
+    lines += [
+        "",
+        "🧠 <b>Settings & profile cache</b>",
+        f"   Settings: {hot['settings']} cached | Hits: {hot['setting_hits']} | Misses: {hot['setting_misses']} | "
+        f"Hit rate: {hot['setting_hit_rate']:.1f}%",
+        f"   Profiles: {hot['profiles']} cached | Hits: {hot['profile_hits']} | Misses: {hot['profile_misses']} | "
+        f"Hit rate: {hot['profile_hit_rate']:.1f}% | Invalidated: {hot['profile_invalidations']}",
+    ]
+
+    tcache = stats.get_torrent_cache_stats()
+    lines += [
+        "",
+        "📦 <b>Torrent delivery cache</b>",
+        f"   Torrents: {tcache['torrents']} | Files: {tcache['files']}",
+        f"   Lookups: {tcache['lookups']} | With hits: {tcache['hits']} ({tcache['hit_rate']:.1f}%) | Files resent: {tcache['files_hit']}",
+    ]
+
+    writes = stats.get_write_buffer_stats()
+    lines += [
+        "",
+        f"🧾 <b>Stats writer</b> ({'write-behind' if writes['running'] else 'writing directly'})",
+        f"   Buffered: {writes['depth']} events ({writes['history']} history rows) | Deduplicated: {writes['deduplicated']}",
+        f"   Flushes: {writes['flushes']} ({writes['flushed_events']} events, {writes['avg_flush_ms']:.1f} ms avg) | "
+        f"Errors: {writes['errors']}",
+    ]
+
+    flights = download_flights.get_stats()
+    lines += [
+        "",
+        "🔗 <b>Download coalescing</b>",
+        f"   In flight: {flights['inflight']} | Shared files: {flights['shared_files']}",
+        f"   Leaders: {flights['leaders']} | Joined followers: {flights['followers']}",
+    ]
+
+    sched = download_scheduler.get_stats()
+    per_platform = ", ".join(f"{p}: {n}" for p, n in sched['by_platform'].items()) or "idle"
+    lines += [
+        "",
+        "🚦 <b>Scheduler</b>",
+        f"   Running: {sched['running']}/{sched['global_slots']} ({per_platform})",
+        f"   Queued: {sched['queued']} (premium: {sched['queued_premium']})",
+        f"   Avg wait: {sched['avg_wait']:.1f}s | Avg job: {sched['avg_duration']:.1f}s | Done: {sched['completed']}",
+        f"   CPU pool: {sched['cpu_running']}/{sched['cpu_slots']} busy, {sched['cpu_waiting']} waiting",
+    ]
+
+    jobs = job_queue.get_stats()
+    job_counts = ", ".join(f"{state}: {count}" for state, count in sorted(jobs['counts'].items())) or "empty"
+    lines += [
+        "",
+        f"🗃 <b>Job queue</b> ({jobs['backend']})",
+        f"   {job_counts}",
+        f"   Resumed: {jobs['resumed']} | Retried: {jobs['retried']} | Gave up: {jobs['failed']}",
+    ]
+
+    pool = ytdlp_pool.get_stats()
+    lines += ["", f"🧵 <b>yt-dlp executor</b> ({pool['mode']})"]
+    if pool['mode'] == 'process':
+        rss = ", ".join(f"{mb}" for mb in pool['rss_mb']) or "-"
+        lines += [
+            f"   Workers: {pool['busy']}/{pool['workers']} busy | RSS MB: {rss} (limit {pool['rss_limit_mb']})",
+            f"   Jobs: {pool['jobs']} | Errors: {pool['errors']} | Recycled: {pool['recycled']} | OOM kills: {pool['rss_kills']} | Crashes: {pool['crashes']}",
+        ]
+
+    probe = media_probe.get_stats()
+    lines += [
+        "",
+        "🔬 <b>Media probe</b>",
+        f"   Header parser: {probe['parsed']} ({probe['parser_rate']:.0f}%) | ffprobe: {probe['ffprobe']} | Failed: {probe['failures']}",
+        f"   Cached: {probe['cached']} | Hits: {probe['hits']}",
+    ]
+
+    pre = preflight.get_stats()
+    rejected = ", ".join(f"{k}: {v}" for k, v in pre['rejections'].items()) or "-"
+    lines += [
+        "",
+        "🛫 <b>Preflight</b>",
+        f"   Checked: {pre['checked']} (avg {pre['avg_ms']:.0f} ms) | Playlists passed through: {pre['skipped']}",
+        f"   Rejected: {rejected} | Answered from memory: {pre['cached_rejections']} | Format changed: {pre['reformatted']}",
+    ]
+
+    tc = transcoder.get_stats()
+    decisions = ", ".join(f"{k}: {v}" for k, v in tc['decisions'].items()) or "-"
+    presets = ", ".join(f"{k}: {v}" for k, v in tc['presets'].items()) or "-"
+    lines += [
+        "",
+        "🎞 <b>Transcoding</b>",
+        f"   Decisions: {decisions} | Failed: {tc['failures']}",
+        f"   Encode: {tc['encode_fps']:.0f} fps ({tc['encode_speed']:.1f}x realtime) | Presets: {presets}",
+        f"   Est. time saved vs full re-encode: {tc['time_saved']:.0f}s",
+    ]
+
+    thumbs = thumbnail_service.get_stats()
+    lines += [
+        "",
+        "🖼 <b>Thumbnails</b>",
+        f"   From platform: {thumbs['from_platform']} | Decoded: {thumbs['decoded']} (avg {thumbs['avg_decode_ms']:.0f} ms) | Cache hits: {thumbs['cache_hits']} | Failed: {thumbs['failures']}",
+        f"   ffmpeg: {thumbs['running']}/{thumbs['workers']} running | Waiting: {thumbs['waiting']}",
+    ]
+
+    loop = loop_monitor.get_stats()
+    lines += [
+        "",
+        f"⏱ <b>Event loop</b> ({'monitoring' if loop['running'] else 'not monitored'})",
+        f"   Lag avg/p99/max: {loop['avg_lag_ms']:.1f}/{loop['p99_lag_ms']:.1f}/{loop['max_lag_ms']:.1f} ms",
+        f"   Stalls ≥{loop['threshold_ms']:.0f} ms: {loop['stalls']} ({loop['stall_time']:.1f}s total)",
+    ]
+
+    daemon = aria2.get_stats()
+    torrents = torrent_service.get_stats()
+    trackers = tracker_health.get_stats()
+    events = ", ".join(f"{e}: {n}" for e, n in sorted(daemon['events'].items())) or "-"
+    lines += [
+        "",
+        f"🧲 <b>Torrents</b> (aria2 {daemon['version'] or '-'} {'running, pid ' + str(daemon['pid']) if daemon['running'] else 'not running'}, "
+        f"{daemon['starts']} starts)",
+        f"   Done: {torrents['completed']} | Failed: {torrents['failed']} | Cancelled: {torrents['cancelled']} | "
+        f"Metadata: {torrents['metadata_hits']} cached / {torrents['metadata_fetches']} fetched ({torrents['metadata_cached']} stored)",
+        f"   Limits: {daemon['overall_limit']} overall, {torrents['per_torrent_limit']} per torrent | RPC calls: {daemon['calls']} ({daemon['errors']} errors)",
+        f"   Events: {events}",
+        f"   First peer: {torrents['first_peer_avg']:.1f}s avg, {torrents['first_peer_last']:.1f}s last | "
+        f"DHT table saved: {datetime.fromtimestamp(daemon['dht_saved']).strftime('%Y-%m-%d %H:%M') if daemon['dht_saved'] else 'never'}",
+        f"   Trackers: {trackers['known']} known, {trackers['dead']} dead ({torrents['trackers_excluded']} exclusions) | "
+        f"Probes: {trackers['probes']} ({trackers['probe_failures']} failed), {trackers['avg_rtt_ms']:.0f} ms avg",
+    ]
+    for gid, job in torrents['active'].items():
+        lines.append(
+            f"   <code>{gid}</code> {job['state']}: {job['progress'] * 100:.0f}%, {job['files_ready']}/{job['files']} files, "
+            f"{job['speed'] / 1024 / 1024:.1f} MiB/s, S {job['seeds']} / P {job['peers']}"
+        )
+
+    hedge = fallback_chain.get_stats()
+    delays = ", ".join(f"{p}: {d:g}s" for p, d in hedge['delays'].items()) or "-"
+    wins = ", ".join(f"{m}: {n}" for m, n in sorted(hedge['wins'].items(), key=lambda i: -i[1])) or "-"
+    lines += [
+        "",
+        f"🏁 <b>Fallback chain</b> ({'hedged' if hedge['enabled'] else 'sequential'})",
+        f"   Wins by method: {wins}",
+    ]
+    if hedge['enabled']:
+        lines.append(f"   Hedge delays: {delays}")
+        for platform, launched in sorted(hedge['hedges'].items()):
+            avg = hedge['avg_latency'].get(platform, 0.0)
+            lines.append(f"   {platform}: {launched} hedges, {hedge['hedge_wins'].get(platform, 0)} won by a hedge, avg {avg:.1f}s")
+
+    breakers = method_health.get_stats()
+    if breakers['methods']:
+        icons = {'closed': '🟢', 'half_open': '🟡', 'open': '🔴'}
+        lines += ["", f"🔌 <b>Circuit breakers</b> (skipped: {breakers['skipped']})"]
+        for m in breakers['methods']:
+            retry = f", retry in {m['retry_in']:.0f}s" if m['state'] == 'open' else ""
+            lines.append(
+                f"   {icons[m['state']]} {m['platform']}/{m['method']}: {m['success_rate'] * 100:.0f}% of {m['samples']}, "
+                f"{m['avg_latency']:.1f}s, trips {m['trips']}{retry}"
+            )
+
+    http = http_client.get_stats()
+    lines += ["", f"🌐 <b>HTTP pools</b> ({http['limit_per_host']}/host, DNS TTL {http['dns_ttl']}s, impersonated: {http['impersonated']})"]
+    for p in http['pools']:
+        if 'hosts' in p:
+            lines.append(f"   <code>{p['name']}</code>: {p['hosts']} hosts, {p.get('requests', 0)} requests")
+            continue
+        lines.append(
+            f"   <code>{p['name']}</code>: {p['in_use']}/{p['limit']} in use, {p['idle']} idle | "
+            f"{p.get('requests', 0)} requests, {p.get('connections', 0)} new / {p.get('reused', 0)} reused conns, "
+            f"{p.get('queued', 0)} queued, DNS {p.get('dns_hits', 0)}/{p.get('dns_hits', 0) + p.get('dns_misses', 0)} cached"
+        )
+
+    remote = remote_workers.get_stats()
+    if remote['enabled']:
+        lines += [
+            "",
+            "🛰 <b>Remote workers</b>",
+            f"   Dispatched: {remote['dispatched']} | Local fallbacks: {remote['fallbacks']}",
+        ]
+        for node in remote['nodes']:
+            state = "🟢" if node['healthy'] else "🔴"
+            lines.append(
+                f"   {state} <code>{node['address']}</code> {node['active']}/{node['capacity']} busy, "
+                f"{node['jobs']} jobs, {node['failures']} failures, {node['latency_ms']:.0f} ms"
+            )
+    return "\n".join(lines)
+
 def get_back_keyboard():
     return InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="🔙 Back", callback_data="admin:back")]
@@ -176,6 +404,7 @@ async def cmd_addpremium(message: types.Message):
                 profile.is_premium = 1
                 profile.premium_expiry = None
                 session.commit()
+            stats.invalidate_user_profile(user_id)
             await message.answer(f"✅ Premium granted to user `{user_id}` **forever**.", parse_mode="Markdown")
     except Exception as e:
         await message.answer(f"❌ Error: {str(e)}")
@@ -213,6 +442,7 @@ async def cmd_removepremium(message: types.Message):
                 profile.is_premium = 0
                 profile.premium_expiry = None
                 session.commit()
+        stats.invalidate_user_profile(user_id)
         await message.answer(f"✅ Premium removed from user `{user_id}`.", parse_mode="Markdown")
     except Exception as e:
         await message.answer(f"❌ Error: {str(e)}")
@@ -283,6 +513,41 @@ async def cmd_listpremium(message: types.Message):
     
     await message.answer(text, parse_mode="Markdown")
 
+@router.message(Command("torrents"))
+async def cmd_torrents(message: types.Message):
+    if str(message.from_user.id) != str(ADMIN_USER_ID) and message.from_user.username != ADMIN_USER_ID:
+        await message.answer("You don't have permission.")
+        return
+
+    args = message.text.split()[1:]
+    if not args:
+        active = torrent_service.get_stats()['active']
+        if not active:
+            await message.answer("🧲 No active torrents.")
+            return
+        text = f"🧲 <b>Active torrents ({len(active)})</b>\n\n"
+        for gid, job in active.items():
+            text += (f"<code>{gid}</code> {html.escape(job['name'][:40])}\n"
+                     f"   {job['state']}: {job['progress'] * 100:.0f}%, {job['files_ready']}/{job['files']} files, "
+                     f"{job['speed'] / 1024 / 1024:.1f} MiB/s\n")
+        await message.answer(text, parse_mode="HTML")
+        return
+
+    action = args[0].lower()
+    try:
+        if action in ("pause", "resume", "cancel") and len(args) == 2:
+            await getattr(torrent_service, action)(args[1])
+            await message.answer(f"✅ Torrent <code>{html.escape(args[1])}</code>: {action}", parse_mode="HTML")
+        elif action == "limit" and len(args) in (2, 3):
+            gid = args[2] if len(args) == 3 else None
+            await torrent_service.set_limit(args[1], gid)
+            target = f"torrent <code>{html.escape(gid)}</code>" if gid else "all torrents"
+            await message.answer(f"✅ Download limit for {target}: <code>{html.escape(args[1])}</code>", parse_mode="HTML")
+        else:
+            await message.answer("Usage: `/torrents [pause|resume|cancel <gid>] [limit <rate> [gid]]`", parse_mode="Markdown")
+    except Exception as e:
+        await message.answer(f"❌ {html.escape(str(e))}", parse_mode="HTML")
+
 @router.message(Command("helpadmin"))
 async def cmd_helpadmin(message: types.Message):
     if str(message.from_user.id) != str(ADMIN_USER_ID) and message.from_user.username != ADMIN_USER_ID:
@@ -299,6 +564,10 @@ async def cmd_helpadmin(message: types.Message):
         "/removepremium `<user>` \u2014 Remove premium\n\n"
         "*Settings:*\n"
         "/setlimit `<N>` \u2014 Set daily download limit\n\n"
+        "*Torrents:*\n"
+        "/torrents \u2014 List active torrents\n"
+        "/torrents `pause|resume|cancel` `<gid>` \u2014 Control one torrent\n"
+        "/torrents limit `<rate>` `[gid]` \u2014 Speed cap (e.g. 5M, 0 = none)\n\n"
         "*Broadcast:*\n"
         "/broadcast `<text>` \u2014 Send message to all users\n"
     )
@@ -310,6 +579,7 @@ async def send_admin_panel(message: types.Message):
         await message.answer("You don't have permission to access the admin panel.")
         return
 
+    await stats.flush()
     weekly_stats = stats.get_weekly_stats()
     total_premium_users = stats.get_total_premium_users()
     total_referrals = stats.get_total_referral_users()
@@ -340,20 +610,7 @@ async def send_admin_panel(message: types.Message):
         f"   🏠 VPS (Local): {local_version}\n\n"
     )
 
-    keyboard = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="👥 Users List", callback_data="admin:users")],
-        [InlineKeyboardButton(text="➕ Add User", callback_data="admin:add_user"),
-        InlineKeyboardButton(text="➖ Remove User", callback_data="admin:remove_user")],
-        [InlineKeyboardButton(text="📊 Statistics", callback_data="admin:stats"),
-        InlineKeyboardButton(text="📜 History", callback_data="admin:history")],
-        [InlineKeyboardButton(text=f"🔄 Toggle Limits: {stats.get_app_setting('premium_limits_enabled', 'True')}", callback_data="admin:toggle_limits")],
-        [InlineKeyboardButton(text="📨 Broadcast Message", callback_data="admin:broadcast")],
-        [InlineKeyboardButton(text="🍪 Update Cookies", callback_data="admin:update_cookies"),
-        InlineKeyboardButton(text="🔄 Update yt-dlp", callback_data="admin:update_ytdlp")],
-        [InlineKeyboardButton(text="📂 Get Logs", callback_data="admin:get_logs"),
-        InlineKeyboardButton(text="🗑 Clear Logs", callback_data="admin:clear_logs")],
-        [InlineKeyboardButton(text="❌ Close", callback_data="admin:close")]
-    ])
+    keyboard = get_admin_keyboard()
     await message.answer(stats_message, reply_markup=keyboard, parse_mode="HTML")
 
 # Broadcast message handlers - Must be before general admin handler
@@ -471,20 +728,7 @@ async def handle_admin_callback(callback: types.CallbackQuery, state: FSMContext
         await callback.answer(f"Premium limits toggled to {new_val}")
         
         # update keyboard
-        keyboard = InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text="👥 Users List", callback_data="admin:users")],
-            [InlineKeyboardButton(text="➕ Add User", callback_data="admin:add_user"),
-            InlineKeyboardButton(text="➖ Remove User", callback_data="admin:remove_user")],
-            [InlineKeyboardButton(text="📊 Statistics", callback_data="admin:stats"),
-            InlineKeyboardButton(text="📜 History", callback_data="admin:history")],
-            [InlineKeyboardButton(text=f"🔄 Toggle Limits: {new_val}", callback_data="admin:toggle_limits")],
-            [InlineKeyboardButton(text="📨 Broadcast Message", callback_data="admin:broadcast")],
-            [InlineKeyboardButton(text="🍪 Update Cookies", callback_data="admin:update_cookies"),
-            InlineKeyboardButton(text="🔄 Update yt-dlp", callback_data="admin:update_ytdlp")],
-            [InlineKeyboardButton(text="📂 Get Logs", callback_data="admin:get_logs"),
-            InlineKeyboardButton(text="🗑 Clear Logs", callback_data="admin:clear_logs")],
-            [InlineKeyboardButton(text="❌ Close", callback_data="admin:close")]
-        ])
+        keyboard = get_admin_keyboard(new_val)
         await callback.message.edit_reply_markup(reply_markup=keyboard)
 
     elif action == "add_user":
@@ -586,6 +830,7 @@ async def handle_admin_callback(callback: types.CallbackQuery, state: FSMContext
         
         ITEMS_PER_PAGE = 20
         
+        await stats.flush()
         if stats.Session:
             try:
                 with stats.Session() as session:
@@ -709,6 +954,7 @@ async def handle_admin_callback(callback: types.CallbackQuery, state: FSMContext
         await callback.message.edit_text(text, parse_mode="Markdown", reply_markup=keyboard, disable_web_page_preview=True)
 
     elif action == "back":
+        await stats.flush()
         weekly_stats = stats.get_weekly_stats()
         total_premium_users = stats.get_total_premium_users()
         total_referrals = stats.get_total_referral_users()
@@ -736,20 +982,7 @@ async def handle_admin_callback(callback: types.CallbackQuery, state: FSMContext
             f"   🏠 VPS (Local): {local_version}\n\n"
         )
 
-        keyboard = InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text="👥 Users List", callback_data="admin:users")],
-            [InlineKeyboardButton(text="➕ Add User", callback_data="admin:add_user"),
-            InlineKeyboardButton(text="➖ Remove User", callback_data="admin:remove_user")],
-            [InlineKeyboardButton(text="📊 Statistics", callback_data="admin:stats"),
-            InlineKeyboardButton(text="📜 History", callback_data="admin:history")],
-            [InlineKeyboardButton(text=f"🔄 Toggle Limits: {stats.get_app_setting('premium_limits_enabled', 'True')}", callback_data="admin:toggle_limits")],
-            [InlineKeyboardButton(text="📨 Broadcast Message", callback_data="admin:broadcast")],
-            [InlineKeyboardButton(text="🍪 Update Cookies", callback_data="admin:update_cookies"),
-            InlineKeyboardButton(text="🔄 Update yt-dlp", callback_data="admin:update_ytdlp")],
-            [InlineKeyboardButton(text="📂 Get Logs", callback_data="admin:get_logs"),
-            InlineKeyboardButton(text="🗑 Clear Logs", callback_data="admin:clear_logs")],
-            [InlineKeyboardButton(text="❌ Close", callback_data="admin:close")]
-        ])
+        keyboard = get_admin_keyboard()
         try:
             await callback.message.edit_text(stats_message, reply_markup=keyboard, parse_mode="HTML")
         except Exception:
@@ -759,6 +992,12 @@ async def handle_admin_callback(callback: types.CallbackQuery, state: FSMContext
         # Stats button - do nothing, already showing stats
         pass
 
+    elif action == "perf":
+        try:
+            await callback.message.edit_text(build_performance_report(), parse_mode="HTML", reply_markup=get_back_keyboard())
+        except Exception:
+            pass
+
     elif action == "get_logs":
         log_files = [Path("logs/bot.log"), Path("bot.log")]
         found = False
@@ -936,6 +1175,7 @@ async def process_broadcast(message: types.Message, state: FSMContext):
     user_ids = set()
     group_ids = set()
     
+    await stats.flush()
     if stats.Session:
         try:
             with stats.Session() as session:
@@ -1,18 +1,21 @@
 import uuid
-from typing import Union
+from typing import Dict, Union, Optional, Tuple
 import re
 import logging
 import asyncio
 import time
 import random
-import subprocess
 from pathlib import Path
 from aiogram import Router, types, F, Bot
-from aiogram.exceptions import TelegramRetryAfter
+from aiogram.exceptions import TelegramRetryAfter, TelegramBadRequest
 from aiogram.filters import Command
 from aiogram.utils.keyboard import InlineKeyboardBuilder
 from aiogram.types import InlineKeyboardButton, ReplyKeyboardMarkup, KeyboardButton
-from services.downloader import download_media, get_platform, is_youtube_music, is_playlist, FUNNY_STATUSES
+from services.downloader import download_media, release_download, download_flights, download_flight_key, get_platform, is_youtube_music, is_playlist, canonicalize_url, FUNNY_STATUSES
+from services.hedging import DownloadRejected
+from services.scheduler import download_scheduler
+from services.job_queue import job_queue
+from services.media_probe import media_probe
 from services.torrent_service import torrent_service
 from services import zip_service
 from database.storage import stats
@@ -84,34 +87,109 @@ def format_caption(metadata: dict, platform: str, original_url: str = "", is_mus
     caption = " | ".join(parts) + "\n" + "Developed by @datapeice"
     return caption
 
+def user_is_premium(user_id: int) -> bool:
+    profile = stats.get_user_profile(user_id)
+    return bool(profile.get("is_premium")) if isinstance(profile, dict) else False
+
+def queue_status_reporter(update_status):
+    """Adapts a status updater to the scheduler's on_queue(position, eta) callback."""
+    async def on_queue(position: int, eta: int):
+        eta_text = f"~{eta // 60} min" if eta >= 60 else f"~{eta}s"
+        await update_status(f"⏳ In queue: #{position} (ETA {eta_text})")
+    return on_queue
+
 async def probe_media_duration_seconds(media_path: Path) -> int:
-    def run_probe() -> int:
-        try:
-            result = subprocess.run(
-                [
-                    "ffprobe",
-                    "-v",
-                    "error",
-                    "-show_entries",
-                    "format=duration",
-                    "-of",
-                    "default=noprint_wrappers=1:nokey=1",
-                    str(media_path),
-                ],
-                capture_output=True,
-                text=True,
-                timeout=10,
+    return int((await media_probe.aprobe(media_path)).duration)
+
+def media_cache_key(url: str, is_music: bool, video_height: int = None) -> Tuple[str, str, str]:
+    """Returns (cache_key, canonical_url, variant) for the Telegram file_id cache."""
+    canonical = canonicalize_url(url)
+    variant = "audio" if is_music else f"video:{video_height or 'max'}"
+    return f"{canonical}|{variant}", canonical, variant
+
+def remember_sent_media(sent: Optional[types.Message], url: str, is_music: bool, video_height: int = None, metadata: dict = None):
+    """Stores the file_id of an uploaded audio/video so the next request for the same link skips the download."""
+    if not sent:
+        return
+    metadata = dict(metadata or {})
+    if sent.audio:
+        media_type, file_id = 'audio', sent.audio.file_id
+        metadata.setdefault('duration', sent.audio.duration)
+    elif sent.video:
+        media_type, file_id = 'video', sent.video.file_id
+        metadata['duration'] = metadata.get('duration') or sent.video.duration
+        metadata['width'] = metadata.get('width') or sent.video.width
+        metadata['height'] = metadata.get('height') or sent.video.height
+    else:
+        return
+
+    cache_key, canonical, variant = media_cache_key(url, is_music, video_height)
+    try:
+        stats.save_cached_media(cache_key, canonical, variant, media_type, file_id, metadata)
+    except Exception as e:
+        logging.error(f"[CACHE] Failed to store file_id for {cache_key}: {e}")
+
+async def send_cached_media(bot: Bot, chat_id: int, url: str, is_music: bool, video_height: int = None, platform: str = "", reply_markup=None, **send_kwargs) -> Optional[dict]:
+    """Resends a previously uploaded file by file_id. Returns the cache entry on success, None on miss."""
+    cache_key, _, _ = media_cache_key(url, is_music, video_height)
+    entry = stats.get_cached_media(cache_key)
+    if not entry:
+        return None
+
+    caption = format_caption(entry, platform, url, is_music=is_music)
+    try:
+        if entry['media_type'] == 'audio':
+            await bot.send_audio(
+                chat_id=chat_id,
+                audio=entry['file_id'],
+                duration=entry['duration'] or None,
+                caption=caption,
+                parse_mode='HTML',
+                reply_markup=reply_markup,
+                **send_kwargs
             )
-            if result.returncode != 0:
-                return 0
-            duration_str = result.stdout.strip()
-            if not duration_str:
-                return 0
-            return int(float(duration_str))
-        except Exception:
-            return 0
+        else:
+            video_kwargs = {
+                'video': entry['file_id'],
+                'duration': entry['duration'] or None,
+                'supports_streaming': True,
+                'caption': caption,
+                'parse_mode': 'HTML',
+                'reply_markup': reply_markup
+            }
+            if entry['width'] and entry['height']:
+                video_kwargs['width'] = entry['width']
+                video_kwargs['height'] = entry['height']
+            await bot.send_video(chat_id=chat_id, **video_kwargs, **send_kwargs)
+    except TelegramBadRequest as e:
+        logging.warning(f"[CACHE] file_id rejected for {cache_key}, dropping entry: {e}")
+        stats.drop_cached_media(cache_key)
+        return None
+
+    logging.info(f"[CACHE] ✅ Resent {cache_key} by file_id")
+    return entry
+
+async def edit_inline_with_cached_media(bot: Bot, inline_message_id: str, url: str, is_music: bool, video_height: int = None, platform: str = "") -> Optional[dict]:
+    """Inline variant of send_cached_media: swaps the inline message to the cached file."""
+    cache_key, _, _ = media_cache_key(url, is_music, video_height)
+    entry = stats.get_cached_media(cache_key)
+    if not entry:
+        return None
+
+    caption = format_caption(entry, platform, url, is_music=is_music)
+    if entry['media_type'] == 'audio':
+        media = types.InputMediaAudio(media=entry['file_id'], caption=caption, parse_mode='HTML')
+    else:
+        media = types.InputMediaVideo(media=entry['file_id'], caption=caption, parse_mode='HTML')
+    try:
+        await bot.edit_message_media(media=media, inline_message_id=inline_message_id)
+    except TelegramBadRequest as e:
+        logging.warning(f"[CACHE] file_id rejected for {cache_key}, dropping entry: {e}")
+        stats.drop_cached_media(cache_key)
+        return None
 
-    return await asyncio.to_thread(run_probe)
+    logging.info(f"[CACHE] ✅ Resent {cache_key} by file_id (inline)")
+    return entry
 
 
 @router.message(Command("start"))
@@ -447,11 +525,15 @@ async def handle_search(message: types.Message):
         successful_platform = "youtube"
         last_error = None
         search_url = search_methods[-1][1]
+        is_premium = user_is_premium(message.from_user.id)
         
         for platform_name, s_url in search_methods:
             try:
                 # Removed detailed platform search status to avoid spamming the user
-                file_path, thumbnail_path, metadata = await download_media(s_url, is_music=True, progress_callback=update_status, min_duration=60)
+                slot_platform = "soundcloud" if s_url.startswith("scsearch") else "youtube"
+                already_running = download_flights.is_inflight(download_flight_key(s_url, True, None, 60))
+                async with download_scheduler.slot(slot_platform, is_premium=is_premium, on_queue=queue_status_reporter(update_status), bypass=already_running):
+                    file_path, thumbnail_path, metadata = await download_media(s_url, is_music=True, progress_callback=update_status, min_duration=60)
                 
                 # Check if download was successful
                 if file_path and (isinstance(file_path, list) or file_path.exists()):
@@ -465,6 +547,7 @@ async def handle_search(message: types.Message):
                 
         if not file_path:
             raise last_error or Exception("All search methods failed.")
+        downloaded_files = (file_path, thumbnail_path)
 
         display_name, stored_name, handle = resolve_user_identity(message.from_user)
         stats.add_active_user(message.from_user.id)
@@ -534,12 +617,8 @@ async def handle_search(message: types.Message):
 
             await message.answer_audio(**audio_kwargs)
 
-            file_path.unlink()
-            if thumbnail_path and thumbnail_path.exists():
-                try:
-                    thumbnail_path.unlink()
-                except Exception:
-                    pass
+            release_download(*downloaded_files)
+            del downloaded_files
             # Clean up the alternative cover just in case
             if local_cover_path_str and Path(local_cover_path_str).exists():
                 try:
@@ -557,14 +636,8 @@ async def handle_search(message: types.Message):
         error_msg = str(e)
         logging.error(f"Search error: {error_msg}")
         try:
-            if 'file_path' in locals() and file_path:
-                if isinstance(file_path, list):
-                    for p in file_path:
-                        if p.exists(): p.unlink()
-                elif file_path.exists():
-                    file_path.unlink()
-            if 'thumbnail_path' in locals() and thumbnail_path and thumbnail_path.exists():
-                thumbnail_path.unlink()
+            if 'downloaded_files' in locals():
+                release_download(*downloaded_files)
         except Exception:
             pass
 
@@ -612,6 +685,71 @@ async def handle_torrent_confirm(callback: types.CallbackQuery, bot: Bot):
     status_msg = await callback.message.edit_text("🎬 Initializing torrent download...")
     await process_torrent_download(callback.message, file_id, bot, status_message=status_msg, is_file_id=True)
 
+# Finished torrent files waiting for the uploader; a full queue holds back the download window
+TORRENT_UPLOAD_QUEUE = 2
+TORRENT_VIDEO_EXTENSIONS = {'.mp4', '.mkv', '.avi', '.mov', '.webm', '.ts'}
+TORRENT_AUDIO_EXTENSIONS = {'.flac', '.mp3', '.m4a', '.wav', '.ogg', '.opus'}
+
+def torrent_media_type(path: Path) -> str:
+    ext = path.suffix.lower()
+    if ext in TORRENT_VIDEO_EXTENSIONS:
+        return 'video'
+    if ext in TORRENT_AUDIO_EXTENSIONS:
+        return 'audio'
+    # Fallback for other media as documents
+    return 'document'
+
+def torrent_caption(name: str, position: int, total: int) -> str:
+    file_num = f"({position}/{total}) " if total > 1 else ""
+    return f"📦 {file_num}<b>{name}</b>\n\nDownloaded via Torrent | Developed by @datapeice"
+
+async def send_torrent_file(bot: Bot, chat_id: int, thread_id: Optional[int], media, media_type: str, caption: str, duration: Optional[int] = None) -> types.Message:
+    """Sends one torrent file; media is an FSInputFile or a cached file_id."""
+    if media_type == 'video':
+        return await bot.send_video(
+            chat_id,
+            media,
+            caption=caption,
+            duration=duration or None,
+            supports_streaming=True,
+            parse_mode='HTML',
+            message_thread_id=thread_id
+        )
+    if media_type == 'audio':
+        return await bot.send_audio(
+            chat_id,
+            media,
+            caption=caption,
+            duration=duration or None,
+            parse_mode='HTML',
+            message_thread_id=thread_id
+        )
+    return await bot.send_document(
+        chat_id,
+        media,
+        caption=caption,
+        parse_mode='HTML',
+        message_thread_id=thread_id
+    )
+
+def remember_torrent_file(sent: Optional[types.Message], info_hash: str, index: str, file_name: str, size: int, duration: Optional[int] = None):
+    """Stores the file_id of an uploaded torrent file so the next request for the torrent skips it."""
+    if not sent:
+        return
+    # Telegram may turn a video it cannot stream (e.g. MKV) into a document; cache what it actually kept
+    if sent.video:
+        media_type, file_id, duration = 'video', sent.video.file_id, duration or sent.video.duration
+    elif sent.audio:
+        media_type, file_id, duration = 'audio', sent.audio.file_id, duration or sent.audio.duration
+    elif sent.document:
+        media_type, file_id = 'document', sent.document.file_id
+    else:
+        return
+    try:
+        stats.save_cached_torrent_file(info_hash, index, file_name, media_type, file_id, size, duration or 0)
+    except Exception as e:
+        logging.error(f"[CACHE] Failed to store file_id for torrent {info_hash}#{index}: {e}")
+
 async def process_torrent_download(event: Union[types.Message, types.ChosenInlineResult], source: str, bot: Bot, status_message: types.Message = None, is_file_id: bool = False):
     """Core logic to download and upload torrent content."""
     display_name, stored_name, handle = resolve_user_identity(event.from_user)
@@ -657,86 +795,134 @@ async def process_torrent_download(event: Union[types.Message, types.ChosenInlin
         else:
             torrent_source = source
         
-        # 2. Get file info and check for 2GB limit
+        # 2. Get file info; only media under the 2GB limit are downloaded
         await update_status("Analyzing torrent content...")
         torrent_info = await torrent_service.get_torrent_info(torrent_source)
         
         files_info = torrent_info.get('files', [])
         total_size = torrent_info.get('total_size', 0)
+        info_hash = torrent_info.get('infohash')
         
         MAX_SIZE = 2 * 1024 * 1024 * 1024 # 2GB
         
-        if files_info:
-            # Check individual files known before download
-            for f in files_info:
-                if f['size'] > MAX_SIZE:
-                    raise Exception(f"File '{f['path']}' is too large ({f['size_str']}). Telegram limit is 2GB.")
-                
-        # 3. Start download via aria2c
-        await update_status("Starting torrent download (this might take a while)...")
-        media_files, download_dir = await torrent_service.download_torrent(torrent_source, progress_callback=update_status)
-        
-        if not media_files:
-            # Check if there were ANY files or just none match media extensions
-            all_files_count = len(list(download_dir.rglob("*")))
-            if all_files_count > 0:
-                raise Exception("No media files (video/audio) found in the torrent, only other file types.")
-            raise Exception("Download completed but no files were found. Check the torrent health.")
-            
-        # 4. Upload to Telegram
-        await update_status(f"Found {len(media_files)} media files. Uploading to Telegram...")
-        
-        for i, file_path in enumerate(media_files):
-            if not file_path.exists(): continue
-            
-            # Per-file size check before upload (Telegram bot limit is 2GB)
-            file_size = file_path.stat().st_size
-            if file_size > MAX_SIZE:
-                size_str = f"{file_size / (1024**3):.1f}GB"
-                await bot.send_message(dest_chat_id, f"⚠️ Skipping <b>{file_path.name}</b>: File is too large ({size_str}). Telegram limit is 2GB.", parse_mode='HTML', message_thread_id=thread_id)
-                continue
-                
-            ext = file_path.suffix.lower()
-            file_num = f"({i+1}/{len(media_files)}) " if len(media_files) > 1 else ""
-            caption = f"📦 {file_num}<b>{file_path.name}</b>\n\nDownloaded via Torrent | Developed by @datapeice"
-            
+        # Only media under the limit are downloaded; everything else in the torrent is skipped
+        wanted_files, too_large = torrent_service.plan_files(files_info, MAX_SIZE)
+        if not wanted_files:
+            if too_large:
+                f = too_large[0]
+                raise Exception(f"File '{f['path']}' is too large ({f['size_str']}). Telegram limit is 2GB.")
+            raise Exception("No media files (video/audio) found in the torrent, only other file types.")
+        positions = {f['index']: i + 1 for i, f in enumerate(wanted_files)}
+        total_files = len(wanted_files)
+
+        # 3. Files delivered before are resent by file_id; only the rest is downloaded
+        cached = stats.get_cached_torrent_files(info_hash) if info_hash else {}
+        missing_files = []
+        resent = 0
+        for f in wanted_files:
+            entry = cached.get(f['index'])
+            name = Path(f['path']).name
+            if entry:
+                try:
+                    await send_torrent_file(bot, dest_chat_id, thread_id, entry['file_id'], entry['media_type'],
+                                            torrent_caption(name, positions[f['index']], total_files), entry['duration'])
+                    resent += 1
+                    continue
+                except TelegramBadRequest as e:
+                    logging.warning(f"[CACHE] file_id rejected for torrent {info_hash}#{f['index']}, dropping entry: {e}")
+                    stats.drop_cached_torrent_file(info_hash, f['index'])
+            missing_files.append(f)
+        if resent:
+            logging.info(f"[CACHE] ✅ Resent {resent}/{total_files} files of torrent {info_hash} by file_id")
+
+        media_files = []
+        if missing_files:
+            # 4. Download via aria2c; every finished file goes straight to a bounded upload queue,
+            # so uploads run while the rest of the torrent is still downloading
+            progress = {'download': "Starting torrent download (this might take a while)...", 'uploading': None, 'uploaded': resent}
+            upload_queue: asyncio.Queue = asyncio.Queue(maxsize=TORRENT_UPLOAD_QUEUE)
+
+            async def show_progress():
+                text = progress['download']
+                upload_line = f"⬆️ Uploaded: {progress['uploaded']}/{total_files}"
+                if progress['uploading']:
+                    upload_line += f" | Sending: {progress['uploading'][:40]}"
+                await update_status(f"{text}\n\n{upload_line}")
+
+            async def on_download_progress(text: str):
+                progress['download'] = text
+                await show_progress()
+
+            async def on_file_ready(path: Path, index: str):
+                await upload_queue.put((path, index))
+
+            async def upload_file(file_path: Path, index: str):
+                if not file_path.exists():
+                    return
+
+                # Per-file size check before upload (Telegram bot limit is 2GB)
+                file_size = file_path.stat().st_size
+                if file_size > MAX_SIZE:
+                    size_str = f"{file_size / (1024**3):.1f}GB"
+                    await bot.send_message(dest_chat_id, f"⚠️ Skipping <b>{file_path.name}</b>: File is too large ({size_str}). Telegram limit is 2GB.", parse_mode='HTML', message_thread_id=thread_id)
+                    return
+
+                media_type = torrent_media_type(file_path)
+                caption = torrent_caption(file_path.name, positions.get(index, 0), total_files)
+                progress['uploading'] = file_path.name
+                await show_progress()
+                try:
+                    duration = await probe_media_duration_seconds(file_path) if media_type == 'video' else None
+                    sent = await send_torrent_file(bot, dest_chat_id, thread_id, types.FSInputFile(file_path), media_type, caption, duration)
+                    progress['uploaded'] += 1
+                    if info_hash:
+                        remember_torrent_file(sent, info_hash, index, file_path.name, file_size, duration)
+                except Exception as e:
+                    logging.error(f"Failed to upload torrent file {file_path.name}: {e}")
+                    prompt_msg = f"❌ Failed to upload {file_path.name[:50]}: {str(e)[:50]}..."
+                    await bot.send_message(dest_chat_id, prompt_msg, message_thread_id=thread_id)
+                finally:
+                    progress['uploading'] = None
+
+            async def uploader():
+                while True:
+                    item = await upload_queue.get()
+                    if item is None:
+                        return
+                    try:
+                        await upload_file(*item)
+                    except Exception as e:
+                        logging.error(f"Torrent uploader error: {e}")
+
+            upload_task = asyncio.create_task(uploader())
             try:
-                # Video extensions
-                if ext in {'.mp4', '.mkv', '.avi', '.mov', '.webm', '.ts'}:
-                    duration = await probe_media_duration_seconds(file_path)
-                    await bot.send_video(
-                        dest_chat_id,
-                        types.FSInputFile(file_path),
-                        caption=caption,
-                        duration=duration,
-                        supports_streaming=True,
-                        parse_mode='HTML',
-                        message_thread_id=thread_id
-                    )
-                # Audio extensions
-                elif ext in {'.flac', '.mp3', '.m4a', '.wav', '.ogg', '.opus'}:
-                    await bot.send_audio(
-                        dest_chat_id,
-                        types.FSInputFile(file_path),
-                        caption=caption,
-                        parse_mode='HTML',
-                        message_thread_id=thread_id
-                    )
-                # Fallback for other media as documents
-                else:
-                    await bot.send_document(
-                        dest_chat_id,
-                        types.FSInputFile(file_path),
-                        caption=caption,
-                        parse_mode='HTML',
-                        message_thread_id=thread_id
+                is_premium = bool(profile.get("is_premium")) if isinstance(profile, dict) else False
+                async with download_scheduler.slot('torrent', is_premium=is_premium, on_queue=queue_status_reporter(update_status)):
+                    await show_progress()
+                    media_files, download_dir = await torrent_service.download_torrent(
+                        torrent_source, progress_callback=on_download_progress, on_file_ready=on_file_ready,
+                        indexes=[f['index'] for f in missing_files]
                     )
-            except Exception as e:
-                logging.error(f"Failed to upload torrent file {file_path.name}: {e}")
-                prompt_msg = f"❌ Failed to upload {file_path.name[:50]}: {str(e)[:50]}..."
-                await bot.send_message(dest_chat_id, prompt_msg, message_thread_id=thread_id)
-            
-            # Individual file upload...
+
+                if not media_files:
+                    raise Exception("Download completed but no files were found. Check the torrent health.")
+
+                # 5. Let the uploader drain what is left in the queue
+                progress['download'] = f"Download complete ({len(media_files)} files). Uploading to Telegram..."
+                await show_progress()
+                await upload_queue.put(None)
+                await upload_task
+            finally:
+                if not upload_task.done():
+                    upload_task.cancel()
+                    try:
+                        await upload_task
+                    except asyncio.CancelledError:
+                        pass
+
+        for f in too_large:
+            name = Path(f['path']).name
+            await bot.send_message(dest_chat_id, f"⚠️ Skipping <b>{name}</b>: File is too large ({f['size_str']}). Telegram limit is 2GB.", parse_mode='HTML', message_thread_id=thread_id)
                 
         await status_message.delete()
         # Extract original tracker URL if possible
@@ -747,7 +933,7 @@ async def process_torrent_download(event: Union[types.Message, types.ChosenInlin
             tracker_url = torrent_source
         # Record stat once for the whole torrent
         stats.add_download('Torrent', user_id, stored_name, 'torrent', 'torrent_file', tracker_url)
-        download_logger.info(f"Torrent success: {display_name} ({handle}) downloaded {len(media_files)} files")
+        download_logger.info(f"Torrent success: {display_name} ({handle}) downloaded {len(media_files)} files, {resent} resent from cache")
 
     except Exception as e:
         error_msg = str(e)
@@ -911,6 +1097,33 @@ async def handle_url(message: types.Message, bot: Bot):
             await message.answer("🎹 YouTube Music Album/Playlist detected!\nHow would you like to download it?", reply_markup=builder.as_markup(), **reply_kwargs)
             return
 
+        is_music = is_youtube_music(target_url) or platform == "soundcloud"
+        video_height = None if is_premium else 720
+
+        thread_kwargs = {'message_thread_id': message.message_thread_id} if message.is_topic_message else {}
+        cached = await send_cached_media(
+            bot, message.chat.id, target_url, is_music, video_height, platform,
+            reply_markup=get_random_support_kb(), **thread_kwargs, **reply_kwargs
+        )
+        if cached:
+            display_name, stored_name, handle = resolve_user_identity(message.from_user)
+            stats.add_active_user(user_id)
+            stats.add_download(
+                content_type='Music' if is_music else 'Video',
+                user_id=user_id,
+                username=stored_name,
+                platform=platform,
+                url=target_url,
+                title=cached.get('title') or 'Media'
+            )
+            download_logger.info(
+                f"User: {display_name} ({handle}, ID: {user_id}) | "
+                f"Platform: {platform} | "
+                f"Type: {'Music' if is_music else 'Video'} | "
+                f"URL: {target_url} | Cache: hit"
+            )
+            return
+
         is_youtube = platform == "youtube" or 'youtu.be' in target_url or 'youtube.com' in target_url
         status_message = None
         if is_group and not is_youtube:
@@ -926,16 +1139,32 @@ async def handle_url(message: types.Message, bot: Bot):
                 except Exception:
                     pass
 
-        is_music = is_youtube_music(target_url) or platform == "soundcloud"
-        video_height = None if is_premium else 720
-        try:
-            file_path, thumbnail_path, metadata = await download_media(target_url, is_music, video_height=video_height, progress_callback=update_status)
-        except Exception as quality_err:
-            if video_height and "no video formats" not in str(quality_err).lower():
-                raise
-            # Fallback: retry without height restriction if 720p failed
-            logging.info(f"[QUALITY-FALLBACK] Retrying without height limit after: {quality_err}")
-            file_path, thumbnail_path, metadata = await download_media(target_url, is_music, progress_callback=update_status)
+        # Journal the job so it survives a restart mid-download
+        job_id = job_queue.enqueue(
+            target_url, user_id, message.chat.id,
+            message_thread_id=message.message_thread_id if message.is_topic_message else None,
+            reply_to_message_id=reply_kwargs.get('reply_to_message_id'),
+            status_message_id=status_message.message_id if status_message else None,
+            username=resolve_user_identity(message.from_user)[1],
+            platform=platform,
+            is_music=int(is_music),
+            video_height=video_height,
+            is_premium=int(is_premium),
+        )
+        job_heartbeat = job_queue.keep_alive(job_id)
+        job_state = None
+
+        already_running = download_flights.is_inflight(download_flight_key(target_url, is_music, video_height))
+        async with download_scheduler.slot(platform, is_premium=is_premium, on_queue=queue_status_reporter(update_status), bypass=already_running):
+            job_queue.update(job_id, 'running')
+            try:
+                file_path, thumbnail_path, metadata = await download_media(target_url, is_music, video_height=video_height, progress_callback=update_status)
+            except Exception as quality_err:
+                if video_height and "no video formats" not in str(quality_err).lower():
+                    raise
+                # Fallback: retry without height restriction if 720p failed
+                logging.info(f"[QUALITY-FALLBACK] Retrying without height limit after: {quality_err}")
+                file_path, thumbnail_path, metadata = await download_media(target_url, is_music, progress_callback=update_status)
 
         # Determine title based on file_path type
         if isinstance(file_path, list):
@@ -962,6 +1191,7 @@ async def handle_url(message: types.Message, bot: Bot):
             f"URL: {target_url}"
         )
 
+        job_queue.update(job_id, 'uploading')
         if isinstance(file_path, list):
             await update_status("📤 Uploading slideshow to Telegram...")
             
@@ -1027,11 +1257,9 @@ async def handle_url(message: types.Message, bot: Bot):
                         logging.error(f"Failed to send audio: {e}")
 
             # Cleanup
-            for photo_path in file_path:
-                try:
-                    photo_path.unlink()
-                except Exception:
-                    pass
+            release_download(file_path, thumbnail_path)
+            file_path = thumbnail_path = None
+            job_state = 'done'
             if status_message:
                 await status_message.delete()
 
@@ -1050,16 +1278,16 @@ async def handle_url(message: types.Message, bot: Bot):
                     reply_markup=get_random_support_kb(),
                     **reply_kwargs
                 )
-                file_path.unlink()
-                if thumbnail_path and thumbnail_path.exists():
-                    thumbnail_path.unlink()
+                release_download(file_path, thumbnail_path)
+                file_path = thumbnail_path = None
+                job_state = 'done'
                 if status_message:
                     await status_message.delete()
                 return
 
             if is_music:
                 if thumbnail_path:
-                    await message.answer_audio(
+                    sent = await message.answer_audio(
                         types.FSInputFile(file_path), 
                         thumbnail=types.FSInputFile(thumbnail_path),
                         duration=int(metadata.get('duration', 0)),
@@ -1069,7 +1297,7 @@ async def handle_url(message: types.Message, bot: Bot):
                         **reply_kwargs
                     )
                 else:
-                    await message.answer_audio(
+                    sent = await message.answer_audio(
                         types.FSInputFile(file_path),
                         duration=int(metadata.get('duration', 0)),
                         caption=caption,
@@ -1102,30 +1330,31 @@ async def handle_url(message: types.Message, bot: Bot):
                 
                 # Measure upload time to Telegram
                 upload_start = time.time()
-                await message.answer_video(**video_kwargs, **reply_kwargs)
+                sent = await message.answer_video(**video_kwargs, **reply_kwargs)
                 upload_time = time.time() - upload_start
                 file_size_mb = file_path.stat().st_size / (1024 * 1024)
                 logging.info(f"✅ Video uploaded to Telegram in {upload_time:.1f}s ({file_size_mb:.2f}MB, {file_size_mb/upload_time:.2f}MB/s)")
             
-            file_path.unlink()
-            if thumbnail_path and thumbnail_path.exists():
-                thumbnail_path.unlink()
+            remember_sent_media(sent, target_url, is_music, video_height, metadata)
+            release_download(file_path, thumbnail_path)
+            file_path = thumbnail_path = None
+            job_state = 'done'
             if status_message:
                 await status_message.delete()
         else:
+            job_state = 'failed'
             if status_message:
                 await safe_edit_text(status_message, "Sorry, something went wrong during download.")
     
     except Exception as e:
         error_msg = str(e)
         logging.error(f"Error: {error_msg}")
+        if "job_id" in locals() and not job_state:
+            job_state = 'failed'
+            job_queue.update(job_id, last_error=error_msg[:500])
         try:
             if "file_path" in locals() and file_path:
-                if isinstance(file_path, list):
-                    for p in file_path:
-                        if p.exists(): p.unlink()
-                elif file_path.exists(): file_path.unlink()
-            if "thumbnail_path" in locals() and thumbnail_path and thumbnail_path.exists(): thumbnail_path.unlink()
+                release_download(file_path, locals().get("thumbnail_path"))
         except Exception:
             pass
         
@@ -1134,7 +1363,9 @@ async def handle_url(message: types.Message, bot: Bot):
             return
 
         # User-friendly error messages
-        if "Unsupported URL" in error_msg:
+        if isinstance(e, DownloadRejected):
+            user_error = f"❌ {error_msg}"
+        elif "Unsupported URL" in error_msg:
             user_error = "❌ This URL is not supported. Please try a different link."
         elif "Private video" in error_msg or "Login required" in error_msg:
             user_error = "❌ This video is private or requires login."
@@ -1152,11 +1383,153 @@ async def handle_url(message: types.Message, bot: Bot):
             await message.answer(user_error, parse_mode='Markdown' if '```' in user_error else None, **reply_kwargs)
             
     finally:
+        if "job_id" in locals():
+            if job_heartbeat:
+                job_heartbeat.cancel()
+            # Without a final state (e.g. cancelled on shutdown) the job is left for resume
+            if job_state:
+                job_queue.update(job_id, job_state)
         if sem:
             sem.release()
             if is_prem_site and 'error_msg' not in locals():
                 stats.increment_daily_premium(user_id)
 
+async def resume_download_job(bot: Bot, job: dict):
+    """Executor for jobs picked up by the durable queue, e.g. downloads interrupted by a restart."""
+    url = job['url']
+    chat_id = job['chat_id']
+    platform = job['platform'] or get_platform(url)
+    is_music = bool(job['is_music'])
+    video_height = job['video_height']
+    final_attempt = (job['attempts'] or 0) + 1 >= (job['max_attempts'] or 1)
+
+    send_kwargs = {}
+    if job['message_thread_id']:
+        send_kwargs['message_thread_id'] = job['message_thread_id']
+    if job['reply_to_message_id']:
+        send_kwargs['reply_to_message_id'] = job['reply_to_message_id']
+        send_kwargs['allow_sending_without_reply'] = True
+
+    status_message = None
+    if job['status_message_id']:
+        try:
+            status_message = await bot.edit_message_text("♻️ Resuming your download after a restart...", chat_id=chat_id, message_id=job['status_message_id'])
+        except Exception:
+            status_message = None
+
+    async def update_status(text: str):
+        if status_message:
+            try:
+                await safe_edit_text(status_message, text)
+            except Exception:
+                pass
+
+    try:
+        cached = await send_cached_media(bot, chat_id, url, is_music, video_height, platform, **send_kwargs)
+        if cached:
+            title = cached.get('title') or 'Media'
+        else:
+            async with download_scheduler.slot(platform, is_premium=bool(job['is_premium']), on_queue=queue_status_reporter(update_status)):
+                file_path, thumbnail_path, metadata = await download_media(url, is_music, video_height=video_height, progress_callback=update_status)
+
+            try:
+                job_queue.update(job['id'], 'uploading')
+                await update_status("📤 Uploading to Telegram...")
+                caption = format_caption(metadata, platform, url, is_music=is_music)
+                title = metadata.get('title') or 'Media'
+
+                if isinstance(file_path, list):
+                    ordered_files = sorted(p for p in file_path if p.suffix.lower() in ('.jpg', '.jpeg', '.png', '.webp', '.mp4', '.mov', '.webm'))
+                    media_group = [
+                        types.InputMediaPhoto(media=types.FSInputFile(p), caption=caption if i == 0 else None, parse_mode='HTML' if i == 0 else None)
+                        if p.suffix.lower() in ('.jpg', '.jpeg', '.png', '.webp') else
+                        types.InputMediaVideo(media=types.FSInputFile(p), caption=caption if i == 0 else None, parse_mode='HTML' if i == 0 else None, supports_streaming=True)
+                        for i, p in enumerate(ordered_files)
+                    ]
+                    for i in range(0, len(media_group), 10):
+                        await bot.send_media_group(chat_id, media_group[i:i + 10], **send_kwargs)
+                elif is_music:
+                    sent = await bot.send_audio(
+                        chat_id,
+                        types.FSInputFile(file_path),
+                        thumbnail=types.FSInputFile(thumbnail_path) if thumbnail_path else None,
+                        duration=int(metadata.get('duration', 0)),
+                        caption=caption,
+                        parse_mode='HTML',
+                        **send_kwargs
+                    )
+                    remember_sent_media(sent, url, is_music, video_height, metadata)
+                else:
+                    duration_value = int(metadata.get('duration', 0)) or await probe_media_duration_seconds(file_path)
+                    video_kwargs = {
+                        'video': types.FSInputFile(file_path),
+                        'duration': duration_value,
+                        'supports_streaming': True,
+                        'caption': caption,
+                        'parse_mode': 'HTML',
+                    }
+                    if metadata.get('width') and metadata.get('height'):
+                        video_kwargs['width'] = int(metadata.get('width'))
+                        video_kwargs['height'] = int(metadata.get('height'))
+                    if thumbnail_path:
+                        video_kwargs['thumbnail'] = types.FSInputFile(thumbnail_path)
+                    sent = await bot.send_video(chat_id, **video_kwargs, **send_kwargs)
+                    remember_sent_media(sent, url, is_music, video_height, metadata)
+            finally:
+                release_download(file_path, thumbnail_path)
+
+        stats.add_download(
+            content_type='Music' if is_music else 'Video',
+            user_id=job['user_id'],
+            username=job['username'],
+            platform=platform,
+            url=url,
+            title=title
+        )
+        if status_message:
+            try: await status_message.delete()
+            except: pass
+    except Exception as e:
+        if final_attempt:
+            text = f"❌ Could not finish your download after a restart:\n{str(e)[:200]}"
+            try:
+                if status_message:
+                    await safe_edit_text(status_message, text)
+                else:
+                    await bot.send_message(chat_id, text, **send_kwargs)
+            except Exception:
+                pass
+        raise
+
+async def deliver_cached_for_callback(callback: types.CallbackQuery, bot: Bot, url: str, is_music: bool, video_height: int = None) -> bool:
+    """Cache-hit path shared by the YouTube format/resolution buttons."""
+    if callback.inline_message_id:
+        cached = await edit_inline_with_cached_media(bot, callback.inline_message_id, url, is_music, video_height, 'youtube')
+    else:
+        chat_id = callback.message.chat.id if callback.message else callback.from_user.id
+        thread_id = getattr(callback.message, 'message_thread_id', None) if callback.message else None
+        cached = await send_cached_media(
+            bot, chat_id, url, is_music, video_height, 'youtube',
+            reply_markup=get_random_support_kb(), message_thread_id=thread_id
+        )
+    if not cached:
+        return False
+
+    display_name, stored_name, handle = resolve_user_identity(callback.from_user)
+    stats.add_active_user(callback.from_user.id)
+    stats.add_download(
+        content_type='Music' if is_music else 'Video',
+        user_id=callback.from_user.id,
+        username=stored_name,
+        platform='youtube',
+        url=url,
+        title=cached.get('title') or 'Media'
+    )
+    if not callback.inline_message_id:
+        try: await callback.message.delete()
+        except: pass
+    return True
+
 @router.callback_query(F.data.startswith("format:"))
 async def handle_format_selection(callback: types.CallbackQuery, bot: Bot):
     try:
@@ -1204,7 +1577,13 @@ async def handle_format_selection(callback: types.CallbackQuery, bot: Bot):
         
         try:
             is_music = True
-            file_path, thumbnail_path, metadata = await download_media(url, is_music, progress_callback=update_status)
+            if await deliver_cached_for_callback(callback, bot, url, is_music, None):
+                return
+
+            already_running = download_flights.is_inflight(download_flight_key(url, is_music))
+            async with download_scheduler.slot(get_platform(url), is_premium=user_is_premium(callback.from_user.id),
+                                               on_queue=queue_status_reporter(update_status), bypass=already_running):
+                file_path, thumbnail_path, metadata = await download_media(url, is_music, progress_callback=update_status)
 
             display_name, stored_name, handle = resolve_user_identity(callback.from_user)
             stats.add_active_user(callback.from_user.id)
@@ -1240,6 +1619,7 @@ async def handle_format_selection(callback: types.CallbackQuery, bot: Bot):
                     reply_markup=get_random_support_kb(),
                     message_thread_id=thread_id
                 )
+                remember_sent_media(sent, url, is_music, None, metadata)
                 
                 if callback.inline_message_id:
                     media = types.InputMediaAudio(media=sent.audio.file_id, caption=caption, parse_mode='HTML')
@@ -1248,9 +1628,8 @@ async def handle_format_selection(callback: types.CallbackQuery, bot: Bot):
                     try: await sent.delete()
                     except: pass
                 
-                file_path.unlink()
-                if thumbnail_path and thumbnail_path.exists():
-                    thumbnail_path.unlink()
+                release_download(file_path, thumbnail_path)
+                file_path = thumbnail_path = None
                 
                 if not callback.inline_message_id:
                     try: await callback.message.delete()
@@ -1264,12 +1643,7 @@ async def handle_format_selection(callback: types.CallbackQuery, bot: Bot):
             await update_status(f"❌ Error: {error_msg[:100]}")
             try:
                 if 'file_path' in locals() and file_path:
-                    if isinstance(file_path, list):
-                        for p in file_path:
-                            if p.exists(): p.unlink()
-                    elif file_path.exists(): file_path.unlink()
-                if 'thumbnail_path' in locals() and thumbnail_path and thumbnail_path.exists():
-                    thumbnail_path.unlink()
+                    release_download(file_path, locals().get('thumbnail_path'))
             except: pass
 
     except Exception as e:
@@ -1320,12 +1694,18 @@ async def handle_resolution_selection(callback: types.CallbackQuery, bot: Bot):
                 pass
         
         try:
-            file_path, thumbnail_path, metadata = await download_media(
-                url,
-                is_music=False,
-                video_height=int(height),
-                progress_callback=update_status
-            )
+            if await deliver_cached_for_callback(callback, bot, url, False, int(height)):
+                return
+
+            already_running = download_flights.is_inflight(download_flight_key(url, False, int(height)))
+            async with download_scheduler.slot(get_platform(url), is_premium=user_is_premium(callback.from_user.id),
+                                               on_queue=queue_status_reporter(update_status), bypass=already_running):
+                file_path, thumbnail_path, metadata = await download_media(
+                    url,
+                    is_music=False,
+                    video_height=int(height),
+                    progress_callback=update_status
+                )
 
             display_name, stored_name, handle = resolve_user_identity(callback.from_user)
             stats.add_active_user(callback.from_user.id)
@@ -1365,6 +1745,7 @@ async def handle_resolution_selection(callback: types.CallbackQuery, bot: Bot):
                    video_kwargs['thumbnail'] = types.FSInputFile(thumbnail_path)
                 
                 sent = await bot.send_video(chat_id=user_id, message_thread_id=thread_id, **video_kwargs)
+                remember_sent_media(sent, url, False, int(height), metadata)
                 
                 if callback.inline_message_id:
                     media = types.InputMediaVideo(media=sent.video.file_id, caption=caption, parse_mode='HTML')
@@ -1373,9 +1754,8 @@ async def handle_resolution_selection(callback: types.CallbackQuery, bot: Bot):
                     try: await sent.delete()
                     except: pass
                 
-                file_path.unlink()
-                if thumbnail_path and thumbnail_path.exists():
-                    thumbnail_path.unlink()
+                release_download(file_path, thumbnail_path)
+                file_path = thumbnail_path = None
                 
                 if not callback.inline_message_id:
                     try: await callback.message.delete()
@@ -1389,12 +1769,7 @@ async def handle_resolution_selection(callback: types.CallbackQuery, bot: Bot):
             await update_status(f"❌ Error: {error_msg[:100]}")
             try:
                 if 'file_path' in locals() and file_path:
-                    if isinstance(file_path, list):
-                        for p in file_path:
-                            if p.exists(): p.unlink()
-                    elif file_path.exists(): file_path.unlink()
-                if 'thumbnail_path' in locals() and thumbnail_path and thumbnail_path.exists():
-                    thumbnail_path.unlink()
+                    release_download(file_path, locals().get('thumbnail_path'))
             except: pass
 
     except Exception as e:
@@ -1467,11 +1842,41 @@ async def handle_playlist_selection(callback: types.CallbackQuery, bot: Bot):
             except: pass
 
         is_music = "music.youtube.com" in url or action in ('each', 'zip')
+
+        archive = None
+        if action == 'zip':
+            # The archive is filled while tracks download, so the link can be handed out now
+            archive = zip_service.start_playlist_zip()
+            download_url = f"https://bot.datapeice.me/dl/{archive.token('youtube_playlist')}"
+
+            kb = InlineKeyboardBuilder()
+            kb.add(InlineKeyboardButton(text="⬇️ Download ZIP", url=download_url))
+            kb.add(InlineKeyboardButton(text="⭐️ Support Bot", callback_data="show_donate_menu"))
+            kb.adjust(1)
+
+            await bot.send_message(
+                user_id,
+                f"📦 <b>Playlist ZIP is being built</b>\n\n"
+                f"Tracks are added as they download; the link works right away.\n"
+                f"Valid for: <b>24 hours</b>\n\n"
+                f"Your private link:\n<code>{download_url}</code>",
+                reply_markup=kb.as_markup(),
+                parse_mode='HTML'
+            )
         
         async def on_track_ready(res, i, total):
+            file_path, thumbnail_path, metadata = res
+            if action == 'zip':
+                try:
+                    await archive.add(file_path)
+                    # Already in the archive - no need to keep it on disk until the playlist ends
+                    file_path.unlink(missing_ok=True)
+                    if thumbnail_path and thumbnail_path.exists(): thumbnail_path.unlink()
+                except Exception as e:
+                    logging.error(f"Error adding track {i} to ZIP: {e}")
+                return
             if action != 'each': return
             
-            file_path, thumbnail_path, metadata = res
             try:
                 caption = format_caption(metadata, 'youtube', metadata.get('webpage_url', url), is_music=True)
                 audio_kwargs = {
@@ -1483,21 +1888,31 @@ async def handle_playlist_selection(callback: types.CallbackQuery, bot: Bot):
                 if thumbnail_path and thumbnail_path.exists():
                     audio_kwargs["thumbnail"] = types.FSInputFile(thumbnail_path)
                 
-                await bot.send_audio(chat_id, message_thread_id=thread_id, **audio_kwargs)
-                # Small delay to avoid Telegram flood limits
-                await asyncio.sleep(1.5)
+                # No fixed pause between tracks: wait only when Telegram asks for it
+                for attempt in range(3):
+                    try:
+                        await bot.send_audio(chat_id, message_thread_id=thread_id, **audio_kwargs)
+                        break
+                    except TelegramRetryAfter as e:
+                        if attempt == 2:
+                            raise
+                        logging.warning(f"Flood control on send_audio: sleeping for {e.retry_after}s")
+                        await asyncio.sleep(e.retry_after)
             except Exception as e:
                 logging.error(f"Error sending track {i} (streaming): {e}")
 
-        # Start download
+        # Start download; every track takes its own scheduler slot inside the playlist downloader
         results = await download_media(
             url, 
             is_music=True, 
             progress_callback=update_status,
-            on_track_callback=on_track_ready if action == 'each' else None
+            on_track_callback=on_track_ready if action in ('each', 'zip') else None,
+            is_premium=user_is_premium(user_id)
         )
         
         if not results or not isinstance(results, list):
+            if archive:
+                await archive.abort()
             await update_status("❌ Failed to process playlist or it's empty.")
             return
 
@@ -1526,29 +1941,23 @@ async def handle_playlist_selection(callback: types.CallbackQuery, bot: Bot):
                     thumb_path.unlink()
 
         elif action == 'zip':
-            await update_status("📦 Creating ZIP archive...")
-            
-            files = [r[0] for r in results]
-            # Try to get a decent name for the ZIP
+            await archive.close()
+            # The first link was signed before any title was known; this one carries a proper file name
             zip_name = "youtube_playlist"
-            if results and results[0][2].get('title'):
+            if results[0][2].get('title'):
                 zip_name = f"playlist_{results[0][2].get('title')[:20]}"
-            
-            secure_id = zip_service.create_playlist_zip(files, zip_name)
-            
-            # Use the user's domain
-            download_url = f"https://bot.datapeice.me/dl/{secure_id}"
-            
+            download_url = f"https://bot.datapeice.me/dl/{archive.token(zip_name)}"
+
             kb = InlineKeyboardBuilder()
             kb.add(InlineKeyboardButton(text="⬇️ Download ZIP", url=download_url))
             kb.add(InlineKeyboardButton(text="⭐️ Support Bot", callback_data="show_donate_menu"))
             kb.adjust(1)
-            
+
             await status_msg.delete()
             await bot.send_message(
                 user_id,
                 f"📦 <b>Playlist ZIP is ready!</b>\n\n"
-                f"Contains: <b>{len(files)}</b> tracks\n"
+                f"Contains: <b>{archive.count}</b> tracks\n"
                 f"Valid for: <b>24 hours</b>\n\n"
                 f"Your private link:\n<code>{download_url}</code>",
                 reply_markup=kb.as_markup(),
@@ -1573,6 +1982,8 @@ async def handle_playlist_selection(callback: types.CallbackQuery, bot: Bot):
 
     except Exception as e:
         logging.error(f"Playlist handler error: {e}")
+        if locals().get('archive'):
+            await archive.abort()
         try: await callback.message.edit_text(f"❌ Error processing playlist: {str(e)}")
         except: pass
 
@@ -1628,8 +2039,25 @@ async def handle_inline_result_chosen(chosen_result: types.ChosenInlineResult, b
                 await bot.edit_message_text(text=text, inline_message_id=inline_message_id)
             except: pass
 
+        cached = await edit_inline_with_cached_media(bot, inline_message_id, target_url, is_music, None, platform)
+        if cached:
+            display_name, stored_name, handle = resolve_user_identity(chosen_result.from_user)
+            stats.add_active_user(chosen_result.from_user.id)
+            stats.add_download(
+                content_type='music' if is_music else 'video',
+                user_id=chosen_result.from_user.id,
+                username=stored_name,
+                platform=platform,
+                url=target_url,
+                title=cached.get('title') or 'Unknown'
+            )
+            return
+
         await update_status("⏳ Downloading...")
-        file_path, thumbnail_path, metadata = await download_media(target_url, is_music=is_music, progress_callback=update_status)
+        already_running = download_flights.is_inflight(download_flight_key(target_url, is_music))
+        async with download_scheduler.slot(platform, is_premium=user_is_premium(chosen_result.from_user.id),
+                                           on_queue=queue_status_reporter(update_status), bypass=already_running):
+            file_path, thumbnail_path, metadata = await download_media(target_url, is_music=is_music, progress_callback=update_status)
 
         await update_status("📤 Uploading...")
 
@@ -1647,9 +2075,7 @@ async def handle_inline_result_chosen(chosen_result: types.ChosenInlineResult, b
             media_group = [types.InputMediaPhoto(media=types.FSInputFile(p), caption=caption if i == 0 else "", parse_mode='HTML' if i == 0 else None) for i, p in enumerate(ordered_files) if p.suffix.lower() in image_exts][:10]
             if media_group:
                 await bot.send_media_group(user_id, media_group)
-            for p in file_path:
-                try: p.unlink()
-                except: pass
+            release_download(file_path, thumbnail_path)
             stats.add_download(
                 content_type='Music' if is_music else 'Video',
                 user_id=user_id,
@@ -1680,6 +2106,7 @@ async def handle_inline_result_chosen(chosen_result: types.ChosenInlineResult, b
                     parse_mode='HTML'
                 )
                 media = types.InputMediaVideo(media=sent.video.file_id, caption=caption, parse_mode='HTML')
+            remember_sent_media(sent, target_url, is_music, None, metadata)
 
             # Update the inline message with the media
             await bot.edit_message_media(media=media, inline_message_id=inline_message_id)
@@ -1689,8 +2116,7 @@ async def handle_inline_result_chosen(chosen_result: types.ChosenInlineResult, b
             except: pass
 
             # Clean up
-            file_path.unlink()
-            if thumbnail_path and thumbnail_path.exists(): thumbnail_path.unlink()
+            release_download(file_path, thumbnail_path)
 
             stats.add_download(
                 content_type='music' if is_music else 'video',
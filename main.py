@@ -1,6 +1,7 @@
 import os
 import asyncio
 import logging
+import time
 from pathlib import Path
 from aiohttp import web
 from aiogram import Bot, Dispatcher
@@ -72,6 +73,7 @@ async def check_premium_expiry_worker(bot: Bot):
                         profile.premium_expiry = None
                         profile.notified_expiry_soon = 0
                         profile.notified_expired = 0
+                        stats.invalidate_user_profile(profile.user_id)
                         
                         if profile.user_id > 0:
                             try:
@@ -117,6 +119,28 @@ async def on_startup(bot: Bot):
     asyncio.create_task(delete_old_files())
     asyncio.create_task(zip_cleanup_worker())
     asyncio.create_task(check_premium_expiry_worker(bot))
+
+    from services.http_client import http_client
+    http_client.start()
+
+    from services.loop_monitor import loop_monitor
+    loop_monitor.start()
+
+    from services.aria2 import aria2
+    aria2.start()
+
+    from database.storage import stats
+    stats.start()
+
+    from services.ytdlp_pool import ytdlp_pool
+    ytdlp_pool.start()
+
+    from services.remote_worker import remote_workers
+    await remote_workers.start()
+
+    # Resume downloads that were interrupted by a restart
+    from services.job_queue import job_queue
+    job_queue.start_workers(lambda job: user.resume_download_job(bot, job))
     is_local_api = "telegram-bot-api" in os.getenv("TELEGRAM_API_URL", "")
 
     if is_local_api and WEBHOOK_INTERNAL_HOST:
@@ -207,6 +231,27 @@ async def on_shutdown(bot: Bot):
     await bot.delete_webhook()
     logging.info("Webhook deleted")
 
+    from services.job_queue import job_queue
+    await job_queue.shutdown()
+
+    from services.ytdlp_pool import ytdlp_pool
+    await ytdlp_pool.shutdown()
+
+    from services.remote_worker import remote_workers
+    await remote_workers.shutdown()
+
+    from services.aria2 import aria2
+    await aria2.shutdown()
+
+    from database.storage import stats
+    await stats.shutdown()
+
+    from services.http_client import http_client
+    await http_client.close()
+
+    from services.loop_monitor import loop_monitor
+    await loop_monitor.stop()
+
 async def zip_cleanup_worker():
     """Background worker to clean up expired ZIP files."""
     while True:
@@ -223,6 +268,13 @@ async def handle_zip_download_page(request):
     
     if not info:
         return web.Response(text="<h1>404 - Link expired or not found</h1><p>Files are stored for 24 hours only.</p>", content_type='text/html', status=404)
+
+    building = None
+    if info['building']:
+        try:
+            building = info['part_path'].stat().st_size / 1024 / 1024
+        except FileNotFoundError:
+            building = 0.0
     
     html = f"""
     <!DOCTYPE html>
@@ -243,27 +295,59 @@ async def handle_zip_download_page(request):
     </head>
     <body>
         <div class="card">
-            <h1>Ready to Download</h1>
-            <p>{info['name']}</p>
+            <h1>{'Ready to Download' if building is None else 'Preparing Download'}</h1>
+            <p>{info['name']}</p>{'' if building is None else f"<p>{building:.0f} MB added so far. The download starts now and finishes with the last track.</p>"}
             <a href="/dl/file/{secure_id}" class="btn">Download ZIP</a>
-            <div class="expiry">Link expires in 24 hours</div>
+            <div class="expiry">Link expires {time.strftime('%Y-%m-%d %H:%M UTC', time.gmtime(info['expiry']))}</div>
         </div>
     </body>
     </html>
     """
-    return web.Response(text=html, content_type='text/html')
+    # The page changes while the archive is being built
+    return web.Response(text=html, content_type='text/html', headers={'Cache-Control': 'private, no-cache'})
 
 async def handle_zip_file_serve(request):
-    """Directly serves the ZIP file."""
+    """Serves the ZIP file: streamed while it is still being built, otherwise via sendfile with Range."""
     secure_id = request.match_info.get('secure_id')
     info = zip_service.get_zip_info(secure_id)
-    
-    if not info or not info['path'].exists():
+    if not info:
         return web.Response(text="File not found", status=404)
-        
-    return web.FileResponse(info['path'], headers={
-        'Content-Disposition': f'attachment; filename="{info["name"]}"'
+
+    headers = {'Content-Disposition': f'attachment; filename="{info["name"]}"'}
+    if info['building']:
+        # Size is unknown until the last track is in: chunked, no Range, nothing to cache yet
+        response = web.StreamResponse(headers={**headers, 'Content-Type': 'application/zip', 'Cache-Control': 'no-store'})
+        await response.prepare(request)
+        try:
+            async for chunk in zip_service.stream_zip(info):
+                await response.write(chunk)
+        except (zip_service.ZipBuildFailed, OSError) as e:
+            logging.warning(f"ZIP {info['id']} stream aborted: {e}")
+            # Drop the connection so the client sees an incomplete download, not a truncated ZIP
+            if request.transport:
+                request.transport.close()
+            return response
+        await response.write_eof()
+        return response
+
+    try:
+        st = info['path'].stat()
+    except FileNotFoundError:
+        return web.Response(text="File not found", status=404)
+    # A finished archive never changes: validators plus a lifetime bounded by the link expiry
+    etag = f'"{st.st_mtime_ns:x}-{st.st_size:x}"'
+    headers.update({
+        'ETag': etag,
+        'Cache-Control': f"private, max-age={max(0, int(info['expiry'] - time.time()))}, immutable",
     })
+    if_none_match = request.headers.get('If-None-Match')
+    if if_none_match:
+        if if_none_match.strip() == '*' or etag in [tag.strip() for tag in if_none_match.split(',')]:
+            return web.Response(status=304, headers=headers)
+    elif request.if_modified_since and int(st.st_mtime) <= request.if_modified_since.timestamp():
+        return web.Response(status=304, headers=headers)
+    # Range / If-Range and Last-Modified are handled by FileResponse
+    return web.FileResponse(info['path'], headers=headers)
 
 async def handle_landing_page(request):
     """Beautiful landing page for bot.datapeice.me."""
@@ -0,0 +1,289 @@
+import asyncio
+import itertools
+import json
+import logging
+import secrets
+import shutil
+import time
+from collections import defaultdict
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import aiohttp
+
+from config import ARIA2_RPC_PORT, ARIA2_RPC_SECRET, TORRENT_MAX_OVERALL_DOWNLOAD_LIMIT, DATA_DIR
+from services.http_client import http_client
+
+# Swarm state that outlives the daemon: DHT routing table and tracker health (data/ is a volume)
+STATE_DIR = DATA_DIR / "aria2"
+
+# Options every download inherits; one process means one DHT node and peer table for all torrents
+DAEMON_OPTIONS = {
+    'seed-time': '0',
+    'file-allocation': 'none',
+    'enable-dht': 'true',
+    # Only used while the routing table is empty; aria2 has no bootstrap node of its own
+    'dht-entry-point': 'dht.transmissionbt.com:6881',
+    'bt-enable-lpd': 'true',
+    'enable-peer-exchange': 'true',  # PEX helps find peers without tracker
+    'bt-max-peers': '120',
+    'listen-port': '16881-16890',
+    'dht-listen-port': '16881-16890',
+    'bt-tracker-timeout': '30',
+    'bt-tracker-interval': '60',
+    'user-agent': 'Transmission/3.00',  # Some trackers block aria2c
+    'peer-id-prefix': '-TR3000-',       # Impersonate Transmission
+    # Concurrency is the scheduler's job; aria2 must not queue torrents behind each other
+    'max-concurrent-downloads': '64',
+    'max-download-result': '200',
+    # Files are handed off as soon as getFiles reports them complete, so nothing may sit in a write cache
+    'disk-cache': '0',
+}
+START_TIMEOUT = 10.0
+RPC_TIMEOUT = 30.0
+# aria2 needs several seconds to stop and writes dht.dat on the way out; killing it loses the table
+SHUTDOWN_TIMEOUT = 15.0
+
+
+class Aria2Error(Exception):
+    pass
+
+
+class Aria2Daemon:
+    """One long-running aria2c shared by all torrents, driven over JSON-RPC on localhost.
+
+    The process is started on first use (or warmed by start()) and restarted if it
+    dies. Its DHT routing table lives in state_dir/dht.dat: aria2 loads it on start
+    and saves it every 30 minutes and on shutdown, so a restart rejoins the DHT
+    through known nodes instead of bootstrapping from scratch. Calls go over HTTP through the shared aiohttp pool; a websocket listener
+    turns aria2's notifications (onDownloadComplete, onBtDownloadComplete,
+    onDownloadError, ...) into per-gid wake-ups, so waiters react to completion
+    immediately instead of at their next poll.
+    """
+
+    def __init__(self, port: int, secret: str, overall_limit: str, state_dir: Path):
+        self.port = port
+        self.state_dir = state_dir
+        # The daemon is ours alone, so a per-process token is enough unless one is configured
+        self.secret = secret or secrets.token_hex(16)
+        self.overall_limit = overall_limit or '0'
+        self._process: Optional[asyncio.subprocess.Process] = None
+        self._listener: Optional[asyncio.Task] = None
+        self._warmup: Optional[asyncio.Task] = None
+        self._lock = asyncio.Lock()
+        self._ids = itertools.count(1)
+        self._changed: Dict[str, asyncio.Event] = {}
+        self.version = ''
+        self.starts = 0
+        self.calls = 0
+        self.errors = 0
+        self.events: Dict[str, int] = defaultdict(int)
+        self.started_at = 0.0
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.port}/jsonrpc"
+
+    @property
+    def dht_file(self) -> Path:
+        return self.state_dir / "dht.dat"
+
+    @property
+    def running(self) -> bool:
+        return self._process is not None and self._process.returncode is None
+
+    def start(self) -> None:
+        """Warms the daemon in the background so the first torrent finds DHT already bootstrapped."""
+        if shutil.which("aria2c") and (self._warmup is None or self._warmup.done()):
+            self._warmup = asyncio.create_task(self._warm())
+
+    async def _warm(self) -> None:
+        try:
+            await self.ensure_started()
+        except Exception as e:
+            logging.warning(f"[ARIA2] Daemon warm-up failed: {e}")
+
+    async def ensure_started(self) -> None:
+        if self.running:
+            return
+        async with self._lock:
+            if self.running:
+                return
+            if self._process is not None:
+                logging.warning(f"[ARIA2] Daemon exited with code {self._process.returncode}, restarting")
+            self.state_dir.mkdir(parents=True, exist_ok=True)
+            cmd = [
+                "aria2c", "--enable-rpc", "--rpc-listen-all=false",
+                f"--rpc-listen-port={self.port}", f"--rpc-secret={self.secret}",
+                f"--max-overall-download-limit={self.overall_limit}",
+                f"--dht-file-path={self.dht_file}",
+                "--quiet=true", "--console-log-level=warn",
+                *[f"--{key}={value}" for key, value in DAEMON_OPTIONS.items()],
+            ]
+            try:
+                self._process = await asyncio.create_subprocess_exec(
+                    *cmd, stdin=asyncio.subprocess.DEVNULL, stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.DEVNULL
+                )
+            except FileNotFoundError:
+                raise Aria2Error("aria2c is not installed on the system.")
+
+            deadline = time.monotonic() + START_TIMEOUT
+            while True:
+                try:
+                    self.version = (await self._rpc('getVersion')).get('version', '')
+                    break
+                except (aiohttp.ClientError, OSError, asyncio.TimeoutError):
+                    if self._process.returncode is not None or time.monotonic() > deadline:
+                        await self._kill()
+                        raise Aria2Error(f"aria2c RPC did not come up on port {self.port}")
+                    await asyncio.sleep(0.2)
+
+            self.starts += 1
+            self.started_at = time.time()
+            if self._listener is None or self._listener.done():
+                self._listener = asyncio.create_task(self._listen())
+            logging.info(f"[ARIA2] ✅ Daemon {self.version} running (pid {self._process.pid}, RPC port {self.port})")
+
+    async def _rpc(self, method: str, *params):
+        payload = {
+            'jsonrpc': '2.0',
+            'id': str(next(self._ids)),
+            'method': f"aria2.{method}",
+            'params': [f"token:{self.secret}", *params],
+        }
+        async with http_client.session().post(self.url, json=payload,
+                                              timeout=aiohttp.ClientTimeout(total=RPC_TIMEOUT)) as resp:
+            data = await resp.json(content_type=None)
+        if data.get('error'):
+            raise Aria2Error(data['error'].get('message') or str(data['error']))
+        return data.get('result')
+
+    async def call(self, method: str, *params):
+        """aria2.<method>(*params); starts the daemon if needed. Raises Aria2Error."""
+        await self.ensure_started()
+        self.calls += 1
+        try:
+            return await self._rpc(method, *params)
+        except Aria2Error:
+            self.errors += 1
+            raise
+        except (aiohttp.ClientError, OSError, asyncio.TimeoutError) as e:
+            self.errors += 1
+            raise Aria2Error(f"aria2 RPC {method} failed: {e}")
+
+    async def _listen(self) -> None:
+        ws_url = f"ws://127.0.0.1:{self.port}/jsonrpc"
+        while self.running:
+            try:
+                async with http_client.session().ws_connect(ws_url, heartbeat=30) as ws:
+                    async for msg in ws:
+                        if msg.type != aiohttp.WSMsgType.TEXT:
+                            continue
+                        data = json.loads(msg.data)
+                        method = data.get('method') or ''
+                        if not method.startswith('aria2.on'):
+                            continue
+                        self.events[method[len('aria2.'):]] += 1
+                        for param in data.get('params') or []:
+                            event = self._changed.get(param.get('gid'))
+                            if event is not None:
+                                event.set()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.debug(f"[ARIA2] Notification socket dropped: {e}")
+            await asyncio.sleep(1)
+
+    async def wait_change(self, gid: str, timeout: float) -> bool:
+        """Sleeps up to timeout; returns early (True) when aria2 reports an event for gid."""
+        event = self._changed.setdefault(gid, asyncio.Event())
+        try:
+            await asyncio.wait_for(event.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            event.clear()
+
+    def forget(self, gid: str) -> None:
+        self._changed.pop(gid, None)
+
+    async def status(self, gid: str, keys: Optional[List[str]] = None) -> Dict:
+        return await self.call('tellStatus', gid, keys) if keys else await self.call('tellStatus', gid)
+
+    async def pause(self, gid: str) -> None:
+        await self.call('pause', gid)
+
+    async def resume(self, gid: str) -> None:
+        await self.call('unpause', gid)
+
+    async def set_limit(self, gid: str, limit: str) -> None:
+        """Per-download cap, e.g. '2M'; '0' removes it."""
+        await self.call('changeOption', gid, {'max-download-limit': limit})
+
+    async def set_overall_limit(self, limit: str) -> None:
+        await self.call('changeGlobalOption', {'max-overall-download-limit': limit})
+        self.overall_limit = limit
+
+    async def remove(self, gid: str) -> None:
+        """Stops the download if it is still running and drops its result; never raises."""
+        self.forget(gid)
+        if not self.running:
+            return
+        try:
+            await self.call('forceRemove', gid)
+            # forceRemove only schedules the stop; wait until aria2 has let go of the files
+            for _ in range(50):
+                if (await self.status(gid, ['status'])).get('status') != 'active':
+                    break
+                await asyncio.sleep(0.1)
+        except Aria2Error:
+            pass  # Already finished
+        try:
+            await self.call('removeDownloadResult', gid)
+        except Aria2Error:
+            pass
+
+    async def _kill(self) -> None:
+        if self._process is not None and self._process.returncode is None:
+            self._process.kill()
+            await self._process.wait()
+
+    async def shutdown(self) -> None:
+        for task in (self._warmup, self._listener):
+            if task is not None and not task.done():
+                task.cancel()
+                try:
+                    await task
+                except (asyncio.CancelledError, Exception):
+                    pass
+        self._listener = None
+        if not self.running:
+            return
+        try:
+            await self._rpc('forceShutdown')
+            await asyncio.wait_for(self._process.wait(), timeout=SHUTDOWN_TIMEOUT)
+        except Exception:
+            await self._kill()
+        logging.info("[ARIA2] Daemon stopped")
+
+    def get_stats(self) -> dict:
+        try:
+            dht_saved = self.dht_file.stat().st_mtime
+        except OSError:
+            dht_saved = 0.0
+        return {
+            'running': self.running,
+            'version': self.version,
+            'pid': self._process.pid if self.running else None,
+            'starts': self.starts,
+            'uptime': time.time() - self.started_at if self.running else 0.0,
+            'calls': self.calls,
+            'errors': self.errors,
+            'events': dict(self.events),
+            'overall_limit': self.overall_limit,
+            'dht_saved': dht_saved,
+        }
+
+
+aria2 = Aria2Daemon(ARIA2_RPC_PORT, ARIA2_RPC_SECRET, TORRENT_MAX_OVERALL_DOWNLOAD_LIMIT, STATE_DIR)
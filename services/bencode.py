@@ -0,0 +1,103 @@
+import hashlib
+from typing import Dict, List, Optional, Tuple, Union
+
+Value = Union[int, bytes, List["Value"], Dict[bytes, "Value"]]
+
+# Deeper nesting than any real .torrent; stops crafted files from exhausting the stack
+MAX_DEPTH = 64
+
+
+class BencodeError(ValueError):
+    pass
+
+
+def _decode(data: bytes, i: int, depth: int) -> Tuple[Value, int]:
+    if depth > MAX_DEPTH:
+        raise BencodeError("nesting too deep")
+    try:
+        c = data[i]
+    except IndexError:
+        raise BencodeError("unexpected end of data")
+
+    if c == 0x69:  # i<digits>e
+        end = data.index(b'e', i)
+        try:
+            return int(data[i + 1:end]), end + 1
+        except ValueError:
+            raise BencodeError(f"bad integer at {i}")
+    if c == 0x6c:  # l<items>e
+        i += 1
+        items = []
+        while data[i:i + 1] != b'e':
+            item, i = _decode(data, i, depth + 1)
+            items.append(item)
+        return items, i + 1
+    if c == 0x64:  # d<key><value>...e
+        i += 1
+        result = {}
+        while data[i:i + 1] != b'e':
+            key, i = _decode(data, i, depth + 1)
+            if not isinstance(key, bytes):
+                raise BencodeError(f"non-string key at {i}")
+            result[key], i = _decode(data, i, depth + 1)
+        return result, i + 1
+    if 0x30 <= c <= 0x39:  # <length>:<bytes>
+        colon = data.find(b':', i)
+        if colon < 0:
+            raise BencodeError(f"bad string at {i}")
+        try:
+            length = int(data[i:colon])
+        except ValueError:
+            raise BencodeError(f"bad string length at {i}")
+        start = colon + 1
+        if start + length > len(data):
+            raise BencodeError("string runs past the end of data")
+        return data[start:start + length], start + length
+    raise BencodeError(f"unexpected byte {c:#x} at {i}")
+
+
+def decode(data: bytes) -> Value:
+    """Decodes a bencoded value; strings stay bytes. Raises BencodeError."""
+    try:
+        value, end = _decode(data, 0, 0)
+    except BencodeError:
+        raise
+    except ValueError:  # bytes.index found no terminator
+        raise BencodeError("unterminated integer")
+    if data[end:].strip():
+        raise BencodeError(f"trailing data at {end}")
+    return value
+
+
+def encode(value: Value) -> bytes:
+    if isinstance(value, bool):
+        value = int(value)
+    if isinstance(value, int):
+        return b'i%de' % value
+    if isinstance(value, str):
+        value = value.encode()
+    if isinstance(value, bytes):
+        return b'%d:%s' % (len(value), value)
+    if isinstance(value, list):
+        return b'l' + b''.join(encode(v) for v in value) + b'e'
+    if isinstance(value, dict):
+        items = sorted((k.encode() if isinstance(k, str) else k, v) for k, v in value.items())
+        return b'd' + b''.join(encode(k) + encode(v) for k, v in items) + b'e'
+    raise BencodeError(f"cannot encode {type(value).__name__}")
+
+
+def info_hash(data: bytes) -> Optional[str]:
+    """Hex SHA-1 of the `info` dictionary exactly as stored (BitTorrent v1 infohash)."""
+    if data[:1] != b'd':
+        return None
+    try:
+        i = 1
+        while data[i:i + 1] != b'e':
+            key, i = _decode(data, i, 1)
+            start = i
+            _, i = _decode(data, i, 1)
+            if key == b'info':
+                return hashlib.sha1(data[start:i]).hexdigest()
+    except ValueError:
+        return None
+    return None
@@ -0,0 +1,176 @@
+import logging
+import random
+import time
+from collections import deque
+from typing import Deque, Dict, List, Tuple
+
+from config import (
+    BREAKER_FAILURE_THRESHOLD,
+    BREAKER_COOLDOWN_SECONDS,
+    BREAKER_MAX_COOLDOWN_SECONDS,
+    BREAKER_WINDOW,
+    BREAKER_HORIZON_SECONDS,
+    BREAKER_EXPLORE_RATE,
+)
+
+CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+# Pseudo-observations that pull a method's success estimate towards PRIOR until it has history,
+# so the hard-coded order is kept for methods we know little about
+PRIOR = 0.5
+PRIOR_WEIGHT = 4
+
+
+class _MethodState:
+    def __init__(self, window: int, horizon: float):
+        self.outcomes: Deque[Tuple[bool, float, float]] = deque(maxlen=window)
+        self.horizon = horizon
+        self.state = CLOSED
+        self.consecutive_failures = 0
+        self.cooldown = 0.0
+        self.opened_at = 0.0
+        self.probing = False
+        self.trips = 0
+
+    def recent(self) -> List[Tuple[bool, float, float]]:
+        cutoff = time.monotonic() - self.horizon
+        return [o for o in self.outcomes if o[2] >= cutoff]
+
+    @property
+    def success_rate(self) -> float:
+        recent = self.recent()
+        successes = sum(1 for ok, _, _ in recent if ok)
+        return (successes + PRIOR * PRIOR_WEIGHT) / (len(recent) + PRIOR_WEIGHT)
+
+    @property
+    def avg_latency(self) -> float:
+        latencies = [latency for ok, latency, _ in self.recent() if ok]
+        return sum(latencies) / len(latencies) if latencies else 0.0
+
+
+class MethodHealth:
+    """Rolling success-rate / latency tracker and circuit breaker per (platform, method).
+
+    A method trips open after `failure_threshold` consecutive failures and is skipped
+    for a cooldown that doubles on every failed probe (up to max_cooldown). After the
+    cooldown one request is let through as a half-open probe: success closes the
+    breaker, failure re-opens it. order() sorts the fallback chain by estimated
+    success rate over the last `horizon` seconds, then by latency. A share of requests
+    (explore_rate) keeps the configured order so demoted methods get a chance to
+    show they work again.
+    """
+
+    def __init__(self, failure_threshold: int, cooldown: float, max_cooldown: float, window: int,
+                 horizon: float = 1800, explore_rate: float = 0.1):
+        self.failure_threshold = max(1, failure_threshold)
+        self.base_cooldown = max(1.0, cooldown)
+        self.max_cooldown = max(self.base_cooldown, max_cooldown)
+        self.window = max(1, window)
+        self.horizon = max(1.0, horizon)
+        self.explore_rate = min(max(explore_rate, 0.0), 1.0)
+        self._methods: Dict[Tuple[str, str], _MethodState] = {}
+        self.skipped = 0
+
+    def _get(self, platform: str, method: str) -> _MethodState:
+        key = (platform, method)
+        if key not in self._methods:
+            self._methods[key] = _MethodState(self.window, self.horizon)
+        return self._methods[key]
+
+    def allow(self, platform: str, method: str) -> bool:
+        state = self._get(platform, method)
+        if state.state == CLOSED:
+            return True
+        if state.state == OPEN and time.monotonic() - state.opened_at >= state.cooldown:
+            state.state = HALF_OPEN
+            state.probing = False
+            logging.info(f"[BREAKER] {platform}/{method} half-open, probing")
+        if state.state == HALF_OPEN and not state.probing:
+            state.probing = True
+            return True
+        return False
+
+    def record(self, platform: str, method: str, ok: bool, latency: float) -> None:
+        state = self._get(platform, method)
+        state.outcomes.append((ok, latency, time.monotonic()))
+        if ok:
+            if state.state != CLOSED:
+                logging.info(f"[BREAKER] ✅ {platform}/{method} recovered, closing breaker")
+            state.state = CLOSED
+            state.consecutive_failures = 0
+            state.cooldown = 0.0
+            state.probing = False
+            return
+
+        state.consecutive_failures += 1
+        if state.state == HALF_OPEN:
+            self._trip(platform, method, state, min(self.max_cooldown, state.cooldown * 2))
+        elif state.state == CLOSED and state.consecutive_failures >= self.failure_threshold:
+            self._trip(platform, method, state, self.base_cooldown)
+
+    def release_probe(self, platform: str, method: str) -> None:
+        """A probe that was cancelled (lost a hedged race) gives its probe slot back."""
+        state = self._get(platform, method)
+        if state.state == HALF_OPEN:
+            state.probing = False
+
+    def _trip(self, platform: str, method: str, state: _MethodState, cooldown: float) -> None:
+        state.state = OPEN
+        state.opened_at = time.monotonic()
+        state.cooldown = cooldown
+        state.probing = False
+        state.trips += 1
+        logging.warning(f"[BREAKER] ⛔ {platform}/{method} opened after {state.consecutive_failures} failures, skipping for {cooldown:.0f}s")
+
+    def order(self, platform: str, attempts: List) -> List:
+        """Drops methods with an open breaker and sorts the rest, most likely to succeed first.
+
+        attempts is a list of (method_name, factory); half-open probes run first and ties
+        keep their original order.
+        If every breaker is open the original chain is returned unchanged.
+        """
+        ranked = []
+        for index, attempt in enumerate(attempts):
+            if not self.allow(platform, attempt[0]):
+                self.skipped += 1
+                continue
+            state = self._get(platform, attempt[0])
+            # A half-open probe goes first - trying it is the only way to close the breaker
+            probe = 0 if state.state == HALF_OPEN else 1
+            ranked.append((probe, -round(state.success_rate, 2), state.avg_latency or float('inf'), index, attempt))
+        if not ranked:
+            return list(attempts)
+        if random.random() < self.explore_rate:
+            ranked.sort(key=lambda r: (r[0], r[3]))
+        else:
+            ranked.sort(key=lambda r: r[:4])
+        return [r[4] for r in ranked]
+
+    def get_stats(self) -> dict:
+        methods = []
+        for (platform, method), state in sorted(self._methods.items()):
+            recent = state.recent()
+            if not recent and state.state == CLOSED:
+                continue
+            remaining = max(0.0, state.cooldown - (time.monotonic() - state.opened_at)) if state.state == OPEN else 0.0
+            methods.append({
+                'platform': platform,
+                'method': method,
+                'state': state.state,
+                'samples': len(recent),
+                'success_rate': sum(1 for ok, _, _ in recent if ok) / len(recent) if recent else 0.0,
+                'avg_latency': state.avg_latency,
+                'trips': state.trips,
+                'retry_in': remaining,
+            })
+        return {'methods': methods, 'skipped': self.skipped}
+
+
+method_health = MethodHealth(
+    failure_threshold=BREAKER_FAILURE_THRESHOLD,
+    cooldown=BREAKER_COOLDOWN_SECONDS,
+    max_cooldown=BREAKER_MAX_COOLDOWN_SECONDS,
+    window=BREAKER_WINDOW,
+    horizon=BREAKER_HORIZON_SECONDS,
+    explore_rate=BREAKER_EXPLORE_RATE,
+)
@@ -1,9 +1,11 @@
+import asyncio
 import logging
 import aiohttp
 from urllib.parse import urlparse
 from pathlib import Path
 from typing import Optional, Dict, List, Tuple, Callable
 from config import COBALT_API_URL, COBALT_API_KEY, HTTP_PROXY, HTTPS_PROXY, DOWNLOADS_DIR
+from services.http_client import http_client
 
 
 class CobaltClient:
@@ -42,40 +44,39 @@ class CobaltClient:
         if self.api_key:
             headers["Authorization"] = f"Api-Key {self.api_key}"
         
-        # Создаем connector с поддержкой прокси
-        connector = aiohttp.TCPConnector(ssl=False)
         timeout = aiohttp.ClientTimeout(total=300)  # 5 минут для больших файлов
+        session = http_client.session()
         
         try:
-            async with aiohttp.ClientSession(
-                connector=connector, 
-                timeout=timeout
-            ) as session:
-                if method == "POST":
-                    async with session.post(
-                        url, 
-                        json=json_data, 
-                        headers=headers,
-                        proxy=self.proxy  # Прокси только для Cobalt запросов
-                    ) as response:
-                        if response.status == 200:
-                            return await response.json()
-                        else:
-                            error_text = await response.text()
-                            logging.error(f"Cobalt API error {response.status}: {error_text}")
-                            raise Exception(f"Cobalt API returned {response.status}: {error_text}")
-                else:
-                    async with session.get(
-                        url, 
-                        headers=headers,
-                        proxy=self.proxy
-                    ) as response:
-                        if response.status == 200:
-                            return await response.json()
-                        else:
-                            error_text = await response.text()
-                            logging.error(f"Cobalt API error {response.status}: {error_text}")
-                            raise Exception(f"Cobalt API returned {response.status}")
+            if method == "POST":
+                async with session.post(
+                    url, 
+                    json=json_data, 
+                    headers=headers,
+                    proxy=self.proxy,  # Прокси только для Cobalt запросов
+                    ssl=False,
+                    timeout=timeout
+                ) as response:
+                    if response.status == 200:
+                        return await response.json()
+                    else:
+                        error_text = await response.text()
+                        logging.error(f"Cobalt API error {response.status}: {error_text}")
+                        raise Exception(f"Cobalt API returned {response.status}: {error_text}")
+            else:
+                async with session.get(
+                    url, 
+                    headers=headers,
+                    proxy=self.proxy,
+                    ssl=False,
+                    timeout=timeout
+                ) as response:
+                    if response.status == 200:
+                        return await response.json()
+                    else:
+                        error_text = await response.text()
+                        logging.error(f"Cobalt API error {response.status}: {error_text}")
+                        raise Exception(f"Cobalt API returned {response.status}")
         except Exception as e:
             logging.error(f"Request to Cobalt failed: {str(e)}")
             raise
@@ -188,33 +189,29 @@ class CobaltClient:
         
         logging.info(f"Downloading file from: {file_url}")
         
-        connector = aiohttp.TCPConnector(ssl=False)
         timeout = aiohttp.ClientTimeout(total=600)  # 10 минут
         
         try:
-            async with aiohttp.ClientSession(
-                connector=connector, 
-                timeout=timeout
-            ) as session:
-                async with session.get(file_url, proxy=self.proxy) as response:
-                    if response.status != 200:
-                        raise Exception(f"Failed to download file: HTTP {response.status}")
-                    
-                    # Получаем размер файла для прогресса
-                    total_size = int(response.headers.get('content-length', 0))
-                    downloaded = 0
-                    
-                    # Скачиваем файл chunked с прогрессом
-                    with open(file_path, 'wb') as f:
-                        async for chunk in response.content.iter_chunked(8192):
-                            f.write(chunk)
-                            downloaded += len(chunk)
-                            
-                            if progress_callback and total_size > 0:
-                                percent = int(downloaded * 100 / total_size)
-                                if percent % 5 == 0:  # Update every 5%
-                                    await progress_callback(f"{percent}%")
-            
+            session = http_client.session()
+            async with session.get(file_url, proxy=self.proxy, ssl=False, timeout=timeout) as response:
+                if response.status != 200:
+                    raise Exception(f"Failed to download file: HTTP {response.status}")
+                
+                # Получаем размер файла для прогресса
+                total_size = int(response.headers.get('content-length', 0))
+                downloaded = 0
+                
+                # Скачиваем файл chunked с прогрессом
+                with open(file_path, 'wb') as f:
+                    async for chunk in response.content.iter_chunked(8192):
+                        f.write(chunk)
+                        downloaded += len(chunk)
+                        
+                        if progress_callback and total_size > 0:
+                            percent = int(downloaded * 100 / total_size)
+                            if percent % 5 == 0:  # Update every 5%
+                                await progress_callback(f"{percent}%")
+        
             if not file_path.exists() or file_path.stat().st_size == 0:
                 raise Exception("Downloaded file is empty or doesn't exist")
             
@@ -244,7 +241,6 @@ class CobaltClient:
             # Обогащаем метаданные через tikwm для TikTok
             if original_url and 'tiktok.com' in original_url:
                 from services.tiktok_scraper import fetch_tiktok_metadata
-                import asyncio
                 try:
                     tikwm = await asyncio.to_thread(fetch_tiktok_metadata, original_url)
                     if tikwm:
@@ -263,6 +259,9 @@ class CobaltClient:
 
             return file_path, None, result_metadata
         
+        except asyncio.CancelledError:
+            file_path.unlink(missing_ok=True)
+            raise
         except Exception as e:
             if file_path.exists():
                 file_path.unlink()
@@ -9,15 +9,26 @@ import random
 import aiohttp
 import requests
 import concurrent.futures
-import subprocess
+from collections import deque
 from pathlib import Path
 from typing import Tuple, Dict, Optional, Callable, Union, List
+from urllib.parse import urlparse, parse_qs, parse_qsl, urlencode
 
-from config import DOWNLOADS_DIR, DATA_DIR, COOKIES_CONTENT, USE_COBALT, COBALT_API_URL, SOCKS_PROXY
+from config import DOWNLOADS_DIR, DATA_DIR, COOKIES_CONTENT, USE_COBALT, COBALT_API_URL, SOCKS_PROXY, PLAYLIST_CONCURRENCY
 from database.storage import stats
 from database.models import Cookie
 from services.tiktok_scraper import download_tiktok_images, fetch_tiktok_metadata
 from services.ai_extractor_agent import get_plugin_dirs, run_ai_extractor_autofix, should_attempt_ai_autofix
+from services.single_flight import SingleFlight
+from services.ytdlp_pool import extract_info as ytdlp_extract_info, duration_filter
+from services.remote_worker import remote_workers
+from services.hedging import fallback_chain, ChainExhausted, race, discard_result
+from services.http_client import http_client
+from services.media_probe import media_probe
+from services.thumbnails import thumbnail_service
+from services.transcoder import transcoder
+from services.preflight import preflight, TELEGRAM_MAX_BYTES
+from services.scheduler import download_scheduler
 
 USER_AGENTS = [
     'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
@@ -31,93 +42,6 @@ USER_AGENTS = [
     'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/138.0.0.0 Safari/537.36 Edg/138.0.0.0',
 ]
 
-def generate_video_thumbnail(video_path: Path, output_path: Path) -> bool:
-    """Generate a high-quality thumbnail from video using ffmpeg."""
-    try:
-        logging.info(f"Generating thumbnail for {video_path.name}")
-        # Take a frame from 1 second in to avoid black start
-        cmd = [
-            "ffmpeg", "-y",
-            "-ss", "00:00:01",
-            "-i", str(video_path),
-            "-vframes", "1",
-            "-vf", "format=yuv420p,scale=w=320:h=320:force_original_aspect_ratio=decrease",
-            "-q:v", "2",
-            str(output_path)
-        ]
-        result = subprocess.run(cmd, capture_output=True, text=True, timeout=30)
-        if result.returncode != 0:
-            logging.warning(f"ffmpeg thumbnail generation failed: {result.stderr}")
-            return False
-        return True
-    except Exception as e:
-        logging.error(f"Error generating thumbnail: {e}")
-        return False
-
-    return 0, 0
-
-def probe_video_dimensions(video_path: Path) -> Tuple[int, int]:
-    """Probe video dimensions using ffprobe."""
-    try:
-        cmd = [
-            "ffprobe", "-v", "error",
-            "-select_streams", "v:0",
-            "-show_entries", "stream=width,height",
-            "-of", "csv=s=x:p=0",
-            str(video_path)
-        ]
-        result = subprocess.run(cmd, capture_output=True, text=True, timeout=10)
-        if result.returncode == 0:
-            dims = result.stdout.strip().split('x')
-            if len(dims) == 2:
-                return int(dims[0]), int(dims[1])
-    except Exception:
-        pass
-    return 0, 0
-
-def probe_video_codec(video_path: Path) -> str:
-    """Probe video codec using ffprobe."""
-    try:
-        cmd = [
-            "ffprobe", "-v", "error",
-            "-select_streams", "v:0",
-            "-show_entries", "stream=codec_name",
-            "-of", "default=noprint_wrappers=1:nokey=1",
-            str(video_path)
-        ]
-        result = subprocess.run(cmd, capture_output=True, text=True, timeout=10)
-        if result.returncode == 0:
-            return result.stdout.strip().lower()
-    except Exception:
-        pass
-    return ""
-
-def convert_video_to_h264(input_path: Path) -> Path:
-    """Convert video to H.264 using ffmpeg with fast settings."""
-    output_path = input_path.parent / f"{input_path.stem}_h264.mp4"
-    try:
-        logging.info(f"Transcoding {input_path.name} to H.264 (iPhone compatibility)")
-        cmd = [
-            "ffmpeg", "-y",
-            "-i", str(input_path),
-            "-c:v", "libx264",
-            "-preset", "ultrafast",  # Minimal CPU usage (high speed)
-            "-crf", "23",            # Standard quality
-            "-c:a", "copy",          # Keep audio as is
-            "-movflags", "+faststart",
-            str(output_path)
-        ]
-        result = subprocess.run(cmd, capture_output=True, text=True, timeout=300)
-        if result.returncode == 0 and output_path.exists():
-            input_path.unlink()  # Delete original VP9 file
-            return output_path
-    except Exception as e:
-        logging.error(f"Failed to transcode video: {e}")
-    
-    if output_path.exists():
-        output_path.unlink()
-    return input_path  # Return original if failed
-
 # TLS fingerprints для curl-cffi (имитация браузеров)
 # Список реально доступных targets в curl_cffi 0.5.10 (формат из --list-impersonate-targets)
 IMPERSONATE_TARGETS = [
@@ -229,6 +153,8 @@ def get_cookies_content() -> str:
             
     return content
 
+download_flights = SingleFlight("SINGLE-FLIGHT")
+
 # Инициализируем куки при старте модуля
 get_cookies_content()
 
@@ -303,6 +229,58 @@ def is_playlist(url: str) -> bool:
         return True
     return False
 
+# Share/analytics parameters that never select a different video; everything else in
+# the query (facebook ?v=, vk ?z=, story_fbid, ...) is part of the identity and is kept
+TRACKING_PARAMS = {
+    'si', 's', 't', 'igsh', 'igshid', 'fbclid', 'gclid', 'yclid', 'mibextid', 'ref', 'ref_src',
+    'ref_url', 'feature', 'share_id', 'share_app_id', 'sender_device', 'is_from_webapp',
+    'is_copy_url', 'rdt', 'context', '_t', '_r', '__tn__',
+}
+
+def _is_tracking_param(name: str) -> bool:
+    name = name.lower()
+    return name in TRACKING_PARAMS or name.startswith(('utm_', 'share_', '__cft__'))
+
+def canonicalize_url(url: str) -> str:
+    """Cheap, offline URL normalization used as a cache/dedup key (no redirects are followed)."""
+    url = url.strip().rstrip('\\/')
+    if "threads.com" in url:
+        url = url.replace("threads.com", "threads.net")
+
+    parsed = urlparse(url)
+    if not parsed.scheme or not parsed.netloc:
+        return url
+
+    host = parsed.netloc.lower()
+    for prefix in ("www.", "m."):
+        if host.startswith(prefix):
+            host = host[len(prefix):]
+
+    platform = get_platform(url)
+    if platform == "youtube":
+        video_id = None
+        if host == "youtu.be":
+            video_id = parsed.path.strip('/').split('/')[0]
+        elif parsed.path.startswith(("/shorts/", "/live/", "/embed/")):
+            video_id = parsed.path.split('/')[2]
+        else:
+            video_id = (parse_qs(parsed.query).get('v') or [None])[0]
+        if video_id and not is_playlist(url):
+            domain = "music.youtube.com" if host == "music.youtube.com" else "youtube.com"
+            return f"https://{domain}/watch?v={video_id}"
+        return f"https://{host}{parsed.path}?{parsed.query}" if parsed.query else f"https://{host}{parsed.path}"
+
+    if platform == "pornhub" and parsed.query:
+        viewkey = (parse_qs(parsed.query).get('viewkey') or [None])[0]
+        if viewkey:
+            return f"https://{host}{parsed.path}?viewkey={viewkey}"
+
+    path = parsed.path.rstrip('/')
+    params = sorted((k, v) for k, v in parse_qsl(parsed.query, keep_blank_values=True) if not _is_tracking_param(k))
+    if params:
+        return f"https://{host}{path}?{urlencode(params)}"
+    return f"https://{host}{path}"
+
 def unshorten_reddit_url(url: str, proxy_url: Optional[str]) -> str:
     if "/comments/" in url:
         return url
@@ -317,10 +295,10 @@ def unshorten_reddit_url(url: str, proxy_url: Optional[str]) -> str:
     headers = {"User-Agent": USER_AGENTS[0]}
 
     try:
-        response = requests.head(url, proxies=proxies, headers=headers, allow_redirects=True, timeout=10)
+        response = http_client.sync_session().head(url, proxies=proxies, headers=headers, allow_redirects=True, timeout=10)
         final_url = response.url
         if final_url and ("/s/" in final_url):
-            response = requests.get(url, proxies=proxies, headers=headers, allow_redirects=True, timeout=10)
+            response = http_client.sync_session().get(url, proxies=proxies, headers=headers, allow_redirects=True, timeout=10)
             final_url = response.url
         if final_url and "?" in final_url:
             final_url = final_url.split("?")[0]
@@ -368,220 +346,383 @@ def resolve_facebook_share_url(url: str) -> str:
     return url
 
 
-def _download_reddit_direct(url: str, proxy_url: Optional[str] = None) -> Optional[Union[Path, List[Path]]]:
+# Streaming downloads: no total limit, but give up on stalled connections
+STREAM_TIMEOUT = aiohttp.ClientTimeout(total=None, sock_connect=30, sock_read=60)
+
+REDDIT_AUDIO_NAMES = ('DASH_AUDIO_128.mp4', 'DASH_audio.mp4', 'DASH_AUDIO_64.mp4')
+
+FACEBOOK_VIDEO_PATTERNS = [
+    r'"browser_native_hd_url"\s*:\s*"([^"]+)"',
+    r'"browser_native_sd_url"\s*:\s*"([^"]+)"',
+    r'"playable_url_quality_hd"\s*:\s*"([^"]+)"',
+    r'"playable_url"\s*:\s*"([^"]+)"',
+    r'"playable_url_quality_standard"\s*:\s*"([^"]+)"',
+    r'"hd_src_no_ratelimit"\s*:\s*"([^"]+)"',
+    r'"sd_src_no_ratelimit"\s*:\s*"([^"]+)"',
+    r'hd_src\s*:\s*"([^"]+\.mp4[^"]*?)"',
+    r'sd_src\s*:\s*"([^"]+\.mp4[^"]*?)"',
+    r'"video_url"\s*:\s*"([^"]+)"',
+    r'"scrubber_video_url"\s*:\s*"([^"]+)"',
+    r'\[\{"url"\s*:\s*"([^"]+\.mp4[^"]*?)"',  # Common in GraphQL arrays
+]
+
+
+def _http_route(proxy_url: Optional[str]) -> Tuple[aiohttp.ClientSession, Optional[str]]:
+    """Shared session and per-request proxy for a route (proxy_url=None means direct)."""
+    if proxy_url and proxy_url.lower().startswith('socks'):
+        return http_client.session(proxy_url), None
+    return http_client.session(), proxy_url or None
+
+
+def _close_response(response: Optional[aiohttp.ClientResponse]) -> None:
+    if response is not None:
+        response.close()
+
+
+async def _open_stream(session: aiohttp.ClientSession, url: str, headers: Dict, proxy: Optional[str] = None) -> Optional[aiohttp.ClientResponse]:
+    """GETs url and returns the open response if it is a 200, otherwise None."""
+    response = await session.get(url, headers=headers, proxy=proxy, timeout=STREAM_TIMEOUT)
+    if response.status != 200:
+        logging.debug(f"HTTP {response.status} for {url[:100]}")
+        response.release()
+        return None
+    return response
+
+
+async def _stream_to_file(response: aiohttp.ClientResponse, path: Path) -> int:
+    """Writes the response body to path; a failed or cancelled transfer leaves no file behind."""
+    written = 0
+    try:
+        with open(path, 'wb') as f:
+            async for chunk in response.content.iter_chunked(65536):
+                f.write(chunk)
+                written += len(chunk)
+        return written
+    except BaseException:
+        path.unlink(missing_ok=True)
+        raise
+    finally:
+        response.release()
+
+
+async def _pump_to_pipe(response: aiohttp.ClientResponse, pipe) -> None:
+    """Copies an HTTP body into the write end of a pipe without blocking the loop."""
+    loop = asyncio.get_running_loop()
+    transport, protocol = await loop.connect_write_pipe(lambda: asyncio.streams.FlowControlMixin(loop=loop), pipe)
+    writer = asyncio.StreamWriter(transport, protocol, None, loop)
+    try:
+        async for chunk in response.content.iter_chunked(65536):
+            writer.write(chunk)
+            await writer.drain()
+    finally:
+        writer.close()
+
+
+async def _terminate(process: asyncio.subprocess.Process) -> None:
+    if process.returncode is None:
+        try:
+            process.kill()
+        except ProcessLookupError:
+            pass
+        await process.wait()
+
+
+async def _mux_streams(video: aiohttp.ClientResponse, audio: Optional[aiohttp.ClientResponse], output_path: Path) -> bool:
+    """Muxes video (+audio) into output_path while both are still downloading.
+
+    Each body is fed to ffmpeg through its own pipe, so only the result touches the
+    disk. Inputs must be streamable (fragmented MP4 such as Reddit DASH, WebM, TS).
     """
-    Fallback: fetch Reddit post JSON API, extract v.redd.it HLS/DASH video URL,
-    download video+audio separately and merge with ffmpeg.
-    Returns Path to merged mp4, or None on failure.
+    responses = [video] + ([audio] if audio is not None else [])
+    fds = [os.pipe() for _ in responses]
+    pipes = [os.fdopen(write_fd, 'wb', buffering=0) for _, write_fd in fds]
+    cmd = ['ffmpeg', '-y', '-loglevel', 'error']
+    for read_fd, _ in fds:
+        cmd += ['-i', f'pipe:{read_fd}']
+    if audio is not None:
+        cmd += ['-map', '0:v:0', '-map', '1:a:0', '-c:v', 'copy', '-c:a', 'aac']
+    else:
+        cmd += ['-c', 'copy']
+    cmd += ['-movflags', '+faststart', str(output_path)]
+
+    process = None
+    pumps = []
+    try:
+        try:
+            process = await asyncio.create_subprocess_exec(
+                *cmd,
+                pass_fds=[read_fd for read_fd, _ in fds],
+                stdin=asyncio.subprocess.DEVNULL,
+                stdout=asyncio.subprocess.DEVNULL,
+                stderr=asyncio.subprocess.PIPE,
+            )
+        finally:
+            for read_fd, _ in fds:
+                os.close(read_fd)
+
+        pumps = [asyncio.ensure_future(_pump_to_pipe(response, pipe)) for response, pipe in zip(responses, pipes)]
+        *pumped, communicated = await asyncio.gather(*pumps, process.communicate(), return_exceptions=True)
+        if isinstance(communicated, BaseException):
+            raise communicated
+        stderr = communicated[1].decode(errors='replace')
+        broken = [e for e in pumped if isinstance(e, BaseException)]
+        if process.returncode != 0 or broken:
+            logging.error(f"ffmpeg pipe mux failed (rc={process.returncode}, stream errors={broken}): {stderr[:300]}")
+            output_path.unlink(missing_ok=True)
+            return False
+        return output_path.exists() and output_path.stat().st_size > 0
+    except BaseException:
+        output_path.unlink(missing_ok=True)
+        raise
+    finally:
+        for pump in pumps:
+            pump.cancel()
+        await asyncio.gather(*pumps, return_exceptions=True)
+        for pipe in pipes:
+            pipe.close()
+        if process is not None:
+            await _terminate(process)
+        for response in responses:
+            response.release()
+
+
+async def _ffmpeg_copy_url(stream_url: str, output_path: Path, headers: Dict[str, str], timeout: float = 600) -> bool:
+    """Remuxes a remote stream (HLS playlist) with ffmpeg; cancellable, kills ffmpeg on cancel."""
+    header_lines = "".join(f"{name}: {value}\r\n" for name, value in headers.items())
+    cmd = [
+        'ffmpeg', '-y', '-loglevel', 'error',
+        '-headers', header_lines,
+        '-i', stream_url,
+        '-c', 'copy', '-bsf:a', 'aac_adtstoasc',
+        str(output_path)
+    ]
+    process = await asyncio.create_subprocess_exec(
+        *cmd, stdin=asyncio.subprocess.DEVNULL, stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.PIPE
+    )
+    try:
+        _, stderr = await asyncio.wait_for(process.communicate(), timeout=timeout)
+    except BaseException:
+        await _terminate(process)
+        output_path.unlink(missing_ok=True)
+        raise
+    if process.returncode == 0 and output_path.exists() and output_path.stat().st_size > 1000:
+        return True
+    logging.warning(f"ffmpeg stream copy failed: {stderr.decode(errors='replace')[:300]}")
+    output_path.unlink(missing_ok=True)
+    return False
+
+
+def _load_cookies(domain: str) -> Dict[str, str]:
+    """name -> value of the cookies.txt entries for domain (empty if there is no cookie file)."""
+    cookie_file = DATA_DIR / "cookies.txt"
+    if not cookie_file.exists():
+        return {}
+    try:
+        from http.cookiejar import MozillaCookieJar
+        cj = MozillaCookieJar(str(cookie_file))
+        cj.load(ignore_discard=True, ignore_expires=True)
+        return {c.name: c.value for c in cj if domain in c.domain}
+    except Exception as e:
+        logging.warning(f"Failed to load cookies for {domain}: {e}")
+        return {}
+
+
+def _reddit_media_urls(post: Dict) -> Tuple[Optional[str], List[str]]:
+    """(video_url, image_urls) from a Reddit post object, following crossposts."""
+    def video_of(item: Dict) -> Optional[str]:
+        media = item.get('secure_media') or item.get('media') or {}
+        reddit_video = media.get('reddit_video') or {}
+        preview_video = (item.get('preview') or {}).get('reddit_video_preview') or {}
+        return (reddit_video.get('fallback_url') or reddit_video.get('hls_url')
+                or preview_video.get('fallback_url'))
+
+    video_url = video_of(post)
+    if not video_url:
+        xposts = post.get('crosspost_parent_list') or []
+        if xposts:
+            video_url = video_of(xposts[0])
+    if video_url:
+        return video_url, []
+
+    image_urls = []
+    # Case 1: Gallery
+    if post.get('is_gallery') and 'media_metadata' in post:
+        metadata = post['media_metadata']
+        gallery_data = (post.get('gallery_data') or {}).get('items', [])
+        # Use gallery order if available
+        item_ids = [item['media_id'] for item in gallery_data] if gallery_data else metadata.keys()
+        for mid in item_ids:
+            # Try to get highest resolution version
+            s = (metadata.get(mid) or {}).get('s', {})
+            img_url = s.get('u') or s.get('gif')
+            if img_url:
+                image_urls.append(img_url.replace('&amp;', '&'))
+
+    # Case 2: Single Image or Preview
+    elif not post.get('is_video'):
+        url_candidate = post.get('url', '')
+        if any(url_candidate.lower().endswith(ext) for ext in ('.jpg', '.jpeg', '.png', '.webp', '.gif')):
+            image_urls.append(url_candidate)
+        else:
+            # Try to get the highest res source from preview images
+            p_images = (post.get('preview') or {}).get('images', [])
+            p_url = p_images[0].get('source', {}).get('url') if p_images else None
+            if p_url:
+                image_urls.append(p_url.replace('&amp;', '&'))
+        # Last resort: thumbnail if it's a valid link
+        if not image_urls and str(post.get('thumbnail', '')).startswith('http'):
+            image_urls.append(post['thumbnail'])
+    return None, image_urls
+
+
+async def _download_reddit_direct(url: str, proxy_url: Optional[str] = None) -> Optional[Union[Path, List[Path]]]:
+    """
+    Fallback: fetch Reddit post JSON API, extract the v.redd.it DASH video URL and
+    stream video+audio concurrently into ffmpeg. Galleries/images are downloaded
+    in parallel. Returns Path to the mp4 (or a list of images), or None on failure.
     """
-    import re, subprocess, tempfile
+    import re
 
-    # Normalize URL: ensure it ends with .json and use old.reddit.com to avoid JS pages
+    # Normalize URL: strip query and ask the JSON API
     post_url = url.rstrip('/')
     if '?' in post_url:
         post_url = post_url.split('?')[0]
     json_url = post_url + '/.json'
 
-    proxies = None
-    if proxy_url:
-        pv = proxy_url.replace('socks5h', 'socks5')
-        proxies = {'http': pv, 'https': pv}
-
     headers = {
         'User-Agent': 'Mozilla/5.0 (compatible; RedditBot/1.0; +https://github.com/ytttins)',
         'Accept': 'application/json',
     }
 
+    async def fetch_json(route: Optional[str]):
+        session, proxy = _http_route(route)
+        async with session.get(json_url, headers=headers, proxy=proxy, timeout=aiohttp.ClientTimeout(total=15)) as resp:
+            if resp.status == 429:
+                logging.warning(f"[REDDIT-DIRECT] Rate limited on JSON API ({'proxy' if route else 'direct'})")
+                return None
+            if resp.status != 200:
+                logging.warning(f"[REDDIT-DIRECT] JSON API returned {resp.status}")
+                return None
+            return route, await resp.json(content_type=None)
+
+    # Race the proxy against a direct connection; the winner's route is used for the media too
+    routes = [proxy_url, None] if proxy_url else [None]
+    fetched = await race([lambda r=r: fetch_json(r) for r in routes])
+    if not fetched:
+        logging.warning("[REDDIT-DIRECT] Failed to fetch post JSON")
+        return None
+    route, data = fetched
+    session, proxy = _http_route(route)
+
     try:
-        resp = requests.get(json_url, headers=headers, proxies=proxies, timeout=15)
-        if resp.status_code == 429:
-            logging.warning("[REDDIT-DIRECT] Rate limited on JSON API")
-            return None
-        if resp.status_code != 200:
-            logging.warning(f"[REDDIT-DIRECT] JSON API returned {resp.status_code}")
-            return None
-        data = resp.json()
-    except Exception as e:
-        logging.warning(f"[REDDIT-DIRECT] Failed to fetch JSON: {e}")
+        post = data[0]['data']['children'][0]['data']
+    except (KeyError, IndexError, TypeError):
+        logging.warning("[REDDIT-DIRECT] Unexpected JSON structure")
         return None
 
-        # Try crosspost
-        if not video_url:
-            xposts = post.get('crosspost_parent_list') or []
-            if xposts:
-                xpost = xposts[0]
-                xmedia = xpost.get('media') or xpost.get('secure_media') or {}
-                reddit_video = xmedia.get('reddit_video', {})
-                video_url = reddit_video.get('fallback_url') or reddit_video.get('hls_url')
-
-        # === IMAGE / GALLERY SUPPORT ===
-        if not video_url:
-            image_urls = []
-            
-            # Case 1: Gallery
-            if post.get('is_gallery') and 'media_metadata' in post:
-                metadata = post['media_metadata']
-                gallery_data = post.get('gallery_data', {}).get('items', [])
-                
-                # Use gallery order if available
-                item_ids = [item['media_id'] for item in gallery_data] if gallery_data else metadata.keys()
-                
-                for mid in item_ids:
-                    if mid in metadata:
-                        media_item = metadata[mid]
-                        # Try to get highest resolution version
-                        s = media_item.get('s', {})
-                        img_url = s.get('u') or s.get('gif')
-                        if img_url:
-                            image_urls.append(img_url.replace('&amp;', '&'))
-            
-            # Case 2: Single Image or Preview
-            elif not post.get('is_video'):
-                url_candidate = post.get('url', '')
-                if any(url_candidate.lower().endswith(ext) for ext in ('.jpg', '.jpeg', '.png', '.webp', '.gif')):
-                    image_urls.append(url_candidate)
-                elif 'preview' in post:
-                    # Try to get the highest res source from preview images
-                    try:
-                        p_images = post['preview'].get('images', [])
-                        if p_images:
-                            source = p_images[0].get('source', {})
-                            p_url = source.get('url')
-                            if p_url:
-                                image_urls.append(p_url.replace('&amp;', '&'))
-                    except: pass
-                
-                # Last resort: thumbnail if it's a valid link
-                if not image_urls and post.get('thumbnail', '').startswith('http'):
-                    image_urls.append(post['thumbnail'])
-                
-            if image_urls:
-                logging.info(f"[REDDIT-DIRECT] Found gallery/images: {len(image_urls)} items")
-                downloaded_images = []
-                unique_id = uuid.uuid4().hex[:8]
-                
-                for i, img_url in enumerate(image_urls):
-                    try:
-                        ext = '.jpg'
-                        if '.png' in img_url.lower(): ext = '.png'
-                        elif '.webp' in img_url.lower(): ext = '.webp'
-                        elif '.gif' in img_url.lower(): ext = '.gif'
-                        
-                        img_path = DOWNLOADS_DIR / f"reddit_{unique_id}_{i}{ext}"
-                        ir = requests.get(img_url, headers=headers, proxies=proxies, timeout=30)
-                        if ir.status_code == 200:
-                            with open(img_path, 'wb') as f:
-                                f.write(ir.content)
-                            downloaded_images.append(img_path)
-                    except Exception as img_err:
-                        logging.error(f"[REDDIT-DIRECT] Image {i} download error: {img_err}")
-                
-                if downloaded_images:
-                    return downloaded_images if len(downloaded_images) > 1 else downloaded_images[0]
-                    
+    video_url, image_urls = _reddit_media_urls(post)
+    unique_id = uuid.uuid4().hex[:8]
+
+    if not video_url:
+        if not image_urls:
             logging.warning("[REDDIT-DIRECT] No video or image content found in post JSON")
             return None
+        logging.info(f"[REDDIT-DIRECT] Found gallery/images: {len(image_urls)} items")
+
+        async def fetch_image(i: int, img_url: str) -> Optional[Path]:
+            ext = '.jpg'
+            if '.png' in img_url.lower(): ext = '.png'
+            elif '.webp' in img_url.lower(): ext = '.webp'
+            elif '.gif' in img_url.lower(): ext = '.gif'
+            img_path = DOWNLOADS_DIR / f"reddit_{unique_id}_{i}{ext}"
+            try:
+                response = await _open_stream(session, img_url, headers, proxy)
+                if response is None:
+                    return None
+                await _stream_to_file(response, img_path)
+                return img_path
+            except asyncio.CancelledError:
+                raise
+            except Exception as img_err:
+                logging.error(f"[REDDIT-DIRECT] Image {i} download error: {img_err}")
+                return None
 
-        # Strip quality param to get best quality
-        video_url = video_url.split('?')[0]
-        # Derive audio URL: replace DASH_XXX with DASH_audio
-        audio_url = re.sub(r'DASH_\d+(\.mp4)?$', 'DASH_audio.mp4', video_url)
-
-        unique_id = uuid.uuid4().hex[:8]
-        video_tmp = DOWNLOADS_DIR / f"reddit_v_{unique_id}.mp4"
-        audio_tmp = DOWNLOADS_DIR / f"reddit_a_{unique_id}.mp4"
-        output_path = DOWNLOADS_DIR / f"reddit_{unique_id}.mp4"
-
-        dl_headers = {
-            'User-Agent': headers['User-Agent'],
-            'Referer': 'https://www.reddit.com/',
-        }
-
-        # Download video stream
-        logging.info(f"[REDDIT-DIRECT] Downloading video: {video_url}")
-        vr = requests.get(video_url, headers=dl_headers, proxies=proxies, stream=True, timeout=60)
-        if vr.status_code != 200:
-            logging.warning(f"[REDDIT-DIRECT] Video stream returned {vr.status_code}")
+        try:
+            results = await asyncio.gather(*(fetch_image(i, u) for i, u in enumerate(image_urls)))
+        except asyncio.CancelledError:
+            _remove_partial_downloads(unique_id)
+            raise
+        downloaded_images = [path for path in results if path]
+        if not downloaded_images:
             return None
-        with open(video_tmp, 'wb') as f:
-            for chunk in vr.iter_content(8192):
-                f.write(chunk)
+        return downloaded_images if len(downloaded_images) > 1 else downloaded_images[0]
 
-        # Try to download audio stream (may not exist for old posts)
-        has_audio = False
-        try:
-            ar = requests.get(audio_url, headers=dl_headers, proxies=proxies, stream=True, timeout=30)
-            if ar.status_code == 200:
-                with open(audio_tmp, 'wb') as f:
-                    for chunk in ar.iter_content(8192):
-                        f.write(chunk)
-                has_audio = True
-                logging.info("[REDDIT-DIRECT] Audio stream downloaded")
-        except Exception:
-            pass
+    output_path = DOWNLOADS_DIR / f"reddit_{unique_id}.mp4"
+    dl_headers = {
+        'User-Agent': headers['User-Agent'],
+        'Referer': 'https://www.reddit.com/',
+    }
 
-        # Merge with ffmpeg
-        if has_audio:
-            cmd = [
-                'ffmpeg', '-y',
-                '-i', str(video_tmp),
-                '-i', str(audio_tmp),
-                '-c:v', 'copy', '-c:a', 'aac',
-                '-movflags', '+faststart',
-                str(output_path)
-            ]
-        else:
-            cmd = [
-                'ffmpeg', '-y',
-                '-i', str(video_tmp),
-                '-c', 'copy',
-                str(output_path)
-            ]
-
-        result = subprocess.run(cmd, capture_output=True, timeout=120)
-        # Cleanup temp files
-        for tmp in (video_tmp, audio_tmp):
-            try:
-                if tmp.exists():
-                    tmp.unlink()
-            except Exception:
-                pass
+    if '.m3u8' in video_url:
+        logging.info(f"[REDDIT-DIRECT] Copying HLS stream: {video_url}")
+        return output_path if await _ffmpeg_copy_url(video_url, output_path, dl_headers) else None
+
+    # Strip quality param to get best quality
+    video_url = video_url.split('?')[0]
+    # Audio track sits next to the video; its name depends on the post's age
+    base_url = re.sub(r'/DASH_[^/]+$', '', video_url)
+    audio_urls = [f"{base_url}/{name}" for name in REDDIT_AUDIO_NAMES]
+
+    logging.info(f"[REDDIT-DIRECT] Streaming video+audio: {video_url}")
+    video_task = asyncio.ensure_future(_open_stream(session, video_url, dl_headers, proxy))
+    audio_task = asyncio.ensure_future(race(
+        [lambda u=u: _open_stream(session, u, dl_headers, proxy) for u in audio_urls],
+        cleanup=_close_response,
+    ))
+    try:
+        video_resp, audio_resp = await asyncio.gather(video_task, audio_task, return_exceptions=True)
+    except asyncio.CancelledError:
+        # A stream that opened just before the cancel must not keep its connection
+        for task in (video_task, audio_task):
+            task.add_done_callback(lambda t: _close_response(t.result()) if not t.cancelled() and t.exception() is None else None)
+        raise
+    if isinstance(audio_resp, BaseException):
+        audio_resp = None  # Audio may not exist for old posts
+    if isinstance(video_resp, BaseException) or video_resp is None:
+        logging.warning(f"[REDDIT-DIRECT] Video stream unavailable: {video_resp}")
+        _close_response(audio_resp)
+        return None
+    if audio_resp is not None:
+        logging.info(f"[REDDIT-DIRECT] Audio stream: {audio_resp.url.name}")
 
-        if result.returncode != 0:
-            logging.error(f"[REDDIT-DIRECT] ffmpeg failed: {result.stderr.decode()[:300]}")
-            return None
+    if not await _mux_streams(video_resp, audio_resp, output_path):
+        return None
+    logging.info(f"[REDDIT-DIRECT] ✅ Downloaded and merged: {output_path}")
+    return output_path
 
-        logging.info(f"[REDDIT-DIRECT] ✅ Downloaded and merged: {output_path}")
-        return output_path
 
-    except Exception as e:
-        logging.error(f"[REDDIT-DIRECT] Unexpected error: {e}")
-        return None
+def _match_facebook_video(html: str) -> Optional[str]:
+    import re
+    for pattern in FACEBOOK_VIDEO_PATTERNS:
+        m = re.search(pattern, html)
+        if m:
+            candidate = m.group(1).replace('\\/', '/').replace('\\u0025', '%').replace('\\u0026', '&')
+            if 'fbcdn.net' in candidate or 'fbext' in candidate or '.mp4' in candidate:
+                logging.info(f"[FB-DIRECT] Found video URL via pattern: {pattern[:40]}")
+                return candidate
+    return None
 
-def _download_facebook_direct(url: str, proxy_url: Optional[str] = None) -> Optional[Path]:
+
+async def _download_facebook_direct(url: str, proxy_url: Optional[str] = None) -> Optional[Path]:
     """
     Fallback: scrape Facebook page HTML to extract video CDN URLs.
     Works when yt-dlp extractor is broken (Cannot parse data bug).
     """
-    import re, subprocess
+    import re
 
-    proxies = None
-    if proxy_url:
-        pv = proxy_url.replace('socks5h', 'socks5')
-        proxies = {'http': pv, 'https': pv}
-
-    # Load Netscape cookies if available
-    session = requests.Session()
-    cookie_file = DATA_DIR / "cookies.txt"
-    if cookie_file.exists():
-        try:
-            from http.cookiejar import MozillaCookieJar
-            cj = MozillaCookieJar(str(cookie_file))
-            cj.load(ignore_discard=True, ignore_expires=True)
-            session.cookies.update(cj)
-            logging.info(f"[FB-DIRECT] Loaded cookies from {cookie_file.name}")
-        except Exception as ce:
-            logging.warning(f"[FB-DIRECT] Failed to load cookies: {ce}")
+    cookies = _load_cookies('facebook.com')
+    if cookies:
+        logging.info(f"[FB-DIRECT] Loaded {len(cookies)} cookies from cookies.txt")
 
     headers = {
         'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/99.0.4844.51 Safari/537.36',
@@ -590,118 +731,137 @@ def _download_facebook_direct(url: str, proxy_url: Optional[str] = None) -> Opti
         'Sec-Fetch-Mode': 'navigate',
         'Sec-Fetch-Dest': 'document',
     }
+    # Facebook serves the video data to real browsers; curl_cffi brings a matching TLS fingerprint (and its own UA)
+    browser = http_client.impersonated(proxy=proxy_url)
 
-    # Also try mbasic/mobile FB which is simpler HTML
-    urls_to_try = [url]
-    # Convert to mbasic if not already
-    if 'mbasic.facebook' not in url:
-        mbasic = url.replace('www.facebook.com', 'mbasic.facebook.com').replace('m.facebook.com', 'mbasic.facebook.com')
-        urls_to_try.append(mbasic)
-
-    video_url = None
-    for try_url in urls_to_try:
+    async def fetch_page(page_url: str) -> Optional[str]:
         try:
-            resp = session.get(try_url, headers=headers, proxies=proxies, timeout=15, allow_redirects=True)
-            if resp.status_code != 200:
-                logging.warning(f"[FB-DIRECT] HTTP {resp.status_code} for {try_url}")
-                continue
-            html = resp.text
-
-            # Patterns that appear in Facebook's page source (HD first, then SD)
-            patterns = [
-                r'"browser_native_hd_url"\s*:\s*"([^"]+)"',
-                r'"browser_native_sd_url"\s*:\s*"([^"]+)"',
-                r'"playable_url_quality_hd"\s*:\s*"([^"]+)"',
-                r'"playable_url"\s*:\s*"([^"]+)"',
-                r'"playable_url_quality_standard"\s*:\s*"([^"]+)"',
-                r'"hd_src_no_ratelimit"\s*:\s*"([^"]+)"',
-                r'"sd_src_no_ratelimit"\s*:\s*"([^"]+)"',
-                r'hd_src\s*:\s*"([^"]+\.mp4[^"]*?)"',
-                r'sd_src\s*:\s*"([^"]+\.mp4[^"]*?)"',
-                r'"video_url"\s*:\s*"([^"]+)"',
-                r'"scrubber_video_url"\s*:\s*"([^"]+)"',
-                r'\[\{"url"\s*:\s*"([^"]+\.mp4[^"]*?)"',  # Common in GraphQL arrays
-            ]
-
-            for pattern in patterns:
-                m = re.search(pattern, html)
-                if m:
-                    candidate = m.group(1).replace('\\/', '/').replace('\\u0025', '%').replace('\\u0026', '&')
-                    if 'fbcdn.net' in candidate or 'fbext' in candidate or '.mp4' in candidate:
-                        video_url = candidate
-                        logging.info(f"[FB-DIRECT] Found video URL via pattern: {pattern[:40]}")
-                        break
-            if video_url:
-                break
+            if browser is not None:
+                page_headers = {k: v for k, v in headers.items() if k != 'User-Agent'}
+                resp = await browser.get(page_url, headers=page_headers, cookies=cookies, timeout=15, allow_redirects=True)
+                status, html = resp.status_code, resp.text
+            else:
+                session, proxy = _http_route(proxy_url)
+                async with session.get(page_url, headers=headers, cookies=cookies, proxy=proxy,
+                                       timeout=aiohttp.ClientTimeout(total=15)) as resp:
+                    status, html = resp.status, await resp.text(errors='replace')
+        except asyncio.CancelledError:
+            raise
         except Exception as e:
-            logging.warning(f"[FB-DIRECT] Error fetching {try_url}: {e}")
-            continue
+            logging.warning(f"[FB-DIRECT] Error fetching {page_url}: {e}")
+            return None
+        if status != 200:
+            logging.warning(f"[FB-DIRECT] HTTP {status} for {page_url}")
+            return None
+        return _match_facebook_video(html)
+
+    # The full page and the simpler mbasic page are fetched at the same time
+    urls_to_try = [url]
+    if 'mbasic.facebook' not in url:
+        urls_to_try.append(url.replace('www.facebook.com', 'mbasic.facebook.com').replace('m.facebook.com', 'mbasic.facebook.com'))
+    video_url = await race([lambda u=u: fetch_page(u) for u in urls_to_try])
 
     if not video_url:
         # Final attempt: extract video ID and try a canonical page
-        # Search for long sequence of digits at end of URL or after a slash
         video_id_match = re.search(r'(?:/videos/|/reel/|/pcb\.[0-9]+/|v=)([0-9]{12,})', url)
         if not video_id_match:
-             video_id_match = re.search(r'/([0-9]{12,})', url)
-             
+            video_id_match = re.search(r'/([0-9]{12,})', url)
         if video_id_match:
-            video_id = video_id_match.group(1)
-            can_url = f"https://www.facebook.com/video.php?v={video_id}"
+            can_url = f"https://www.facebook.com/video.php?v={video_id_match.group(1)}"
             logging.info(f"[FB-DIRECT] No patterns matched in original page. Trying canonical: {can_url}")
-            try:
-                resp = session.get(can_url, headers=headers, proxies=proxies, timeout=15, allow_redirects=True)
-                if resp.status_code == 200:
-                    html = resp.text
-                    for pattern in patterns:
-                        m = re.search(pattern, html)
-                        if m:
-                            candidate = m.group(1).replace('\\/', '/').replace('\\u0025', '%').replace('\\u0026', '&')
-                            if 'fbcdn.net' in candidate or 'fbext' in candidate or '.mp4' in candidate:
-                                video_url = candidate
-                                logging.info(f"[FB-DIRECT] Found video URL in canonical page via pattern: {pattern[:40]}")
-                                break
-            except Exception as e:
-                logging.warning(f"[FB-DIRECT] Error fetching canonical {can_url}: {e}")
+            video_url = await fetch_page(can_url)
 
     if not video_url:
         logging.warning("[FB-DIRECT] No video URL found in page HTML")
         return None
 
     # Download the video
-    unique_id = uuid.uuid4().hex[:8]
-    output_path = DOWNLOADS_DIR / f"facebook_{unique_id}.mp4"
+    output_path = DOWNLOADS_DIR / f"facebook_{uuid.uuid4().hex[:8]}.mp4"
     try:
         dl_headers = dict(headers)
         dl_headers['Accept'] = 'video/mp4,video/*;q=0.9,*/*;q=0.8'
-        # Use simple requests with proxies for the actual file download to avoid potential session issues with binary streams
-        vr = requests.get(video_url, headers=dl_headers, proxies=proxies, stream=True, timeout=120)
-        if vr.status_code != 200:
-            logging.warning(f"[FB-DIRECT] Video download returned HTTP {vr.status_code}")
+        session, proxy = _http_route(proxy_url)
+        response = await _open_stream(session, video_url, dl_headers, proxy)
+        if response is None:
+            logging.warning("[FB-DIRECT] Video download was refused by the CDN")
             return None
-        with open(output_path, 'wb') as f:
-            for chunk in vr.iter_content(8192):
-                f.write(chunk)
+        await _stream_to_file(response, output_path)
         logging.info(f"[FB-DIRECT] ✅ Downloaded: {output_path} ({output_path.stat().st_size // 1024} KB)")
         return output_path
+    except asyncio.CancelledError:
+        raise
     except Exception as e:
         logging.error(f"[FB-DIRECT] Download error: {e}")
-        if output_path.exists():
-            output_path.unlink()
+        output_path.unlink(missing_ok=True)
         return None
 
 
-def _download_generic_stream(url: str, proxy_url: Optional[str] = None) -> Optional[Path]:
+def _find_stream_urls(html: str, page_url: str) -> List[str]:
+    """Video stream candidates (DASH, HLS, direct MP4) found in page HTML, JS or data attributes."""
+    import re
+    from urllib.parse import urljoin
+
+    # Patterns for video streams, prioritized by likely quality/directness
+    patterns = [
+        # OpenGraph meta tags (Danbooru, social sites, etc.)
+        r'<meta\s+(?:property|name)=["\']og:video(?::secure_url)?["\']\s+content=["\']([^"\']+)["\']',
+        r'content=["\']([^"\']+)["\']\s+(?:property|name)=["\']og:video(?::secure_url)?["\']',
+        r'<meta\s+(?:property|name)=["\']og:image["\']\s+content=["\']([^"\']+\.(?:mp4|webm|gif)[^"\']*)["\']',
+        # Standard JS/HTML patterns
+        r'"file"\s*:\s*"([^"]+\.(?:mp4|m3u8|webm)[^"]*)"',
+        r'"src"\s*:\s*"([^"]+\.(?:mp4|m3u8|webm)[^"]*)"',
+        r'"video_url"\s*:\s*"([^"]+)"',
+        r'"playable_url"\s*:\s*"([^"]+)"',
+        r'"hls_url"\s*:\s*"([^"]+)"',
+        r'source\s+src\s*=\s*"([^"]+)"',
+        r'data-video-src\s*=\s*"([^"]+)"',
+        r'data-src\s*=\s*"([^"]+\.mp4[^"]*)"',
+    ]
+
+    found_urls = []
+    for pattern in patterns:
+        for match in re.finditer(pattern, html):
+            candidate = match.group(1).replace('\\/', '/').replace('\\u0025', '%').replace('\\u0026', '&')
+            if candidate.startswith('//'):
+                candidate = 'https:' + candidate
+            elif candidate.startswith('/'):
+                candidate = urljoin(page_url, candidate)
+            elif not candidate.startswith('http'):
+                continue
+
+            # Filter out ads or obvious garbage
+            low_cand = candidate.lower()
+            if any(x in low_cand for x in ['ads', 'pixel', 'tracking', '/ad/']):
+                continue
+
+            if candidate not in found_urls:
+                found_urls.append(candidate)
+
+    if not found_urls:
+        # Fallback scan for any mp4/m3u8 link
+        for cand in re.findall(r'https?://[^"\s>]+(?:\.mp4|\.m3u8)[^"\s>]*', html):
+            if 'ads' not in cand.lower() and cand not in found_urls:
+                found_urls.append(cand)
+
+    # Clean candidates from trailing commas/bracket artifacts often found in JS
+    cleaned_urls = []
+    for cand in found_urls:
+        # Usually adult sites have "url","[quality]"; keep commas that belong to the query string
+        c = cand.rstrip(',').rstrip(']').strip()
+        if ',' in c and not any(x in c.split(',')[-1] for x in ['mp4', 'm3u8', '?', '=']):
+            c = c.split(',')[0].strip('"').strip("'")
+        if c not in cleaned_urls:
+            cleaned_urls.append(c)
+    return cleaned_urls
+
+
+async def _download_generic_stream(url: str, proxy_url: Optional[str] = None) -> Optional[Path]:
     """
     Scrape any HTML page for video stream patterns (DASH, HLS, direct MP4) 
     that might be hidden in JS or data attributes.
     """
-    import re, requests
-    from urllib.parse import urljoin
-    
-    proxies = None
-    if proxy_url:
-        pv = proxy_url.replace('socks5h', 'socks5')
-        proxies = {'http': pv, 'https': pv}
+    if not url.startswith('http'):
+        return None
 
     user_agent = random.choice(USER_AGENTS)
     headers = {
@@ -710,151 +870,76 @@ def _download_generic_stream(url: str, proxy_url: Optional[str] = None) -> Optio
         'Accept-Language': 'en-US,en;q=0.9',
         'Referer': url
     }
+    # Simple curl-like headers bypass some Cloudflare rules that answer 403
+    simple_headers = {'User-Agent': 'curl/7.81.0', 'Accept': '*/*'}
+
+    async def fetch_page(route: Optional[str]):
+        session, proxy = _http_route(route)
+        for attempt_headers in (headers, simple_headers):
+            async with session.get(url, headers=attempt_headers, proxy=proxy,
+                                   timeout=aiohttp.ClientTimeout(total=15), allow_redirects=True) as resp:
+                if resp.status == 200:
+                    return route, attempt_headers, await resp.text(errors='replace')
+                if resp.status != 403:
+                    return None
+        return None
 
     try:
-        if not url.startswith('http'):
+        # Direct and proxied fetches race; the download reuses whichever route answered first
+        routes = [None, proxy_url] if proxy_url else [None]
+        logging.info(f"[GENERIC-STREAM] Fetching page ({len(routes)} route(s))...")
+        fetched = await race([lambda r=r: fetch_page(r) for r in routes])
+        if not fetched:
             return None
-        
-        # Try direct first, then proxy fallback
-        html = None
-        working_proxies = None  # Track what worked
-        working_headers = headers
-        for attempt_proxies in [None, proxies]:
-            if attempt_proxies is None:
-                logging.info("[GENERIC-STREAM] Trying direct fetch (no proxy)...")
-            else:
-                logging.info("[GENERIC-STREAM] Trying fetch via proxy...")
-            try:
-                resp = requests.get(url, headers=headers, proxies=attempt_proxies, timeout=15, allow_redirects=True)
-                if resp.status_code == 200:
-                    html = resp.text
-                    working_proxies = attempt_proxies
-                    break
-                # If 403, also try with simple curl-like headers (bypasses some Cloudflare rules)
-                if resp.status_code == 403:
-                    simple_headers = {'User-Agent': 'curl/7.81.0', 'Accept': '*/*'}
-                    resp2 = requests.get(url, headers=simple_headers, proxies=attempt_proxies, timeout=15, allow_redirects=True)
-                    if resp2.status_code == 200:
-                        html = resp2.text
-                        working_proxies = attempt_proxies
-                        working_headers = simple_headers
-                        break
-            except Exception as fetch_err:
-                logging.debug(f"[GENERIC-STREAM] Fetch attempt failed: {fetch_err}")
-                continue
-
-        if not html:
-            return None
-
-        # Patterns for video streams, prioritized by likely quality/directness
-        patterns = [
-            # OpenGraph meta tags (Danbooru, social sites, etc.)
-            r'<meta\s+(?:property|name)=["\']og:video(?::secure_url)?["\']\s+content=["\']([^"\']+)["\']',
-            r'content=["\']([^"\']+)["\']\s+(?:property|name)=["\']og:video(?::secure_url)?["\']',
-            r'<meta\s+(?:property|name)=["\']og:image["\']\s+content=["\']([^"\']+\.(?:mp4|webm|gif)[^"\']*)["\']',
-            # Standard JS/HTML patterns
-            r'"file"\s*:\s*"([^"]+\.(?:mp4|m3u8|webm)[^"]*)"',
-            r'"src"\s*:\s*"([^"]+\.(?:mp4|m3u8|webm)[^"]*)"',
-            r'"video_url"\s*:\s*"([^"]+)"',
-            r'"playable_url"\s*:\s*"([^"]+)"',
-            r'"hls_url"\s*:\s*"([^"]+)"',
-            r'source\s+src\s*=\s*"([^"]+)"',
-            r'data-video-src\s*=\s*"([^"]+)"',
-            r'data-src\s*=\s*"([^"]+\.mp4[^"]*)"',
-        ]
-
-        found_urls = []
-        for pattern in patterns:
-            matches = re.finditer(pattern, html)
-            for match in matches:
-                candidate = match.group(1).replace('\\/', '/').replace('\\u0025', '%').replace('\\u0026', '&')
-                if candidate.startswith('//'):
-                    candidate = 'https:' + candidate
-                elif candidate.startswith('/'):
-                    candidate = urljoin(url, candidate)
-                elif not candidate.startswith('http'):
-                    continue
-                
-                # Filter out ads or obvious garbage
-                low_cand = candidate.lower()
-                if any(x in low_cand for x in ['ads', 'pixel', 'tracking', '/ad/']):
-                    continue
-                
-                if candidate not in found_urls:
-                    found_urls.append(candidate)
-
-        if not found_urls:
-            # Fallback scan for any mp4/m3u8 link
-            ext_matches = re.findall(r'https?://[^"\s>]+(?:\.mp4|\.m3u8)[^"\s>]*', html)
-            for cand in ext_matches:
-                 if 'ads' not in cand.lower() and cand not in found_urls:
-                     found_urls.append(cand)
+        route, working_headers, html = fetched
 
-        if not found_urls:
+        cleaned_urls = _find_stream_urls(html, url)
+        if not cleaned_urls:
             return None
 
         # Prefer higher quality (avoid 240p/144p if better exists)
-        # Clean candidates from trailing commas/bracket artifacts often found in JS
-        cleaned_urls = []
-        for cand in found_urls:
-            # Remove trailing part after a comma if it looks like JS array [480p] etc.
-            # but keep it if it's part of query string. 
-            # Usually adult sites have "url","[quality]"
-            c = cand.rstrip(',').rstrip(']').strip()
-            if ',' in c and not any(x in c.split(',')[-1] for x in ['mp4','m3u8','?','=']):
-                c = c.split(',')[0].strip('"').strip("'")
-            if c not in cleaned_urls:
-                cleaned_urls.append(c)
-
         video_url = cleaned_urls[0]
         for cand in cleaned_urls:
             low_cand = cand.lower()
             if any(q in low_cand for q in ['1080p', '720p', '480p', 'hd']):
                 video_url = cand
-                if '1080p' in low_cand or '720p' in low_cand: 
-                    break # Stop at first high-quality link
+                if '1080p' in low_cand or '720p' in low_cand:
+                    break  # Stop at first high-quality link
 
         logging.info(f"[GENERIC-STREAM] Best stream found: {video_url[:100]}")
+        output_path = DOWNLOADS_DIR / f"generic_{uuid.uuid4().hex[:8]}.mp4"
 
-        unique_id = uuid.uuid4().hex[:8]
-        output_path = DOWNLOADS_DIR / f"generic_{unique_id}.mp4"
-        
         # HLS Download
         if '.m3u8' in video_url.lower():
-            logging.info(f"[GENERIC-STREAM] Starting HLS download via ffmpeg...")
-            cmd = [
-                'ffmpeg', '-y', '-i', video_url,
-                '-headers', f'User-Agent: {user_agent}\r\nReferer: {url}\r\n',
-                '-c', 'copy', '-bsf:a', 'aac_adtstoasc',
-                str(output_path)
-            ]
-            res = subprocess.run(cmd, capture_output=True, timeout=600)
-            if res.returncode == 0 and output_path.exists() and output_path.stat().st_size > 1000:
-                return output_path
+            logging.info("[GENERIC-STREAM] Starting HLS download via ffmpeg...")
+            ok = await _ffmpeg_copy_url(video_url, output_path, {'User-Agent': user_agent, 'Referer': url})
+            return output_path if ok else None
+
+        # Direct MP4 Download (same route that worked for HTML)
+        logging.info(f"[GENERIC-STREAM] Downloading binary stream (proxied={route is not None})...")
+        session, proxy = _http_route(route)
+        response = await _open_stream(session, video_url, {**working_headers, 'Referer': url}, proxy)
+        if response is None:
             return None
-
-        # Direct MP4 Download (use same connection method that worked for HTML)
-        logging.info(f"[GENERIC-STREAM] Downloading binary stream (proxied={working_proxies is not None})...")
-        dl_headers = {**working_headers, 'Referer': url}
-        vr = requests.get(video_url, headers=dl_headers, proxies=working_proxies, stream=True, timeout=300)
-        if vr.status_code == 200:
-            with open(output_path, 'wb') as f:
-                for chunk in vr.iter_content(65536):
-                    f.write(chunk)
-            if output_path.exists() and output_path.stat().st_size > 1000:
-                return output_path
-
+        await _stream_to_file(response, output_path)
+        if output_path.stat().st_size > 1000:
+            return output_path
+        output_path.unlink(missing_ok=True)
+    except asyncio.CancelledError:
+        raise
     except Exception as e:
         logging.error(f"[GENERIC-STREAM] Critical failure: {e}")
-    
+
     return None
 
 
-def _run_ytdlp_extract(ydl_opts: Dict, url: str) -> Tuple[Dict, str]:
-    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-        info = ydl.extract_info(url, download=True)
-        prepared_name = ydl.prepare_filename(info)
-    return info, prepared_name
+def _remove_partial_downloads(unique_id: str) -> None:
+    """Deletes every file (incl. .part/.ytdl leftovers) of an abandoned yt-dlp attempt."""
+    for path in DOWNLOADS_DIR.glob(f"*{unique_id}*"):
+        try:
+            path.unlink(missing_ok=True)
+        except Exception as e:
+            logging.warning(f"Failed to remove partial download {path.name}: {e}")
 
 def _select_best_downloaded_file(files: List[Path]) -> Path:
     if not files:
@@ -885,7 +970,40 @@ def _cleanup_extra_files(files: List[Path], keep: Path) -> None:
 
 # === Основная логика ===
 
+def download_flight_key(url: str, is_music: bool = False, video_height: int = None, min_duration: int = 0) -> tuple:
+    """Requests with equal keys share one download, so the URL part must never merge two different videos:
+    canonicalize_url only drops tracking parameters and keeps the rest of the query (facebook ?v=, vk ?z=)."""
+    return (canonicalize_url(url), bool(is_music), video_height, min_duration)
+
+def release_download(*paths) -> None:
+    """Hands back files returned by download_media; they are removed once no other caller needs them."""
+    download_flights.release(*paths)
+
 async def download_media(url: str, is_music: bool = False, video_height: int = None, progress_callback: Optional[Callable] = None, min_duration: int = 0, **kwargs) -> Tuple[Union[Path, List[Path]], Optional[Path], Dict]:
+    """Single-flight front of _download_media: identical concurrent requests share one download.
+
+    Callers must clean up the returned files with release_download() instead of unlinking them.
+    """
+    # Playlists stream per-track callbacks and are never shared
+    if kwargs.get('on_track_callback') or is_playlist(url):
+        return await _download_media(url, is_music, video_height, progress_callback, min_duration, **kwargs)
+
+    key = download_flight_key(url, is_music, video_height, min_duration)
+    return await download_flights.run(
+        key,
+        lambda fan_out: _dispatch_download(url, is_music, video_height, fan_out, min_duration, **kwargs),
+        progress_callback
+    )
+
+async def _dispatch_download(url: str, is_music: bool = False, video_height: int = None, progress_callback: Optional[Callable] = None, min_duration: int = 0, **kwargs) -> Tuple[Union[Path, List[Path]], Optional[Path], Dict]:
+    """Sends the job to a remote gRPC worker when one is healthy, otherwise downloads locally."""
+    if remote_workers.enabled and not kwargs:
+        result = await remote_workers.download(url, is_music, video_height, progress_callback, min_duration)
+        if result is not None:
+            return result
+    return await _download_media(url, is_music, video_height, progress_callback, min_duration, **kwargs)
+
+async def _download_media(url: str, is_music: bool = False, video_height: int = None, progress_callback: Optional[Callable] = None, min_duration: int = 0, **kwargs) -> Tuple[Union[Path, List[Path]], Optional[Path], Dict]:
     # Clean URL from trailing slashes/backslashes and whitespace
     url = url.strip().rstrip('\\/')
     logging.info(f"Using yt-dlp version: {yt_dlp.version.__version__}")
@@ -958,9 +1076,9 @@ async def download_media(url: str, is_music: bool = False, video_height: int = N
     # Resolve short URLs to detect slideshows and help yt-dlp
     if "vm.tiktok.com" in url or "vt.tiktok.com" in url or "/t/" in url:
         try:
-            async with aiohttp.ClientSession() as session:
-                async with session.head(url, allow_redirects=True, timeout=5) as resp:
-                    url = str(resp.url)
+            session = http_client.session()
+            async with session.head(url, allow_redirects=True, timeout=5) as resp:
+                url = str(resp.url)
         except Exception as e:
             logging.warning(f"Failed to resolve TikTok URL: {e}")
     
@@ -996,11 +1114,15 @@ async def download_media(url: str, is_music: bool = False, video_height: int = N
     if is_playlist(url) and (platform == "youtube" or is_youtube_music(url)):
         on_track = kwargs.get('on_track_callback')
         logging.info(f"Downloading playlist: {url}")
-        return await _download_playlist_ytdlp(url, is_music=is_music, progress_callback=wrapped_callback if progress_callback else None, on_track_callback=on_track)
+        return await _download_playlist_ytdlp(url, is_music=is_music, progress_callback=wrapped_callback if progress_callback else None, on_track_callback=on_track,
+                                              is_premium=kwargs.get('is_premium', False))
     
-    # === МЕТОД 1: YT-DLP (основной) ===
+    progress = wrapped_callback if progress_callback else None
     ytdlp_error = None
-    try:
+    add_instagram_audio = False
+
+    # === МЕТОД 1: YT-DLP (основной) ===
+    async def via_ytdlp():
         logging.info(f"[YT-DLP] Attempting download: {url}")
         
         # TikTok через специальный метод
@@ -1009,7 +1131,7 @@ async def download_media(url: str, is_music: bool = False, video_height: int = N
             enrich_task = asyncio.create_task(asyncio.to_thread(fetch_tiktok_metadata, url))
             
             # Always use tiktok_local first
-            res = await _download_local_tiktok(url, progress_callback=wrapped_callback if progress_callback else None)
+            res = await _download_local_tiktok(url, progress_callback=progress)
             
             # Enrich metadata with verification for TikTok ALWAYS
             if res and len(res) == 3:
@@ -1020,14 +1142,14 @@ async def download_media(url: str, is_music: bool = False, video_height: int = N
                     video_file = files
                     # Always generate thumbnail if missing
                     if not thumb or not thumb.exists():
-                        new_thumb = DOWNLOADS_DIR / f"{video_file.stem}_thumb.jpg"
-                        if generate_video_thumbnail(video_file, new_thumb):
+                        new_thumb = await thumbnail_service.for_video(video_file, thumbnail_url=meta.get('thumbnail_url'))
+                        if new_thumb:
                             thumb = new_thumb
                             res = (video_file, thumb, meta)
                     
                     # Ensure dimensions are present
                     if not meta.get('width') or not meta.get('height'):
-                        w, h = probe_video_dimensions(video_file)
+                        w, h = (await media_probe.aprobe(video_file)).dimensions
                         if w > 0:
                             meta['width'] = w
                             meta['height'] = h
@@ -1052,151 +1174,171 @@ async def download_media(url: str, is_music: bool = False, video_height: int = N
                 resolved_url = await _resolve_spotify_via_songlink(url)
                 if resolved_url:
                     logging.info(f"[SPOTIFY] Resolved {url} to {resolved_url}")
-                    return await _download_local_ytdlp(resolved_url, is_music=True, progress_callback=wrapped_callback if progress_callback else None)
+                    return await _download_local_ytdlp(resolved_url, is_music=True, progress_callback=progress)
                 
                 logging.info(f"[SPOTIFY] Attempting spotdl: {url}")
-                return await _download_spotify_spotdl(url, progress_callback=wrapped_callback if progress_callback else None)
+                return await _download_spotify_spotdl(url, progress_callback=progress)
             except Exception as spot_err:
                 logging.error(f"[SPOTIFY] ❌ Failed: {spot_err}")
                 # Fallback continues to search mode in yt-dlp
         
         # YouTube/Instagram/музыка через универсальный метод
-        return await _download_local_ytdlp(url, is_music, video_height=video_height, min_duration=min_duration, progress_callback=wrapped_callback if progress_callback else None)
-        
-    except Exception as e:
-        ytdlp_error = f"{type(e).__name__}: {str(e)}"
-        logging.warning(f"[YT-DLP] ❌ Failed: {ytdlp_error}")
-        
-        # If Instagram photo-only post, go straight to Cobalt fallback
-        if platform == "instagram" and cobalt_client and ytdlp_error and "There is no video in this post" in ytdlp_error:
-            try:
-                logging.info(f"[COBALT] Instagram fallback after photo-only error: {url}")
-                file_path, thumb_path, metadata = await cobalt_client.download_media(
-                    url=url,
-                    quality="1080",
-                    is_audio=is_music,
-                    progress_callback=wrapped_callback if progress_callback else None
-                )
-                if file_path:
-                    if isinstance(file_path, list):
-                        logging.info(f"[COBALT] ✅ Success: {len(file_path)} files")
+        return await _download_local_ytdlp(url, is_music, video_height=video_height, min_duration=min_duration, progress_callback=progress)
+
+    # === МЕТОД 1.5: YT-DLP С ПРОКСИ (fallback если есть прокси) ===
+    async def via_ytdlp_proxy():
+        try:
+            logging.info(f"[YT-DLP+PROXY] Attempting with SOCKS proxy")
+            
+            # TikTok через специальный метод с прокси
+            if platform == "tiktok":
+                return await _download_local_tiktok(url, use_proxy=True, progress_callback=progress)
+            
+            # YouTube/Instagram/музыка с прокси
+            return await _download_local_ytdlp(url, is_music, video_height=video_height, use_proxy=True, progress_callback=progress)
+            
+        except Exception as proxy_error:
+            logging.warning(f"[YT-DLP+PROXY] ❌ Failed: {proxy_error}")
+            raise
+
+    # === МЕТОД 2: COBALT API (fallback) ===
+    async def via_cobalt():
+        try:
+            logging.info(f"[COBALT] Attempting download: {url}")
+            file_path, thumb_path, metadata = await cobalt_client.download_media(
+                url=url,
+                quality=str(video_height) if video_height else "1080",
+                is_audio=is_music,
+                progress_callback=progress
+            )
+            if file_path:
+                if isinstance(file_path, list):
+                    logging.info(f"[COBALT] ✅ Success: {len(file_path)} files")
+                    if add_instagram_audio:
                         file_path = await maybe_add_instagram_audio(file_path)
-                        return file_path, thumb_path, metadata
-                    if file_path.exists():
-                        logging.info(f"[COBALT] ✅ Success: {file_path.name}")
-                        return file_path, thumb_path, metadata
+                    return file_path, thumb_path, metadata
+                if file_path.exists():
+                    logging.info(f"[COBALT] ✅ Success: {file_path.name}")
+                    return file_path, thumb_path, metadata
+            else:
                 logging.warning("[COBALT] ⚠️ No file returned")
-            except Exception as cobalt_error:
-                logging.error(f"[COBALT] ❌ Error (Instagram-photo fallback): {cobalt_error}")
+            return None
+        except Exception as cobalt_error:
+            logging.error(f"[COBALT] ❌ Error: {cobalt_error}")
+            raise
 
-        # === МЕТОД 1.5: YT-DLP С ПРОКСИ (fallback если есть прокси) ===
-        if SOCKS_PROXY and ytdlp_error:
-            try:
-                logging.info(f"[YT-DLP+PROXY] Attempting with SOCKS proxy")
-                
-                # TikTok через специальный метод с прокси
-                if platform == "tiktok":
-                    return await _download_local_tiktok(url, use_proxy=True, progress_callback=wrapped_callback if progress_callback else None)
-                
-                # YouTube/Instagram/музыка с прокси
-                return await _download_local_ytdlp(url, is_music, video_height=video_height, use_proxy=True, progress_callback=wrapped_callback if progress_callback else None)
-                
-            except Exception as proxy_error:
-                logging.warning(f"[YT-DLP+PROXY] ❌ Failed: {proxy_error}")
-                # Silent fallback to method 2 (Cobalt)
-        
-        # === МЕТОД 2: COBALT API (fallback) ===
-        if cobalt_client:
-            try:
-                logging.info(f"[COBALT] Attempting download: {url}")
-                file_path, thumb_path, metadata = await cobalt_client.download_media(
-                    url=url,
-                    quality=str(video_height) if video_height else "1080",
-                    is_audio=is_music,
-                    progress_callback=wrapped_callback if progress_callback else None
-                )
-                if file_path:
-                    if isinstance(file_path, list):
-                        logging.info(f"[COBALT] ✅ Success: {len(file_path)} files")
-                        return file_path, thumb_path, metadata
-                    if file_path.exists():
-                        logging.info(f"[COBALT] ✅ Success: {file_path.name}")
-                        return file_path, thumb_path, metadata
-                else:
-                    logging.warning("[COBALT] ⚠️ No file returned")
-            except Exception as cobalt_error:
-                logging.error(f"[COBALT] ❌ Error: {cobalt_error}")
-        
-        # === МЕТОД 3: TIKWM (только для TikTok) ===
-        if platform == "tiktok":
-            try:
-                logging.info("[TIKWM] Attempting download...")
-                return await _download_tiktok_tikwm(url)
-            except Exception as tikwm_error:
-                logging.error(f"[TIKWM] ❌ Failed: {tikwm_error}")
+    # === МЕТОД 3: TIKWM (только для TikTok) ===
+    async def via_tikwm():
+        try:
+            logging.info("[TIKWM] Attempting download...")
+            return await _download_tiktok_tikwm(url)
+        except Exception as tikwm_error:
+            logging.error(f"[TIKWM] ❌ Failed: {tikwm_error}")
+            raise
+
+    # === МЕТОД 4: REDDIT DIRECT (fallback for Reddit 429/auth errors) ===
+    async def via_reddit_direct():
+        try:
+            logging.info(f"[REDDIT-DIRECT] Trying direct JSON API download: {url}")
+            reddit_file = await _download_reddit_direct(url, SOCKS_PROXY)
+            if isinstance(reddit_file, list):
+                logging.info(f"[REDDIT-DIRECT] ✅ Success: {len(reddit_file)} images")
+                return reddit_file, None, {'title': None, 'uploader': None, 'webpage_url': url, 'duration': 0, 'verified': False}
+            if reddit_file and reddit_file.exists():
+                logging.info(f"[REDDIT-DIRECT] ✅ Success: {reddit_file.name}")
+                # Generate thumbnail + probe dimensions
+                w, h = (await media_probe.aprobe(reddit_file)).dimensions
+                thumb_path = await thumbnail_service.for_video(reddit_file)
+                meta = {
+                    'title': None,
+                    'uploader': None,
+                    'webpage_url': url,
+                    'duration': 0,
+                    'width': w,
+                    'height': h,
+                    'verified': False,
+                }
+                return reddit_file, thumb_path, meta
+            return None
+        except Exception as reddit_direct_error:
+            logging.error(f"[REDDIT-DIRECT] ❌ Failed: {reddit_direct_error}")
+            raise
 
-        # === МЕТОД 4: REDDIT DIRECT (fallback for Reddit 429/auth errors) ===
-        if platform == "reddit":
-            try:
-                logging.info(f"[REDDIT-DIRECT] Trying direct JSON API download: {url}")
-                reddit_file = await asyncio.to_thread(_download_reddit_direct, url, SOCKS_PROXY)
-                if reddit_file and reddit_file.exists():
-                    logging.info(f"[REDDIT-DIRECT] ✅ Success: {reddit_file.name}")
-                    # Generate thumbnail + probe dimensions
-                    w, h = probe_video_dimensions(reddit_file)
-                    thumb_path = DOWNLOADS_DIR / f"{reddit_file.stem}_thumb.jpg"
-                    if not generate_video_thumbnail(reddit_file, thumb_path):
-                        thumb_path = None
-                    meta = {
-                        'title': None,
-                        'uploader': None,
-                        'webpage_url': url,
-                        'duration': 0,
-                        'width': w,
-                        'height': h,
-                        'verified': False,
-                    }
-                    return reddit_file, thumb_path, meta
-            except Exception as reddit_direct_error:
-                logging.error(f"[REDDIT-DIRECT] ❌ Failed: {reddit_direct_error}")
-
-        # === МЕТОД 5: FACEBOOK DIRECT SCRAPE ===
-        if platform == "facebook":
-            try:
-                logging.info(f"[FB-DIRECT] Trying HTML scrape fallback: {url}")
-                fb_file = await asyncio.to_thread(_download_facebook_direct, url, SOCKS_PROXY)
-                if fb_file and fb_file.exists():
-                    logging.info(f"[FB-DIRECT] ✅ Success: {fb_file.name}")
-                    w, h = probe_video_dimensions(fb_file)
-                    fb_thumb = DOWNLOADS_DIR / f"{fb_file.stem}_thumb.jpg"
-                    if not generate_video_thumbnail(fb_file, fb_thumb):
-                        fb_thumb = None
-                    return fb_file, fb_thumb, {
-                        'title': None, 'uploader': None,
-                        'webpage_url': url, 'duration': 0,
-                        'width': int(w), 'height': int(h), 'verified': False,
-                    }
-            except Exception as fb_err:
-                logging.error(f"[FB-DIRECT] ❌ Failed: {fb_err}")
-
-        # === МЕТОД 6: GENERIC VIDEO STREAM SCRAPE (Last resort) ===
-        if platform == "video" or ytdlp_error:
-            try:
-                logging.info(f"[GENERIC-STREAM] Trying manual stream extraction: {url}")
-                stream_file = await asyncio.to_thread(_download_generic_stream, url, SOCKS_PROXY)
-                if stream_file and stream_file.exists():
-                    logging.info(f"[GENERIC-STREAM] ✅ Success: {stream_file.name}")
-                    w, h = probe_video_dimensions(stream_file)
-                    gen_thumb = DOWNLOADS_DIR / f"{stream_file.stem}_thumb.jpg"
-                    if not generate_video_thumbnail(stream_file, gen_thumb):
-                        gen_thumb = None
-                    return stream_file, gen_thumb, {
-                        'title': 'Downloaded Video', 'uploader': None,
-                        'webpage_url': url, 'duration': 0,
-                        'width': int(w), 'height': int(h), 'verified': False,
-                    }
-            except Exception as gen_err:
-                logging.error(f"[GENERIC-STREAM] ❌ Failed: {gen_err}")
+    # === МЕТОД 5: FACEBOOK DIRECT SCRAPE ===
+    async def via_facebook_direct():
+        try:
+            logging.info(f"[FB-DIRECT] Trying HTML scrape fallback: {url}")
+            fb_file = await _download_facebook_direct(url, SOCKS_PROXY)
+            if fb_file and fb_file.exists():
+                logging.info(f"[FB-DIRECT] ✅ Success: {fb_file.name}")
+                w, h = (await media_probe.aprobe(fb_file)).dimensions
+                fb_thumb = await thumbnail_service.for_video(fb_file)
+                return fb_file, fb_thumb, {
+                    'title': None, 'uploader': None,
+                    'webpage_url': url, 'duration': 0,
+                    'width': int(w), 'height': int(h), 'verified': False,
+                }
+            return None
+        except Exception as fb_err:
+            logging.error(f"[FB-DIRECT] ❌ Failed: {fb_err}")
+            raise
+
+    # === МЕТОД 6: GENERIC VIDEO STREAM SCRAPE (Last resort) ===
+    async def via_generic_stream():
+        try:
+            logging.info(f"[GENERIC-STREAM] Trying manual stream extraction: {url}")
+            stream_file = await _download_generic_stream(url, SOCKS_PROXY)
+            if stream_file and stream_file.exists():
+                logging.info(f"[GENERIC-STREAM] ✅ Success: {stream_file.name}")
+                w, h = (await media_probe.aprobe(stream_file)).dimensions
+                gen_thumb = await thumbnail_service.for_video(stream_file)
+                return stream_file, gen_thumb, {
+                    'title': 'Downloaded Video', 'uploader': None,
+                    'webpage_url': url, 'duration': 0,
+                    'width': int(w), 'height': int(h), 'verified': False,
+                }
+            return None
+        except Exception as gen_err:
+            logging.error(f"[GENERIC-STREAM] ❌ Failed: {gen_err}")
+            raise
+
+    attempts = deque([("ytdlp", via_ytdlp)])
+    if SOCKS_PROXY:
+        attempts.append(("ytdlp_proxy", via_ytdlp_proxy))
+    if cobalt_client:
+        attempts.append(("cobalt", via_cobalt))
+    if platform == "tiktok":
+        attempts.append(("tikwm", via_tikwm))
+    if platform == "reddit":
+        attempts.append(("reddit_direct", via_reddit_direct))
+    if platform == "facebook":
+        attempts.append(("facebook_direct", via_facebook_direct))
+    attempts.append(("generic_stream", via_generic_stream))
+
+    def on_failure(method: str, error: BaseException):
+        nonlocal ytdlp_error, add_instagram_audio
+        if method != "ytdlp":
+            return
+        ytdlp_error = f"{type(error).__name__}: {str(error)}"
+        logging.warning(f"[YT-DLP] ❌ Failed: {ytdlp_error}")
+
+        # If Instagram photo-only post, go straight to Cobalt fallback (with the post's audio)
+        if platform == "instagram" and "There is no video in this post" in ytdlp_error:
+            add_instagram_audio = True
+            for attempt in list(attempts):
+                if attempt[0] == "cobalt":
+                    attempts.remove(attempt)
+                    attempts.appendleft(attempt)
+
+    try:
+        try:
+            _, result = await fallback_chain.run(platform, attempts, on_failure)
+            return result
+        except ChainExhausted as chain_error:
+            logging.warning(f"[CHAIN] All download methods failed for {url}: {chain_error}")
+            # yt-dlp may have been skipped by its circuit breaker
+            if ytdlp_error is None:
+                ytdlp_error = str(chain_error)
 
         ai_autofix_attempted = False
         ai_autofix_result = None
@@ -1283,7 +1425,7 @@ async def _download_local_ytdlp(url: str, is_music: bool = False, video_height:
             'low_speed_limit': 0,
             'low_speed_time': 300,
             'playlist_items': '1' if is_youtube else '1-5',
-            'max_filesize': 2048 * 1024 * 1024,
+            'max_filesize': TELEGRAM_MAX_BYTES,
             'exec_before_download': [],
             'extractor_args': {
                 'reddit': {'impersonate': True},
@@ -1293,8 +1435,9 @@ async def _download_local_ytdlp(url: str, is_music: bool = False, video_height:
             },
             'remote_components': ['ejs:github'],
             'plugin_dirs': get_plugin_dirs(),
+            # faststart only when merging (free in that pass); other files go through transcoder.prepare
             'postprocessor_args': {
-                'ffmpeg': ['-movflags', '+faststart']
+                'merger+ffmpeg': ['-movflags', '+faststart']
             },
             'fixup': 'detect_or_warn',
             'concurrent_fragment_downloads': 1, # Avoid thread safety issues with curl_cffi
@@ -1304,12 +1447,7 @@ async def _download_local_ytdlp(url: str, is_music: bool = False, video_height:
             ydl_opts['default_search'] = 'https://music.youtube.com/search?q='
 
         if min_duration > 0:
-            def duration_filter(info_dict, *, incomplete):
-                duration = info_dict.get('duration')
-                if duration and duration < min_duration:
-                    return f'Duration {duration}s is shorter than {min_duration}s'
-                return None
-            ydl_opts['match_filter'] = duration_filter
+            ydl_opts['match_filter'] = duration_filter(min_duration)
         
         ydl_opts['progress_hooks'] = []
         browser_headers = {
@@ -1376,7 +1514,13 @@ async def _download_local_ytdlp(url: str, is_music: bool = False, video_height:
             else:
                 ydl_opts['format'] = 'bestvideo[vcodec^=avc]+bestaudio/bestvideo[vcodec^=h264]+bestaudio/best[vcodec^=avc]/best[vcodec^=h264]/bestvideo+bestaudio/best'
         
-        info, prepared_name = await asyncio.to_thread(_run_ytdlp_extract, ydl_opts, url)
+        # Metadata first: impossible jobs fail before any byte is downloaded, and the info is reused below
+        preflight_info, preflight_format = await preflight.run(ydl_opts, url, is_music, video_height, min_duration)
+        if preflight_format:
+            ydl_opts['format'] = preflight_format
+
+        info, prepared_name = await ytdlp_extract_info(ydl_opts, url, min_duration=min_duration, on_abandon=lambda: _remove_partial_downloads(unique_id),
+                                                       info=preflight_info)
 
         metadata = {
             'title': None if info.get('title') in ('Unknown', 'None') else info.get('title', 'Media'),
@@ -1402,11 +1546,9 @@ async def _download_local_ytdlp(url: str, is_music: bool = False, video_height:
         if not skip_cleanup: _cleanup_extra_files(downloaded_files, file_path)
         
         # --- IPHONE COMPATIBILITY CHECK ---
-        # If video is VP9 or AV1, convert it to H.264 for iPhone support
+        # VP9/AV1 gets re-encoded to H.264; otherwise only the container, audio or moov position is fixed
         if not is_music and file_path.suffix.lower() in ('.mp4', '.webm', '.mkv'):
-            codec = await asyncio.to_thread(probe_video_codec, file_path)
-            if codec in ('vp9', 'av1'):
-                file_path = await asyncio.to_thread(convert_video_to_h264, file_path)
+            file_path = await transcoder.prepare(file_path)
         # ----------------------------------
 
         if file_path.suffix == '.unknown_video':
@@ -1420,13 +1562,16 @@ async def _download_local_ytdlp(url: str, is_music: bool = False, video_height:
         final_thumbnail = None
         if not is_music:
             if not metadata.get('width') or not metadata.get('height'):
-                w, h = probe_video_dimensions(file_path)
+                w, h = (await media_probe.aprobe(file_path)).dimensions
                 metadata['width'], metadata['height'] = w, h
-            thumbnail_path = DOWNLOADS_DIR / f"{file_path.stem}_thumb.jpg"
-            if generate_video_thumbnail(file_path, thumbnail_path): final_thumbnail = thumbnail_path
+            final_thumbnail = await thumbnail_service.for_video(file_path, thumbnail_url=info.get('thumbnail'))
 
         return file_path, final_thumbnail, metadata
                     
+    except asyncio.CancelledError:
+        # Lost a hedged race - drop whatever this attempt already wrote
+        _remove_partial_downloads(unique_id)
+        raise
     except Exception as e:
         # Retry once if we hit the curl_cffi shutdown error
         if "cannot schedule new futures after shutdown" in str(e) and attempt == 1:
@@ -1473,7 +1618,7 @@ async def _download_local_tiktok(url: str, use_proxy: bool = False, progress_cal
         'plugin_dirs': get_plugin_dirs(),
         'fixup': 'detect_or_warn',
         'postprocessor_args': {
-            'ffmpeg': ['-movflags', '+faststart']
+            'merger+ffmpeg': ['-movflags', '+faststart']
         },
         # Не указываем target явно — yt-dlp сам выберет доступный на ARM64
     }
@@ -1519,7 +1664,7 @@ async def _download_local_tiktok(url: str, use_proxy: bool = False, progress_cal
         ydl_opts = ydl_opts_base.copy()
         ydl_opts['format'] = 'best[vcodec^=h264]/best[vcodec^=avc]'
 
-    info, prepared_name = await asyncio.to_thread(_run_ytdlp_extract, ydl_opts, url)
+    info, prepared_name = await ytdlp_extract_info(ydl_opts, url)
 
     metadata = {
         'title': None if info.get('title') == 'Unknown' or info.get('title') == 'None' else info.get('title', 'TikTok Media'),
@@ -1529,6 +1674,7 @@ async def _download_local_tiktok(url: str, use_proxy: bool = False, progress_cal
         'width': info.get('width', 0),
         'height': info.get('height', 0),
         'verified': info.get('creator_is_verified') or info.get('uploader_is_verified') or info.get('verified') or False,
+        'thumbnail_url': info.get('thumbnail'),
     }
     
     # Check description for 'Unknown' as well
@@ -1577,7 +1723,6 @@ async def _download_local_tiktok(url: str, use_proxy: bool = False, progress_cal
 
 async def _download_tiktok_tikwm(url: str) -> Tuple[Path, Optional[Path], Dict]:
     """Fallback: download TikTok video using tikwm.com API when yt-dlp fails"""
-    import requests
     import subprocess
     
     headers = {
@@ -1591,12 +1736,11 @@ async def _download_tiktok_tikwm(url: str) -> Tuple[Path, Optional[Path], Dict]:
     # Add a small delay for TikWM free tier limit (1 req/sec)
     await asyncio.sleep(1.5)
     
-    response = requests.get(api_url, params=params, headers=headers, timeout=15)
-    
-    if response.status_code != 200:
-        raise Exception(f"tikwm API returned status {response.status_code}")
-    
-    data = response.json()
+    session = http_client.session()
+    async with session.get(api_url, params=params, headers=headers, timeout=aiohttp.ClientTimeout(total=15)) as response:
+        if response.status != 200:
+            raise Exception(f"tikwm API returned status {response.status}")
+        data = await response.json(content_type=None)
     
     if data.get('code') != 0:
         raise Exception(f"tikwm API error: {data.get('msg', 'Unknown error')}")
@@ -1623,14 +1767,14 @@ async def _download_tiktok_tikwm(url: str) -> Tuple[Path, Optional[Path], Dict]:
     unique_id = uuid.uuid4().hex[:8]
     video_path = DOWNLOADS_DIR / f"tiktok_{unique_id}.mp4"
     
-    video_response = requests.get(video_url, headers={'User-Agent': headers['User-Agent']}, stream=True, timeout=30)
-    
-    if video_response.status_code != 200:
-        raise Exception(f"Failed to download video: status {video_response.status_code}")
-    
-    with open(video_path, 'wb') as f:
-        for chunk in video_response.iter_content(chunk_size=8192):
-            f.write(chunk)
+    video_timeout = aiohttp.ClientTimeout(total=None, sock_connect=30, sock_read=30)
+    async with session.get(video_url, headers={'User-Agent': headers['User-Agent']}, timeout=video_timeout) as video_response:
+        if video_response.status != 200:
+            raise Exception(f"Failed to download video: status {video_response.status}")
+        
+        with open(video_path, 'wb') as f:
+            async for chunk in video_response.content.iter_chunked(65536):
+                f.write(chunk)
     
     logging.info(f"tikwm: Video downloaded successfully to {video_path}")
     
@@ -1639,14 +1783,13 @@ async def _download_tiktok_tikwm(url: str) -> Tuple[Path, Optional[Path], Dict]:
     if thumbnail_url:
         try:
             thumbnail_path = DOWNLOADS_DIR / f"tiktok_{unique_id}.jpg"
-            thumb_response = requests.get(thumbnail_url, headers={'User-Agent': headers['User-Agent']}, timeout=10)
-            
-            if thumb_response.status_code == 200:
-                with open(thumbnail_path, 'wb') as f:
-                    f.write(thumb_response.content)
-                logging.info(f"tikwm: Thumbnail downloaded to {thumbnail_path}")
-            else:
-                thumbnail_path = None
+            async with session.get(thumbnail_url, headers={'User-Agent': headers['User-Agent']}, timeout=aiohttp.ClientTimeout(total=10)) as thumb_response:
+                if thumb_response.status == 200:
+                    with open(thumbnail_path, 'wb') as f:
+                        f.write(await thumb_response.read())
+                    logging.info(f"tikwm: Thumbnail downloaded to {thumbnail_path}")
+                else:
+                    thumbnail_path = None
         except Exception as e:
             logging.warning(f"tikwm: Failed to download thumbnail: {e}")
             thumbnail_path = None
@@ -1673,8 +1816,12 @@ async def _download_tiktok_tikwm(url: str) -> Tuple[Path, Optional[Path], Dict]:
     
     return video_path, thumbnail_path, metadata
 
-async def _download_playlist_ytdlp(url: str, is_music: bool = True, progress_callback: Optional[Callable] = None, on_track_callback: Optional[Callable] = None) -> List[Tuple[Path, Optional[Path], dict]]:
-    """Download entire playlist/album via local yt-dlp."""
+async def _download_playlist_ytdlp(url: str, is_music: bool = True, progress_callback: Optional[Callable] = None, on_track_callback: Optional[Callable] = None, is_premium: bool = False) -> List[Tuple[Path, Optional[Path], dict]]:
+    """Download entire playlist/album via local yt-dlp.
+
+    Every track takes its own download_scheduler slot, so parallel tracks count against
+    the same per-platform and global caps as single downloads.
+    """
     playlist_results = []
     
     ydl_opts = {
@@ -1685,37 +1832,62 @@ async def _download_playlist_ytdlp(url: str, is_music: bool = True, progress_cal
     }
     
     try:
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            # We must use wait=True or similar to get entries correctly in flat mode
-            info = await asyncio.to_thread(ydl.extract_info, url, download=False)
-            entries = info.get('entries', [])
-            
-            total = len(entries)
-            if not entries: return []
-
+        info, _ = await ytdlp_extract_info(ydl_opts, url, download=False)
+        entries = info.get('entries', [])
+        
+        total = len(entries)
+        if not entries: return []
+
+        # Downloads run PLAYLIST_CONCURRENCY at a time; `window` caps how far they may run
+        # ahead of delivery. The queue holds the tasks in playlist order (the reorder buffer),
+        # so on_track_callback sees track i only after 1..i-1 while later tracks keep downloading.
+        slots = asyncio.Semaphore(PLAYLIST_CONCURRENCY)
+        window = asyncio.Semaphore(PLAYLIST_CONCURRENCY * 2)
+        pending: asyncio.Queue = asyncio.Queue()
+
+        async def fetch(entry_url: str):
+            async with slots, download_scheduler.slot('youtube', is_premium=is_premium):
+                # WE PASS skip_cleanup=True here to preserve all files for the ZIP
+                return await _download_local_ytdlp(entry_url, is_music=is_music, skip_cleanup=True)
+
+        async def feed():
             for i, entry in enumerate(entries, 1):
                 entry_url = entry.get('url') or entry.get('webpage_url')
                 if not entry_url: continue
-                
-                if progress_callback:
+                await window.acquire()
+                pending.put_nowait((i, asyncio.ensure_future(fetch(entry_url))))
+            pending.put_nowait(None)
+
+        feeder = asyncio.ensure_future(feed())
+        try:
+            while (item := await pending.get()) is not None:
+                i, task = item
+                if progress_callback and not task.done():
                     await progress_callback(f"⏳ Downloading track {i}/{total}...")
-                
                 try:
-                    # WE PASS skip_cleanup=True here to preserve all files for the ZIP
-                    res = await _download_local_ytdlp(entry_url, is_music=is_music, skip_cleanup=True)
-                    
-                    if on_track_callback:
-                        # If we have a track callback (e.g. for direct sending), use it immediately
-                        await on_track_callback(res, i, total)
-                        # We can still add to results, BUT if on_track handled it, 
-                        # maybe we don't want to keep it in memory? 
-                        # For ZIP we NEED to keep it. For 'each' we can skip.
-                    
-                    playlist_results.append(res)
+                    res = await task
                 except Exception as e:
                     logging.error(f"Error downloading playlist item {i}: {e}")
                     continue
-                    
+                finally:
+                    window.release()
+
+                if on_track_callback:
+                    # Track i is uploaded while the following ones download
+                    await on_track_callback(res, i, total)
+                playlist_results.append(res)
+        finally:
+            feeder.cancel()
+            leftover = []
+            while not pending.empty():
+                item = pending.get_nowait()
+                if item is not None:
+                    item[1].cancel()
+                    leftover.append(item[1])
+            for outcome in await asyncio.gather(*leftover, return_exceptions=True):
+                if outcome and not isinstance(outcome, BaseException):
+                    discard_result(outcome)
+                
         return playlist_results
     except Exception as e:
         logging.error(f"Playlist download error: {e}")
@@ -1723,19 +1895,18 @@ async def _download_playlist_ytdlp(url: str, is_music: bool = True, progress_cal
 
 async def _resolve_spotify_via_songlink(url: str) -> str:
     """Helper to resolve Spotify URL to YouTube Music using Odesli (song.link)."""
-    import aiohttp
     try:
         api_url = f"https://api.song.link/v1-alpha.1/links?url={url}"
-        async with aiohttp.ClientSession() as session:
-            async with session.get(api_url, timeout=10) as resp:
-                if resp.status == 200:
-                    data = await resp.json()
-                    # Try to find YouTube Music link
-                    links = data.get('linksByPlatform', {})
-                    if 'youtubeMusic' in links:
-                        return links['youtubeMusic']['url']
-                    if 'youtube' in links:
-                        return links['youtube']['url']
+        session = http_client.session()
+        async with session.get(api_url, timeout=10) as resp:
+            if resp.status == 200:
+                data = await resp.json()
+                # Try to find YouTube Music link
+                links = data.get('linksByPlatform', {})
+                if 'youtubeMusic' in links:
+                    return links['youtubeMusic']['url']
+                if 'youtube' in links:
+                    return links['youtube']['url']
     except Exception as e:
         logging.error(f"Songlink resolution failed: {e}")
     return ""
@@ -0,0 +1,253 @@
+import asyncio
+import logging
+import time
+from collections import defaultdict, deque
+from pathlib import Path
+from typing import Any, Awaitable, Callable, Deque, Dict, Iterable, Optional, Tuple
+
+from config import HEDGE_ENABLED, HEDGE_DELAYS
+from services.circuit_breaker import MethodHealth, method_health
+
+Attempt = Tuple[str, Callable[[], Awaitable[Any]]]
+
+
+def parse_hedge_delays(value: str) -> Dict[str, float]:
+    """Parses "default:20,tiktok:8" into {"default": 20.0, "tiktok": 8.0} (seconds)."""
+    delays = {}
+    for item in (value or "").split(","):
+        if ":" not in item:
+            continue
+        name, delay = item.split(":", 1)
+        try:
+            delays[name.strip().lower()] = max(0.0, float(delay))
+        except ValueError:
+            logging.warning(f"[HEDGE] Ignoring invalid hedge delay: {item}")
+    return delays
+
+
+def _iter_paths(result: Any) -> Iterable[Path]:
+    if isinstance(result, (list, tuple)):
+        for item in result:
+            yield from _iter_paths(item)
+    elif isinstance(result, Path):
+        yield result
+
+
+def discard_result(result: Any) -> None:
+    """Deletes every file referenced by a (file_path, thumbnail, metadata) result."""
+    for path in set(_iter_paths(result)):
+        try:
+            path.unlink(missing_ok=True)
+        except Exception as e:
+            logging.warning(f"[HEDGE] Failed to remove {path}: {e}")
+
+
+def _after(future: asyncio.Future, callback: Callable[[Any], None]) -> None:
+    """Calls callback(result) (None on failure) once future settles; exceptions are consumed."""
+    def done(f: asyncio.Future):
+        result = None
+        if not f.cancelled() and f.exception() is None:
+            result = f.result()
+        try:
+            callback(result)
+        except Exception as e:
+            logging.warning(f"[HEDGE] Cleanup failed: {e}")
+    future.add_done_callback(done)
+
+
+async def run_abandonable(func: Callable, *args, cleanup: Callable[[Any], None] = discard_result) -> Any:
+    """asyncio.to_thread for blocking downloaders that cannot be interrupted.
+
+    If the caller is cancelled (it lost a hedged race) the thread is left to finish and
+    whatever it produced is handed to cleanup, so no orphaned files stay behind.
+    """
+    future = asyncio.ensure_future(asyncio.to_thread(func, *args))
+    try:
+        return await asyncio.shield(future)
+    except asyncio.CancelledError:
+        _after(future, cleanup)
+        raise
+
+
+async def race(factories: Iterable[Callable[[], Awaitable[Any]]], cleanup: Optional[Callable[[Any], None]] = None) -> Any:
+    """Starts every factory at once and returns the first truthy result (None if all fail).
+
+    The others are cancelled; results that still arrive are handed to cleanup
+    (which must accept None for candidates that failed).
+    """
+    tasks = [asyncio.ensure_future(factory()) for factory in factories]
+    seen = set()
+    winner = None
+    try:
+        pending = set(tasks)
+        while pending and winner is None:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                seen.add(task)
+                if task.cancelled():
+                    continue
+                if task.exception() is not None:
+                    logging.debug(f"[RACE] Candidate failed: {task.exception()}")
+                    continue
+                result = task.result()
+                if result and winner is None:
+                    winner = result
+                elif result and cleanup:
+                    cleanup(result)
+        return winner
+    finally:
+        for task in tasks:
+            if task in seen:
+                continue
+            task.cancel()
+            if cleanup:
+                _after(task, cleanup)
+
+
+class DownloadRejected(Exception):
+    """The job itself cannot succeed (live stream, too large, too short): no other method is tried."""
+
+
+# yt-dlp messages about the link itself rather than the method that fetched it; another
+# method may still get it (cookies, a different API), but they say nothing about method health
+CONTENT_ERRORS = (
+    'private video', 'video unavailable', 'unsupported url', 'is not available', 'no longer available',
+    'has been removed', 'does not exist', 'account has been terminated', 'sign in to confirm your age',
+)
+
+
+def is_content_error(error: Optional[BaseException]) -> bool:
+    return error is not None and any(marker in str(error).lower() for marker in CONTENT_ERRORS)
+
+
+class ChainExhausted(Exception):
+    def __init__(self, errors: Dict[str, str]):
+        self.errors = errors
+        super().__init__("; ".join(f"{name}: {error}" for name, error in errors.items()) or "No download method available")
+
+
+class HedgedChain:
+    """Runs the download fallback chain, optionally hedged.
+
+    Sequential mode starts the next method only after the current one failed. In
+    hedged mode the next method is also started once the running ones have used up
+    the platform's latency budget; the first method that returns a result wins and
+    the others are cancelled (their partial files are removed).
+
+    With a MethodHealth tracker the chain is reordered per platform before it starts
+    (methods with an open circuit breaker are skipped) and every outcome is recorded.
+    """
+
+    def __init__(self, enabled: bool, delays: Dict[str, float], health: Optional[MethodHealth] = None):
+        self.enabled = enabled
+        self.delays = delays
+        self.health = health
+        self.races = 0
+        self.hedges: Dict[str, int] = defaultdict(int)
+        self.hedge_wins: Dict[str, int] = defaultdict(int)
+        self.wins: Dict[str, int] = defaultdict(int)
+        self._latency: Dict[str, Deque[float]] = defaultdict(lambda: deque(maxlen=50))
+
+    def delay_for(self, platform: str) -> Optional[float]:
+        if not self.enabled:
+            return None
+        return self.delays.get(platform, self.delays.get('default'))
+
+    async def run(self, platform: str, attempts: Deque[Attempt],
+                  on_failure: Optional[Callable[[str, BaseException], None]] = None) -> Tuple[str, Any]:
+        """Returns (method_name, result) of the first method that produced a result.
+
+        attempts is consumed from the left, so on_failure may reorder what has not started yet.
+        A method that returns None counts as failed. Raises ChainExhausted when all fail.
+        """
+        delay = self.delay_for(platform)
+        if self.health:
+            ordered = self.health.order(platform, list(attempts))
+            attempts.clear()
+            attempts.extend(ordered)
+        running: Dict[asyncio.Task, Tuple[str, bool, float]] = {}
+        errors: Dict[str, str] = {}
+        chain_started = time.monotonic()
+        self.races += 1
+
+        def launch(hedged: bool):
+            name, factory = attempts.popleft()
+            if hedged:
+                self.hedges[platform] += 1
+                logging.info(f"[HEDGE] {platform}: no result after {delay:.0f}s, starting {name} in parallel")
+            running[asyncio.ensure_future(factory())] = (name, hedged, time.monotonic())
+
+        if attempts:
+            launch(False)
+        try:
+            while running:
+                timeout = delay if attempts else None
+                done, _ = await asyncio.wait(running, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    launch(True)
+                    continue
+
+                for task in done:
+                    name, hedged, started_at = running.pop(task)
+                    error = task.exception() if not task.cancelled() else asyncio.CancelledError()
+                    result = task.result() if error is None else None
+                    if isinstance(error, DownloadRejected):
+                        await self._cancel_losers(platform, running)
+                        raise error
+                    if self.health:
+                        if is_content_error(error):
+                            # A bad link must not trip a healthy method's breaker for everyone
+                            self.health.release_probe(platform, name)
+                        else:
+                            self.health.record(platform, name, bool(result), time.monotonic() - started_at)
+                    if result:
+                        self.wins[name] += 1
+                        if hedged:
+                            self.hedge_wins[platform] += 1
+                        self._latency[platform].append(time.monotonic() - chain_started)
+                        await self._cancel_losers(platform, running)
+                        return name, result
+                    errors[name] = f"{type(error).__name__}: {error}" if error else "no file returned"
+                    if on_failure:
+                        on_failure(name, error or Exception("no file returned"))
+
+                if not running and attempts:
+                    launch(False)
+        except asyncio.CancelledError:
+            await self._cancel_losers(platform, running)
+            raise
+        finally:
+            # Methods that never ran give back any half-open probe slot order() reserved for them
+            if self.health:
+                for name, _ in attempts:
+                    self.health.release_probe(platform, name)
+
+        raise ChainExhausted(errors)
+
+    async def _cancel_losers(self, platform: str, running: Dict[asyncio.Task, Tuple[str, bool, float]]) -> None:
+        tasks = list(running)
+        names = [name for name, _, _ in running.values()]
+        running.clear()
+        for task in tasks:
+            task.cancel()
+        if self.health:
+            for name in names:
+                self.health.release_probe(platform, name)
+        for task, outcome in zip(tasks, await asyncio.gather(*tasks, return_exceptions=True)):
+            # Finished between our decision and the cancel - its files are not needed
+            if outcome and not isinstance(outcome, BaseException):
+                discard_result(outcome)
+
+    def get_stats(self) -> dict:
+        return {
+            'enabled': self.enabled,
+            'delays': dict(self.delays),
+            'races': self.races,
+            'hedges': dict(self.hedges),
+            'hedge_wins': dict(self.hedge_wins),
+            'wins': dict(self.wins),
+            'avg_latency': {p: sum(v) / len(v) for p, v in self._latency.items() if v},
+        }
+
+
+fallback_chain = HedgedChain(HEDGE_ENABLED, parse_hedge_delays(HEDGE_DELAYS), health=method_health)
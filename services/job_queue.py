@@ -0,0 +1,316 @@
+import asyncio
+import logging
+import os
+import socket
+import uuid
+from datetime import datetime, timedelta
+from typing import Awaitable, Callable, Optional
+
+from sqlalchemy import create_engine, or_, and_, func
+from sqlalchemy.orm import sessionmaker
+
+from config import DATA_DIR, JOB_LEASE_SECONDS, JOB_HEARTBEAT_SECONDS, JOB_MAX_ATTEMPTS, JOB_WORKERS, JOB_POLL_SECONDS
+from database.models import DownloadQueueItem
+from database.storage import stats
+
+ACTIVE_STATES = ('running', 'uploading')
+JOB_FIELDS = (
+    'id', 'user_id', 'url', 'status', 'chat_id', 'message_thread_id', 'reply_to_message_id',
+    'status_message_id', 'username', 'platform', 'is_music', 'video_height', 'is_premium',
+    'attempts', 'max_attempts', 'last_error',
+)
+
+
+def _now() -> datetime:
+    return datetime.utcnow()
+
+
+class JobQueue:
+    """Durable download jobs on the download_queue table.
+
+    A job is owned through a lease (lease_owner + lease_expires_at) that the owner keeps
+    alive with heartbeats. Jobs whose lease ran out - the process died or was redeployed
+    mid-download - are claimed again by the worker pool and resumed. Postgres claims use
+    SELECT ... FOR UPDATE SKIP LOCKED so several bot replicas can share one queue; in
+    JSON-fallback mode the queue lives in a local SQLite file.
+    """
+
+    def __init__(self):
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
+        self.Session = stats.Session
+        self.backend = "database"
+
+        if not self.Session:
+            try:
+                engine = create_engine(f"sqlite:///{DATA_DIR / 'jobs.db'}", connect_args={"check_same_thread": False})
+                DownloadQueueItem.__table__.create(engine, checkfirst=True)
+                self.Session = sessionmaker(bind=engine)
+                self.backend = "sqlite"
+            except Exception as e:
+                logging.error(f"[JOBS] Failed to open SQLite job queue: {e}")
+                self.Session = None
+                self.backend = "disabled"
+
+        self.resumed = 0
+        self.retried = 0
+        self.failed = 0
+        self._workers = []
+
+    # --- job lifecycle ---
+
+    def enqueue(self, url: str, user_id: int, chat_id: int, **fields) -> Optional[int]:
+        """Persists a new job leased to this process (the caller is expected to work on it)."""
+        if not self.Session:
+            return None
+        try:
+            with self.Session() as session:
+                now = _now()
+                job = DownloadQueueItem(
+                    url=url,
+                    user_id=user_id,
+                    chat_id=chat_id,
+                    status='pending',
+                    attempts=0,
+                    max_attempts=JOB_MAX_ATTEMPTS,
+                    lease_owner=self.worker_id,
+                    lease_expires_at=now + timedelta(seconds=JOB_LEASE_SECONDS),
+                    heartbeat_at=now,
+                    added_at=now,
+                    updated_at=now,
+                    **fields
+                )
+                session.add(job)
+                session.commit()
+                return job.id
+        except Exception as e:
+            logging.error(f"[JOBS] Failed to enqueue job for {url}: {e}")
+            return None
+
+    def update(self, job_id: Optional[int], status: str = None, **fields) -> None:
+        if not self.Session or not job_id:
+            return
+        try:
+            with self.Session() as session:
+                job = session.query(DownloadQueueItem).filter_by(id=job_id).first()
+                if not job:
+                    return
+                if status:
+                    job.status = status
+                    if status in ('running', 'uploading'):
+                        job.lease_owner = self.worker_id
+                        job.lease_expires_at = _now() + timedelta(seconds=JOB_LEASE_SECONDS)
+                    elif status in ('done', 'failed'):
+                        job.lease_owner = None
+                        job.lease_expires_at = None
+                for name, value in fields.items():
+                    setattr(job, name, value)
+                job.updated_at = _now()
+                session.commit()
+        except Exception as e:
+            logging.error(f"[JOBS] Failed to update job {job_id}: {e}")
+
+    def heartbeat(self, job_id: int) -> bool:
+        """Extends our lease; returns False if the job is no longer ours."""
+        if not self.Session:
+            return False
+        try:
+            with self.Session() as session:
+                now = _now()
+                updated = session.query(DownloadQueueItem).filter(
+                    DownloadQueueItem.id == job_id,
+                    DownloadQueueItem.lease_owner == self.worker_id,
+                ).update({
+                    DownloadQueueItem.heartbeat_at: now,
+                    DownloadQueueItem.lease_expires_at: now + timedelta(seconds=JOB_LEASE_SECONDS),
+                }, synchronize_session=False)
+                session.commit()
+                return updated == 1
+        except Exception as e:
+            logging.error(f"[JOBS] Heartbeat failed for job {job_id}: {e}")
+            return False
+
+    def fail_or_retry(self, job_id: int, error: str) -> str:
+        """Records a failed attempt; the job goes back to pending until max_attempts is reached."""
+        if not self.Session:
+            return 'failed'
+        try:
+            with self.Session() as session:
+                job = session.query(DownloadQueueItem).filter_by(id=job_id).first()
+                if not job:
+                    return 'failed'
+                job.attempts = (job.attempts or 0) + 1
+                job.last_error = str(error)[:500]
+                job.lease_owner = None
+                job.lease_expires_at = None
+                job.updated_at = _now()
+                if job.attempts >= (job.max_attempts or JOB_MAX_ATTEMPTS):
+                    job.status = 'failed'
+                    self.failed += 1
+                else:
+                    job.status = 'pending'
+                    self.retried += 1
+                session.commit()
+                return job.status
+        except Exception as e:
+            logging.error(f"[JOBS] Failed to record failure for job {job_id}: {e}")
+            return 'failed'
+
+    def claim(self) -> Optional[dict]:
+        """Claims the oldest pending job or a job whose owner stopped heartbeating."""
+        if not self.Session:
+            return None
+        try:
+            with self.Session() as session:
+                now = _now()
+                claimable = or_(
+                    and_(DownloadQueueItem.status == 'pending',
+                         or_(DownloadQueueItem.lease_expires_at.is_(None), DownloadQueueItem.lease_expires_at < now)),
+                    and_(DownloadQueueItem.status.in_(ACTIVE_STATES),
+                         or_(DownloadQueueItem.lease_expires_at.is_(None), DownloadQueueItem.lease_expires_at < now)),
+                )
+                job = session.query(DownloadQueueItem).filter(claimable)\
+                    .order_by(DownloadQueueItem.added_at.asc())\
+                    .with_for_update(skip_locked=True)\
+                    .first()
+                if not job:
+                    session.rollback()
+                    return None
+
+                # Conditional update keeps the claim atomic on SQLite, where FOR UPDATE is a no-op
+                previous_owner = job.lease_owner
+                updated = session.query(DownloadQueueItem).filter(
+                    DownloadQueueItem.id == job.id,
+                    or_(DownloadQueueItem.lease_owner.is_(None), DownloadQueueItem.lease_owner == previous_owner),
+                    or_(DownloadQueueItem.lease_expires_at.is_(None), DownloadQueueItem.lease_expires_at < now),
+                ).update({
+                    DownloadQueueItem.status: 'running',
+                    DownloadQueueItem.lease_owner: self.worker_id,
+                    DownloadQueueItem.lease_expires_at: now + timedelta(seconds=JOB_LEASE_SECONDS),
+                    DownloadQueueItem.heartbeat_at: now,
+                    DownloadQueueItem.updated_at: now,
+                }, synchronize_session=False)
+                session.commit()
+                if updated != 1:
+                    return None
+
+                session.refresh(job)
+                return {name: getattr(job, name) for name in JOB_FIELDS}
+        except Exception as e:
+            logging.error(f"[JOBS] Failed to claim job: {e}")
+            return None
+
+    def release_leases(self) -> int:
+        """Hands our unfinished jobs back to the queue so the next process resumes them immediately."""
+        if not self.Session:
+            return 0
+        try:
+            with self.Session() as session:
+                released = session.query(DownloadQueueItem).filter(
+                    DownloadQueueItem.lease_owner == self.worker_id,
+                    DownloadQueueItem.status.in_(('pending',) + ACTIVE_STATES),
+                ).update({
+                    DownloadQueueItem.status: 'pending',
+                    DownloadQueueItem.lease_owner: None,
+                    DownloadQueueItem.lease_expires_at: None,
+                    DownloadQueueItem.updated_at: _now(),
+                }, synchronize_session=False)
+                session.commit()
+                if released:
+                    logging.info(f"[JOBS] Released {released} unfinished job(s) for resume after restart")
+                return released
+        except Exception as e:
+            logging.error(f"[JOBS] Failed to release leases: {e}")
+            return 0
+
+    def purge_finished(self, older_than_days: int = 7) -> None:
+        if not self.Session:
+            return
+        try:
+            with self.Session() as session:
+                session.query(DownloadQueueItem).filter(
+                    DownloadQueueItem.status.in_(('done', 'failed')),
+                    DownloadQueueItem.updated_at < _now() - timedelta(days=older_than_days),
+                ).delete(synchronize_session=False)
+                session.commit()
+        except Exception as e:
+            logging.error(f"[JOBS] Failed to purge finished jobs: {e}")
+
+    # --- heartbeats & workers ---
+
+    def keep_alive(self, job_id: Optional[int]) -> Optional[asyncio.Task]:
+        """Starts a background heartbeat for job_id; cancel the returned task when done."""
+        if not self.Session or not job_id:
+            return None
+
+        async def beat():
+            while True:
+                await asyncio.sleep(JOB_HEARTBEAT_SECONDS)
+                if not await asyncio.to_thread(self.heartbeat, job_id):
+                    logging.warning(f"[JOBS] Lost lease on job {job_id}")
+                    return
+
+        return asyncio.create_task(beat())
+
+    async def _worker_loop(self, index: int, executor: Callable[[dict], Awaitable[None]]):
+        while True:
+            try:
+                job = await asyncio.to_thread(self.claim)
+                if not job:
+                    await asyncio.sleep(JOB_POLL_SECONDS)
+                    continue
+
+                self.resumed += 1
+                logging.info(f"[JOBS] Worker {index} resuming job {job['id']} ({job['status']}, attempt {job['attempts'] + 1}): {job['url']}")
+                heartbeat_task = self.keep_alive(job['id'])
+                try:
+                    await executor(job)
+                    await asyncio.to_thread(self.update, job['id'], 'done')
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    state = await asyncio.to_thread(self.fail_or_retry, job['id'], str(e))
+                    logging.error(f"[JOBS] Job {job['id']} failed ({state}): {e}")
+                finally:
+                    if heartbeat_task:
+                        heartbeat_task.cancel()
+            except asyncio.CancelledError:
+                break
+            except Exception as e:
+                logging.error(f"[JOBS] Worker {index} error: {e}")
+                await asyncio.sleep(JOB_POLL_SECONDS)
+
+    def start_workers(self, executor: Callable[[dict], Awaitable[None]], concurrency: int = JOB_WORKERS) -> None:
+        if not self.Session:
+            logging.warning("[JOBS] Job queue disabled (no database available)")
+            return
+        self.purge_finished()
+        for index in range(max(1, concurrency)):
+            self._workers.append(asyncio.create_task(self._worker_loop(index, executor)))
+        logging.info(f"[JOBS] Started {len(self._workers)} job worker(s) ({self.backend}, id {self.worker_id})")
+
+    async def shutdown(self) -> None:
+        for task in self._workers:
+            task.cancel()
+        self._workers.clear()
+        await asyncio.to_thread(self.release_leases)
+
+    def get_stats(self) -> dict:
+        counts = {}
+        if self.Session:
+            try:
+                with self.Session() as session:
+                    rows = session.query(DownloadQueueItem.status, func.count(DownloadQueueItem.id))\
+                        .group_by(DownloadQueueItem.status).all()
+                    counts = {status: count for status, count in rows}
+            except Exception as e:
+                logging.error(f"[JOBS] Failed to count jobs: {e}")
+        return {
+            'backend': self.backend,
+            'counts': counts,
+            'resumed': self.resumed,
+            'retried': self.retried,
+            'failed': self.failed,
+        }
+
+
+job_queue = JobQueue()
@@ -0,0 +1,64 @@
+import asyncio
+import logging
+import time
+from collections import deque
+from typing import Optional
+
+from config import LOOP_MONITOR_INTERVAL_MS, LOOP_STALL_THRESHOLD_MS
+
+
+class LoopMonitor:
+    """Measures event-loop stalls: how late a periodic wake-up fires.
+
+    Any blocking call on the loop (subprocess.run, file I/O, CPU work) shows up as
+    lag; lags above `threshold` count as stalls and are logged with their length.
+    """
+
+    def __init__(self, interval_ms: int, threshold_ms: int):
+        self.interval = max(10, interval_ms) / 1000
+        self.threshold = max(1, threshold_ms) / 1000
+        self._task: Optional[asyncio.Task] = None
+        self._lags = deque(maxlen=600)
+        self.stalls = 0
+        self.stall_time = 0.0
+        self.max_lag = 0.0
+
+    def start(self) -> None:
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self) -> None:
+        while True:
+            started = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            lag = max(0.0, time.perf_counter() - started - self.interval)
+            self._lags.append(lag)
+            self.max_lag = max(self.max_lag, lag)
+            if lag >= self.threshold:
+                self.stalls += 1
+                self.stall_time += lag
+                logging.warning(f"[LOOP] ⚠️ Event loop stalled for {lag * 1000:.0f} ms")
+
+    def get_stats(self) -> dict:
+        lags = sorted(self._lags)
+        return {
+            'running': self._task is not None and not self._task.done(),
+            'avg_lag_ms': sum(lags) / len(lags) * 1000 if lags else 0.0,
+            'p99_lag_ms': lags[min(len(lags) - 1, int(len(lags) * 0.99))] * 1000 if lags else 0.0,
+            'max_lag_ms': self.max_lag * 1000,
+            'stalls': self.stalls,
+            'stall_time': self.stall_time,
+            'threshold_ms': self.threshold * 1000,
+        }
+
+
+loop_monitor = LoopMonitor(LOOP_MONITOR_INTERVAL_MS, LOOP_STALL_THRESHOLD_MS)
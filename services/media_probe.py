@@ -0,0 +1,402 @@
+import asyncio
+import json
+import logging
+import struct
+import subprocess
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import BinaryIO, Iterator, Optional, Tuple, Union
+
+# Probed files are short-lived; this only has to cover the jobs currently in flight
+CACHE_SIZE = 512
+
+MP4_TOP_LEVEL = {b'ftyp', b'moov', b'mdat', b'free', b'skip', b'wide', b'moof', b'styp', b'sidx'}
+
+MP4_CODECS = {
+    'avc1': 'h264', 'avc3': 'h264', 'hvc1': 'hevc', 'hev1': 'hevc', 'av01': 'av1',
+    'vp09': 'vp9', 'vp08': 'vp8', 'mp4v': 'mpeg4', 'mp4a': 'aac', 'Opus': 'opus',
+    'ac-3': 'ac3', 'ec-3': 'eac3', 'fLaC': 'flac', '.mp3': 'mp3', 'alac': 'alac',
+}
+
+MATROSKA_CODECS = {
+    'V_VP9': 'vp9', 'V_VP8': 'vp8', 'V_AV1': 'av1', 'V_MPEG4/ISO/AVC': 'h264',
+    'V_MPEGH/ISO/HEVC': 'hevc', 'A_OPUS': 'opus', 'A_VORBIS': 'vorbis', 'A_MPEG/L3': 'mp3',
+    'A_FLAC': 'flac', 'A_AC3': 'ac3', 'A_EAC3': 'eac3',
+}
+
+# Matroska element IDs (with their length marker, as they appear in the file)
+EBML_HEADER, EBML_DOCTYPE = 0x1A45DFA3, 0x4282
+MKV_SEGMENT, MKV_INFO, MKV_TRACKS, MKV_CLUSTER = 0x18538067, 0x1549A966, 0x1654AE6B, 0x1F43B675
+MKV_TIMECODE_SCALE, MKV_DURATION = 0x2AD7B1, 0x4489
+MKV_TRACK_ENTRY, MKV_TRACK_TYPE, MKV_CODEC_ID = 0xAE, 0x83, 0x86
+MKV_VIDEO, MKV_PIXEL_WIDTH, MKV_PIXEL_HEIGHT = 0xE0, 0xB0, 0xBA
+
+
+class MediaInfo:
+    """Everything the bot needs to know about a media file, from one probe."""
+
+    __slots__ = ("container", "video_codec", "audio_codec", "width", "height",
+                 "duration", "bitrate", "faststart", "source")
+
+    def __init__(self, container: str = "", video_codec: str = "", audio_codec: str = "",
+                 width: int = 0, height: int = 0, duration: float = 0.0, bitrate: int = 0,
+                 faststart: Optional[bool] = None, source: str = ""):
+        self.container = container
+        self.video_codec = video_codec
+        self.audio_codec = audio_codec
+        self.width = width
+        self.height = height
+        self.duration = duration
+        self.bitrate = bitrate
+        # moov before mdat (MP4 only); None when it does not apply
+        self.faststart = faststart
+        self.source = source
+
+    @property
+    def dimensions(self) -> Tuple[int, int]:
+        return self.width, self.height
+
+    @property
+    def complete(self) -> bool:
+        return self.duration > 0 and bool(self.video_codec or self.audio_codec)
+
+    def __repr__(self) -> str:
+        return (f"MediaInfo({self.container} {self.video_codec or '-'}/{self.audio_codec or '-'} "
+                f"{self.width}x{self.height} {self.duration:.1f}s {self.bitrate // 1000}kbps "
+                f"faststart={self.faststart} via {self.source})")
+
+
+# ── MP4 / MOV ────────────────────────────────────────────────────────────────
+
+def _mp4_boxes(f: BinaryIO, start: int, end: int) -> Iterator[Tuple[bytes, int, int]]:
+    """Yields (type, body_start, box_end) for the boxes between start and end."""
+    pos = start
+    while pos + 8 <= end:
+        f.seek(pos)
+        header = f.read(8)
+        if len(header) < 8:
+            return
+        size, kind = struct.unpack('>I4s', header)
+        header_len = 8
+        if size == 1:
+            size = struct.unpack('>Q', f.read(8))[0]
+            header_len = 16
+        elif size == 0:
+            size = end - pos
+        if size < header_len:
+            return
+        yield kind, pos + header_len, min(pos + size, end)
+        pos += size
+
+
+def _mp4_child(f: BinaryIO, start: int, end: int, kind: bytes) -> Optional[Tuple[int, int]]:
+    for child, body, box_end in _mp4_boxes(f, start, end):
+        if child == kind:
+            return body, box_end
+    return None
+
+
+def _read_at(f: BinaryIO, pos: int, size: int) -> bytes:
+    f.seek(pos)
+    return f.read(size)
+
+
+def _mp4_time(f: BinaryIO, body: int) -> Tuple[int, int]:
+    """(timescale, duration) from an mvhd/mdhd box body."""
+    version = _read_at(f, body, 1)[0]
+    if version == 1:
+        return struct.unpack('>IQ', _read_at(f, body + 20, 12))
+    return struct.unpack('>II', _read_at(f, body + 12, 8))
+
+
+def _parse_mp4(f: BinaryIO, file_size: int) -> Optional[MediaInfo]:
+    info = MediaInfo(container="mp4", source="parser")
+    order = []
+    moov = None
+    for kind, body, end in _mp4_boxes(f, 0, file_size):
+        if not order and kind not in MP4_TOP_LEVEL:
+            return None
+        order.append(kind)
+        if kind == b'moov':
+            moov = (body, end)
+    if moov is None:
+        return None
+    info.faststart = b'mdat' not in order or order.index(b'moov') < order.index(b'mdat')
+
+    mvhd = _mp4_child(f, *moov, b'mvhd')
+    if mvhd:
+        timescale, duration = _mp4_time(f, mvhd[0])
+        if not duration:
+            # Fragmented MP4: total length is in mvex/mehd (same timescale)
+            mvex = _mp4_child(f, *moov, b'mvex')
+            mehd = _mp4_child(f, *mvex, b'mehd') if mvex else None
+            if mehd:
+                version = _read_at(f, mehd[0], 1)[0]
+                fmt = '>Q' if version == 1 else '>I'
+                duration = struct.unpack(fmt, _read_at(f, mehd[0] + 4, struct.calcsize(fmt)))[0]
+        if timescale:
+            info.duration = duration / timescale
+
+    for kind, body, end in _mp4_boxes(f, *moov):
+        if kind != b'trak':
+            continue
+        mdia = _mp4_child(f, body, end, b'mdia')
+        hdlr = _mp4_child(f, *mdia, b'hdlr') if mdia else None
+        if not hdlr:
+            continue
+        handler = _read_at(f, hdlr[0] + 8, 4)
+        minf = _mp4_child(f, *mdia, b'minf')
+        stbl = _mp4_child(f, *minf, b'stbl') if minf else None
+        stsd = _mp4_child(f, *stbl, b'stsd') if stbl else None
+        if not stsd:
+            continue
+        entry = stsd[0] + 8
+        fourcc = _read_at(f, entry + 4, 4).decode('latin-1')
+        codec = MP4_CODECS.get(fourcc, fourcc.strip().lower())
+
+        if not info.duration:
+            mdhd = _mp4_child(f, *mdia, b'mdhd')
+            if mdhd:
+                timescale, duration = _mp4_time(f, mdhd[0])
+                if timescale:
+                    info.duration = duration / timescale
+
+        if handler == b'vide' and not info.video_codec:
+            info.video_codec = codec
+            info.width, info.height = struct.unpack('>HH', _read_at(f, entry + 32, 4))
+        elif handler == b'soun' and not info.audio_codec:
+            info.audio_codec = codec
+    return info
+
+
+# ── Matroska / WebM ──────────────────────────────────────────────────────────
+
+def _ebml_vint(f: BinaryIO, keep_marker: bool) -> Tuple[Optional[int], int]:
+    first = f.read(1)
+    if not first:
+        return None, 0
+    length, mask = 1, 0x80
+    while length <= 8 and not first[0] & mask:
+        length += 1
+        mask >>= 1
+    if length > 8:
+        raise ValueError("invalid EBML variable-length integer")
+    value = first[0] if keep_marker else first[0] & (mask - 1)
+    for byte in f.read(length - 1):
+        value = (value << 8) | byte
+    return value, length
+
+
+def _ebml_elements(f: BinaryIO, start: int, end: int) -> Iterator[Tuple[int, int, int]]:
+    """Yields (id, body_start, element_end); unknown sizes extend to end."""
+    pos = start
+    while pos < end:
+        f.seek(pos)
+        element_id, id_len = _ebml_vint(f, keep_marker=True)
+        if element_id is None:
+            return
+        size, size_len = _ebml_vint(f, keep_marker=False)
+        if size is None:
+            return
+        body = pos + id_len + size_len
+        unknown = size == (1 << (7 * size_len)) - 1
+        element_end = end if unknown else min(body + size, end)
+        yield element_id, body, element_end
+        pos = element_end
+
+
+def _ebml_uint(f: BinaryIO, body: int, end: int) -> int:
+    return int.from_bytes(_read_at(f, body, end - body), 'big')
+
+
+def _parse_matroska(f: BinaryIO, file_size: int) -> Optional[MediaInfo]:
+    elements = _ebml_elements(f, 0, file_size)
+    header = next(elements, None)
+    if not header or header[0] != EBML_HEADER:
+        return None
+    info = MediaInfo(container="matroska", source="parser")
+    for element_id, body, end in _ebml_elements(f, header[1], header[2]):
+        if element_id == EBML_DOCTYPE:
+            info.container = _read_at(f, body, end - body).decode('ascii', 'replace').strip('\x00') or "matroska"
+
+    segment = next(elements, None)
+    if not segment or segment[0] != MKV_SEGMENT:
+        return None
+    timecode_scale, duration, have_tracks = 1_000_000, 0.0, False
+    for element_id, body, end in _ebml_elements(f, segment[1], segment[2]):
+        if element_id == MKV_INFO:
+            for child_id, child_body, child_end in _ebml_elements(f, body, end):
+                if child_id == MKV_TIMECODE_SCALE:
+                    timecode_scale = _ebml_uint(f, child_body, child_end) or timecode_scale
+                elif child_id == MKV_DURATION:
+                    raw = _read_at(f, child_body, child_end - child_body)
+                    duration = struct.unpack('>f' if len(raw) == 4 else '>d', raw)[0]
+        elif element_id == MKV_TRACKS:
+            have_tracks = True
+            for entry_id, entry_body, entry_end in _ebml_elements(f, body, end):
+                if entry_id == MKV_TRACK_ENTRY:
+                    _read_matroska_track(f, entry_body, entry_end, info)
+        elif element_id == MKV_CLUSTER:
+            # Media data starts here; Info and Tracks always come first in files we produce
+            break
+    if not have_tracks:
+        return None
+    info.duration = duration * timecode_scale / 1e9
+    return info
+
+
+def _read_matroska_track(f: BinaryIO, body: int, end: int, info: MediaInfo) -> None:
+    track_type, codec, width, height = 0, "", 0, 0
+    for element_id, child_body, child_end in _ebml_elements(f, body, end):
+        if element_id == MKV_TRACK_TYPE:
+            track_type = _ebml_uint(f, child_body, child_end)
+        elif element_id == MKV_CODEC_ID:
+            codec_id = _read_at(f, child_body, child_end - child_body).decode('ascii', 'replace').strip('\x00')
+            codec = MATROSKA_CODECS.get(codec_id) or ('aac' if codec_id.startswith('A_AAC') else codec_id.lower())
+        elif element_id == MKV_VIDEO:
+            for video_id, video_body, video_end in _ebml_elements(f, child_body, child_end):
+                if video_id == MKV_PIXEL_WIDTH:
+                    width = _ebml_uint(f, video_body, video_end)
+                elif video_id == MKV_PIXEL_HEIGHT:
+                    height = _ebml_uint(f, video_body, video_end)
+    if track_type == 1 and not info.video_codec:
+        info.video_codec, info.width, info.height = codec, width, height
+    elif track_type == 2 and not info.audio_codec:
+        info.audio_codec = codec
+
+
+# ── ffprobe fallback ─────────────────────────────────────────────────────────
+
+def _ffprobe(path: Path) -> Optional[MediaInfo]:
+    cmd = [
+        "ffprobe", "-v", "error",
+        "-show_entries", "format=format_name,duration,bit_rate:stream=codec_type,codec_name,width,height",
+        "-of", "json",
+        str(path)
+    ]
+    try:
+        result = subprocess.run(cmd, capture_output=True, text=True, timeout=15)
+        if result.returncode != 0:
+            return None
+        data = json.loads(result.stdout or "{}")
+    except Exception as e:
+        logging.warning(f"[PROBE] ffprobe failed for {path.name}: {e}")
+        return None
+
+    fmt = data.get("format") or {}
+    info = MediaInfo(container=(fmt.get("format_name") or "").split(",")[0], source="ffprobe")
+    try:
+        info.duration = float(fmt.get("duration") or 0)
+        info.bitrate = int(fmt.get("bit_rate") or 0)
+    except ValueError:
+        pass
+    for stream in data.get("streams") or []:
+        if stream.get("codec_type") == "video" and not info.video_codec:
+            info.video_codec = (stream.get("codec_name") or "").lower()
+            info.width, info.height = int(stream.get("width") or 0), int(stream.get("height") or 0)
+        elif stream.get("codec_type") == "audio" and not info.audio_codec:
+            info.audio_codec = (stream.get("codec_name") or "").lower()
+    return info
+
+
+class MediaProbe:
+    """Codec, dimensions, duration, bitrate and faststart flag of a file, from one probe.
+
+    MP4/MOV and Matroska/WebM headers are parsed in Python (a few small reads, no
+    subprocess); anything else, or a header that lacks what we need, goes to a
+    single ffprobe call. Results are memoized by (path, size, mtime), so every step
+    of a job (codec check, thumbnail, upload) shares one probe.
+    """
+
+    def __init__(self, cache_size: int = CACHE_SIZE):
+        self.cache_size = cache_size
+        self._cache: "OrderedDict[Tuple[str, int, int], MediaInfo]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.parsed = 0
+        self.ffprobe_calls = 0
+        self.failures = 0
+
+    def _parse(self, path: Path, file_size: int) -> Optional[MediaInfo]:
+        try:
+            with open(path, 'rb') as f:
+                head = f.read(12)
+                if head[:4] == b'\x1a\x45\xdf\xa3':
+                    return _parse_matroska(f, file_size)
+                if head[4:8] in MP4_TOP_LEVEL:
+                    return _parse_mp4(f, file_size)
+        except Exception as e:
+            logging.debug(f"[PROBE] Header parse failed for {path.name}: {e}")
+        return None
+
+    def probe(self, path: Union[str, Path]) -> MediaInfo:
+        """Blocking probe; never raises (an unreadable file gives an empty MediaInfo)."""
+        path = Path(path)
+        try:
+            st = path.stat()
+        except OSError:
+            return MediaInfo()
+        key = (str(path), st.st_size, st.st_mtime_ns)
+        with self._lock:
+            cached = self._cache.get(key)
+            if cached is not None:
+                self._cache.move_to_end(key)
+                self.hits += 1
+                return cached
+
+        info = self._parse(path, st.st_size)
+        if info is not None and info.complete:
+            self.parsed += 1
+        else:
+            self.ffprobe_calls += 1
+            probed = _ffprobe(path)
+            if probed is None:
+                self.failures += 1
+                info = info or MediaInfo()
+            elif info is None:
+                info = probed
+            else:
+                # Keep what the header gave us (faststart), fill the gaps from ffprobe
+                for field in ("video_codec", "audio_codec", "width", "height", "duration", "bitrate"):
+                    if not getattr(info, field):
+                        setattr(info, field, getattr(probed, field))
+                info.source = "parser+ffprobe"
+        if info.duration and not info.bitrate:
+            info.bitrate = int(st.st_size * 8 / info.duration)
+
+        with self._lock:
+            self._cache[key] = info
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return info
+
+    async def aprobe(self, path: Union[str, Path]) -> MediaInfo:
+        """probe() off the event loop (cache hits return without a thread hop)."""
+        path = Path(path)
+        try:
+            st = path.stat()
+            key = (str(path), st.st_size, st.st_mtime_ns)
+        except OSError:
+            return MediaInfo()
+        with self._lock:
+            cached = self._cache.get(key)
+            if cached is not None:
+                self._cache.move_to_end(key)
+                self.hits += 1
+                return cached
+        return await asyncio.to_thread(self.probe, path)
+
+    def get_stats(self) -> dict:
+        probes = self.parsed + self.ffprobe_calls
+        return {
+            'cached': len(self._cache),
+            'hits': self.hits,
+            'parsed': self.parsed,
+            'ffprobe': self.ffprobe_calls,
+            'failures': self.failures,
+            'parser_rate': self.parsed / probes * 100 if probes else 0.0,
+        }
+
+
+media_probe = MediaProbe()
@@ -5,6 +5,7 @@ import asyncio
 from pathlib import Path
 from typing import Dict, Optional
 from config import DOWNLOADS_DIR
+from services.http_client import http_client
 
 try:
     from ytmusicapi import YTMusic as _YTMusic
@@ -32,14 +33,14 @@ async def search_ytmusic_video_id(query: str) -> Optional[str]:
         deezer_url = "https://api.deezer.com/search/track"
         params = {"q": query, "limit": 1}
         timeout = aiohttp.ClientTimeout(total=5)
-        async with aiohttp.ClientSession() as session:
-            async with session.get(deezer_url, params=params, timeout=timeout) as resp:
-                if resp.status == 200:
-                    data = await resp.json(content_type=None)
-                    items = data.get("data", [])
-                    if items:
-                        isrc = items[0].get("isrc")
-                        logging.info(f"[SEARCH] Deezer ISRC for '{query}': {isrc}")
+        session = http_client.session()
+        async with session.get(deezer_url, params=params, timeout=timeout) as resp:
+            if resp.status == 200:
+                data = await resp.json(content_type=None)
+                items = data.get("data", [])
+                if items:
+                    isrc = items[0].get("isrc")
+                    logging.info(f"[SEARCH] Deezer ISRC for '{query}': {isrc}")
     except Exception as e:
         logging.warning(f"[SEARCH] Deezer ISRC lookup failed: {e}")
 
@@ -91,27 +92,27 @@ async def fetch_song_metadata(query: str) -> Dict[str, str]:
     
     metadata = {}
     try:
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url, params=params, timeout=5) as response:
-                if response.status == 200:
-                    data = await response.json(content_type=None)
-                    if data.get("resultCount", 0) > 0:
-                        result = data["results"][0]
-                        metadata["title"] = result.get("trackName")
-                        metadata["artist"] = result.get("artistName")
-                        metadata["album"] = result.get("collectionName")
-                        # Get a high-res cover art (iTunes returns 100x100, we replace to 1000x1000)
-                        if "artworkUrl100" in result:
-                            cover_url = result["artworkUrl100"].replace("100x100bb", "1000x1000bb")
-                            metadata["cover_url"] = cover_url
-                            
-                            # Download the cover locally
-                            async with session.get(cover_url, timeout=10) as img_resp:
-                                if img_resp.status == 200:
-                                    img_path = DOWNLOADS_DIR / f"cover_{uuid.uuid4().hex[:8]}.jpg"
-                                    with open(img_path, "wb") as f:
-                                        f.write(await img_resp.read())
-                                    metadata["local_cover_path"] = str(img_path)
+        session = http_client.session()
+        async with session.get(url, params=params, timeout=5) as response:
+            if response.status == 200:
+                data = await response.json(content_type=None)
+                if data.get("resultCount", 0) > 0:
+                    result = data["results"][0]
+                    metadata["title"] = result.get("trackName")
+                    metadata["artist"] = result.get("artistName")
+                    metadata["album"] = result.get("collectionName")
+                    # Get a high-res cover art (iTunes returns 100x100, we replace to 1000x1000)
+                    if "artworkUrl100" in result:
+                        cover_url = result["artworkUrl100"].replace("100x100bb", "1000x1000bb")
+                        metadata["cover_url"] = cover_url
+                        
+                        # Download the cover locally
+                        async with session.get(cover_url, timeout=10) as img_resp:
+                            if img_resp.status == 200:
+                                img_path = DOWNLOADS_DIR / f"cover_{uuid.uuid4().hex[:8]}.jpg"
+                                with open(img_path, "wb") as f:
+                                    f.write(await img_resp.read())
+                                metadata["local_cover_path"] = str(img_path)
     except Exception as e:
         logging.warning(f"Failed to fetch metadata from iTunes for '{query}': {e}")
         
@@ -0,0 +1,208 @@
+import logging
+import time
+from collections import OrderedDict, defaultdict
+from typing import Dict, List, Optional, Tuple, Union
+
+from services.hedging import DownloadRejected
+from services.transcoder import MP4_AUDIO, REENCODE_VIDEO
+from services.ytdlp_pool import extract_info
+
+# Largest file the bot can send (local Bot API server limit)
+TELEGRAM_MAX_BYTES = 2048 * 1024 * 1024
+# How long a rejected URL is answered from memory
+REJECTION_TTL = 600
+# Rejections that hold whatever the user picks; the others are remembered per (url, variant)
+URL_WIDE_REJECTIONS = ('live', 'upcoming')
+REJECTION_CACHE_SIZE = 1024
+
+# yt-dlp codec strings (avc1.64001F, vp09.00.40.08, mp4a.40.2, ...) -> media_probe names
+CODEC_PREFIXES = (
+    ('avc', 'h264'), ('h264', 'h264'), ('hvc', 'hevc'), ('hev', 'hevc'), ('h265', 'hevc'),
+    ('vp09', 'vp9'), ('vp9', 'vp9'), ('vp8', 'vp8'), ('av01', 'av1'), ('av1', 'av1'),
+    ('mp4a', 'aac'), ('aac', 'aac'), ('mp3', 'mp3'), ('opus', 'opus'), ('vorbis', 'vorbis'),
+)
+
+
+def normalize_codec(name: Optional[str]) -> Optional[str]:
+    """'' for 'none' (stream absent), None if unknown, otherwise the media_probe codec name."""
+    if name is None:
+        return None
+    name = name.lower()
+    if name == 'none':
+        return ''
+    for prefix, codec in CODEC_PREFIXES:
+        if name.startswith(prefix):
+            return codec
+    return name
+
+
+def estimate_size(fmt: Dict, duration: float) -> Optional[int]:
+    """Bytes a format will take: exact, yt-dlp's estimate, or bitrate x duration."""
+    size = fmt.get('filesize') or fmt.get('filesize_approx')
+    if size:
+        return int(size)
+    if fmt.get('tbr') and duration:
+        return int(fmt['tbr'] * 1000 / 8 * duration)
+    return None
+
+
+def _human(size: int) -> str:
+    return f"{size / 1024 / 1024 / 1024:.1f} GB" if size >= 1024 ** 3 else f"{size / 1024 / 1024:.0f} MB"
+
+
+class Preflight:
+    """Metadata-only yt-dlp pass that runs before anything is downloaded.
+
+    It rejects jobs that cannot succeed (live or upcoming streams, media shorter
+    than min_duration, every format over Telegram's limit) and picks the best
+    format that fits the limit and needs no transcode. The extracted info is
+    handed to the download (ytdlp_pool.extract_info(info=...)), so the URL is
+    extracted only once. Rejections are remembered for a while, so a resent link
+    fails instantly: live/upcoming by URL, too short/too large only for the same
+    audio/resolution/min_duration pick, since another pick of that URL may work.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._rejected: "OrderedDict[Union[str, Tuple], Tuple[float, str]]" = OrderedDict()
+        self.checked = 0
+        self.rejections: Dict[str, int] = defaultdict(int)
+        self.cached_rejections = 0
+        self.reformatted = 0
+        self.skipped = 0
+        self._time = 0.0
+
+    def _reject(self, url: str, variant: Tuple, kind: str, reason: str) -> DownloadRejected:
+        self.rejections[kind] += 1
+        key = url if kind in URL_WIDE_REJECTIONS else variant
+        self._rejected[key] = (time.monotonic() + REJECTION_TTL, reason)
+        self._rejected.move_to_end(key)
+        while len(self._rejected) > REJECTION_CACHE_SIZE:
+            self._rejected.popitem(last=False)
+        logging.info(f"[PREFLIGHT] ⛔ {url}: {reason}")
+        return DownloadRejected(reason)
+
+    async def run(self, ydl_opts: Dict, url: str, is_music: bool = False, video_height: Optional[int] = None,
+                  min_duration: int = 0) -> Tuple[Optional[Dict], Optional[str]]:
+        """Returns (info, format) for the download; the info is always handed on, so the URL is extracted once.
+
+        Searches and carousels are checked through their entry when they resolve to a single one;
+        with several entries the info is passed on unchecked.
+
+        format is a yt-dlp format spec ("137+140") or None to keep the caller's selector.
+        Raises DownloadRejected when the job cannot succeed.
+        """
+        variant = (url, bool(is_music), video_height, min_duration)
+        now = time.monotonic()
+        for key in (url, variant):
+            cached = self._rejected.get(key)
+            if cached and cached[0] > now:
+                self.cached_rejections += 1
+                raise DownloadRejected(cached[1])
+
+        started = time.monotonic()
+        opts = {k: v for k, v in ydl_opts.items() if k != 'progress_hooks'}
+        try:
+            info, _ = await extract_info(opts, url, download=False)
+        finally:
+            self.checked += 1
+            self._time += time.monotonic() - started
+
+        if not info:
+            self.skipped += 1
+            return None, None
+        result = info
+        if info.get('entries') is not None or info.get('_type') in ('playlist', 'multi_video'):
+            entries = list(info.get('entries') or [])
+            info['entries'] = entries
+            if len(entries) != 1 or not isinstance(entries[0], dict):
+                # Several tracks/slides: the download processes the entries already resolved here
+                self.skipped += 1
+                return result, None
+            info = entries[0]
+
+        live_status = info.get('live_status')
+        if info.get('is_live') or live_status == 'is_live':
+            raise self._reject(url, variant, 'live', "This is a live stream; it can be downloaded once it has ended.")
+        if live_status == 'is_upcoming':
+            raise self._reject(url, variant, 'upcoming', "This stream has not started yet.")
+
+        duration = info.get('duration') or 0
+        if min_duration and duration and duration < min_duration:
+            raise self._reject(url, variant, 'too_short', f"Media is {duration:.0f}s long, shorter than the required {min_duration}s.")
+
+        if is_music:
+            fmt, size = None, self._audio_size(info, duration)
+        else:
+            fmt, size = self._pick_video(info, duration, video_height)
+        if size is not None and size > self.max_bytes:
+            raise self._reject(url, variant, 'too_large', f"File is too large (~{_human(size)}). Telegram limit is {_human(self.max_bytes)}.")
+
+        if fmt and fmt != info.get('format_id'):
+            self.reformatted += 1
+            logging.info(f"[PREFLIGHT] {url}: using format {fmt} (~{_human(size) if size else '? MB'}) instead of {info.get('format_id')}")
+        return result, fmt
+
+    def _audio_size(self, info: Dict, duration: float) -> Optional[int]:
+        sizes = [estimate_size(f, duration) for f in info.get('requested_formats') or [info]]
+        return sum(sizes) if sizes and None not in sizes else None
+
+    def _pick_video(self, info: Dict, duration: float, video_height: Optional[int]) -> Tuple[Optional[str], Optional[int]]:
+        """Best (format spec, size) within the limit, preferring codecs that need no transcode.
+
+        Falls back to (None, size of yt-dlp's own pick) when formats carry no usable data.
+        """
+        formats: List[Dict] = info.get('formats') or []
+        audios, candidates = [], []
+        for f in formats:
+            vcodec, acodec = normalize_codec(f.get('vcodec')), normalize_codec(f.get('acodec'))
+            if vcodec == '' and acodec == '':
+                continue  # storyboards and the like
+            if vcodec == '':
+                audios.append((acodec in MP4_AUDIO, f.get('abr') or f.get('tbr') or 0, f))
+                continue
+            if video_height and (f.get('height') or 0) > video_height:
+                continue
+            candidates.append((f, vcodec, acodec))
+
+        audio = max(audios, key=lambda a: a[:2])[2] if audios else None
+        audio_ok = bool(audio) and normalize_codec(audio.get('acodec')) in MP4_AUDIO
+        audio_size = estimate_size(audio, duration) if audio else 0
+
+        ranked = []
+        for f, vcodec, acodec in candidates:
+            size = estimate_size(f, duration)
+            if acodec == '':
+                if audio is None:
+                    continue
+                spec, pair_audio_ok = f"{f['format_id']}+{audio['format_id']}", audio_ok
+                size = size + audio_size if size is not None and audio_size is not None else None
+            else:
+                spec, pair_audio_ok = f['format_id'], acodec is None or acodec in MP4_AUDIO
+            key = (vcodec not in REENCODE_VIDEO, pair_audio_ok, f.get('height') or 0, f.get('fps') or 0, f.get('tbr') or 0)
+            ranked.append((key, spec, size))
+
+        if not ranked:
+            chosen = info.get('requested_formats') or [info]
+            sizes = [estimate_size(f, duration) for f in chosen]
+            return None, (sum(sizes) if None not in sizes else None)
+
+        ranked.sort(key=lambda r: r[0], reverse=True)
+        for _, spec, size in ranked:
+            if size is None or size <= self.max_bytes:
+                return spec, size
+        # Nothing fits: report the smallest so the rejection quotes a realistic size
+        return None, min(size for _, _, size in ranked)
+
+    def get_stats(self) -> dict:
+        return {
+            'checked': self.checked,
+            'rejections': dict(self.rejections),
+            'cached_rejections': self.cached_rejections,
+            'reformatted': self.reformatted,
+            'skipped': self.skipped,
+            'avg_ms': self._time / self.checked * 1000 if self.checked else 0.0,
+        }
+
+
+preflight = Preflight(TELEGRAM_MAX_BYTES)
@@ -0,0 +1,377 @@
+import argparse
+import asyncio
+import hmac
+import json
+import logging
+import sys
+import time
+import uuid
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Tuple, Union
+
+from config import (
+    BASE_DIR,
+    DOWNLOADS_DIR,
+    REMOTE_WORKERS_ENABLED,
+    REMOTE_WORKERS,
+    REMOTE_WORKER_TOKEN,
+    REMOTE_WORKER_CAPACITY,
+    REMOTE_WORKER_HEALTH_SECONDS,
+    REMOTE_WORKER_TIMEOUT,
+    HOME_SERVER_ADDRESS,
+)
+
+try:
+    import grpc
+except ImportError:
+    grpc = None  # type: ignore
+
+CHUNK_SIZE = 1024 * 1024
+MAX_MESSAGE_SIZE = 8 * 1024 * 1024
+TOKEN_HEADER = "x-worker-token"
+CHANNEL_OPTIONS = [
+    ("grpc.max_send_message_length", MAX_MESSAGE_SIZE),
+    ("grpc.max_receive_message_length", MAX_MESSAGE_SIZE),
+    ("grpc.keepalive_time_ms", 30000),
+]
+
+_protos = None
+_services = None
+
+
+def _load_protos():
+    """Compiles protos/worker.proto on first use (grpcio-tools), no generated files in the tree."""
+    global _protos, _services
+    if _protos is None:
+        if str(BASE_DIR) not in sys.path:
+            sys.path.append(str(BASE_DIR))
+        _protos, _services = grpc.protos_and_services("protos/worker.proto")
+    return _protos, _services
+
+
+# --- worker side ---
+
+class WorkerServicer:
+    """Runs download jobs for the bot and streams progress, files and metadata back."""
+
+    def __init__(self, capacity: int = REMOTE_WORKER_CAPACITY, token: str = REMOTE_WORKER_TOKEN):
+        self.capacity = max(1, capacity)
+        self.token = token
+        self.active = 0
+        self.completed = 0
+
+    async def _authorize(self, context) -> None:
+        sent = dict(context.invocation_metadata()).get(TOKEN_HEADER) or ""
+        if not self.token or not hmac.compare_digest(sent.encode(), self.token.encode()):
+            await context.abort(grpc.StatusCode.UNAUTHENTICATED, "invalid worker token")
+
+    async def Health(self, request, context):
+        protos, _ = _load_protos()
+        await self._authorize(context)
+        return protos.HealthReply(ok=True, active=self.active, capacity=self.capacity, version="1")
+
+    async def Download(self, request, context):
+        protos, _ = _load_protos()
+        await self._authorize(context)
+        if self.active >= self.capacity:
+            await context.abort(grpc.StatusCode.RESOURCE_EXHAUSTED, "worker is at capacity")
+
+        # Imported lazily: the worker needs the full downloader, the bot only this module
+        from services.downloader import _download_media
+
+        self.active += 1
+        events: asyncio.Queue = asyncio.Queue()
+
+        async def on_progress(text: str = ""):
+            events.put_nowait(protos.DownloadEvent(progress=protos.Progress(text=text)))
+
+        logging.info(f"[WORKER] Job started: {request.url}")
+        task = asyncio.create_task(_download_media(
+            request.url,
+            request.is_music,
+            request.video_height or None,
+            on_progress,
+            request.min_duration,
+        ))
+        task.add_done_callback(lambda _: events.put_nowait(None))
+        produced: List[Path] = []
+        try:
+            while (event := await events.get()) is not None:
+                yield event
+
+            try:
+                file_path, thumbnail_path, metadata = task.result()
+            except Exception as e:
+                logging.error(f"[WORKER] Job failed: {request.url}: {e}")
+                yield protos.DownloadEvent(error=protos.Error(message=str(e)))
+                return
+
+            multiple = isinstance(file_path, list)
+            media = [p for p in (file_path if multiple else [file_path]) if p]
+            produced = media + ([thumbnail_path] if thumbnail_path else [])
+
+            for index, path in enumerate(produced):
+                yield protos.DownloadEvent(file=protos.FileHeader(
+                    index=index, name=path.name, size=path.stat().st_size, thumbnail=path == thumbnail_path,
+                ))
+                with open(path, "rb") as f:
+                    while chunk := f.read(CHUNK_SIZE):
+                        yield protos.DownloadEvent(chunk=protos.FileChunk(index=index, data=chunk))
+
+            yield protos.DownloadEvent(result=protos.Result(
+                metadata_json=json.dumps(metadata or {}, default=str),
+                multiple_files=multiple,
+            ))
+            self.completed += 1
+            logging.info(f"[WORKER] ✅ Job finished: {request.url} ({len(produced)} file(s))")
+        finally:
+            self.active -= 1
+            if not task.done():
+                task.cancel()
+            for path in produced:
+                path.unlink(missing_ok=True)
+
+
+async def start_worker_server(address: str, capacity: int = REMOTE_WORKER_CAPACITY, token: str = REMOTE_WORKER_TOKEN):
+    """Starts a gRPC download worker on address (e.g. "127.0.0.1:50057") and returns the server.
+
+    The port is plaintext gRPC and fetches any URL it is given, so a token is required;
+    between hosts put it behind TLS termination or a tunnel (WireGuard, SSH) as well.
+    """
+    if not token:
+        raise ValueError("REMOTE_WORKER_TOKEN must be set to run a download worker")
+    _, services = _load_protos()
+    server = grpc.aio.server(options=CHANNEL_OPTIONS)
+    services.add_DownloadWorkerServicer_to_server(WorkerServicer(capacity, token), server)
+    server.add_insecure_port(address)
+    await server.start()
+    logging.info(f"[WORKER] ✅ Download worker listening on {address} (capacity {capacity})")
+    return server
+
+
+# --- bot side ---
+
+class _Node:
+    def __init__(self, address: str):
+        self.address = address
+        self.channel = None
+        self.stub = None
+        self.healthy = False
+        self.active = 0
+        self.capacity = 1
+        self.jobs = 0
+        self.failures = 0
+        self.last_error = ""
+        self.latency_ms = 0.0
+
+
+class RemoteWorkerPool:
+    """Dispatches downloads to remote gRPC workers.
+
+    Nodes are health-checked in the background; a job goes to the healthy node with
+    the lowest load. download() returns None when no node could take the job (none
+    healthy, all busy, or the connection broke mid-transfer) and the caller is
+    expected to fall back to downloading locally.
+    """
+
+    def __init__(self, addresses: List[str], token: str = "", enabled: bool = True,
+                 health_interval: int = REMOTE_WORKER_HEALTH_SECONDS, timeout: int = REMOTE_WORKER_TIMEOUT):
+        self.nodes = [_Node(a) for a in addresses if a]
+        self.token = token
+        self.configured = enabled and bool(self.nodes)
+        self.health_interval = max(1, health_interval)
+        self.timeout = timeout
+        self._health_task: Optional[asyncio.Task] = None
+        self.dispatched = 0
+        self.fallbacks = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self._health_task is not None
+
+    def _metadata(self):
+        return ((TOKEN_HEADER, self.token),) if self.token else ()
+
+    async def start(self) -> None:
+        if not self.configured or self.enabled:
+            return
+        if grpc is None:
+            logging.error("[REMOTE] grpcio is not installed; remote workers disabled")
+            return
+        try:
+            _, services = _load_protos()
+        except Exception as e:
+            logging.error(f"[REMOTE] Failed to load worker protocol: {e}")
+            return
+        for node in self.nodes:
+            node.channel = grpc.aio.insecure_channel(node.address, options=CHANNEL_OPTIONS)
+            node.stub = services.DownloadWorkerStub(node.channel)
+        await self.check_health()
+        self._health_task = asyncio.create_task(self._health_loop())
+        healthy = sum(1 for n in self.nodes if n.healthy)
+        logging.info(f"[REMOTE] ✅ {healthy}/{len(self.nodes)} remote worker(s) healthy: {', '.join(n.address for n in self.nodes)}")
+
+    async def shutdown(self) -> None:
+        if self._health_task:
+            self._health_task.cancel()
+            self._health_task = None
+        for node in self.nodes:
+            if node.channel:
+                await node.channel.close()
+                node.channel = node.stub = None
+
+    async def _check_node(self, node: _Node) -> None:
+        protos, _ = _load_protos()
+        started = time.monotonic()
+        try:
+            reply = await node.stub.Health(protos.HealthRequest(), timeout=5, metadata=self._metadata())
+            node.latency_ms = (time.monotonic() - started) * 1000
+            node.active, node.capacity = reply.active, max(1, reply.capacity)
+            if not node.healthy:
+                logging.info(f"[REMOTE] Worker {node.address} is healthy ({node.latency_ms:.0f} ms)")
+            node.healthy = reply.ok
+        except Exception as e:
+            error = f"{e.code().name}: {e.details()}" if isinstance(e, grpc.aio.AioRpcError) else str(e)
+            if node.healthy:
+                logging.warning(f"[REMOTE] Worker {node.address} is down: {error}")
+            node.healthy = False
+            node.last_error = error[:200]
+
+    async def check_health(self) -> None:
+        await asyncio.gather(*(self._check_node(n) for n in self.nodes if n.stub))
+
+    async def _health_loop(self):
+        while True:
+            await asyncio.sleep(self.health_interval)
+            try:
+                await self.check_health()
+            except Exception as e:
+                logging.error(f"[REMOTE] Health check error: {e}")
+
+    def _candidates(self) -> List[_Node]:
+        nodes = [n for n in self.nodes if n.healthy and n.active < n.capacity]
+        return sorted(nodes, key=lambda n: (n.active / n.capacity, n.latency_ms))
+
+    async def download(self, url: str, is_music: bool = False, video_height: int = None,
+                       progress_callback: Optional[Callable] = None, min_duration: int = 0
+                       ) -> Optional[Tuple[Union[Path, List[Path]], Optional[Path], Dict]]:
+        """Runs the download on a remote worker; None means "do it locally"."""
+        if not self.enabled:
+            return None
+        for node in self._candidates():
+            try:
+                result = await self._download_on(node, url, is_music, video_height, progress_callback, min_duration)
+                self.dispatched += 1
+                return result
+            except _NodeUnavailable as e:
+                logging.warning(f"[REMOTE] {node.address} could not take {url}: {e}")
+                continue
+        self.fallbacks += 1
+        return None
+
+    async def _download_on(self, node: _Node, url: str, is_music: bool, video_height: Optional[int],
+                           progress_callback: Optional[Callable], min_duration: int):
+        protos, _ = _load_protos()
+        request = protos.DownloadRequest(url=url, is_music=is_music, video_height=video_height or 0, min_duration=min_duration or 0)
+        prefix = uuid.uuid4().hex[:8]
+        files: Dict[int, Tuple[Path, bool]] = {}
+        handles = {}
+        node.active += 1
+        node.jobs += 1
+        call = None
+        ok = False
+        try:
+            call = node.stub.Download(request, timeout=self.timeout, metadata=self._metadata())
+            async for event in call:
+                kind = event.WhichOneof("event")
+                if kind == "progress":
+                    if progress_callback:
+                        try:
+                            await progress_callback(event.progress.text)
+                        except Exception:
+                            pass
+                elif kind == "file":
+                    path = DOWNLOADS_DIR / f"{prefix}_{Path(event.file.name).name}"
+                    files[event.file.index] = (path, event.file.thumbnail)
+                    handles[event.file.index] = open(path, "wb")
+                elif kind == "chunk":
+                    handles[event.chunk.index].write(event.chunk.data)
+                elif kind == "error":
+                    # The worker is fine, the job itself failed - same as a local failure
+                    raise Exception(event.error.message)
+                elif kind == "result":
+                    for handle in handles.values():
+                        handle.close()
+                    handles.clear()
+                    media = [p for i, (p, thumb) in sorted(files.items()) if not thumb]
+                    thumbnail = next((p for p, thumb in files.values() if thumb), None)
+                    if not media:
+                        raise Exception("Remote worker returned no media files")
+                    metadata = json.loads(event.result.metadata_json or "{}")
+                    ok = True
+                    logging.info(f"[REMOTE] ✅ {url} downloaded by {node.address} ({len(files)} file(s))")
+                    return (media if event.result.multiple_files else media[0]), thumbnail, metadata
+            raise _NodeUnavailable("stream ended without a result")
+        except grpc.aio.AioRpcError as e:
+            if e.code() != grpc.StatusCode.RESOURCE_EXHAUSTED:
+                node.healthy = False
+                node.failures += 1
+                node.last_error = f"{e.code().name}: {e.details()}"
+            raise _NodeUnavailable(f"{e.code().name}: {e.details()}")
+        finally:
+            node.active -= 1
+            if call is not None and not call.done():
+                call.cancel()
+            for handle in handles.values():
+                handle.close()
+            if not ok:
+                for path, _ in files.values():
+                    path.unlink(missing_ok=True)
+
+    def get_stats(self) -> dict:
+        return {
+            'enabled': self.enabled,
+            'dispatched': self.dispatched,
+            'fallbacks': self.fallbacks,
+            'nodes': [
+                {
+                    'address': n.address,
+                    'healthy': n.healthy,
+                    'active': n.active,
+                    'capacity': n.capacity,
+                    'jobs': n.jobs,
+                    'failures': n.failures,
+                    'latency_ms': n.latency_ms,
+                    'last_error': n.last_error,
+                }
+                for n in self.nodes
+            ],
+        }
+
+
+class _NodeUnavailable(Exception):
+    pass
+
+
+remote_workers = RemoteWorkerPool(
+    addresses=[a.strip() for a in REMOTE_WORKERS.split(",")],
+    token=REMOTE_WORKER_TOKEN,
+    enabled=REMOTE_WORKERS_ENABLED,
+)
+
+
+async def _serve(address: str, capacity: int):
+    server = await start_worker_server(address, capacity)
+    await server.wait_for_termination()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run a remote download worker")
+    # Loopback by default; expose it to other hosts only through a tunnel or TLS proxy
+    parser.add_argument("--listen", default=f"127.0.0.1:{HOME_SERVER_ADDRESS.rsplit(':', 1)[-1]}")
+    parser.add_argument("--capacity", type=int, default=REMOTE_WORKER_CAPACITY)
+    args = parser.parse_args()
+
+    from services.logger import setup_logging
+    setup_logging()
+    asyncio.run(_serve(args.listen, args.capacity))
@@ -0,0 +1,209 @@
+import asyncio
+import itertools
+import logging
+import math
+import time
+from collections import defaultdict, deque
+from contextlib import asynccontextmanager
+from typing import Callable, Dict, List, Optional
+
+from config import (
+    SCHEDULER_GLOBAL_SLOTS,
+    SCHEDULER_PLATFORM_LIMITS,
+    SCHEDULER_CPU_SLOTS,
+    SCHEDULER_PREMIUM_WEIGHT,
+    SCHEDULER_STANDARD_WEIGHT,
+)
+
+
+def parse_platform_limits(value: str) -> Dict[str, int]:
+    """Parses "youtube:3,tiktok:4" into {"youtube": 3, "tiktok": 4}."""
+    limits = {}
+    for item in (value or "").split(","):
+        if ":" not in item:
+            continue
+        name, limit = item.split(":", 1)
+        try:
+            limits[name.strip().lower()] = max(1, int(limit))
+        except ValueError:
+            logging.warning(f"[SCHEDULER] Ignoring invalid platform limit: {item}")
+    return limits
+
+
+class _Ticket:
+    __slots__ = ("seq", "platform", "cls", "tag", "future", "on_queue", "position", "enqueued_at")
+
+    def __init__(self, seq: int, platform: str, cls: str, tag: float, on_queue: Optional[Callable]):
+        self.seq = seq
+        self.platform = platform
+        self.cls = cls
+        self.tag = tag
+        self.future = asyncio.get_running_loop().create_future()
+        self.on_queue = on_queue
+        self.position = None
+        self.enqueued_at = time.monotonic()
+
+
+class DownloadScheduler:
+    """Process-wide admission control for downloads.
+
+    Jobs hold one of `global_slots` while running and at most `platform_limits[platform]`
+    run per platform. Waiting jobs are ordered by weighted fair queueing: every class
+    (premium / standard) gets a virtual finish tag that advances by 1/weight per job, so
+    premium users are served `premium_weight` times as often as standard users without
+    starving them. ffmpeg transcodes use a separate CPU pool (cpu_slot).
+    """
+
+    def __init__(self, global_slots: int, platform_limits: Dict[str, int], cpu_slots: int,
+                 premium_weight: float = 3.0, standard_weight: float = 1.0):
+        self.global_slots = max(1, global_slots)
+        self.platform_limits = platform_limits
+        self.weights = {'premium': max(premium_weight, 0.1), 'standard': max(standard_weight, 0.1)}
+        self.cpu_slots = max(1, cpu_slots)
+        self._cpu_sem: Optional[asyncio.Semaphore] = None
+
+        self.running = 0
+        self.running_by_platform: Dict[str, int] = defaultdict(int)
+        self._waiters: List[_Ticket] = []
+        self._seq = itertools.count()
+        self._virtual_time = 0.0
+        self._last_tag = {'premium': 0.0, 'standard': 0.0}
+        self._durations = deque(maxlen=50)
+
+        self.completed = 0
+        self.total_wait = 0.0
+        self.cpu_running = 0
+        self.cpu_waiting = 0
+
+    # --- download slots ---
+
+    def _platform_limit(self, platform: str) -> int:
+        return self.platform_limits.get(platform, self.platform_limits.get('default', self.global_slots))
+
+    def _can_start(self, platform: str) -> bool:
+        return self.running < self.global_slots and self.running_by_platform[platform] < self._platform_limit(platform)
+
+    def estimate_wait(self, position: int) -> int:
+        """Rough ETA in seconds for a job that has `position` jobs ahead of it."""
+        avg = (sum(self._durations) / len(self._durations)) if self._durations else 30.0
+        return int(math.ceil((position + 1) / self.global_slots) * avg)
+
+    def _dispatch(self):
+        self._waiters.sort(key=lambda t: (t.tag, t.seq))
+        still_waiting = []
+        for ticket in self._waiters:
+            if ticket.future.done():
+                continue
+            if self._can_start(ticket.platform):
+                self.running += 1
+                self.running_by_platform[ticket.platform] += 1
+                self._virtual_time = max(self._virtual_time, ticket.tag)
+                ticket.future.set_result(True)
+            else:
+                still_waiting.append(ticket)
+        self._waiters = still_waiting
+
+        for position, ticket in enumerate(self._waiters, 1):
+            if ticket.on_queue and ticket.position != position:
+                ticket.position = position
+                asyncio.create_task(self._notify(ticket.on_queue, position, self.estimate_wait(position)))
+
+    @staticmethod
+    async def _notify(callback: Callable, position: int, eta: int):
+        try:
+            await callback(position, eta)
+        except Exception:
+            pass
+
+    def _release(self, platform: str, started_at: Optional[float] = None):
+        self.running -= 1
+        self.running_by_platform[platform] -= 1
+        if started_at is not None:
+            self._durations.append(time.monotonic() - started_at)
+            self.completed += 1
+        self._dispatch()
+
+    @asynccontextmanager
+    async def slot(self, platform: str, is_premium: bool = False, on_queue: Optional[Callable] = None, bypass: bool = False):
+        """Holds a download slot for the duration of the block.
+
+        on_queue(position, eta_seconds) is awaited whenever the job's place in the queue changes.
+        bypass=True skips admission (e.g. the job only joins a download that already holds a slot).
+        """
+        if bypass:
+            yield
+            return
+
+        platform = (platform or 'default').lower()
+        cls = 'premium' if is_premium else 'standard'
+        start_tag = max(self._virtual_time, self._last_tag[cls])
+        tag = start_tag + 1.0 / self.weights[cls]
+        self._last_tag[cls] = tag
+        ticket = _Ticket(next(self._seq), platform, cls, tag, on_queue)
+        self._waiters.append(ticket)
+        self._dispatch()
+
+        try:
+            await ticket.future
+        except asyncio.CancelledError:
+            if ticket in self._waiters:
+                self._waiters.remove(ticket)
+                self._dispatch()
+            elif ticket.future.done() and not ticket.future.cancelled():
+                # Granted right before cancellation - hand the slot back
+                self._release(platform)
+            raise
+
+        waited = time.monotonic() - ticket.enqueued_at
+        self.total_wait += waited
+        if waited > 1:
+            logging.info(f"[SCHEDULER] {cls} {platform} job admitted after {waited:.1f}s in queue")
+
+        started_at = time.monotonic()
+        try:
+            yield
+        finally:
+            self._release(platform, started_at)
+
+    # --- CPU pool ---
+
+    @asynccontextmanager
+    async def cpu_slot(self):
+        """Limits concurrent ffmpeg transcodes to the CPU pool size."""
+        if self._cpu_sem is None:
+            self._cpu_sem = asyncio.Semaphore(self.cpu_slots)
+        self.cpu_waiting += 1
+        try:
+            await self._cpu_sem.acquire()
+        finally:
+            self.cpu_waiting -= 1
+        self.cpu_running += 1
+        try:
+            yield
+        finally:
+            self.cpu_running -= 1
+            self._cpu_sem.release()
+
+    def get_stats(self) -> dict:
+        return {
+            'running': self.running,
+            'global_slots': self.global_slots,
+            'queued': len(self._waiters),
+            'queued_premium': sum(1 for t in self._waiters if t.cls == 'premium'),
+            'by_platform': {p: n for p, n in self.running_by_platform.items() if n},
+            'completed': self.completed,
+            'avg_wait': (self.total_wait / self.completed) if self.completed else 0.0,
+            'avg_duration': (sum(self._durations) / len(self._durations)) if self._durations else 0.0,
+            'cpu_running': self.cpu_running,
+            'cpu_waiting': self.cpu_waiting,
+            'cpu_slots': self.cpu_slots,
+        }
+
+
+download_scheduler = DownloadScheduler(
+    global_slots=SCHEDULER_GLOBAL_SLOTS,
+    platform_limits=parse_platform_limits(SCHEDULER_PLATFORM_LIMITS),
+    cpu_slots=SCHEDULER_CPU_SLOTS,
+    premium_weight=SCHEDULER_PREMIUM_WEIGHT,
+    standard_weight=SCHEDULER_STANDARD_WEIGHT,
+)
@@ -0,0 +1,111 @@
+import asyncio
+import logging
+from collections import defaultdict
+from pathlib import Path
+from typing import Any, Awaitable, Callable, Dict, Hashable, Iterable, List, Optional
+
+
+class _Flight:
+    def __init__(self):
+        self.task: Optional[asyncio.Task] = None
+        self.subscribers: List[Callable] = []
+        self.waiters = 0
+
+
+def _iter_paths(items: Iterable) -> Iterable[Path]:
+    for item in items:
+        if isinstance(item, (list, tuple)):
+            yield from _iter_paths(item)
+        elif isinstance(item, Path):
+            yield item
+
+
+class SingleFlight:
+    """Coalesces identical in-flight downloads.
+
+    The first caller for a key (the leader) runs the download; callers that arrive
+    while it is in flight (followers) await the same result. Progress updates are
+    fanned out to every caller's own callback. Result files are reference-counted:
+    each caller must hand its paths back through release() and the files are only
+    unlinked once the last caller is done with them.
+    """
+
+    def __init__(self, name: str = "SINGLE-FLIGHT"):
+        self.name = name
+        self._flights: Dict[Hashable, _Flight] = {}
+        self._refcounts: Dict[Path, int] = defaultdict(int)
+        self.leaders = 0
+        self.followers = 0
+
+    def is_inflight(self, key: Hashable) -> bool:
+        return key in self._flights
+
+    async def run(self, key: Hashable, factory: Callable[[Callable], Awaitable[Any]], progress_callback: Optional[Callable] = None) -> Any:
+        """Runs factory(progress_callback) once per key; concurrent callers share the result."""
+        flight = self._flights.get(key)
+        if flight is None:
+            flight = _Flight()
+            self._flights[key] = flight
+            flight.task = asyncio.create_task(self._lead(key, flight, factory))
+            self.leaders += 1
+        else:
+            self.followers += 1
+            logging.info(f"[{self.name}] Joining in-flight download ({flight.waiters} waiting): {key}")
+
+        if progress_callback:
+            flight.subscribers.append(progress_callback)
+        flight.waiters += 1
+
+        try:
+            return await asyncio.shield(flight.task)
+        except asyncio.CancelledError:
+            if progress_callback in flight.subscribers:
+                flight.subscribers.remove(progress_callback)
+            task = flight.task
+            if task.done() and not task.cancelled() and task.exception() is None:
+                # Result already retained on our behalf - give our reference back
+                self.release(task.result())
+            else:
+                flight.waiters -= 1
+                if flight.waiters <= 0 and not task.done():
+                    task.cancel()
+            raise
+
+    async def _lead(self, key: Hashable, flight: _Flight, factory: Callable[[Callable], Awaitable[Any]]) -> Any:
+        async def fan_out(*args, **kwargs):
+            for callback in list(flight.subscribers):
+                try:
+                    await callback(*args, **kwargs)
+                except Exception:
+                    pass
+
+        try:
+            result = await factory(fan_out)
+        finally:
+            self._flights.pop(key, None)
+
+        # Every caller still waiting holds one reference to the produced files
+        for path in set(_iter_paths([result])):
+            self._refcounts[path] += flight.waiters
+        return result
+
+    def release(self, *items) -> None:
+        """Drops one reference to each path and unlinks files nobody else needs."""
+        for path in set(_iter_paths(items)):
+            if path in self._refcounts:
+                self._refcounts[path] -= 1
+                if self._refcounts[path] > 0:
+                    continue
+                del self._refcounts[path]
+            try:
+                path.unlink(missing_ok=True)
+            except Exception as e:
+                logging.warning(f"[{self.name}] Failed to remove {path}: {e}")
+
+    def get_stats(self) -> dict:
+        return {
+            'inflight': len(self._flights),
+            'leaders': self.leaders,
+            'followers': self.followers,
+            'shared_files': len(self._refcounts),
+        }
@@ -0,0 +1,187 @@
+import asyncio
+import io
+import logging
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Optional, Tuple
+
+import aiohttp
+
+from config import THUMBNAIL_WORKERS
+from services.http_client import http_client
+from services.media_probe import media_probe
+
+# Telegram ignores thumbnails larger than 320px on either side or over 200 KB
+THUMB_MAX_SIDE = 320
+THUMB_MAX_BYTES = 200 * 1024
+CACHE_SIZE = 512
+
+
+def _fit_jpeg(data: bytes, output_path: Path) -> bool:
+    """Resizes image bytes to Telegram's thumbnail limits and writes a JPEG."""
+    from PIL import Image
+
+    with Image.open(io.BytesIO(data)) as img:
+        img = img.convert('RGB')
+        img.thumbnail((THUMB_MAX_SIDE, THUMB_MAX_SIDE))
+        for quality in (90, 80, 70, 60):
+            buf = io.BytesIO()
+            img.save(buf, 'JPEG', quality=quality, optimize=True)
+            if buf.tell() <= THUMB_MAX_BYTES:
+                output_path.write_bytes(buf.getvalue())
+                return True
+    return False
+
+
+class ThumbnailService:
+    """Video thumbnails without blocking the event loop.
+
+    The platform's own thumbnail (what yt-dlp reports as `thumbnail`) is used when
+    there is one; only otherwise is a frame decoded, by an ffmpeg subprocess that
+    takes the keyframe nearest the seek point. At most `workers` ffmpeg processes run at once.
+    Results are cached per source file (path, size, mtime).
+    """
+
+    def __init__(self, workers: int):
+        self.workers = max(1, workers)
+        self._slots = asyncio.Semaphore(self.workers)
+        self._cache: "OrderedDict[Tuple[str, int, int], Path]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.running = 0
+        self.waiting = 0
+        self.from_platform = 0
+        self.decoded = 0
+        self.cache_hits = 0
+        self.failures = 0
+        self._decode_time = 0.0
+
+    @staticmethod
+    def _key(video_path: Path) -> Optional[Tuple[str, int, int]]:
+        try:
+            st = video_path.stat()
+        except OSError:
+            return None
+        return str(video_path), st.st_size, st.st_mtime_ns
+
+    async def for_video(self, video_path: Path, output_path: Optional[Path] = None,
+                        thumbnail_url: Optional[str] = None) -> Optional[Path]:
+        """Returns a JPEG thumbnail for video_path, or None if none could be made."""
+        output_path = output_path or video_path.with_name(f"{video_path.stem}_thumb.jpg")
+        key = self._key(video_path)
+        if key is None:
+            return None
+        with self._lock:
+            cached = self._cache.get(key)
+        if cached is not None and cached.exists():
+            self.cache_hits += 1
+            return cached
+
+        thumb = None
+        if thumbnail_url:
+            thumb = await self._from_url(thumbnail_url, output_path)
+            if thumb:
+                self.from_platform += 1
+        if thumb is None:
+            thumb = await self._decode(video_path, output_path)
+        if thumb is None:
+            self.failures += 1
+            return None
+
+        with self._lock:
+            self._cache[key] = thumb
+            while len(self._cache) > CACHE_SIZE:
+                self._cache.popitem(last=False)
+        return thumb
+
+    async def _from_url(self, url: str, output_path: Path) -> Optional[Path]:
+        try:
+            async with http_client.session().get(url, timeout=aiohttp.ClientTimeout(total=10)) as resp:
+                if resp.status != 200:
+                    return None
+                data = await resp.read()
+            if await asyncio.to_thread(_fit_jpeg, data, output_path):
+                return output_path
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logging.debug(f"[THUMB] Platform thumbnail unusable ({url[:80]}): {e}")
+        return None
+
+    async def _decode(self, video_path: Path, output_path: Path) -> Optional[Path]:
+        info = await media_probe.aprobe(video_path)
+        if info.source and not info.video_codec:
+            return None  # Audio-only file
+        # A frame about a second in avoids black intros; very short clips use their middle
+        position = min(1.0, info.duration / 2) if info.duration else 1.0
+
+        self.waiting += 1
+        try:
+            await self._slots.acquire()
+        finally:
+            self.waiting -= 1
+        self.running += 1
+        started = time.monotonic()
+        try:
+            for seek in (position, 0.0):
+                if await self._run_ffmpeg(video_path, output_path, seek):
+                    self.decoded += 1
+                    return output_path
+            return None
+        finally:
+            self._decode_time += time.monotonic() - started
+            self.running -= 1
+            self._slots.release()
+
+    @staticmethod
+    async def _run_ffmpeg(video_path: Path, output_path: Path, seek: float) -> bool:
+        cmd = [
+            "ffmpeg", "-y", "-loglevel", "error",
+            # Input seek without accurate seeking: the keyframe before `seek` is the output frame
+            "-noaccurate_seek",
+            "-ss", f"{seek:.2f}",
+            "-i", str(video_path),
+            "-frames:v", "1",
+            "-vf", f"format=yuv420p,scale=w={THUMB_MAX_SIDE}:h={THUMB_MAX_SIDE}:force_original_aspect_ratio=decrease",
+            "-q:v", "3",
+            str(output_path)
+        ]
+        try:
+            process = await asyncio.create_subprocess_exec(
+                *cmd, stdin=asyncio.subprocess.DEVNULL, stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.PIPE
+            )
+        except OSError as e:
+            logging.error(f"[THUMB] Cannot start ffmpeg: {e}")
+            return False
+        try:
+            _, stderr = await asyncio.wait_for(process.communicate(), timeout=30)
+        except BaseException as e:
+            if process.returncode is None:
+                process.kill()
+                await process.wait()
+            output_path.unlink(missing_ok=True)
+            if isinstance(e, asyncio.TimeoutError):
+                logging.warning(f"[THUMB] ffmpeg timed out for {video_path.name}")
+                return False
+            raise
+        if process.returncode == 0 and output_path.exists() and output_path.stat().st_size > 0:
+            return True
+        logging.warning(f"[THUMB] ffmpeg failed for {video_path.name} at {seek:.1f}s: {stderr.decode(errors='replace')[:200]}")
+        output_path.unlink(missing_ok=True)
+        return False
+
+    def get_stats(self) -> dict:
+        return {
+            'workers': self.workers,
+            'running': self.running,
+            'waiting': self.waiting,
+            'from_platform': self.from_platform,
+            'decoded': self.decoded,
+            'cache_hits': self.cache_hits,
+            'failures': self.failures,
+            'avg_decode_ms': self._decode_time / self.decoded * 1000 if self.decoded else 0.0,
+        }
+
+
+thumbnail_service = ThumbnailService(THUMBNAIL_WORKERS)
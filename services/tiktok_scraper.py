@@ -5,6 +5,8 @@ import logging
 from pathlib import Path
 from typing import List, Tuple, Dict
 
+from services.http_client import http_client
+
 # Common headers for all requests
 DEFAULT_HEADERS = {
     'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
@@ -24,7 +26,7 @@ def fetch_tiktok_metadata(url: str) -> Dict:
         max_retries = 3
         data = {}
         for attempt in range(max_retries):
-            response = requests.get(
+            response = http_client.sync_session().get(
                 'https://www.tikwm.com/api/',
                 params={'url': url, 'hd': 0},
                 headers=headers,
@@ -45,7 +47,7 @@ def fetch_tiktok_metadata(url: str) -> Dict:
         verified = False
         if unique_id:
             try:
-                user_resp = requests.get(
+                user_resp = http_client.sync_session().get(
                     'https://www.tikwm.com/api/user/info',
                     params={'unique_id': unique_id},
                     headers=headers,
@@ -79,7 +81,7 @@ def download_tiktok_images(link: str, output_dir: Path) -> Tuple[List[Path], Dic
 
 def download_file(url: str, output_dir: Path, prefix: str) -> Path:
     """Download a single file and convert images to JPEG if needed."""
-    response = requests.get(url, headers=DEFAULT_HEADERS, stream=True, timeout=15)
+    response = http_client.sync_session().get(url, headers=DEFAULT_HEADERS, stream=True, timeout=15)
     if response.status_code != 200:
         raise Exception(f"Failed to download file: status {response.status_code}")
     
@@ -161,7 +163,7 @@ def download_tikwm(link: str, output_dir: Path) -> Tuple[List[Path], Dict]:
     max_retries = 3
     data = {}
     for attempt in range(max_retries):
-        response = requests.get(api_url, params=params, headers=headers, timeout=15)
+        response = http_client.sync_session().get(api_url, params=params, headers=headers, timeout=15)
         
         if response.status_code != 200:
             if attempt < max_retries - 1:
@@ -1,272 +1,571 @@
 import asyncio
-import subprocess
+import base64
+import binascii
 import logging
+import os
+import shutil
+import time
 from pathlib import Path
-from typing import List, Tuple, Dict, Optional, Union
+from typing import Iterable, List, Tuple, Dict, Optional, Union
+from urllib.parse import parse_qs, urlsplit
 import uuid
 import re
+from collections import deque
+
+import aiohttp
+
+from config import DATA_DIR
+from services.aria2 import Aria2Error, aria2
+from services.bencode import BencodeError, decode, info_hash
+from services.http_client import http_client
+from services.preflight import TELEGRAM_MAX_BYTES
+from services.tracker_health import tracker_health
+
+# Magnet metadata, saved as <infohash>.torrent and reused by every later request for the same torrent
+METADATA_DIR = DATA_DIR / "torrents"
+METADATA_DIR.mkdir(exist_ok=True)
+METADATA_CACHE_SIZE = 2000
+# How long a magnet may take to produce metadata
+METADATA_TIMEOUT = 60
+# Largest .torrent accepted from a URL
+TORRENT_FILE_LIMIT = 16 * 1024 * 1024
+# Stall detection timeout (increased to 90s for slower trackers)
+STALL_TIMEOUT = 90
+PROGRESS_INTERVAL = 5.0
+MAX_FILES_SHOWN = 5
+STATUS_KEYS = ['status', 'totalLength', 'completedLength', 'downloadSpeed', 'numSeeders', 'connections', 'errorMessage']
+DEAD_TORRENT = "No seeds/peers found. This torrent appears to be dead (cannot download)."
+TRACKER_URL_RE = re.compile(r'https?://[^\s<>"]+viewtopic\.php\?t=\d+')
+
+
+class TorrentCancelled(Exception):
+    pass
+
+
+def _human(size: int) -> str:
+    for unit in ("B", "KiB", "MiB", "GiB"):
+        if size < 1024 or unit == "GiB":
+            return f"{size:.0f}{unit}" if unit == "B" else f"{size:.1f}{unit}"
+        size /= 1024
+    return f"{size:.1f}GiB"
+
+
+def _natural_key(path: str) -> List:
+    """Sort key that puts 'E2' before 'E10'."""
+    return [int(part) if part.isdigit() else part.lower() for part in re.split(r'(\d+)', path)]
+
+
+def _text(d: Dict, key: bytes) -> str:
+    """String field of a metainfo dict, preferring the `<key>.utf-8` variant some clients write."""
+    value = d.get(key + b'.utf-8') or d.get(key)
+    return value.decode('utf-8', errors='replace') if isinstance(value, bytes) else ""
+
+
+def magnet_info_hash(uri: str) -> Optional[str]:
+    """Lowercase hex v1 infohash of a magnet link (hex or base32 btih), or None."""
+    for xt in parse_qs(urlsplit(uri).query).get('xt', []):
+        if not xt.lower().startswith('urn:btih:'):
+            continue
+        value = xt[len('urn:btih:'):]
+        try:
+            if len(value) == 40:
+                return bytes.fromhex(value).hex()
+            if len(value) == 32:
+                return base64.b32decode(value.upper()).hex()
+        except (ValueError, binascii.Error):
+            return None
+    return None
+
+
+def parse_metainfo(data: bytes) -> Dict:
+    """Name, files, sizes, comment and trackers of a .torrent. Raises BencodeError.
+
+    File indexes follow the metainfo order, which is what aria2's select-file uses;
+    BEP 47 padding files keep their index but are marked.
+    """
+    meta = decode(data)
+    info = meta.get(b'info') if isinstance(meta, dict) else None
+    if not isinstance(info, dict):
+        raise BencodeError("no info dictionary")
+
+    name = _text(info, b'name')
+    files = []
+    if isinstance(info.get(b'files'), list):
+        for index, entry in enumerate(info[b'files'], 1):
+            parts = entry.get(b'path.utf-8') or entry.get(b'path') or []
+            path = "/".join(part.decode('utf-8', errors='replace') for part in parts)
+            files.append({
+                'index': str(index),
+                'path': f"{name}/{path}" if name else path,
+                'size': int(entry.get(b'length') or 0),
+                'padding': b'p' in (entry.get(b'attr') or b''),
+            })
+    else:
+        files.append({'index': '1', 'path': name, 'size': int(info.get(b'length') or 0), 'padding': False})
+
+    trackers = [meta[b'announce'].decode('utf-8', errors='replace')] if isinstance(meta.get(b'announce'), bytes) else []
+    for tier in meta.get(b'announce-list') or []:
+        for url in tier if isinstance(tier, list) else []:
+            url = url.decode('utf-8', errors='replace')
+            if url not in trackers:
+                trackers.append(url)
+
+    return {
+        'infohash': info_hash(data),
+        'name': name,
+        'files': files,
+        'total_size': sum(f['size'] for f in files if not f['padding']),
+        'comment': _text(meta, b'comment'),
+        'publisher_url': _text(meta, b'publisher-url'),
+        'trackers': trackers,
+    }
+
+
+class _TorrentJob:
+    """State of one download_torrent call. The aria2 gid changes when a finished
+    download has to be re-added to move the file window."""
+
+    def __init__(self, name: str, torrent_b64: str, options: Dict, wanted: List[Dict], window_size: int):
+        self.name = name
+        self.torrent_b64 = torrent_b64
+        self.options = options
+        self.order = [f['index'] for f in wanted]
+        self.sizes = {f['index']: f['size'] for f in wanted}
+        self.window_size = window_size
+        self.window = self.order[:window_size]
+        self.ready: Dict[str, Path] = {}
+        self.gid: Optional[str] = None
+        self.moves = 0
+        self.state = 'waiting'
+        self.progress = 0.0
+        self.speed = self.seeds = self.peers = 0
+        self.created = time.monotonic()
+        self.first_peer: Optional[float] = None
+
+    def refill(self) -> bool:
+        """Drops finished files from the window and tops it up in upload order; True if files were added."""
+        window = [i for i in self.window if i not in self.ready]
+        added = False
+        for index in self.order:
+            if len(window) >= self.window_size:
+                break
+            if index not in self.ready and index not in window:
+                window.append(index)
+                added = True
+        self.window = window
+        return added
+
+    def update(self, files: List[Dict], state: str, speed: int, seeds: int, peers: int) -> None:
+        total = sum(self.sizes.values())
+        done = sum(self.sizes[i] for i in self.ready)
+        done += sum(min(int(f.get('completedLength') or 0), self.sizes[f['index']])
+                    for f in files if f.get('index') in self.sizes and f['index'] not in self.ready)
+        self.state, self.speed, self.seeds, self.peers = state, speed, seeds, peers
+        self.progress = done / total if total else 0.0
+
+    def snapshot(self) -> Dict:
+        return {'name': self.name, 'state': self.state, 'progress': self.progress, 'speed': self.speed,
+                'seeds': self.seeds, 'peers': self.peers, 'files_ready': len(self.ready), 'files': len(self.sizes)}
+
 
 class TorrentService:
-    def __init__(self, downloads_dir: Path):
+    """Torrents through the shared aria2 daemon (services.aria2).
+
+    .torrent files are parsed in-process (services.bencode). Magnet metadata is
+    fetched once through aria2 (bt-metadata-only), stored under data/torrents as
+    <infohash>.torrent and reused for the download and for later requests of the
+    same magnet. download_torrent follows the aria2 download with tellStatus and
+    getFiles and wakes up early on aria2's completion events. Running torrents are
+    listed in `active` and can be paused, resumed, throttled or cancelled by gid.
+    Trackers that stopped answering (services.tracker_health) are left out of every add.
+    """
+
+    def __init__(self, downloads_dir: Path, per_torrent_limit: str = "0", file_window: int = 2):
         self.downloads_dir = downloads_dir
+        self.per_torrent_limit = per_torrent_limit or "0"
+        self.file_window = max(1, file_window)
         self.media_extensions = {
             '.mp4', '.mkv', '.avi', '.mov', '.flv', '.wmv', '.webm', '.ts', '.m2ts', # Video
             '.flac', '.mp3', '.m4a', '.wav', '.ogg', '.opus', '.wma' # Audio
         }
+        self._fetching: Dict[str, asyncio.Task] = {}
+        self._url_hashes: Dict[str, str] = {}
+        self.active: Dict[str, Dict] = {}
+        self.completed = 0
+        self.failed = 0
+        self.cancelled = 0
+        self.metadata_hits = 0
+        self.metadata_fetches = 0
+        self.metadata_cached = len(list(METADATA_DIR.glob("*.torrent")))
+        self.trackers_excluded = 0
+        self._first_peer = deque(maxlen=100)
 
     def extract_tracker_url(self, torrent_path: Path) -> Optional[str]:
         """Tries to extract a tracker URL (like rutracker) from .torrent metadata."""
         try:
-            with open(torrent_path, 'rb') as f:
-                data = f.read()
-            
-            # 1. Search for typical tracker URL pattern (e.g. rutracker)
-            match = re.search(rb'https?://[^\s<>"]+viewtopic\.php\?t=\d+', data)
-            if match:
-                return match.group(0).decode('utf-8', errors='ignore')
-                
-            # 2. Fallback: Search for bencoded 'comment' field
-            match = re.search(rb'7:comment(\d+):', data)
-            if match:
-                try:
-                    length = int(match.group(1))
-                    start = match.end()
-                    comment = data[start:start+length].decode('utf-8', errors='ignore')
-                    if comment.startswith('http'):
-                        return comment
-                except: pass
+            meta = parse_metainfo(torrent_path.read_bytes())
+        except (OSError, BencodeError):
             return None
-        except Exception:
+        candidates = [meta['comment'], meta['publisher_url']]
+        # 1. Typical tracker topic URL (e.g. rutracker), 2. any URL in the comment
+        for text in candidates:
+            match = TRACKER_URL_RE.search(text)
+            if match:
+                return match.group(0)
+        for text in candidates:
+            if text.startswith('http'):
+                return text
+        return None
+
+    def _tracker_options(self, trackers: List[str], infohash: str, extra: List[str]) -> Dict:
+        """bt-exclude-tracker for trackers known to be dead and bt-tracker for the live ones in `extra`
+        (which aria2 adds after exclusion); queues the unchecked ones for a probe."""
+        tracker_health.check(trackers + extra, infohash)
+        dead = tracker_health.dead(trackers + extra)
+        options = {}
+        if dead:
+            self.trackers_excluded += len(dead)
+            options['bt-exclude-tracker'] = ",".join(dead)
+        extra = [url for url in extra if url not in dead]
+        if extra:
+            options['bt-tracker'] = ",".join(extra)
+        return options
+
+    def _new_dir(self) -> Path:
+        return self.downloads_dir / f"torrent_{uuid.uuid4().hex[:8]}"
+
+    @staticmethod
+    async def _remove_dir(path: Path) -> None:
+        if path.exists():
+            await asyncio.to_thread(shutil.rmtree, path, True)
+
+    @staticmethod
+    def _read_cached(infohash: str) -> Optional[bytes]:
+        path = METADATA_DIR / f"{infohash}.torrent"
+        try:
+            data = path.read_bytes()
+            os.utime(path)  # Recently used entries survive pruning
+            return data
+        except OSError:
             return None
 
+    def _store(self, infohash: str, data: bytes) -> None:
+        path = METADATA_DIR / f"{infohash}.torrent"
+        temp = path.with_suffix(".part")
+        temp.write_bytes(data)
+        os.replace(temp, path)
+        entries = sorted(METADATA_DIR.glob("*.torrent"), key=lambda p: p.stat().st_mtime)
+        for old in entries[:max(0, len(entries) - METADATA_CACHE_SIZE)]:
+            old.unlink(missing_ok=True)
+        self.metadata_cached = min(len(entries), METADATA_CACHE_SIZE)
+
+    async def _load(self, torrent_source: Union[Path, str]) -> Tuple[bytes, Dict]:
+        """(.torrent bytes, parsed metainfo) for a file, magnet link or .torrent URL."""
+        if isinstance(torrent_source, Path):
+            data = await asyncio.to_thread(torrent_source.read_bytes)
+        elif torrent_source.startswith("magnet:"):
+            data = await self._magnet_metadata(torrent_source)
+        else:
+            data = await self._url_metadata(torrent_source)
+        try:
+            return data, parse_metainfo(data)
+        except BencodeError as e:
+            raise Exception(f"Failed to get torrent info: not a valid .torrent file ({e}).")
+
+    async def _magnet_metadata(self, uri: str) -> bytes:
+        infohash = magnet_info_hash(uri)
+        if not infohash:
+            raise Exception("Failed to get torrent info: the magnet link has no BitTorrent infohash.")
+        cached = await asyncio.to_thread(self._read_cached, infohash)
+        if cached is not None:
+            self.metadata_hits += 1
+            return cached
+        # Concurrent requests for the same magnet share one fetch
+        task = self._fetching.get(infohash)
+        if task is None:
+            task = asyncio.create_task(self._fetch_metadata(uri, infohash))
+            self._fetching[infohash] = task
+            task.add_done_callback(lambda _: self._fetching.pop(infohash, None))
+        return await asyncio.shield(task)
+
+    async def _fetch_metadata(self, uri: str, infohash: str) -> bytes:
+        """Downloads only the metadata of a magnet through aria2 and caches it as a .torrent."""
+        self.metadata_fetches += 1
+        started = time.monotonic()
+        work_dir = self.downloads_dir / f"meta_{uuid.uuid4().hex[:8]}"
+        options = {'dir': str(work_dir), 'bt-metadata-only': 'true', 'bt-save-metadata': 'true', 'follow-torrent': 'false'}
+        options.update(self._tracker_options(parse_qs(urlsplit(uri).query).get('tr', []), infohash, []))
+        gid = await aria2.call('addUri', [uri], options)
+        try:
+            while True:
+                status = await aria2.status(gid, ['status', 'errorMessage'])
+                state = status.get('status')
+                if state == 'complete':
+                    break
+                if state in ('error', 'removed'):
+                    raise Exception(f"Failed to get torrent info: {status.get('errorMessage') or state}")
+                if time.monotonic() - started > METADATA_TIMEOUT:
+                    raise Exception(f"Failed to get torrent info: no metadata received within {METADATA_TIMEOUT}s.")
+                await aria2.wait_change(gid, 1.0)
+            # aria2 names the saved metadata after the hex infohash
+            try:
+                data = await asyncio.to_thread((work_dir / f"{infohash}.torrent").read_bytes)
+            except OSError:
+                raise Exception("Failed to get torrent info: aria2 did not save the metadata.")
+        finally:
+            await aria2.remove(gid)
+            await self._remove_dir(work_dir)
+
+        if info_hash(data) != infohash:
+            raise Exception("Failed to get torrent info: received metadata does not match the magnet link.")
+        await asyncio.to_thread(self._store, infohash, data)
+        logging.info(f"[TORRENT] ✅ Metadata for {infohash} fetched in {time.monotonic() - started:.1f}s")
+        return data
+
+    async def _url_metadata(self, url: str) -> bytes:
+        infohash = self._url_hashes.get(url)
+        cached = await asyncio.to_thread(self._read_cached, infohash) if infohash else None
+        if cached is not None:
+            self.metadata_hits += 1
+            return cached
+        try:
+            async with http_client.session().get(url, timeout=aiohttp.ClientTimeout(total=30)) as resp:
+                if resp.status != 200:
+                    raise Exception(f"Failed to get torrent info: HTTP {resp.status}")
+                data = await resp.content.read(TORRENT_FILE_LIMIT + 1)
+        except aiohttp.ClientError as e:
+            raise Exception(f"Failed to get torrent info: {e}")
+        if len(data) > TORRENT_FILE_LIMIT:
+            raise Exception("Failed to get torrent info: .torrent file is too large.")
+        infohash = info_hash(data)
+        if infohash:
+            await asyncio.to_thread(self._store, infohash, data)
+            if len(self._url_hashes) >= METADATA_CACHE_SIZE:
+                self._url_hashes.pop(next(iter(self._url_hashes)))
+            self._url_hashes[url] = infohash
+        return data
+
     async def get_torrent_info(self, torrent_source: Union[Path, str]) -> Dict:
-        """Returns information about the torrent: files, total_size, name."""
-        is_magnet = isinstance(torrent_source, str) and torrent_source.startswith("magnet:")
-        
-        # For magnet links, we need to wait a bit to fetch metadata
-        cmd = ["aria2c", "--show-files"]
-        if is_magnet:
-            # Add timeout to metadata fetching for magnets
-            cmd.extend(["--bt-metadata-only=true", "--bt-stop-timeout=60", "--enable-dht=true"])
-            
-        cmd.append(str(torrent_source))
-        
-        process = await asyncio.create_subprocess_exec(
-            *cmd,
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.PIPE
-        )
-        stdout, stderr = await process.communicate()
-        output = stdout.decode()
-        
-        if process.returncode != 0:
-            err = stderr.decode()
-            if "not found" in err.lower():
-                raise Exception("aria2c is not installed on the system.")
-            raise Exception(f"Failed to get torrent info: {err}")
-        
-        files = []
-        total_size = 0
-        name = ""
-        
-        lines = output.splitlines()
-        data_started = False
-        
-        for line in lines:
-            line = line.strip()
-            if not line: continue
-            
-            # Parse Name
-            if line.lower().startswith("name:"):
-                name = line.split(":", 1)[1].strip()
-                continue
-                
-            # Parse Total Length
-            if line.lower().startswith("total length:"):
-                # Format: Total Length: 279MiB (292,804,887)
-                size_match = re.search(r"\((\d+)\)", line)
-                if size_match:
-                    total_size = int(size_match.group(1))
-                else:
-                    # Try to parse the first part if parenthesis not found
-                    parts = line.split(":", 1)[1].strip().split()
-                    if parts:
-                        total_size = self._parse_size(parts[0])
-                continue
+        """Returns information about the torrent: files, total_size, name, infohash."""
+        _, meta = await self._load(torrent_source)
+        files = [
+            {'index': f['index'], 'path': f['path'], 'size': f['size'], 'size_str': _human(f['size'])}
+            for f in meta['files'] if not f['padding']
+        ]
 
-            # Parse files list (idx|path|size format)
-            if "idx" in line.lower() and "|" in line:
-                data_started = True
-                continue
-            
-            if data_started or (line and line[0].isdigit() and "|" in line):
-                parts = line.split('|')
-                if len(parts) >= 3:
-                    idx = parts[0].strip()
-                    path = parts[1].strip()
-                    size_str = parts[2].strip()
-                    
-                    if not idx.isdigit():
-                        continue
-                        
-                    size_bytes = self._parse_size(size_str)
-                    files.append({
-                        'index': idx,
-                        'path': path,
-                        'size': size_bytes,
-                        'size_str': size_str
-                    })
-                    data_started = True
-        
-        if not name and is_magnet:
+        name = meta['name']
+        if not name and isinstance(torrent_source, str) and torrent_source.startswith("magnet:"):
             # Try to extract name from 'dn' (display name) parameter in magnet link
-            dn_match = re.search(r"dn=([^&]+)", str(torrent_source))
+            dn_match = re.search(r"dn=([^&]+)", torrent_source)
             if dn_match:
                 from urllib.parse import unquote
                 name = unquote(dn_match.group(1)).replace('+', ' ')
 
         return {
             'files': files,
-            'total_size': total_size,
-            'name': name or "Torrent"
+            'total_size': meta['total_size'],
+            'name': name or "Torrent",
+            'infohash': meta['infohash'],
         }
 
-    def _parse_size(self, size_str: str) -> int:
-        """Converts human readable size (e.g. 1.2GiB, 500MiB) to bytes."""
-        units = {
-            "B": 1, "K": 1024, "KB": 1024, "KIB": 1024,
-            "M": 1024**2, "MB": 1024**2, "MIB": 1024**2,
-            "G": 1024**3, "GB": 1024**3, "GIB": 1024**3,
-            "T": 1024**4, "TB": 1024**4, "TIB": 1024**4
-        }
-        match = re.match(r"^([\d.]+)\s*([a-zA-Z]+)?", size_str.upper())
-        if not match:
-            return 0
-        number = float(match.group(1))
-        unit = match.group(2) or "B"
-        return int(number * units.get(unit, 1))
-
-    async def download_torrent(self, torrent_source: Union[Path, str], progress_callback=None) -> Tuple[List[Path], Path]:
-        """Downloads the torrent and returns a list of media files and the output directory."""
-        unique_id = uuid.uuid4().hex[:8]
-        output_dir = self.downloads_dir / f"torrent_{unique_id}"
+    def plan_files(self, files: List[Dict], max_size: int = TELEGRAM_MAX_BYTES) -> Tuple[List[Dict], List[Dict]]:
+        """(media files to download, in upload order; media files skipped for being over max_size)."""
+        media = sorted((f for f in files if Path(f['path']).suffix.lower() in self.media_extensions),
+                       key=lambda f: _natural_key(f['path']))
+        return [f for f in media if f['size'] <= max_size], [f for f in media if f['size'] > max_size]
+
+    async def download_torrent(self, torrent_source: Union[Path, str], progress_callback=None,
+                               on_file_ready=None, indexes: Optional[Iterable[str]] = None) -> Tuple[List[Path], Path]:
+        """Downloads the media files of the torrent; returns them in upload order and the output directory.
+
+        Only media under the Telegram limit are selected (aria2 select-file), restricted
+        to `indexes` when given, at most file_window at a time in upload order;
+        on_file_ready(path, index) is awaited as soon as each file is complete.
+        """
+        data, meta = await self._load(torrent_source)
+        wanted, _ = self.plan_files([f for f in meta['files'] if not f['padding']])
+        if indexes is not None:
+            indexes = set(indexes)
+            wanted = [f for f in wanted if f['index'] in indexes]
+        if not wanted:
+            raise Exception("No media files (video/audio) under 2GB found in the torrent.")
+        output_dir = self._new_dir()
         output_dir.mkdir(exist_ok=True)
-        
-        # aria2c command with BitTorrent optimizations
-        cmd = [
-            "aria2c",
-            "--dir", str(output_dir),
-            "--seed-time=0",
-            "--summary-interval=6",
-            "--bt-stop-timeout=120", # Wait up to 120s of no progress
-            "--file-allocation=none",
-            "--enable-dht=true",
-            "--bt-enable-lpd=true",
-            "--enable-peer-exchange=true", # PEX helps find peers without tracker
-            "--bt-max-peers=120",
-            "--listen-port=16881-16890",
-            "--dht-listen-port=16881-16890",
-            "--bt-tracker-timeout=30",
-            "--bt-tracker-interval=60",
-            "--user-agent=Transmission/3.00", # Some trackers block aria2c
-            "--peer-id-prefix=-TR3000-",      # Impersonate Transmission
-            str(torrent_source)
-        ]
-        
-        logging.info(f"Starting torrent download: {' '.join(cmd)}")
-        
-        process = await asyncio.create_subprocess_exec(
-            *cmd,
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.PIPE
-        )
-        
-        last_progress_time = asyncio.get_event_loop().time()
-        start_time = last_progress_time
+
+        options = {'dir': str(output_dir), 'bt-stop-timeout': '120'}
+        if self.per_torrent_limit != "0":
+            options['max-download-limit'] = self.per_torrent_limit
+        link_trackers = []
+        if isinstance(torrent_source, str) and torrent_source.startswith("magnet:"):
+            # Cached metadata carries no trackers; keep the ones from the link
+            link_trackers = [url for url in parse_qs(urlsplit(torrent_source).query).get('tr', []) if url not in meta['trackers']]
+        options.update(self._tracker_options(meta['trackers'], meta['infohash'], link_trackers))
+
+        job = _TorrentJob(meta['name'], base64.b64encode(data).decode(), options, wanted, self.file_window)
+        try:
+            await self._start(job, job.window)
+            logging.info(f"[TORRENT] Starting {job.gid} ({meta['infohash']}): {len(wanted)} of {len(meta['files'])} files "
+                         f"in {output_dir.name}")
+            await self._follow(job, output_dir, progress_callback, on_file_ready)
+        except BaseException as e:
+            if isinstance(e, (asyncio.CancelledError, TorrentCancelled)):
+                self.cancelled += 1
+            else:
+                self.failed += 1
+            if job.gid:
+                await aria2.remove(job.gid)
+            await self._remove_dir(output_dir)
+            raise
+        finally:
+            if job.gid:
+                self.active.pop(job.gid, None)
+        await aria2.remove(job.gid)
+        self.completed += 1
+        logging.info(f"[TORRENT] ✅ {job.gid} complete ({len(job.ready)} files, {job.moves} window moves)")
+
+        return [job.ready[f['index']] for f in wanted if f['index'] in job.ready], output_dir
+
+    async def _start(self, job: "_TorrentJob", selection: List[str], recheck: bool = False) -> None:
+        options = {**job.options, 'select-file': ",".join(selection)}
+        if recheck:
+            # Pieces shared with files already on disk are verified instead of refused
+            options['check-integrity'] = 'true'
+        job.gid = await aria2.call('addTorrent', job.torrent_b64, [], options)
+        self.active[job.gid] = job
+
+    async def _move_window(self, job: "_TorrentJob", selection: List[str]) -> None:
+        """Points the download at a new set of files: changeOption on the paused download,
+        or a fresh addTorrent if aria2 has already finished it."""
+        job.moves += 1
+        gid = job.gid
+        try:
+            if (await aria2.status(gid, ['status'])).get('status') != 'complete':
+                await aria2.call('forcePause', gid)
+                for _ in range(50):
+                    if (await aria2.status(gid, ['status'])).get('status') == 'paused':
+                        break
+                    await asyncio.sleep(0.1)
+                await aria2.call('changeOption', gid, {'select-file': ",".join(selection)})
+                await aria2.resume(gid)
+                return
+        except Aria2Error as e:
+            logging.info(f"[TORRENT] Re-adding {gid} to move the file window: {e}")
+        self.active.pop(gid, None)
+        await aria2.remove(gid)
+        await self._start(job, selection, recheck=True)
+
+    async def _follow(self, job: "_TorrentJob", output_dir: Path, progress_callback=None, on_file_ready=None) -> None:
+        """Reports progress and hands off finished files until every wanted file is done;
+        raises if the download fails, stalls or is cancelled."""
+        start_time = time.monotonic()
         has_health_ever = False
         last_status_text = ""
-        
-        # Stall detection timeout (increased to 90s for slower trackers)
-        STALL_TIMEOUT = 90
-        
+
         while True:
-            try:
-                line = await asyncio.wait_for(process.stdout.readline(), timeout=1.0)
-            except asyncio.TimeoutError:
-                if asyncio.get_event_loop().time() - start_time > STALL_TIMEOUT and not has_health_ever:
-                    process.terminate()
-                    raise Exception("No seeds/peers found. This torrent appears to be dead (cannot download).")
+            status = await aria2.status(job.gid, STATUS_KEYS)
+            state = status.get('status')
+            total = int(status.get('totalLength') or 0)
+            done = int(status.get('completedLength') or 0)
+            speed = int(status.get('downloadSpeed') or 0)
+            seeds = int(status.get('numSeeders') or 0)
+            peers = int(status.get('connections') or 0)
+
+            if state == 'error':
+                err_msg = status.get('errorMessage') or 'unknown error'
+                logging.error(f"Torrent download failed: {err_msg}")
+                raise Exception(f"Download failed: {err_msg[:200]}")
+            if state == 'removed':
+                raise TorrentCancelled("Torrent download was cancelled.")
+
+            files = await aria2.call('getFiles', job.gid)
+            for f in files:
+                index = f.get('index')
+                if index in job.sizes and index not in job.ready and int(f.get('completedLength') or 0) >= job.sizes[index]:
+                    path = Path(f['path'])
+                    job.ready[index] = path
+                    logging.info(f"[TORRENT] {job.gid}: {path.name} ready ({len(job.ready)}/{len(job.sizes)})")
+                    if on_file_ready:
+                        await on_file_ready(path, index)
+
+            if len(job.ready) == len(job.sizes):
+                return
+            if state == 'complete':
+                if not job.refill():
+                    # bt-stop-timeout ends a download that stopped receiving data as "complete"
+                    raise Exception(DEAD_TORRENT)
+                await self._move_window(job, job.window)
                 continue
-                
-            if not line:
-                break
-            
-            line_str = line.decode().strip()
-            
-            # Seed/Peer/Connection regexes
-            percent_match = re.search(r"\((\d+)%\)", line_str) or re.search(r"(\d+)%", line_str)
-            sp_match = re.search(r"[(\[]S:(\d+)[, ]+P:(\d+)[\)\]]", line_str)
-            if not sp_match:
-                sp_match = re.search(r"S:(\d+).*P:(\d+)", line_str)
-            
-            cn_match = re.search(r"CN:(\d+)", line_str)
-            dl_match = re.search(r"DL:([\d.]+)([a-zA-Z]+)", line_str)
-            
-            status_text = ""
-            status_parts = []
-            
-            if percent_match:
-                status_parts.append(f"Downloading: {percent_match.group(1)}%")
-                if int(percent_match.group(1)) > 0:
-                    has_health_ever = True
-            
-            if sp_match:
-                seeds = int(sp_match.group(1))
-                peers = int(sp_match.group(2))
-                if seeds > 0 or peers > 0:
-                    has_health_ever = True
-                status_parts.append(f"Seeds: {seeds} | Peers: {peers}")
-            elif cn_match:
-                status_parts.append(f"Connections: {cn_match.group(1)}")
-            
-            if dl_match:
-                speed_val = float(dl_match.group(1))
-                if speed_val > 0:
-                    has_health_ever = True
-                status_parts.append(f"Speed: {dl_match.group(1)}{dl_match.group(2)}")
-            
-            if status_parts:
-                status_text = "\n".join(status_parts)
-            
-            if status_text and status_text != last_status_text:
+            if state == 'active' and job.refill():
+                await self._move_window(job, job.window)
+
+            if (peers or done) and job.first_peer is None:
+                job.first_peer = time.monotonic() - job.created
+                self._first_peer.append(job.first_peer)
+                logging.info(f"[TORRENT] {job.gid}: first peer after {job.first_peer:.1f}s")
+            if done or seeds or peers:
+                has_health_ever = True
+            if state != 'active':
+                # Paused (or queued) time does not count towards the stall timeout
+                start_time = time.monotonic()
+            if not has_health_ever and time.monotonic() - start_time > STALL_TIMEOUT:
+                raise Exception(DEAD_TORRENT)
+
+            job.update(files, state, speed, seeds, peers)
+            status_text = self._status_text(job, files, state, speed, seeds, peers)
+            if status_text != last_status_text:
                 if progress_callback:
                     await progress_callback(status_text)
                 last_status_text = status_text
-                
-            # Periodic check for dead torrents if stuck at start
-            if asyncio.get_event_loop().time() - start_time > STALL_TIMEOUT and not has_health_ever:
-                process.terminate()
-                raise Exception("No seeds/peers found. This torrent appears to be dead (cannot download).")
-        
-        await process.wait()
-        
-        if process.returncode != 0:
-            # Check if it was terminated by us or failed
-            stderr_data = await process.stderr.read()
-            err_msg = stderr_data.decode()
-            if "Terminated" in err_msg or process.returncode == -15: # SIGTERM
-                raise Exception("No seeds/peers found. This torrent appears to be dead (cannot download).")
-            
-            logging.error(f"Torrent download failed: {err_msg}")
-            raise Exception(f"Download failed: {err_msg[:200]}")
-            
-        media_files = []
-        for p in output_dir.rglob("*"):
-            if p.is_file() and p.suffix.lower() in self.media_extensions:
-                media_files.append(p)
-                
-        return media_files, output_dir
+
+            await aria2.wait_change(job.gid, PROGRESS_INTERVAL)
+
+    @staticmethod
+    def _status_text(job: "_TorrentJob", files: List[Dict], state: str, speed: int, seeds: int, peers: int) -> str:
+        lines = [f"{'Paused' if state == 'paused' else 'Downloading'}: {int(job.progress * 100)}%",
+                 f"Seeds: {seeds} | Peers: {peers}",
+                 f"Speed: {_human(speed)}/s"]
+        if len(job.sizes) > 1:
+            lines.append(f"Files ready: {len(job.ready)}/{len(job.sizes)}")
+            # Per-file progress of the files being downloaded now
+            current = [f for f in files if f.get('index') in job.window and f.get('index') not in job.ready]
+            for f in current[:MAX_FILES_SHOWN]:
+                length = job.sizes[f['index']]
+                file_percent = int(int(f.get('completedLength') or 0) * 100 / length) if length else 100
+                lines.append(f"• {Path(f.get('path') or '').name[:40]}: {file_percent}%")
+        return "\n".join(lines)
+
+    async def pause(self, gid: str) -> None:
+        await aria2.pause(gid)
+
+    async def resume(self, gid: str) -> None:
+        await aria2.resume(gid)
+
+    async def cancel(self, gid: str) -> None:
+        """Stops the download; its download_torrent call fails with 'cancelled'."""
+        await aria2.call('forceRemove', gid)
+
+    async def set_limit(self, limit: str, gid: Optional[str] = None) -> None:
+        """Download cap for one torrent, or for all of them together when gid is None ('0' = unlimited)."""
+        if gid:
+            await aria2.set_limit(gid, limit)
+        else:
+            await aria2.set_overall_limit(limit)
+
+    def get_stats(self) -> dict:
+        return {
+            'active': {gid: job.snapshot() for gid, job in self.active.items()},
+            'completed': self.completed,
+            'failed': self.failed,
+            'cancelled': self.cancelled,
+            'metadata_hits': self.metadata_hits,
+            'metadata_fetches': self.metadata_fetches,
+            'metadata_cached': self.metadata_cached,
+            'per_torrent_limit': self.per_torrent_limit,
+            'trackers_excluded': self.trackers_excluded,
+            'first_peer_avg': sum(self._first_peer) / len(self._first_peer) if self._first_peer else 0.0,
+            'first_peer_last': self._first_peer[-1] if self._first_peer else 0.0,
+        }
 
 # Singleton
-from config import DOWNLOADS_DIR
-torrent_service = TorrentService(DOWNLOADS_DIR)
+from config import DOWNLOADS_DIR, TORRENT_MAX_DOWNLOAD_LIMIT, TORRENT_FILE_WINDOW
+torrent_service = TorrentService(DOWNLOADS_DIR, TORRENT_MAX_DOWNLOAD_LIMIT, TORRENT_FILE_WINDOW)
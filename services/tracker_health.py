@@ -0,0 +1,171 @@
+import asyncio
+import json
+import logging
+import os
+import secrets
+import struct
+import time
+from pathlib import Path
+from typing import Dict, Iterable, List
+from urllib.parse import urlencode, urlsplit
+
+import aiohttp
+from yarl import URL
+
+from services.aria2 import STATE_DIR
+from services.bencode import BencodeError, decode
+from services.http_client import http_client
+
+# How long a probe result is trusted; a dead tracker gets another chance sooner
+PROBE_TTL = 3600
+RETRY_AFTER = 600
+PROBE_TIMEOUT = 10.0
+# Consecutive failed probes before a tracker is left out; one slow answer is not enough
+DEAD_AFTER = 3
+MAX_TRACKERS = 5000
+UDP_PROTOCOL_ID = 0x41727101980
+# BEP 15 clients resend unanswered UDP requests; a lost datagram must not make a tracker dead
+UDP_RESEND = 3.0
+# Port reported in HTTP probes; matches the daemon's listen-port range
+ANNOUNCE_PORT = 16881
+
+
+class _UdpConnect(asyncio.DatagramProtocol):
+    """BEP 15 connect handshake: the tracker must echo our transaction id."""
+
+    def __init__(self, transaction: int):
+        self.transaction = transaction
+        self.answered = asyncio.get_running_loop().create_future()
+
+    def datagram_received(self, data: bytes, addr) -> None:
+        if len(data) >= 16 and struct.unpack('>II', data[:8]) == (0, self.transaction) and not self.answered.done():
+            self.answered.set_result(True)
+
+    def error_received(self, exc: Exception) -> None:
+        if not self.answered.done():
+            self.answered.set_exception(exc)
+
+
+class TrackerHealth:
+    """Which trackers answer, remembered across jobs and restarts (data/aria2/trackers.json).
+
+    check() probes every tracker of a torrent whose last result is older than
+    PROBE_TTL in the background (UDP connect handshake, or an HTTP announce with
+    event=stopped), so the download itself never waits for it. dead() lists the
+    trackers that failed DEAD_AFTER probes in a row; they are passed to aria2 as
+    bt-exclude-tracker, and a torrent whose first tier is dead goes straight to a
+    tracker that answers instead of sitting out bt-tracker-timeout first. A torrent
+    never loses all of its trackers this way. Failing trackers are probed again after
+    RETRY_AFTER, so one that comes back is used again.
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.trackers: Dict[str, Dict] = {}
+        self._probing: Dict[str, asyncio.Task] = {}
+        self._save_lock = asyncio.Lock()
+        self.probes = 0
+        self.probe_failures = 0
+        try:
+            self.trackers = json.loads(path.read_text())
+        except (OSError, ValueError):
+            pass
+
+    def _is_dead(self, url: str) -> bool:
+        return self.trackers.get(url, {}).get('streak', 0) >= DEAD_AFTER
+
+    def dead(self, trackers: Iterable[str]) -> List[str]:
+        """Trackers to exclude; empty when that would be every tracker of the torrent."""
+        trackers = list(dict.fromkeys(trackers))
+        dead = [url for url in trackers if self._is_dead(url)]
+        return dead if len(dead) < len(trackers) else []
+
+    def check(self, trackers: Iterable[str], infohash: str) -> None:
+        """Probes the trackers that are due in the background."""
+        now = time.time()
+        for url in trackers:
+            entry = self.trackers.get(url, {})
+            if url in self._probing or now - entry.get('checked', 0) < (RETRY_AFTER if entry.get('streak') else PROBE_TTL):
+                continue
+            if urlsplit(url).scheme not in ('udp', 'http', 'https'):
+                continue
+            task = asyncio.create_task(self._check(url, infohash))
+            self._probing[url] = task
+            task.add_done_callback(lambda _, url=url: self._probing.pop(url, None))
+
+    async def _check(self, url: str, infohash: str) -> None:
+        started = time.monotonic()
+        try:
+            ok = await asyncio.wait_for(self._probe(url, infohash), PROBE_TIMEOUT)
+        except (asyncio.TimeoutError, aiohttp.ClientError, OSError, ValueError):
+            ok = False
+        self.probes += 1
+        entry = self.trackers.pop(url, {})
+        entry['checked'] = time.time()
+        if ok:
+            entry['streak'] = 0
+            entry['rtt'] = round(time.monotonic() - started, 3)
+        else:
+            self.probe_failures += 1
+            entry['streak'] = entry.get('streak', 0) + 1
+            if entry['streak'] == DEAD_AFTER:
+                logging.info(f"[TRACKERS] {url} did not answer, excluding it from new downloads")
+        self.trackers[url] = entry
+        while len(self.trackers) > MAX_TRACKERS:
+            self.trackers.pop(next(iter(self.trackers)))
+        try:
+            async with self._save_lock:
+                await asyncio.to_thread(self._save, dict(self.trackers))
+        except OSError as e:
+            logging.warning(f"[TRACKERS] Could not save tracker health: {e}")
+
+    async def _probe(self, url: str, infohash: str) -> bool:
+        parts = urlsplit(url)
+        if parts.scheme == 'udp':
+            transaction = secrets.randbits(32)
+            transport, protocol = await asyncio.get_running_loop().create_datagram_endpoint(
+                lambda: _UdpConnect(transaction), remote_addr=(parts.hostname, parts.port or 80))
+            try:
+                while True:
+                    transport.sendto(struct.pack('>QII', UDP_PROTOCOL_ID, 0, transaction))
+                    try:
+                        return await asyncio.wait_for(asyncio.shield(protocol.answered), UDP_RESEND)
+                    except asyncio.TimeoutError:
+                        continue
+            finally:
+                transport.close()
+
+        query = urlencode({
+            'info_hash': bytes.fromhex(infohash), 'peer_id': b'-TR3000-' + secrets.token_hex(6).encode(),
+            'port': ANNOUNCE_PORT, 'uploaded': 0, 'downloaded': 0, 'left': 0, 'event': 'stopped', 'compact': 1,
+        })
+        separator = '&' if parts.query else '?'
+        async with http_client.session().get(URL(f"{url}{separator}{query}", encoded=True)) as resp:
+            if resp.status != 200:
+                # Private/passkey trackers often refuse a synthetic announce; they still answered
+                return resp.status < 500
+            try:
+                # Any bencoded reply counts, even a failure reason: the tracker is up
+                return isinstance(decode(await resp.content.read(64 * 1024)), dict)
+            except BencodeError:
+                return False
+
+    def _save(self, trackers: Dict) -> None:
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        temp = self.path.with_suffix(".tmp")
+        temp.write_text(json.dumps(trackers))
+        os.replace(temp, self.path)
+
+    def get_stats(self) -> dict:
+        rtts = [t['rtt'] for t in self.trackers.values() if 'rtt' in t and not t.get('streak')]
+        return {
+            'known': len(self.trackers),
+            'dead': sum(1 for url in self.trackers if self._is_dead(url)),
+            'probing': len(self._probing),
+            'probes': self.probes,
+            'probe_failures': self.probe_failures,
+            'avg_rtt_ms': sum(rtts) / len(rtts) * 1000 if rtts else 0.0,
+        }
+
+
+tracker_health = TrackerHealth(STATE_DIR / "trackers.json")
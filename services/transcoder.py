@@ -0,0 +1,193 @@
+import asyncio
+import logging
+import os
+import time
+from collections import defaultdict
+from pathlib import Path
+from typing import List, Optional
+
+from config import TRANSCODE_CRF
+from services.media_probe import MediaInfo, media_probe
+from services.scheduler import download_scheduler
+
+# Codecs Telegram clients (iPhone in particular) cannot play inline in MP4
+REENCODE_VIDEO = {'vp9', 'av1', 'vp8'}
+# Audio that can stay as is in MP4; everything else (opus, vorbis, flac, ...) becomes AAC
+MP4_AUDIO = {'aac', 'mp3'}
+
+# (max CPU pressure, x264 preset): slower presets compress better, but only while there is CPU to spare
+PRESET_LADDER = ((0.5, 'veryfast'), (1.0, 'superfast'))
+FALLBACK_PRESET = 'ultrafast'
+
+NOOP, REMUX, AUDIO, VIDEO = 'noop', 'remux', 'audio', 'video'
+
+
+def plan_transcode(path: Path, info: MediaInfo) -> str:
+    """Cheapest operation that makes the file a faststart MP4 Telegram can play.
+
+    noop  - already H.264/HEVC + AAC/MP3 in a faststart MP4 (or unknown: leave it alone)
+    remux - streams are fine, only the container or moov position is wrong
+    audio - video can be copied, audio needs AAC
+    video - video codec needs a full x264 re-encode
+    """
+    if not info.source:
+        return NOOP
+    if info.video_codec in REENCODE_VIDEO:
+        return VIDEO
+    if info.audio_codec and info.audio_codec not in MP4_AUDIO:
+        return AUDIO
+    if path.suffix.lower() != '.mp4' or info.faststart is False:
+        return REMUX
+    return NOOP
+
+
+class Transcoder:
+    """Turns downloaded videos into faststart H.264/AAC MP4 with the least work.
+
+    Each file is probed once and gets the cheapest plan (see plan_transcode). Audio
+    and video re-encodes share the scheduler's CPU pool, so no more encodes run than
+    there are slots (cores by default); remuxes are I/O bound and skip the pool.
+    The x264 preset follows CPU pressure (load average and CPU pool queue).
+    """
+
+    def __init__(self, crf: int):
+        self.crf = crf
+        self.decisions = defaultdict(int)
+        self.presets = defaultdict(int)
+        self.failures = 0
+        self.encode_frames = 0
+        self.encode_time = 0.0
+        self.encode_media = 0.0
+        self.cheap_time = 0.0
+        self.cheap_media = 0.0
+
+    @staticmethod
+    def _pressure() -> float:
+        cores = os.cpu_count() or 1
+        try:
+            load = os.getloadavg()[0] / cores
+        except (AttributeError, OSError):
+            load = 0.0
+        queue = download_scheduler.cpu_waiting / download_scheduler.cpu_slots
+        return max(load, queue)
+
+    def pick_preset(self) -> str:
+        pressure = self._pressure()
+        for limit, preset in PRESET_LADDER:
+            if pressure < limit:
+                return preset
+        return FALLBACK_PRESET
+
+    def _command(self, action: str, info: MediaInfo, source: Path, output: Path, preset: str) -> List[str]:
+        cmd = ["ffmpeg", "-y", "-loglevel", "error", "-nostats", "-progress", "pipe:1",
+               "-i", str(source), "-map", "0:v:0?", "-map", "0:a:0?"]
+        if action == VIDEO:
+            cmd += ["-c:v", "libx264", "-preset", preset, "-crf", str(self.crf), "-pix_fmt", "yuv420p"]
+        else:
+            cmd += ["-c:v", "copy"]
+        if info.audio_codec and info.audio_codec not in MP4_AUDIO:
+            cmd += ["-c:a", "aac", "-b:a", "160k"]
+        else:
+            cmd += ["-c:a", "copy"]
+        cmd += ["-movflags", "+faststart", str(output)]
+        return cmd
+
+    async def prepare(self, path: Path) -> Path:
+        """Returns a Telegram-friendly version of path (path itself when nothing is needed).
+
+        The source is replaced on success; on failure the original is returned untouched.
+        """
+        info = await media_probe.aprobe(path)
+        action = plan_transcode(path, info)
+        self.decisions[action] += 1
+        if action == NOOP:
+            self.cheap_media += info.duration
+            return path
+
+        logging.info(f"[TRANSCODE] {path.name}: {action} ({info.video_codec or '-'}/{info.audio_codec or '-'}, "
+                     f"{path.suffix.lstrip('.')}, faststart={info.faststart})")
+        if action == REMUX:
+            return await self._run(path, info, action, None)
+        async with download_scheduler.cpu_slot():
+            preset = self.pick_preset() if action == VIDEO else None
+            return await self._run(path, info, action, preset)
+
+    async def _run(self, path: Path, info: MediaInfo, action: str, preset: Optional[str]) -> Path:
+        final = path.with_suffix('.mp4')
+        temp = path.with_name(f"{path.stem}.transcode.mp4")
+        cmd = self._command(action, info, path, temp, preset)
+        # Generous: a slow preset on a busy box can run well below realtime
+        timeout = max(300.0, info.duration * 4)
+        started = time.monotonic()
+        try:
+            process = await asyncio.create_subprocess_exec(
+                *cmd, stdin=asyncio.subprocess.DEVNULL, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE
+            )
+        except OSError as e:
+            logging.error(f"[TRANSCODE] Cannot start ffmpeg: {e}")
+            self.failures += 1
+            return path
+        try:
+            stdout, stderr = await asyncio.wait_for(process.communicate(), timeout=timeout)
+        except BaseException as e:
+            if process.returncode is None:
+                process.kill()
+                await process.wait()
+            temp.unlink(missing_ok=True)
+            if isinstance(e, asyncio.TimeoutError):
+                logging.error(f"[TRANSCODE] {action} of {path.name} timed out after {timeout:.0f}s")
+                self.failures += 1
+                return path
+            raise
+        elapsed = time.monotonic() - started
+
+        if process.returncode != 0 or not temp.exists() or temp.stat().st_size == 0:
+            logging.error(f"[TRANSCODE] {action} of {path.name} failed: {stderr.decode(errors='replace')[-300:]}")
+            temp.unlink(missing_ok=True)
+            self.failures += 1
+            return path
+
+        os.replace(temp, final)
+        if final != path:
+            path.unlink(missing_ok=True)
+
+        if action == VIDEO:
+            frames = _last_progress_value(stdout, b'frame')
+            self.presets[preset] += 1
+            self.encode_frames += frames
+            self.encode_time += elapsed
+            self.encode_media += info.duration
+            fps = frames / elapsed if elapsed else 0.0
+            logging.info(f"[TRANSCODE] ✅ Encoded {final.name} with {preset} in {elapsed:.1f}s ({fps:.0f} fps)")
+        else:
+            self.cheap_time += elapsed
+            self.cheap_media += info.duration
+            logging.info(f"[TRANSCODE] ✅ {action.capitalize()} of {final.name} done in {elapsed:.1f}s")
+        return final
+
+    def get_stats(self) -> dict:
+        speed = self.encode_media / self.encode_time if self.encode_time else 0.0
+        return {
+            'decisions': dict(self.decisions),
+            'presets': dict(self.presets),
+            'failures': self.failures,
+            'encode_fps': self.encode_frames / self.encode_time if self.encode_time else 0.0,
+            'encode_speed': speed,
+            # What full re-encodes of the no-op/remux/audio files would have cost at the observed speed
+            'time_saved': max(0.0, self.cheap_media / speed - self.cheap_time) if speed else 0.0,
+        }
+
+
+def _last_progress_value(output: bytes, key: bytes) -> int:
+    """Last `key=N` value in ffmpeg -progress output."""
+    for line in reversed(output.splitlines()):
+        name, _, value = line.partition(b'=')
+        if name.strip() == key:
+            try:
+                return int(value.strip())
+            except ValueError:
+                return 0
+    return 0
+
+
+transcoder = Transcoder(TRANSCODE_CRF)
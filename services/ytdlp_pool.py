@@ -0,0 +1,388 @@
+import asyncio
+import itertools
+import logging
+import multiprocessing
+import os
+import signal
+import sys
+import threading
+import time
+import types
+from typing import Callable, Dict, List, Optional, Tuple
+
+from config import YTDLP_EXECUTOR, YTDLP_PROCESS_WORKERS, YTDLP_WORKER_MAX_JOBS, YTDLP_WORKER_RSS_MB
+
+# Keys of the yt-dlp progress dict that are forwarded from the worker to the parent hooks
+PROGRESS_FIELDS = (
+    'status', 'filename', 'downloaded_bytes', 'total_bytes', 'total_bytes_estimate', 'speed', 'eta',
+    '_percent_str', '_speed_str', '_eta_str', '_total_bytes_str', '_total_bytes_estimate_str',
+)
+PROGRESS_INTERVAL = 0.5
+POLL_INTERVAL = 0.5
+# Workers are started from the event loop and from executor threads (replacements)
+_START_LOCK = threading.Lock()
+
+
+def duration_filter(min_duration: int) -> Callable:
+    """match_filter that skips media shorter than min_duration seconds."""
+    def _filter(info_dict, *, incomplete):
+        duration = info_dict.get('duration')
+        if duration and duration < min_duration:
+            return f'Duration {duration}s is shorter than {min_duration}s'
+        return None
+    return _filter
+
+
+def _extract(ydl, url: str, download: bool, info: Optional[Dict]) -> Dict:
+    # A preflight info dict is processed as is, without extracting the URL again
+    if info is not None:
+        return ydl.process_ie_result(info, download=download)
+    return ydl.extract_info(url, download=download)
+
+
+def run_extract(ydl_opts: Dict, url: str, download: bool = True, cancelled: Optional[threading.Event] = None,
+                info: Optional[Dict] = None) -> Tuple[Dict, Optional[str]]:
+    import yt_dlp
+    if cancelled is not None:
+        def abort_hook(d):
+            if cancelled.is_set():
+                raise yt_dlp.utils.DownloadCancelled("Download abandoned")
+        ydl_opts = {**ydl_opts, 'progress_hooks': list(ydl_opts.get('progress_hooks') or []) + [abort_hook]}
+    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+        info = _extract(ydl, url, download, info)
+        prepared_name = ydl.prepare_filename(info) if download else None
+    return info, prepared_name
+
+
+def _read_rss_mb(pid: int) -> int:
+    """Resident set size of pid in MB (0 where /proc is unavailable)."""
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) // 1024
+    except (OSError, ValueError):
+        pass
+    return 0
+
+
+def _worker_main(conn) -> None:
+    """Worker process loop: receives jobs over the pipe, streams progress and the result back."""
+    # The parent's asyncio loop owns the signal wakeup fd - a signal delivered here must not wake it
+    try:
+        signal.set_wakeup_fd(-1)
+    except (ValueError, OSError):
+        pass
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    # Own process group, so killing the worker also takes down its ffmpeg children
+    os.setpgrp()
+
+    import yt_dlp
+
+    while True:
+        try:
+            job = conn.recv()
+        except (EOFError, OSError):
+            break
+        if job is None:
+            break
+
+        job_id, ydl_opts, url, download, min_duration, want_progress, preflight_info = job
+        if min_duration > 0:
+            ydl_opts['match_filter'] = duration_filter(min_duration)
+
+        if want_progress:
+            last_sent = 0.0
+
+            def hook(d):
+                nonlocal last_sent
+                now = time.monotonic()
+                if d.get('status') == 'downloading' and now - last_sent < PROGRESS_INTERVAL:
+                    return
+                last_sent = now
+                conn.send(('progress', job_id, {k: d.get(k) for k in PROGRESS_FIELDS if k in d}))
+            ydl_opts['progress_hooks'] = [hook]
+
+        try:
+            with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+                info = _extract(ydl, url, download, preflight_info)
+                prepared_name = ydl.prepare_filename(info) if download else None
+                info = ydl.sanitize_info(info)
+            conn.send(('done', job_id, info, prepared_name))
+        except Exception as e:
+            try:
+                conn.send(('error', job_id, e))
+            except Exception:
+                # Exception type is not picklable - keep the message, which callers match on
+                conn.send(('error', job_id, RuntimeError(str(e))))
+
+
+class _Worker:
+    def __init__(self, ctx, index: int):
+        self.index = index
+        self.conn, child_conn = ctx.Pipe(duplex=True)
+        self.process = ctx.Process(target=_worker_main, args=(child_conn,), name=f"ytdlp-worker-{index}", daemon=True)
+        with _START_LOCK:
+            # forkserver/spawn children re-run the script that started the bot (main.py: handlers,
+            # database setup) unless __main__ has no file; the worker only needs this module
+            main_module = sys.modules['__main__']
+            sys.modules['__main__'] = types.ModuleType('__main__')
+            try:
+                self.process.start()
+            finally:
+                sys.modules['__main__'] = main_module
+        child_conn.close()
+        self.jobs = 0
+        self.peak_rss = 0
+
+    @property
+    def pid(self) -> int:
+        return self.process.pid
+
+    def stop(self, graceful: bool = True) -> None:
+        try:
+            if graceful and self.process.is_alive():
+                self.conn.send(None)
+                self.process.join(5)
+            if self.process.is_alive():
+                try:
+                    os.killpg(self.pid, signal.SIGKILL)
+                except OSError:
+                    self.process.kill()
+                self.process.join(5)
+        except Exception as e:
+            logging.warning(f"[YTDLP-POOL] Failed to stop worker {self.pid}: {e}")
+        finally:
+            self.conn.close()
+
+
+class YtdlpProcessPool:
+    """Optional process-pool backend for yt-dlp extraction.
+
+    Workers are started once at startup and reused. They come from a forkserver
+    (spawn where there is none), never from a fork of the bot itself: replacements
+    are started from executor threads, and a forked copy of a multi-threaded process
+    inherits whatever locks those threads held. Each job streams yt-dlp progress
+    back over the worker's pipe; the parent watches the worker's RSS while the job
+    runs and kills it once it exceeds rss_limit_mb. Workers are recycled after
+    max_jobs jobs so leaks in extractors (or curl_cffi) never accumulate. With the
+    default "thread" mode extraction stays on asyncio.to_thread.
+    """
+
+    def __init__(self, mode: str, workers: int, max_jobs: int, rss_limit_mb: int):
+        self.mode = mode if mode in ('thread', 'process') else 'thread'
+        self.size = max(1, workers)
+        self.max_jobs = max(1, max_jobs)
+        self.rss_limit_mb = rss_limit_mb
+        self._ctx = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._idle: Optional[asyncio.Queue] = None
+        self._workers: List[_Worker] = []
+        self._index = itertools.count()
+        self._job_ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+        self.busy = 0
+        self.jobs = 0
+        self.errors = 0
+        self.recycled = 0
+        self.rss_kills = 0
+        self.crashes = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self._idle is not None
+
+    def start(self) -> None:
+        if self.mode != 'process' or self.enabled:
+            return
+        try:
+            if 'forkserver' in multiprocessing.get_all_start_methods():
+                self._ctx = multiprocessing.get_context('forkserver')
+                # Imported once in the server, so every new worker starts with yt-dlp loaded
+                self._ctx.set_forkserver_preload(['yt_dlp', 'services.ytdlp_pool'])
+            else:
+                self._ctx = multiprocessing.get_context('spawn')
+            self._loop = asyncio.get_running_loop()
+            self._idle = asyncio.Queue()
+            for _ in range(self.size):
+                self._idle.put_nowait(self._spawn())
+            logging.info(f"[YTDLP-POOL] ✅ Started {self.size} yt-dlp worker process(es) (max {self.max_jobs} jobs, {self.rss_limit_mb} MB RSS each)")
+        except Exception as e:
+            logging.error(f"[YTDLP-POOL] Failed to start process pool, falling back to threads: {e}")
+            self._stop_all()
+            self._idle = None
+
+    def _spawn(self) -> _Worker:
+        worker = _Worker(self._ctx, next(self._index))
+        with self._lock:
+            self._workers.append(worker)
+        return worker
+
+    def _retire(self, worker: _Worker, graceful: bool) -> None:
+        with self._lock:
+            if worker in self._workers:
+                self._workers.remove(worker)
+        worker.stop(graceful=graceful)
+
+    @staticmethod
+    def _picklable_opts(ydl_opts: Dict) -> Dict:
+        """Drops callables (hooks, match_filter, loggers); the worker rebuilds what it needs."""
+        return {k: v for k, v in ydl_opts.items() if not callable(v) and k not in ('progress_hooks', 'match_filter', 'logger')}
+
+    async def extract(self, ydl_opts: Dict, url: str, download: bool = True, min_duration: int = 0,
+                      on_abandon: Optional[Callable[[], None]] = None, info: Optional[Dict] = None) -> Tuple[Dict, Optional[str]]:
+        hooks = list(ydl_opts.get('progress_hooks') or [])
+        opts = self._picklable_opts(ydl_opts)
+        worker = await self._idle.get()
+        self.busy += 1
+        abort = threading.Event()
+        future = asyncio.ensure_future(asyncio.to_thread(self._run_job, worker, opts, url, download, min_duration, hooks, abort, info))
+        try:
+            return await asyncio.shield(future)
+        except asyncio.CancelledError:
+            # The job thread notices the flag, kills the worker and replaces it
+            abort.set()
+            _when_stopped(future, on_abandon)
+            raise
+
+    def _run_job(self, worker: _Worker, opts: Dict, url: str, download: bool, min_duration: int,
+                 hooks: List[Callable], abort: threading.Event, info: Optional[Dict] = None) -> Tuple[Dict, Optional[str]]:
+        job_id = next(self._job_ids)
+        healthy = True
+        try:
+            worker.conn.send((job_id, opts, url, download, min_duration, bool(hooks), info))
+            while True:
+                if abort.is_set():
+                    healthy = False
+                    raise RuntimeError("yt-dlp job cancelled")
+
+                if worker.conn.poll(POLL_INTERVAL):
+                    kind, _, *payload = worker.conn.recv()
+                    if kind == 'progress':
+                        for hook in hooks:
+                            try:
+                                hook(payload[0])
+                            except Exception:
+                                pass
+                        continue
+                    if kind == 'done':
+                        return payload[0], payload[1]
+                    self.errors += 1
+                    raise payload[0]
+
+                if not worker.process.is_alive():
+                    healthy = False
+                    self.crashes += 1
+                    raise RuntimeError(f"yt-dlp worker {worker.pid} died (exit code {worker.process.exitcode})")
+
+                rss = _read_rss_mb(worker.pid)
+                worker.peak_rss = max(worker.peak_rss, rss)
+                if self.rss_limit_mb and rss > self.rss_limit_mb:
+                    healthy = False
+                    self.rss_kills += 1
+                    logging.warning(f"[YTDLP-POOL] Worker {worker.pid} uses {rss} MB (> {self.rss_limit_mb} MB), killing it: {url}")
+                    raise MemoryError(f"yt-dlp worker exceeded the {self.rss_limit_mb} MB memory limit")
+        except (EOFError, OSError) as e:
+            healthy = False
+            self.crashes += 1
+            worker.process.join(1)
+            raise RuntimeError(f"yt-dlp worker {worker.pid} died (exit code {worker.process.exitcode}): {e!r}")
+        finally:
+            self._checkin(worker, healthy)
+
+    def _checkin(self, worker: _Worker, healthy: bool) -> None:
+        """Returns the worker to the idle queue, replacing it if it is broken or worn out."""
+        worker.jobs += 1
+        self.jobs += 1
+        replacement = worker
+        try:
+            if not healthy or worker.jobs >= self.max_jobs:
+                if healthy:
+                    self.recycled += 1
+                    logging.info(f"[YTDLP-POOL] Recycling worker {worker.pid} after {worker.jobs} jobs (peak {worker.peak_rss} MB)")
+                self._retire(worker, graceful=healthy)
+                replacement = self._spawn()
+        except Exception as e:
+            logging.error(f"[YTDLP-POOL] Failed to replace worker: {e}")
+        finally:
+            self._loop.call_soon_threadsafe(self._release_slot, replacement)
+
+    def _release_slot(self, worker: _Worker) -> None:
+        self.busy -= 1
+        if self._idle is not None:
+            self._idle.put_nowait(worker)
+        else:
+            worker.stop()
+
+    def _stop_all(self) -> None:
+        with self._lock:
+            workers = list(self._workers)
+            self._workers.clear()
+        for worker in workers:
+            worker.stop()
+
+    async def shutdown(self) -> None:
+        if not self.enabled:
+            return
+        self._idle = None
+        await asyncio.to_thread(self._stop_all)
+        logging.info("[YTDLP-POOL] Worker processes stopped")
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            workers = list(self._workers)
+        return {
+            'mode': self.mode if self.enabled else 'thread',
+            'workers': len(workers),
+            'busy': self.busy,
+            'jobs': self.jobs,
+            'errors': self.errors,
+            'recycled': self.recycled,
+            'rss_kills': self.rss_kills,
+            'crashes': self.crashes,
+            'rss_mb': [_read_rss_mb(w.pid) for w in workers],
+            'rss_limit_mb': self.rss_limit_mb,
+        }
+
+
+def _when_stopped(future: asyncio.Future, callback: Optional[Callable[[], None]]) -> None:
+    def done(f: asyncio.Future):
+        if not f.cancelled():
+            f.exception()  # retrieved so a failed abandoned job is not reported as unhandled
+        if callback:
+            try:
+                callback()
+            except Exception as e:
+                logging.warning(f"[YTDLP-POOL] Cleanup after abandoned job failed: {e}")
+    future.add_done_callback(done)
+
+
+async def extract_info(ydl_opts: Dict, url: str, download: bool = True, min_duration: int = 0,
+                       on_abandon: Optional[Callable[[], None]] = None, info: Optional[Dict] = None) -> Tuple[Dict, Optional[str]]:
+    """Runs yt-dlp in the configured backend (process pool or a thread).
+
+    If the caller is cancelled the download is aborted (worker killed, or the thread
+    stopped at its next progress tick) and on_abandon runs once yt-dlp has really stopped.
+    With info (the result of an earlier download=False run) the URL is not extracted again.
+    """
+    if ytdlp_pool.enabled:
+        return await ytdlp_pool.extract(ydl_opts, url, download=download, min_duration=min_duration,
+                                        on_abandon=on_abandon, info=info)
+    cancelled = threading.Event()
+    future = asyncio.ensure_future(asyncio.to_thread(run_extract, ydl_opts, url, download, cancelled, info))
+    try:
+        return await asyncio.shield(future)
+    except asyncio.CancelledError:
+        cancelled.set()
+        _when_stopped(future, on_abandon)
+        raise
+
+
+ytdlp_pool = YtdlpProcessPool(
+    mode=YTDLP_EXECUTOR,
+    workers=YTDLP_PROCESS_WORKERS,
+    max_jobs=YTDLP_WORKER_MAX_JOBS,
+    rss_limit_mb=YTDLP_WORKER_RSS_MB,
+)
@@ -1,77 +1,249 @@
 import os
+import re
+import hmac
 import uuid
 import time
+import base64
+import asyncio
+import hashlib
 import zipfile
-import shutil
 import logging
 from pathlib import Path
-from typing import Dict, Optional
-from config import DOWNLOADS_DIR, BASE_DIR
+from typing import AsyncIterator, Optional, Tuple
+from config import DOWNLOADS_DIR, BOT_TOKEN, ZIP_LINK_SECRET
 
 ZIP_DIR = DOWNLOADS_DIR / "zips"
 ZIP_DIR.mkdir(exist_ok=True)
 
-# Map of secure_id -> { 'path': Path, 'expiry': float, 'name': str }
-zip_cache: Dict[str, dict] = {}
-
-def create_playlist_zip(files: list[Path], playlist_name: str) -> str:
-    """Creates a zip file from a list of files and returns a secure_id."""
-    secure_id = str(uuid.uuid4()).replace("-", "")[:12]
-    zip_filename = f"{secure_id}.zip"
-    zip_path = ZIP_DIR / zip_filename
-    
-    with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED) as zipf:
-        for file in files:
-            if file.exists():
-                # Add file to zip using its original name
-                zipf.write(file, arcname=file.name)
-    
-    expiry = time.time() + (24 * 3600) # 24 hours
-    zip_cache[secure_id] = {
-        'path': zip_path,
-        'expiry': expiry,
-        'name': f"{playlist_name}.zip"
-    }
-    
-    logging.info(f"Created ZIP {secure_id} for playlist '{playlist_name}', expires in 24h")
-    return secure_id
-
-def get_zip_info(secure_id: str) -> Optional[dict]:
-    """Retrieves zip info if it exists and hasn't expired."""
-    info = zip_cache.get(secure_id)
-    if info:
-        if time.time() < info['expiry']:
-            return info
-        else:
-            # Expired, clean up
-            cleanup_zip(secure_id)
-    return None
-
-def cleanup_zip(secure_id: str):
-    """Deletes the zip file and removes from cache."""
-    info = zip_cache.pop(secure_id, None)
-    if info and info['path'].exists():
+ZIP_TTL = 24 * 3600
+STREAM_CHUNK = 256 * 1024
+STREAM_POLL = 0.5
+# A live build touches its .zip.part every HEARTBEAT seconds, even while a track is still
+# downloading; one untouched for STALLED_AFTER belongs to a build that died (e.g. a restart)
+HEARTBEAT = 30
+STALLED_AFTER = 180
+
+# Every replica derives the same key from the bot token unless ZIP_LINK_SECRET is set
+_SECRET = (ZIP_LINK_SECRET or hashlib.sha256(f"zip-links:{BOT_TOKEN or ''}".encode()).hexdigest()).encode()
+_ID_RE = re.compile(r"^[0-9a-f]{12}$")
+
+
+class ZipBuildFailed(Exception):
+    pass
+
+
+def _b64(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode()
+
+
+def _unb64(text: str) -> bytes:
+    return base64.urlsafe_b64decode(text + "=" * (-len(text) % 4))
+
+
+def _safe_name(name: str) -> str:
+    """Filename that is safe inside a Content-Disposition header."""
+    name = re.sub(r'[^\w .()\-]+', '_', name).strip(' ._') or "playlist"
+    return name if name.endswith(".zip") else f"{name}.zip"
+
+
+def make_token(zip_id: str, name: str, expires: int) -> str:
+    """Signed link token: archive id, download name and expiry, under an HMAC."""
+    payload = f"{zip_id}|{expires}|{_safe_name(name)}".encode()
+    signature = hmac.new(_SECRET, payload, hashlib.sha256).digest()[:16]
+    return f"{_b64(payload)}.{_b64(signature)}"
+
+
+def parse_token(token: str) -> Optional[Tuple[str, str, int]]:
+    """(zip_id, name, expires) of a valid, unexpired token; None otherwise."""
+    try:
+        payload_b64, signature_b64 = token.split(".", 1)
+        payload = _unb64(payload_b64)
+        expected = hmac.new(_SECRET, payload, hashlib.sha256).digest()[:16]
+        if not hmac.compare_digest(expected, _unb64(signature_b64)):
+            return None
+        zip_id, expires, name = payload.decode().split("|", 2)
+        expires = int(expires)
+    except (ValueError, UnicodeDecodeError):
+        return None
+    if not _ID_RE.match(zip_id) or time.time() >= expires:
+        return None
+    return zip_id, name, expires
+
+
+class _AppendOnly:
+    """File wrapper without seek(): zipfile then writes data descriptors instead of
+    patching local headers, so bytes already written never change."""
+
+    def __init__(self, fp):
+        self._fp = fp
+        self._offset = 0
+
+    def write(self, data) -> int:
+        n = self._fp.write(data)
+        self._offset += n
+        return n
+
+    def tell(self) -> int:
+        return self._offset
+
+    def flush(self) -> None:
+        self._fp.flush()
+
+
+class StreamingZip:
+    """Store-only (ZIP_STORED) archive that grows while the playlist downloads.
+
+    Tracks are appended in a worker thread as each one finishes; MP3/M4A do not
+    compress, so nothing is deflated. The archive is written append-only to
+    <id>.zip.part and renamed to <id>.zip once closed, which is all a reader
+    (stream_zip) needs to know - no state is shared with the process serving it.
+    While open, the .part file's mtime is refreshed every HEARTBEAT seconds so
+    readers can tell a slow build from a dead one.
+    """
+
+    def __init__(self, zip_id: str):
+        self.zip_id = zip_id
+        self.path = ZIP_DIR / f"{zip_id}.zip"
+        self.part_path = ZIP_DIR / f"{zip_id}.zip.part"
+        self.expires = int(time.time()) + ZIP_TTL
+        self._file = open(self.part_path, 'wb')
+        self._zip = zipfile.ZipFile(_AppendOnly(self._file), 'w', zipfile.ZIP_STORED, allowZip64=True)
+        self._lock = asyncio.Lock()
+        self.count = 0
+        self.finished = False
+        self.failed = False
+        self._heartbeat = asyncio.get_running_loop().create_task(self._beat())
+
+    async def _beat(self) -> None:
+        while True:
+            await asyncio.sleep(HEARTBEAT)
+            try:
+                os.utime(self.part_path)
+            except OSError:
+                return
+
+    def token(self, name: str) -> str:
+        return make_token(self.zip_id, name, self.expires)
+
+    def _write(self, file: Path) -> None:
+        self._zip.write(file, arcname=file.name)
+        self._file.flush()
+
+    async def add(self, file: Path) -> bool:
+        """Appends file under its own name; False if the archive is closed or the file is gone."""
+        async with self._lock:
+            if self.finished or self.failed or not file.exists():
+                return False
+            await asyncio.to_thread(self._write, file)
+            self.count += 1
+        return True
+
+    def _close(self) -> None:
+        self._zip.close()
+        self._file.close()
+        os.replace(self.part_path, self.path)
+
+    async def close(self) -> None:
+        """Writes the central directory and publishes <id>.zip."""
+        async with self._lock:
+            if self.finished or self.failed:
+                return
+            self._heartbeat.cancel()
+            await asyncio.to_thread(self._close)
+            self.finished = True
+
+    async def abort(self) -> None:
+        async with self._lock:
+            if self.finished or self.failed:
+                return
+            self.failed = True
+            self._heartbeat.cancel()
+            try:
+                await asyncio.to_thread(self._zip.close)
+                self._file.close()
+            except Exception as e:
+                logging.warning(f"Error closing aborted ZIP {self.path.name}: {e}")
+            finally:
+                self.part_path.unlink(missing_ok=True)
+
+
+def start_playlist_zip() -> StreamingZip:
+    """Creates an empty streaming archive; links to it work before the first track is added."""
+    archive = StreamingZip(uuid.uuid4().hex[:12])
+    logging.info(f"Started streaming ZIP {archive.zip_id}, expires in 24h")
+    return archive
+
+
+def get_zip_info(token: str) -> Optional[dict]:
+    """Validates a link token against the files on disk; no lookup table involved."""
+    parsed = parse_token(token)
+    if not parsed:
+        return None
+    zip_id, name, expires = parsed
+    path = ZIP_DIR / f"{zip_id}.zip"
+    part_path = ZIP_DIR / f"{zip_id}.zip.part"
+    building = not path.exists()
+    if building:
+        try:
+            if time.time() - part_path.stat().st_mtime > STALLED_AFTER:
+                return None  # The build died; its leftover is removed by run_zip_cleanup_task
+        except FileNotFoundError:
+            if not path.exists():
+                return None
+            building = False  # Renamed to .zip just now
+    return {'id': zip_id, 'name': name, 'expiry': expires, 'path': path, 'part_path': part_path, 'building': building}
+
+
+async def stream_zip(info: dict) -> AsyncIterator[bytes]:
+    """Archive bytes from the start, following a .zip.part until it is renamed to .zip."""
+    path, part_path = info['path'], info['part_path']
+    try:
+        f = open(part_path, 'rb')
+    except FileNotFoundError:
+        f = open(path, 'rb')
+    # The descriptor stays valid when the .part file is renamed on completion
+    with f:
+        while True:
+            data = await asyncio.to_thread(f.read, STREAM_CHUNK)
+            if data:
+                yield data
+                continue
+            if path.exists():
+                # Renamed: the writer closed the file first, so whatever is left is the central directory
+                rest = await asyncio.to_thread(f.read)
+                if rest:
+                    yield rest
+                return
+            try:
+                idle = time.time() - part_path.stat().st_mtime
+            except FileNotFoundError:
+                if path.exists():
+                    continue
+                raise ZipBuildFailed("Archive could not be completed")
+            if idle > STALLED_AFTER:
+                raise ZipBuildFailed(f"Archive build stalled {idle / 60:.0f} min ago")
+            await asyncio.sleep(STREAM_POLL)
+
+
+def cleanup_zip(zip_id: str):
+    """Deletes the archive (finished or not)."""
+    for path in (ZIP_DIR / f"{zip_id}.zip", ZIP_DIR / f"{zip_id}.zip.part"):
         try:
-            info['path'].unlink()
-            logging.info(f"Cleaned up expired ZIP {secure_id}")
+            if path.exists():
+                path.unlink()
+                logging.info(f"Cleaned up ZIP {path.name}")
         except Exception as e:
-            logging.error(f"Error cleaning up ZIP {secure_id}: {e}")
+            logging.error(f"Error cleaning up ZIP {path.name}: {e}")
 
 def run_zip_cleanup_task():
-    """Checks all cached zips and removes expired ones."""
+    """Removes archives older than their links (and .part files of builds that died)."""
     now = time.time()
-    to_delete = [sid for sid, info in zip_cache.items() if now > info['expiry']]
-    for sid in to_delete:
-        cleanup_zip(sid)
-        
-    # Also scan directory for stray files not in cache (e.g. from previous runs)
-    for zip_file in ZIP_DIR.glob("*.zip"):
-        sid = zip_file.stem
-        if sid not in zip_cache:
-            file_age = now - zip_file.stat().st_mtime
-            if file_age > (24 * 3600):
-                try:
-                    zip_file.unlink()
-                    logging.info(f"Cleaned up stray ZIP {zip_file.name}")
-                except Exception:
-                    pass
+    for zip_file in [*ZIP_DIR.glob("*.zip"), *ZIP_DIR.glob("*.zip.part")]:
+        try:
+            age = now - zip_file.stat().st_mtime
+            # Links are signed for ZIP_TTL from the build start, and the file is younger than that
+            if age > ZIP_TTL or (zip_file.suffix == ".part" and age > STALLED_AFTER):
+                zip_file.unlink()
+                logging.info(f"Cleaned up expired ZIP {zip_file.name}")
+        except Exception:
+            pass
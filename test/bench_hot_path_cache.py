@@ -0,0 +1,106 @@
+"""
+Benchmark: settings/profile reads per message, with and without the read-through cache
+=======================================================================================
+Usage:
+  python test/bench_hot_path_cache.py                          - 5000 messages from up to 500 users, temporary SQLite DB
+  python test/bench_hot_path_cache.py -n 20000 -u 2000         - more messages and users
+  DATABASE_URL=postgresql://... python test/bench_hot_path_cache.py   - against a real database (uses its tables)
+
+Replays what handle_url reads for every link (get_user_profile, then the
+premium_daily_limit and premium_limits_enabled settings) and counts a premium-site
+download every --premium-every messages, which invalidates that user's profile.
+Prints messages per second and DB round-trips avoided for each mode.
+"""
+
+import sys
+import io
+import os
+import argparse
+import random
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+if not os.getenv("DATABASE_URL"):
+    os.environ["DATABASE_URL"] = f"sqlite:///{tempfile.mkdtemp(prefix='bench_cache_')}/bench.db"
+
+from config import APP_SETTING_CACHE_TTL, USER_PROFILE_CACHE_TTL  # noqa: E402
+from database.models import UserProfile  # noqa: E402
+from database.storage import stats  # noqa: E402
+
+if hasattr(sys.stdout, "buffer"):
+    sys.stdout = io.TextIOWrapper(sys.stdout.buffer, encoding="utf-8", errors="replace")
+
+# ── Settings ──────────────────────────────────────────────────────────────────
+FIRST_USER_ID = 9_000_000_000  # Far from real Telegram ids, in case a real DB is used
+# ──────────────────────────────────────────────────────────────────────────────
+
+
+def handle_message(user_id: int, count_premium: bool) -> None:
+    """The settings/profile part of handle_url."""
+    profile = stats.get_user_profile(user_id)
+    premium_site_limit = int(stats.get_app_setting("premium_daily_limit", "10"))
+    if stats.get_app_setting("premium_limits_enabled", "True") == "True" and not profile["is_premium"]:
+        if count_premium and profile["daily_premium_site_downloads"] < premium_site_limit:
+            stats.increment_daily_premium(user_id)
+
+
+def reset_profiles() -> None:
+    with stats.Session() as session:
+        session.query(UserProfile).filter(UserProfile.user_id >= FIRST_USER_ID).update(
+            {UserProfile.daily_premium_site_downloads: 0})
+        session.commit()
+
+
+def run(label: str, messages: list, premium_every: int, setting_ttl: float, profile_ttl: float) -> float:
+    reset_profiles()
+    stats.setting_cache_ttl, stats.profile_cache_ttl = setting_ttl, profile_ttl
+    stats._settings.clear()
+    stats._profiles.clear()
+    before = stats.get_hot_cache_stats()
+
+    started = time.perf_counter()
+    for i, user_id in enumerate(messages):
+        handle_message(user_id, premium_every > 0 and i % premium_every == 0)
+    elapsed = time.perf_counter() - started
+
+    after = stats.get_hot_cache_stats()
+    hits = (after["setting_hits"] - before["setting_hits"]) + (after["profile_hits"] - before["profile_hits"])
+    reads = hits + (after["setting_misses"] - before["setting_misses"]) + (after["profile_misses"] - before["profile_misses"])
+    rate = len(messages) / elapsed
+    print(f"{label:<10} {rate:9.0f} msg/s | {elapsed / len(messages) * 1e6:7.0f} µs/msg | "
+          f"reads served from memory: {hits}/{reads} ({hits / reads * 100 if reads else 0:.1f}%)")
+    return rate
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Hot-path settings/profile cache benchmark")
+    parser.add_argument("-n", "--messages", type=int, default=5000, help="messages to replay")
+    parser.add_argument("-u", "--users", type=int, default=500, help="distinct users sending them")
+    parser.add_argument("--premium-every", type=int, default=10, help="count a premium-site download every N messages (0 = never)")
+    args = parser.parse_args()
+
+    if not stats.Session:
+        sys.exit("No database connection; set DATABASE_URL")
+
+    rng = random.Random(42)
+    # A few users send most of the links, as in real traffic
+    users = [FIRST_USER_ID + int(rng.paretovariate(1.2)) % args.users for _ in range(args.messages)]
+    for user_id in set(users):
+        stats.get_user_profile(user_id)  # Profiles exist in both modes
+
+    print(f"{args.messages} messages from {len(set(users))} users, database: {stats.db_engine.url.get_backend_name()}\n")
+    without = run("no cache", users, args.premium_every, 0, 0)
+    with_cache = run("cache", users, args.premium_every,
+                     APP_SETTING_CACHE_TTL or 60, USER_PROFILE_CACHE_TTL or 30)
+    print(f"\nSpeed-up: {with_cache / without:.1f}x")
+
+    with stats.Session() as session:
+        session.query(UserProfile).filter(UserProfile.user_id >= FIRST_USER_ID).delete()
+        session.commit()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,197 @@
+"""
+Benchmark: torrent time-to-first-peer, cold vs persisted swarm state
+=====================================================================
+Usage:
+  python test/bench_torrent_first_peer.py              - one cold run, then 3 after daemon restarts
+  python test/bench_torrent_first_peer.py --runs 5     - cold run, then 5 runs after restarts
+  python test/bench_torrent_first_peer.py --size 64    - 64 MiB payload instead of 8
+
+Everything runs on localhost and needs aria2c on PATH: a seed (a second aria2c), a
+tracker that hands out the seed, and a dead tracker that accepts connections and
+never answers. The torrent lists the dead tracker in its first tier, like many real
+torrents list trackers that no longer exist. Each run downloads the torrent through
+TorrentService with a fresh daemon and state loaded from disk, exactly like a bot
+restart; the first run starts without any saved state (the old behaviour). Failing
+trackers are re-probed on every run instead of after RETRY_AFTER, so the dead one is
+excluded once it has failed DEAD_AFTER probes.
+"""
+
+import sys
+import io
+import os
+import argparse
+import asyncio
+import hashlib
+import shutil
+import socket
+import struct
+import tempfile
+import time
+from pathlib import Path
+from typing import Tuple
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from aiohttp import web  # noqa: E402
+
+import services.torrent_service as torrent_module  # noqa: E402
+import services.tracker_health as health_module  # noqa: E402
+from services.aria2 import aria2  # noqa: E402
+from services.bencode import encode  # noqa: E402
+from services.http_client import http_client  # noqa: E402
+from services.tracker_health import TrackerHealth  # noqa: E402
+
+if hasattr(sys.stdout, "buffer"):
+    sys.stdout = io.TextIOWrapper(sys.stdout.buffer, encoding="utf-8", errors="replace")
+
+# ── Settings ──────────────────────────────────────────────────────────────────
+PIECE_LENGTH = 256 * 1024
+TORRENT_NAME = "bench_first_peer.mkv"
+# ──────────────────────────────────────────────────────────────────────────────
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def make_payload(path: Path, size_mb: int) -> None:
+    with open(path, "wb") as f:
+        for _ in range(size_mb):
+            f.write(os.urandom(1024 * 1024))
+
+
+def make_torrent(payload: Path, trackers: list) -> bytes:
+    pieces = b""
+    with open(payload, "rb") as f:
+        while chunk := f.read(PIECE_LENGTH):
+            pieces += hashlib.sha1(chunk).digest()
+    info = {"name": payload.name, "length": payload.stat().st_size, "piece length": PIECE_LENGTH, "pieces": pieces}
+    return encode({"announce": trackers[0], "announce-list": [[url] for url in trackers], "info": info})
+
+
+async def start_tracker(seed_port: int, stats: dict) -> web.AppRunner:
+    """HTTP tracker that answers every announce with the seed's address."""
+    async def announce(request: web.Request) -> web.Response:
+        stats["announces"] += 1
+        peers = socket.inet_aton("127.0.0.1") + struct.pack(">H", seed_port)
+        return web.Response(body=encode({"interval": 60, "peers": peers}))
+
+    app = web.Application()
+    app.router.add_get("/announce", announce)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", stats["port"]).start()
+    return runner
+
+
+async def start_dead_tracker(port: int) -> asyncio.AbstractServer:
+    """Accepts connections and never answers, like a tracker behind a dead host."""
+    async def hold(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        await reader.read()
+        writer.close()
+
+    return await asyncio.start_server(hold, "127.0.0.1", port)
+
+
+async def start_seed(torrent: Path, seed_dir: Path, port: int) -> asyncio.subprocess.Process:
+    return await asyncio.create_subprocess_exec(
+        "aria2c", "--check-integrity=true", "--seed-ratio=0.0", "--seed-time=600", f"--dir={seed_dir}",
+        f"--listen-port={port}", "--enable-dht=false", "--bt-enable-lpd=false", "--enable-peer-exchange=false",
+        "--bt-exclude-tracker=*", "--quiet=true", str(torrent),
+        stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.DEVNULL,
+    )
+
+
+async def watch_swarm(started: float, seen: dict) -> None:
+    """Records when aria2 first reports a peer connection and the first downloaded byte, every 0.1s."""
+    while "data" not in seen:
+        try:
+            for status in await aria2.call("tellActive", ["connections", "completedLength"]):
+                if int(status["connections"]):
+                    seen.setdefault("peer", time.monotonic() - started)
+                if int(status["completedLength"]):
+                    seen.setdefault("data", time.monotonic() - started)
+        except Exception:
+            pass
+        await asyncio.sleep(0.1)
+
+
+async def one_run(label: str, torrent: Path, state_dir: Path, downloads: Path) -> Tuple[float, float]:
+    # A restart: new daemon, tracker health read back from disk
+    torrent_module.tracker_health = TrackerHealth(state_dir / "trackers.json")
+    service = torrent_module.TorrentService(downloads)
+    await aria2.ensure_started()
+    started = time.monotonic()
+    seen = {}
+    watcher = asyncio.create_task(watch_swarm(started, seen))
+    files, output_dir = await service.download_torrent(torrent)
+    total = time.monotonic() - started
+    watcher.cancel()
+    first_peer, first_data = seen.get("peer", total), seen.get("data", total)
+    shutil.rmtree(output_dir, ignore_errors=True)
+
+    probing = list(torrent_module.tracker_health._probing.values())
+    if probing:
+        await asyncio.gather(*probing, return_exceptions=True)
+    health = torrent_module.tracker_health.get_stats()
+    await aria2.shutdown()
+    print(f"{label:<10} first peer {first_peer:6.2f}s | first data {first_data:6.2f}s | complete {total:6.2f}s | excluded trackers: "
+          f"{service.trackers_excluded} | known/dead after run: {health['known']}/{health['dead']} | "
+          f"dht.dat: {'saved' if aria2.dht_file.exists() else 'missing'}")
+    return first_peer, first_data
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(description="Torrent time-to-first-peer benchmark")
+    parser.add_argument("--runs", type=int, default=health_module.DEAD_AFTER, help="runs after the cold one (at least 1)")
+    parser.add_argument("--size", type=int, default=8, help="payload size in MiB")
+    args = parser.parse_args()
+    args.runs = max(1, args.runs)
+
+    if not shutil.which("aria2c"):
+        sys.exit("aria2c is not on PATH")
+
+    work = Path(tempfile.mkdtemp(prefix="bench_torrent_"))
+    seed_dir, state_dir, downloads = work / "seed", work / "state", work / "downloads"
+    for d in (seed_dir, downloads):
+        d.mkdir()
+    # Keep the bench away from the bot's own daemon, state and downloads
+    aria2.port = free_port()
+    aria2.state_dir = state_dir
+    health_module.RETRY_AFTER = 0
+
+    tracker = {"port": free_port(), "announces": 0}
+    dead_port, seed_port = free_port(), free_port()
+    payload = seed_dir / TORRENT_NAME
+    make_payload(payload, args.size)
+    torrent = work / "bench.torrent"
+    torrent.write_bytes(make_torrent(payload, [
+        f"http://127.0.0.1:{dead_port}/announce",
+        f"http://127.0.0.1:{tracker['port']}/announce",
+    ]))
+
+    dead = await start_dead_tracker(dead_port)
+    runner = await start_tracker(seed_port, tracker)
+    seed = await start_seed(torrent, seed_dir, seed_port)
+    await asyncio.sleep(1)  # Seed hash check
+    print(f"Payload {args.size} MiB, first tier: dead tracker, second tier: live tracker\n")
+    try:
+        before = await one_run("cold", torrent, state_dir, downloads)
+        after = [await one_run(f"restart {i + 1}", torrent, state_dir, downloads) for i in range(args.runs)]
+        peer_after = sum(a[0] for a in after) / len(after)
+        data_after = sum(a[1] for a in after) / len(after)
+        print(f"\nFirst peer: {before[0]:.2f}s cold -> {peer_after:.2f}s with saved state | "
+              f"First data: {before[1]:.2f}s -> {data_after:.2f}s ({tracker['announces']} announces served)")
+    finally:
+        seed.kill()
+        await seed.wait()
+        dead.close()
+        await runner.cleanup()
+        await http_client.close()
+        shutil.rmtree(work, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,155 @@
+"""
+Benchmark: yt-dlp thread executor vs process pool
+==================================================
+Usage:
+  python test/bench_ytdlp_executor.py                        - metadata-only run on the default URLs
+  python test/bench_ytdlp_executor.py --download             - also download the media
+  python test/bench_ytdlp_executor.py -c 8 -n 32 <url> ...   - 32 jobs, 8 at a time, custom URLs
+
+Runs the same workload through asyncio.to_thread and through the worker process
+pool and prints wall time, per-job latency, event-loop lag and memory for each mode.
+"""
+
+import sys
+import io
+import os
+import argparse
+import asyncio
+import resource
+import shutil
+import statistics
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from services.ytdlp_pool import YtdlpProcessPool, run_extract, _read_rss_mb  # noqa: E402
+
+if hasattr(sys.stdout, "buffer"):
+    sys.stdout = io.TextIOWrapper(sys.stdout.buffer, encoding="utf-8", errors="replace")
+
+# ── Settings ──────────────────────────────────────────────────────────────────
+OUTPUT_DIR   = Path(__file__).parent / "bench_downloads"
+DEFAULT_URLS = [
+    "https://www.youtube.com/watch?v=dQw4w9WgXcQ",
+    "https://www.youtube.com/watch?v=jNQXAC9IVRw",
+    "https://www.youtube.com/watch?v=9bZkp7q19f0",
+    "https://www.youtube.com/watch?v=kJQP7kiw5Fk",
+]
+# ──────────────────────────────────────────────────────────────────────────────
+
+
+def make_opts(download: bool) -> dict:
+    opts = {
+        'outtmpl': str(OUTPUT_DIR / "%(id)s_%(epoch)s.%(ext)s"),
+        'quiet': True,
+        'no_warnings': True,
+        'skip_download': not download,
+    }
+    if download:
+        opts['format'] = 'worst'
+    return opts
+
+
+async def measure_loop_lag(stop: asyncio.Event, samples: list):
+    """Records how late a 50ms sleep wakes up - a proxy for event loop stalls."""
+    while not stop.is_set():
+        started = time.perf_counter()
+        await asyncio.sleep(0.05)
+        samples.append(time.perf_counter() - started - 0.05)
+
+
+async def run_mode(mode: str, urls: list, jobs: int, concurrency: int, download: bool, workers: int) -> dict:
+    pool = None
+    if mode == "process":
+        pool = YtdlpProcessPool(mode="process", workers=workers, max_jobs=1000, rss_limit_mb=0)
+        pool.start()
+
+    sem = asyncio.Semaphore(concurrency)
+    latencies, errors = [], 0
+
+    async def one(i: int):
+        nonlocal errors
+        url = urls[i % len(urls)]
+        async with sem:
+            started = time.perf_counter()
+            try:
+                if pool:
+                    await pool.extract(make_opts(download), url, download=download)
+                else:
+                    await asyncio.to_thread(run_extract, make_opts(download), url, download)
+                latencies.append(time.perf_counter() - started)
+            except Exception as e:
+                errors += 1
+                print(f"   ❌ [{mode}] {url}: {e}")
+
+    lag, stop = [], asyncio.Event()
+    lag_task = asyncio.create_task(measure_loop_lag(stop, lag))
+    worker_rss = 0
+
+    async def sample_workers():
+        nonlocal worker_rss
+        while pool and not stop.is_set():
+            worker_rss = max(worker_rss, sum(pool.get_stats()['rss_mb']))
+            await asyncio.sleep(0.5)
+
+    rss_task = asyncio.create_task(sample_workers())
+    started = time.perf_counter()
+    await asyncio.gather(*(one(i) for i in range(jobs)))
+    wall = time.perf_counter() - started
+    stop.set()
+    await asyncio.gather(lag_task, rss_task)
+
+    if pool:
+        await pool.shutdown()
+
+    latencies.sort()
+    return {
+        "mode": mode,
+        "wall": wall,
+        "ok": len(latencies),
+        "errors": errors,
+        "p50": statistics.median(latencies) if latencies else 0.0,
+        "p95": latencies[int(len(latencies) * 0.95) - 1] if latencies else 0.0,
+        "lag_max": max(lag) * 1000 if lag else 0.0,
+        "lag_avg": statistics.mean(lag) * 1000 if lag else 0.0,
+        "parent_rss": _read_rss_mb(os.getpid()),
+        "parent_peak": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss // 1024,
+        "workers_rss": worker_rss,
+    }
+
+
+def print_result(r: dict):
+    print(f"\n── {r['mode'].upper()} ──")
+    print(f"   Jobs OK/failed : {r['ok']}/{r['errors']}")
+    print(f"   Wall time      : {r['wall']:.2f}s ({r['ok'] / max(r['wall'], 1e-9):.2f} jobs/s)")
+    print(f"   Latency p50/p95: {r['p50']:.2f}s / {r['p95']:.2f}s")
+    print(f"   Loop lag avg/max: {r['lag_avg']:.1f}ms / {r['lag_max']:.1f}ms")
+    print(f"   Parent RSS now/peak: {r['parent_rss']} MB / {r['parent_peak']} MB")
+    if r['mode'] == "process":
+        print(f"   Workers RSS peak (sum): {r['workers_rss']} MB")
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="yt-dlp thread vs process executor benchmark")
+    parser.add_argument("urls", nargs="*", default=DEFAULT_URLS)
+    parser.add_argument("-n", "--jobs", type=int, default=16)
+    parser.add_argument("-c", "--concurrency", type=int, default=4)
+    parser.add_argument("-w", "--workers", type=int, default=4)
+    parser.add_argument("--download", action="store_true", help="download media instead of metadata only")
+    parser.add_argument("--mode", choices=["thread", "process", "both"], default="both")
+    args = parser.parse_args()
+
+    OUTPUT_DIR.mkdir(exist_ok=True)
+    print(f"🔧 {args.jobs} jobs, concurrency {args.concurrency}, {args.workers} workers, download={args.download}")
+
+    modes = ["thread", "process"] if args.mode == "both" else [args.mode]
+    try:
+        for mode in modes:
+            print_result(await run_mode(mode, args.urls, args.jobs, args.concurrency, args.download, args.workers))
+    finally:
+        shutil.rmtree(OUTPUT_DIR, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,59 @@
+"""
+Test: canonical URLs used as the file_id cache and single-flight key
+=====================================================================
+Usage:
+  python test/test_canonicalize_url.py     - offline, no network needed
+
+Links that point to the same media must share a key (tracking parameters,
+www./m. hosts, trailing slashes), and links that only differ in their query
+(facebook ?v=, vk ?z=) must not, or a cache hit would resend another video.
+"""
+
+import sys
+import io
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from services.downloader import canonicalize_url, download_flight_key  # noqa: E402
+
+if hasattr(sys.stdout, "buffer"):
+    sys.stdout = io.TextIOWrapper(sys.stdout.buffer, encoding="utf-8", errors="replace")
+
+# ── Settings ──────────────────────────────────────────────────────────────────
+SAME = [
+    ("https://www.youtube.com/watch?v=jNQXAC9IVRw&si=abc", "https://youtu.be/jNQXAC9IVRw"),
+    ("https://www.instagram.com/reel/ABC123/?igsh=xyz&utm_source=ig_web", "https://instagram.com/reel/ABC123"),
+    ("https://m.facebook.com/watch/?v=123&mibextid=w8EBqM", "https://facebook.com/watch?v=123"),
+    ("https://vk.com/video?z=video-1_2&utm_medium=share", "https://vk.com/video?z=video-1_2"),
+    ("https://www.facebook.com/story.php?id=2&story_fbid=1&fbclid=x", "https://facebook.com/story.php?story_fbid=1&id=2"),
+    ("https://x.com/user/status/1?s=20&t=abc", "https://x.com/user/status/1"),
+]
+DIFFERENT = [
+    ("https://facebook.com/watch/?v=123", "https://facebook.com/watch/?v=456"),
+    ("https://facebook.com/story.php?story_fbid=1&id=2", "https://facebook.com/story.php?story_fbid=3&id=2"),
+    ("https://vk.com/video?z=video-1_2", "https://vk.com/video?z=video-1_3"),
+    ("https://www.pornhub.com/view_video.php?viewkey=a", "https://www.pornhub.com/view_video.php?viewkey=b"),
+]
+# ──────────────────────────────────────────────────────────────────────────────
+
+
+def main():
+    failures = 0
+    for a, b in SAME:
+        ok = canonicalize_url(a) == canonicalize_url(b)
+        failures += not ok
+        print(f"{'✅' if ok else '❌'} same      {canonicalize_url(a)}  <-  {a} | {b}")
+    for a, b in DIFFERENT:
+        # Equal single-flight keys would hand one video's file to the other request
+        ok = canonicalize_url(a) != canonicalize_url(b) and download_flight_key(a) != download_flight_key(b)
+        failures += not ok
+        print(f"{'✅' if ok else '❌'} different {canonicalize_url(a)} / {canonicalize_url(b)}")
+
+    if failures:
+        sys.exit(f"\n{failures} case(s) failed")
+    print("\nAll cases passed")
+
+
+if __name__ == "__main__":
+    main()
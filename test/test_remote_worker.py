@@ -0,0 +1,79 @@
+"""
+Test: remote download worker over gRPC
+=======================================
+Usage:
+  python test/test_remote_worker.py                  - download default URL through an in-process worker
+  python test/test_remote_worker.py <url>            - download by URL
+  python test/test_remote_worker.py <url> --music    - audio only
+
+Starts a worker on localhost, dispatches the job through RemoteWorkerPool exactly
+like the bot does, then stops the worker and checks that the pool reports it as
+unavailable (download() returns None -> local fallback).
+"""
+
+import sys
+import io
+import asyncio
+import socket
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from services.remote_worker import RemoteWorkerPool, start_worker_server  # noqa: E402
+
+if hasattr(sys.stdout, "buffer"):
+    sys.stdout = io.TextIOWrapper(sys.stdout.buffer, encoding="utf-8", errors="replace")
+
+# ── Settings ──────────────────────────────────────────────────────────────────
+DEFAULT_URL = "https://www.youtube.com/watch?v=jNQXAC9IVRw"  # "Me at the zoo", 19s
+TOKEN       = "local-test-token"
+# ──────────────────────────────────────────────────────────────────────────────
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+async def main():
+    args = [a for a in sys.argv[1:] if not a.startswith("--")]
+    url = args[0] if args else DEFAULT_URL
+    is_music = "--music" in sys.argv
+
+    address = f"127.0.0.1:{free_port()}"
+    server = await start_worker_server(address, capacity=1, token=TOKEN)
+    pool = RemoteWorkerPool([address], token=TOKEN, health_interval=1)
+    await pool.start()
+    print(f"🛰  Worker on {address}, healthy: {pool.nodes[0].healthy}")
+
+    async def on_progress(text: str = ""):
+        print(f"   … {text}")
+
+    started = time.perf_counter()
+    result = await pool.download(url, is_music=is_music, progress_callback=on_progress)
+    elapsed = time.perf_counter() - started
+    if result is None:
+        print("❌ Pool fell back to local download")
+    else:
+        file_path, thumbnail_path, metadata = result
+        files = file_path if isinstance(file_path, list) else [file_path]
+        for f in files:
+            print(f"✅ {f.name} ({f.stat().st_size / 1024 / 1024:.2f} MB)")
+        if thumbnail_path:
+            print(f"🖼  {thumbnail_path.name}")
+        print(f"   Title: {metadata.get('title')} | {elapsed:.1f}s")
+        for f in files + ([thumbnail_path] if thumbnail_path else []):
+            f.unlink(missing_ok=True)
+
+    await server.stop(None)
+    await pool.check_health()
+    fallback = await pool.download(url, is_music=is_music)
+    print(f"{'✅' if fallback is None else '❌'} Worker stopped -> healthy: {pool.nodes[0].healthy}, local fallback: {fallback is None}")
+    print(pool.get_stats())
+    await pool.shutdown()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())